@@ -19,7 +19,7 @@ def home(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def chat(request):
+async def chat(request):
     """Handle chat messages"""
     try:
         data = json.loads(request.body)
@@ -30,31 +30,31 @@ def chat(request):
         # Create or get session
         if not session_id:
             session_id = str(uuid.uuid4())
-            session = ChatSession.objects.create(
+            session = await ChatSession.objects.acreate(
                 session_id=session_id,
                 model_choice=model_choice
             )
         else:
-            session, created = ChatSession.objects.get_or_create(
+            session, created = await ChatSession.objects.aget_or_create(
                 session_id=session_id,
                 defaults={'model_choice': model_choice}
             )
         
         # Get AI response based on model choice
         if model_choice == 'openai':
-            response = get_openai_response(message)
+            response = await get_openai_response(message)
         else:
-            response = get_google_response(message)
+            response = await get_google_response(message)
         
         # Save messages
-        ChatMessage.objects.create(
+        await ChatMessage.objects.acreate(
             session=session,
             message=message,
             response=response,
             is_user_message=True
         )
         
-        ChatMessage.objects.create(
+        await ChatMessage.objects.acreate(
             session=session,
             message=message,
             response=response,
@@ -73,7 +73,7 @@ def chat(request):
             'success': False
         }, status=500)
 
-def get_openai_response(message):
+async def get_openai_response(message):
     """Get response from OpenAI"""
     try:
         # You'll need to set OPENAI_API_KEY in environment variables
@@ -81,22 +81,22 @@ def get_openai_response(message):
         print(f"DEBUG: API Key loaded: {api_key[:20] if api_key else 'NOT_FOUND'}...")
         if not api_key:
             return "Sorry, OpenAI API key is not configured. Please set the OPENAI_API_KEY environment variable."
-        client = openai.OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are Zoal AI, a helpful assistant with knowledge about Sudanese and African culture. Respond in a friendly and informative way."},
-                {"role": "user", "content": message}
-            ],
-            max_tokens=500
-        )
+        async with openai.AsyncOpenAI(api_key=api_key) as client:
+            response = await client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": "You are Zoal AI, a helpful assistant with knowledge about Sudanese and African culture. Respond in a friendly and informative way."},
+                    {"role": "user", "content": message}
+                ],
+                max_tokens=500
+            )
         return response.choices[0].message.content
     except Exception as e:
         error_msg = str(e)
         print(f"DEBUG: OpenAI error: {error_msg}")
         return f"Sorry, I'm having trouble connecting to OpenAI. Please check your API key. Error: {error_msg}"
 
-def get_google_response(message):
+async def get_google_response(message):
     """Get response from Google Gemini"""
     try:
         # You'll need to set GOOGLE_API_KEY in environment variables
@@ -106,7 +106,7 @@ def get_google_response(message):
             return "Sorry, Google API key is not configured. Please set the GOOGLE_API_KEY environment variable."
         genai.configure(api_key=api_key)
         model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(
+        response = await model.generate_content_async(
             f"You are Zoal AI, a helpful assistant with knowledge about Sudanese and African culture. Respond in a friendly and informative way. User message: {message}"
         )
         return response.text
@@ -115,18 +115,18 @@ def get_google_response(message):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def get_chat_history(request):
+async def get_chat_history(request):
     """Get chat history for a session"""
     try:
         data = json.loads(request.body)
         session_id = data.get('session_id', '')
         
         if session_id:
-            session = ChatSession.objects.get(session_id=session_id)
+            session = await ChatSession.objects.aget(session_id=session_id)
             messages = session.messages.all()
             
             history = []
-            for msg in messages:
+            async for msg in messages:
                 history.append({
                     'message': msg.message,
                     'response': msg.response,
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import MundiMapProject, MundiLayer, MundiMapRender
+from .models import MundiMapProject, MundiLayer, MundiMapRender, LayerStatistics, BackgroundJob, UploadSession
 
 
 @admin.register(MundiMapProject)
@@ -25,8 +25,21 @@ class MundiMapProjectAdmin(admin.ModelAdmin):
     )
 
 
+class LayerStatisticsInline(admin.StackedInline):
+    model = LayerStatistics
+    can_delete = False
+    readonly_fields = [
+        'feature_count', 'geometry_types', 'bbox', 'crs', 'attribute_schema',
+        'field_stats', 'file_size', 'error', 'computed_at'
+    ]
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(MundiLayer)
 class MundiLayerAdmin(admin.ModelAdmin):
+    inlines = [LayerStatisticsInline]
     list_display = ['name', 'layer_type', 'map_project', 'created_at']
     list_filter = ['layer_type', 'created_at']
     search_fields = ['name', 'map_project__name']
@@ -75,3 +88,20 @@ class MundiMapRenderAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'status', 'attempts', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['kind', 'status', 'created_at']
+    search_fields = ['id', 'kind', 'created_by__username']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'finished_at', 'locked_by', 'locked_at']
+    date_hierarchy = 'created_at'
+
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'map_project', 'status', 'received_size', 'total_size', 'created_by', 'updated_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['id', 'filename', 'name', 'created_by__username']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'received_size', 'validation_state', 'layer']
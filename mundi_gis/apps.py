@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MundiGisConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mundi_gis'
+
+    def ready(self):
+        # Register the background job handlers
+        from . import tasks  # noqa: F401
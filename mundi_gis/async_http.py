@@ -0,0 +1,60 @@
+"""
+Pooled async HTTP client for the async views.
+
+An ``httpx.AsyncClient`` owns connections bound to the event loop that
+opened them, so one client is kept per running loop. Under ASGI all requests
+run on a single loop and share one keep-alive pool, which lets a single
+worker keep many slow upstream calls (Ollama, Mundi AI) in flight at once.
+Under WSGI, async_to_sync runs every async view in a fresh loop through
+``asyncio.run``; a watcher task closes that loop's client when ``asyncio.run``
+cancels the leftover tasks, so no connections outlive the request.
+"""
+
+import asyncio
+import weakref
+import httpx
+from django.conf import settings
+
+
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+
+# Strong references to the watcher tasks; the loop only holds weak ones
+_closers: 'set[asyncio.Task]' = set()
+
+
+def _build_async_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=getattr(settings, 'ASYNC_HTTP_MAX_CONNECTIONS', 200),
+        max_keepalive_connections=getattr(settings, 'OLLAMA_POOL_SIZE', 10),
+    )
+    # Like the sync session, only connection failures are retried
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=getattr(settings, 'OLLAMA_MAX_RETRIES', 2))
+    return httpx.AsyncClient(transport=transport)
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Return the pooled client for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _clients[loop] = _build_async_client()
+        closer = loop.create_task(_close_with_loop(client))
+        _closers.add(closer)
+        closer.add_done_callback(_closers.discard)
+    return client
+
+
+async def _close_with_loop(client: httpx.AsyncClient):
+    """Wait until the loop cancels this task on shutdown, then close the client"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.create_future()
+    finally:
+        if _clients.get(loop) is client:
+            del _clients[loop]
+        await client.aclose()
+
+
+def async_timeout(read_timeout: float) -> httpx.Timeout:
+    """Connect timeout from settings plus the given read timeout"""
+    return httpx.Timeout(read_timeout, connect=getattr(settings, 'OLLAMA_CONNECT_TIMEOUT', 3.05))
@@ -0,0 +1,650 @@
+"""
+Compact columnar storage for uploaded vector layers.
+
+A GeoJSON layer is converted once into a single binary file beside the
+upload (``<file>.mcol``). Geometries are stored as flat float64 coordinate
+buffers with offset arrays for parts and rings, and attributes are stored as
+typed columns. The file is memory-mapped and read through NumPy views, so
+statistics, filtering and re-serialization work on whole arrays instead of
+building a Python object per vertex. The original upload is left untouched.
+
+File layout: an 8-byte magic, the header length (uint64), a JSON header
+describing every buffer, then the buffers, each aligned to 8 bytes.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from django.conf import settings
+from .layer_stats import geometry_bbox
+
+
+_MAGIC = b'MCOL0001'
+_PREAMBLE = struct.Struct('<8sQ')
+_ALIGNMENT = 8
+
+# Geometry type codes; OPAQUE geometries (collections, unknown types or
+# malformed coordinates) are kept as JSON text
+NULL, POINT, LINESTRING, POLYGON, MULTIPOINT, MULTILINESTRING, MULTIPOLYGON, OPAQUE = range(8)
+GEOMETRY_TYPE_NAMES = {
+    POINT: 'Point', LINESTRING: 'LineString', POLYGON: 'Polygon', MULTIPOINT: 'MultiPoint',
+    MULTILINESTRING: 'MultiLineString', MULTIPOLYGON: 'MultiPolygon',
+}
+_GEOMETRY_CODES = {name: code for code, name in GEOMETRY_TYPE_NAMES.items()}
+
+# Per-feature attribute states
+ABSENT, NULL_VALUE, VALUE, INT_VALUE = range(4)
+
+# Features re-serialized together share one vectorized coordinate formatting pass
+_BATCH_COORDS = 65536
+
+_FEATURE_KEYS = ('type', 'id', 'properties', 'geometry')
+
+# Marks a missing property, id or member, as opposed to a JSON null
+_ABSENT = object()
+
+
+class ColumnarFormatError(ValueError):
+    """Raised when a layer cannot be converted or a columnar file is unreadable"""
+
+
+# ---------------------------------------------------------------------------
+# Conversion
+# ---------------------------------------------------------------------------
+
+def _geometry_parts(geometry: Dict[str, Any]) -> Tuple[int, List[List[list]]]:
+    """Normalize a geometry to (type code, parts -> rings -> positions)"""
+    code = _GEOMETRY_CODES.get(geometry.get('type'))
+    coords = geometry.get('coordinates')
+    if code is None or not isinstance(coords, list):
+        raise ValueError('not a simple geometry')
+    if code == POINT:
+        parts = [[[coords]]]
+    elif code == LINESTRING:
+        parts = [[coords]]
+    elif code == POLYGON:
+        parts = [coords]
+    elif code == MULTIPOINT:
+        parts = [[[position]] for position in coords]
+    elif code == MULTILINESTRING:
+        parts = [[line] for line in coords]
+    else:
+        parts = coords
+    return code, parts
+
+
+def _is_position(value) -> bool:
+    return (isinstance(value, list) and 2 <= len(value) <= 3
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value))
+
+
+class _GeometryBuilder:
+    def __init__(self):
+        self.types = array('B')
+        self.feature_offsets = array('q', [0])
+        self.part_offsets = array('q', [0])
+        self.ring_offsets = array('q', [0])
+        self.x = array('d')
+        self.y = array('d')
+        self.z = array('d')
+        self.has_z = False
+        self.opaque: List[Any] = []
+
+    def add(self, geometry):
+        if geometry is None:
+            self._close(NULL, _ABSENT)
+            return
+        try:
+            code, parts = _geometry_parts(geometry)
+            if set(geometry) - {'type', 'coordinates'}:
+                raise ValueError('foreign members')
+            if not all(_is_position(p) for part in parts for ring in part for p in ring):
+                raise ValueError('malformed coordinates')
+        except (ValueError, TypeError, AttributeError):
+            self._close(OPAQUE, geometry)
+            return
+
+        for part in parts:
+            for ring in part:
+                for position in ring:
+                    self.x.append(position[0])
+                    self.y.append(position[1])
+                    if len(position) > 2:
+                        self.has_z = True
+                        self.z.append(position[2])
+                    else:
+                        self.z.append(float('nan'))
+                self.ring_offsets.append(len(self.x))
+            self.part_offsets.append(len(self.ring_offsets) - 1)
+        self._close(code, _ABSENT)
+
+    def _close(self, code, opaque):
+        self.types.append(code)
+        self.opaque.append(opaque)
+        self.feature_offsets.append(len(self.part_offsets) - 1)
+
+
+def _encode_column(values: List[Any]) -> Tuple[str, Dict[str, np.ndarray]]:
+    """Pick the narrowest column type for a property and encode it"""
+    state = np.full(len(values), ABSENT, dtype=np.uint8)
+    present = []
+    for i, value in enumerate(values):
+        if value is _ABSENT:
+            continue
+        if value is None:
+            state[i] = NULL_VALUE
+        else:
+            state[i] = VALUE
+            present.append((i, value))
+
+    kinds = set()
+    for _, value in present:
+        if isinstance(value, bool):
+            kinds.add('bool')
+        elif isinstance(value, int):
+            kinds.add('int' if -2 ** 63 <= value < 2 ** 63 else 'json')
+        elif isinstance(value, float):
+            kinds.add('float')
+        elif isinstance(value, str):
+            kinds.add('string')
+        else:
+            kinds.add('json')
+
+    rows = np.array([i for i, _ in present], dtype=np.int64)
+    if kinds == {'bool'} or kinds == {'int'}:
+        column_type = 'bool' if kinds == {'bool'} else 'int64'
+        data = np.zeros(len(values), dtype=np.uint8 if column_type == 'bool' else np.int64)
+        data[rows] = [value for _, value in present]
+        return column_type, {'state': state, 'values': data}
+
+    if kinds and kinds <= {'int', 'float'}:
+        data = np.zeros(len(values), dtype=np.float64)
+        data[rows] = [float(value) for _, value in present]
+        # Integers are flagged so they are written back without a decimal point
+        for i, value in present:
+            if isinstance(value, int):
+                state[i] = INT_VALUE
+        return 'number', {'state': state, 'values': data}
+
+    column_type = 'string' if kinds <= {'string'} else 'json'
+    encoded = [b''] * len(values)
+    for i, value in present:
+        encoded[i] = (value if column_type == 'string' else json.dumps(value)).encode('utf-8')
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return column_type, {
+        'state': state,
+        'offsets': offsets,
+        'data': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+    }
+
+
+
+def convert_geojson(geojson: Dict[str, Any], path: str, signature: Sequence[int]):
+    """Write a parsed GeoJSON object to path in the columnar format"""
+    if not isinstance(geojson, dict) or 'type' not in geojson:
+        raise ColumnarFormatError('Not a GeoJSON object')
+
+    geojson_type = geojson['type']
+    if geojson_type == 'FeatureCollection':
+        kind = 'FeatureCollection'
+        features = [f for f in geojson.get('features') or [] if isinstance(f, dict)]
+        members = {k: v for k, v in geojson.items() if k != 'features'}
+    elif geojson_type == 'Feature':
+        kind, features, members = 'Feature', [geojson], {}
+    else:
+        kind, features, members = 'Geometry', [{'type': 'Feature', 'geometry': geojson}], {}
+
+    geometry = _GeometryBuilder()
+    columns: Dict[str, List[Any]] = OrderedDict()
+    ids: List[Any] = []
+    extras: List[Any] = []
+    for n, feature in enumerate(features):
+        geometry.add(feature.get('geometry'))
+        ids.append(feature['id'] if 'id' in feature else _ABSENT)
+        extra = {k: v for k, v in feature.items() if k not in _FEATURE_KEYS}
+        extras.append(extra or _ABSENT)
+        properties = feature.get('properties')
+        for key, value in (properties if isinstance(properties, dict) else {}).items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [_ABSENT] * n
+            column.append(value)
+        for column in columns.values():
+            if len(column) < n + 1:
+                column.append(_ABSENT)
+
+    feature_count = len(features)
+    buffers: List[Tuple[str, np.ndarray]] = []
+
+    def add_buffer(name, data):
+        buffers.append((name, np.ascontiguousarray(data)))
+        return name
+
+    dims = 3 if geometry.has_z else 2
+    coords = np.empty((len(geometry.x), dims), dtype=np.float64)
+    coords[:, 0] = np.frombuffer(geometry.x, dtype=np.float64)
+    coords[:, 1] = np.frombuffer(geometry.y, dtype=np.float64)
+    if dims == 3:
+        coords[:, 2] = np.frombuffer(geometry.z, dtype=np.float64)
+
+    types = np.frombuffer(geometry.types, dtype=np.uint8)
+    feature_offsets = np.frombuffer(geometry.feature_offsets, dtype=np.int64)
+    part_offsets = np.frombuffer(geometry.part_offsets, dtype=np.int64)
+    ring_offsets = np.frombuffer(geometry.ring_offsets, dtype=np.int64)
+
+    # Per-feature bounding boxes. Coordinate ranges are contiguous in feature
+    # order, so reducing from each non-empty feature's start to the next one's
+    # covers exactly that feature.
+    bbox = np.full((feature_count, 4), np.nan)
+    coord_bounds = ring_offsets[part_offsets[feature_offsets]]
+    filled = np.flatnonzero(coord_bounds[1:] > coord_bounds[:-1])
+    if len(filled):
+        starts = coord_bounds[filled]
+        for axis in (0, 1):
+            bbox[filled, axis] = np.minimum.reduceat(coords[:, axis], starts)
+            bbox[filled, axis + 2] = np.maximum.reduceat(coords[:, axis], starts)
+    for i in np.flatnonzero(types == OPAQUE):
+        box = geometry_bbox(geometry.opaque[i]) if isinstance(geometry.opaque[i], dict) else None
+        if box is not None:
+            bbox[i] = box
+
+    header = {
+        'signature': list(signature),
+        'kind': kind,
+        'members': members,
+        'crs': geojson.get('crs'),
+        'feature_count': feature_count,
+        'dims': dims,
+        'geometry': {
+            'types': add_buffer('types', types),
+            'feature_offsets': add_buffer('feature_offsets', feature_offsets),
+            'part_offsets': add_buffer('part_offsets', part_offsets),
+            'ring_offsets': add_buffer('ring_offsets', ring_offsets),
+            'coords': add_buffer('coords', coords),
+            'bbox': add_buffer('bbox', bbox),
+        },
+        'columns': [],
+        'buffers': {},
+    }
+
+    for name, values in (('opaque', geometry.opaque), ('ids', ids), ('extra', extras)):
+        if any(value is not _ABSENT for value in values):
+            column_type, column_buffers = _encode_column(values)
+            header[name] = {
+                'type': column_type,
+                **{k: add_buffer(f'{name}.{k}', v) for k, v in column_buffers.items()},
+            }
+    for index, (key, values) in enumerate(columns.items()):
+        column_type, column_buffers = _encode_column(values)
+        header['columns'].append({
+            'name': key,
+            'type': column_type,
+            **{k: add_buffer(f'column{index}.{k}', v) for k, v in column_buffers.items()},
+        })
+
+    _write(path, header, buffers)
+
+
+def _write(path: str, header: Dict[str, Any], buffers: List[Tuple[str, np.ndarray]]):
+    # Buffer offsets are relative to the aligned end of the header, so the
+    # header can be serialized once the layout is known
+    offset = 0
+    for name, data in buffers:
+        header['buffers'][name] = {'dtype': data.dtype.str, 'shape': list(data.shape), 'offset': offset}
+        offset = _align(offset + data.nbytes)
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREAMBLE.pack(_MAGIC, len(header_bytes)))
+            f.write(header_bytes)
+            for name, data in buffers:
+                f.write(b'\0' * (data_start + header['buffers'][name]['offset'] - f.tell()))
+                f.write(data.tobytes())
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+class Column:
+    """A typed column: per-feature states plus fixed-width values or utf-8 spans"""
+
+    def __init__(self, layer: 'ColumnarLayer', spec: Dict[str, Any]):
+        self.name = spec.get('name')
+        self.type = spec['type']
+        self.state = layer._array(spec['state'])
+        if self.type in ('string', 'json'):
+            self.offsets = layer._array(spec['offsets'])
+            self.data = layer._array(spec['data'])
+        else:
+            self.values = layer._array(spec['values'])
+
+    def decode(self, rows: np.ndarray) -> List[Any]:
+        """Python values for the given rows; _ABSENT where a feature has no value"""
+        states = self.state[rows].tolist()
+        if self.type in ('string', 'json'):
+            starts = self.offsets[rows].tolist()
+            ends = self.offsets[rows + 1].tolist()
+            data = self.data
+            decoded = []
+            for state, start, end in zip(states, starts, ends):
+                if state == VALUE:
+                    text = data[start:end].tobytes().decode('utf-8')
+                    decoded.append(text if self.type == 'string' else json.loads(text))
+                else:
+                    decoded.append(_ABSENT if state == ABSENT else None)
+            return decoded
+
+        values = self.values[rows]
+        if self.type == 'bool':
+            values = values.astype(bool)
+        values = values.tolist()
+        return [
+            _ABSENT if state == ABSENT else None if state == NULL_VALUE
+            else int(value) if state == INT_VALUE else value
+            for state, value in zip(states, values)
+        ]
+
+
+    def encode(self, rows: np.ndarray) -> List[Optional[bytes]]:
+        """JSON text for the given rows, without decoding stored JSON; None where a feature has no value"""
+        states = self.state[rows].tolist()
+        if self.type in ('string', 'json'):
+            starts = self.offsets[rows].tolist()
+            ends = self.offsets[rows + 1].tolist()
+            data = memoryview(self.data)
+            encoded = []
+            for state, start, end in zip(states, starts, ends):
+                if state == VALUE:
+                    text = data[start:end].tobytes()
+                    if self.type == 'string':
+                        text = encode_basestring_ascii(text.decode('utf-8')).encode('ascii')
+                    encoded.append(text)
+                else:
+                    encoded.append(None if state == ABSENT else b'null')
+            return encoded
+
+        values = self.values[rows]
+        if self.type == 'bool':
+            text = np.where(values.astype(bool), b'true', b'false').tolist()
+        elif self.type == 'int64':
+            text = [str(v).encode('ascii') for v in values.tolist()]
+        else:
+            text = values.astype('S32')
+            text[np.isnan(values)] = b'NaN'
+            text[values == np.inf] = b'Infinity'
+            text[values == -np.inf] = b'-Infinity'
+            text = text.tolist()
+            for i, state in enumerate(states):
+                if state == INT_VALUE:
+                    text[i] = str(int(values[i])).encode('ascii')
+        return [
+            None if state == ABSENT else b'null' if state == NULL_VALUE else value
+            for state, value in zip(states, text)
+        ]
+
+
+class ColumnarLayer:
+    """Read-only, memory-mapped view of a columnar layer file"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise ColumnarFormatError(f'Empty columnar file: {path}') from e
+        try:
+            magic, header_length = _PREAMBLE.unpack_from(self._mmap, 0)
+            if magic != _MAGIC:
+                raise ColumnarFormatError(f'Not a columnar layer file: {path}')
+            self.header = json.loads(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_length])
+        except (struct.error, ValueError) as e:
+            raise ColumnarFormatError(f'Corrupt columnar layer file: {path}') from e
+        self._data_start = _align(_PREAMBLE.size + header_length)
+
+        header = self.header
+        self.signature = tuple(header['signature'])
+        self.kind = header['kind']
+        self.members = header['members']
+        self.crs = header['crs']
+        self.feature_count = header['feature_count']
+        geometry = header['geometry']
+        self.geometry_types = self._array(geometry['types'])
+        self.feature_offsets = self._array(geometry['feature_offsets'])
+        self.part_offsets = self._array(geometry['part_offsets'])
+        self.ring_offsets = self._array(geometry['ring_offsets'])
+        self.coords = self._array(geometry['coords'])
+        self.bbox = self._array(geometry['bbox'])
+        self.opaque = Column(self, header['opaque']) if 'opaque' in header else None
+        self.ids = Column(self, header['ids']) if 'ids' in header else None
+        self.extra = Column(self, header['extra']) if 'extra' in header else None
+        self.columns = [Column(self, spec) for spec in header['columns']]
+
+    def _array(self, name: str) -> np.ndarray:
+        """Zero-copy array over a buffer of the mapped file"""
+        spec = self.header['buffers'][name]
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape)) if shape else 1
+        return np.frombuffer(
+            self._mmap, dtype=np.dtype(spec['dtype']), count=count,
+            offset=self._data_start + spec['offset'],
+        ).reshape(shape)
+
+    def coordinate_ranges(self) -> np.ndarray:
+        """(start, end) of every feature's slice of the coordinate buffer"""
+        bounds = self.ring_offsets[self.part_offsets[self.feature_offsets]]
+        return np.stack((bounds[:-1], bounds[1:]), axis=1)
+
+    def opaque_geometries(self) -> Dict[int, Any]:
+        """Geometries stored as JSON (collections and anything irregular), by feature index"""
+        rows = np.flatnonzero(self.geometry_types == OPAQUE)
+        if self.opaque is None or not len(rows):
+            return {}
+        return dict(zip(rows.tolist(), self.opaque.decode(rows)))
+
+    def intersecting(self, bbox: Tuple[float, float, float, float]) -> np.ndarray:
+        """Indices of the features whose bounding box intersects bbox, in file order"""
+        minx, miny, maxx, maxy = bbox
+        boxes = self.bbox
+        # NaN boxes (features without coordinates) never compare true
+        return np.flatnonzero(
+            (boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx) & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny)
+        )
+
+    def geojson_chunks(self, indices: Optional[Sequence[int]] = None) -> Iterator[bytes]:
+        """
+        Serialize the layer (or the given features of it) back to GeoJSON bytes.
+
+        Coordinates are formatted a batch at a time with vectorized NumPy string
+        operations, so no Python object is created per vertex.
+        """
+        rows = np.arange(self.feature_count) if indices is None else np.asarray(indices, dtype=np.int64)
+        if self.kind != 'FeatureCollection':
+            yield b''.join(self._feature_bytes(rows[:1], geometry_only=self.kind == 'Geometry'))
+            return
+
+        head = json.dumps(self.members).encode('utf-8')
+        yield head[:-1] + (b', ' if len(head) > 2 else b'') + b'"features": ['
+        first = True
+        for batch in self._batches(rows):
+            chunk = b','.join(self._feature_bytes(batch))
+            if chunk:
+                yield chunk if first else b',' + chunk
+                first = False
+        yield b']}'
+
+    def _batches(self, rows: np.ndarray) -> Iterator[np.ndarray]:
+        # Cut the selection into runs of roughly _BATCH_COORDS coordinates
+        if not len(rows):
+            return
+        ranges = self.coordinate_ranges()[rows]
+        cumulative = np.cumsum(ranges[:, 1] - ranges[:, 0] + 1)
+        cuts = np.searchsorted(cumulative, np.arange(_BATCH_COORDS, cumulative[-1], _BATCH_COORDS))
+        for batch in np.split(rows, np.unique(cuts + 1)):
+            if len(batch):
+                yield batch
+
+    def _feature_bytes(self, rows: np.ndarray, geometry_only: bool = False) -> List[bytes]:
+        ranges = self.coordinate_ranges()[rows]
+        coord_index = np.concatenate(
+            [np.arange(start, end) for start, end in ranges.tolist()] or [np.empty(0, dtype=np.int64)]
+        )
+        blob, bounds = _format_positions(self.coords[coord_index])
+        bounds = bounds.tolist()
+
+        types = self.geometry_types[rows].tolist()
+        absent = [None] * len(rows)
+        opaque = self.opaque.encode(rows) if self.opaque is not None else absent
+        ids = self.ids.encode(rows) if self.ids is not None else absent
+        extras = self.extra.encode(rows) if self.extra is not None else absent
+        columns = [(json.dumps(column.name).encode('utf-8') + b': ', column.encode(rows))
+                   for column in self.columns]
+
+        feature_offsets, part_offsets, ring_offsets = self.feature_offsets, self.part_offsets, self.ring_offsets
+        output = []
+        base = 0
+        ranges = ranges.tolist()
+        for n, row in enumerate(rows.tolist()):
+            code = types[n]
+            coord_start, coord_end = ranges[n]
+            if code == NULL:
+                geometry = b'null'
+            elif code == OPAQUE:
+                geometry = opaque[n]
+            else:
+                parts = part_offsets[feature_offsets[row]:feature_offsets[row + 1] + 1].tolist()
+                rings = ring_offsets[parts[0]:parts[-1] + 1].tolist()
+
+                def ring(r):
+                    # Drop the comma that follows the ring's last position
+                    a = base + rings[r] - coord_start
+                    b = base + rings[r + 1] - coord_start
+                    return blob[bounds[a]:bounds[b] - 1]
+
+                if code == POINT:
+                    coordinates = ring(0)
+                elif code in (LINESTRING, MULTIPOINT):
+                    coordinates = b'[' + blob[bounds[base]:bounds[base + rings[-1] - rings[0]] - 1] + b']'
+                elif code in (POLYGON, MULTILINESTRING):
+                    coordinates = b'[' + b','.join(b'[' + ring(r) + b']' for r in range(len(rings) - 1)) + b']'
+                else:
+                    coordinates = b'[' + b','.join(
+                        b'[' + b','.join(b'[' + ring(r) + b']'
+                                         for r in range(parts[p] - parts[0], parts[p + 1] - parts[0])) + b']'
+                        for p in range(len(parts) - 1)
+                    ) + b']'
+                geometry = (b'{"type": "' + GEOMETRY_TYPE_NAMES[code].encode() +
+                            b'", "coordinates": ' + coordinates + b'}')
+            base += coord_end - coord_start
+
+            if geometry_only:
+                output.append(geometry)
+                continue
+            properties = b', '.join(key + values[n] for key, values in columns if values[n] is not None)
+            feature = b'{"type": "Feature", '
+            if ids[n] is not None:
+                feature += b'"id": ' + ids[n] + b', '
+            feature += b'"properties": {' + properties + b'}, "geometry": ' + geometry
+            if extras[n] is not None:
+                feature += b', ' + extras[n][1:-1]
+            output.append(feature + b'}')
+        return output
+
+
+def _format_positions(coords: np.ndarray) -> Tuple[bytes, np.ndarray]:
+    """
+    Format positions as one blob of '[x, y],' pieces.
+
+    Returns the blob and the piece boundaries (len(coords) + 1 byte offsets).
+    Numbers use the shortest repr, like json.dumps; a NaN z is omitted.
+    """
+    bounds = np.zeros(len(coords) + 1, dtype=np.int64)
+    if not len(coords):
+        return b'', bounds
+    pieces = np.char.add(np.char.add(b'[', coords[:, 0].astype('S32')),
+                         np.char.add(b', ', coords[:, 1].astype('S32')))
+    if coords.shape[1] > 2:
+        z = np.char.add(b', ', coords[:, 2].astype('S32'))
+        z[np.isnan(coords[:, 2])] = b''
+        pieces = np.char.add(pieces, z)
+    pieces = np.char.add(pieces, b'],')
+    np.cumsum(np.char.str_len(pieces), out=bounds[1:])
+    return pieces.tobytes().replace(b'\0', b''), bounds
+
+
+def columnar_path(file_path: str) -> str:
+    return f'{file_path}.mcol'
+
+
+_layer_cache: OrderedDict = OrderedDict()
+_layer_cache_lock = threading.Lock()
+_layer_build_locks: Dict[str, threading.Lock] = {}
+
+
+def _load(path: str, signature: Tuple[int, int]) -> Optional[ColumnarLayer]:
+    try:
+        layer = ColumnarLayer(path)
+    except (OSError, ColumnarFormatError, KeyError):
+        return None
+    return layer if layer.signature == tuple(signature) else None
+
+
+def get_columnar_layer(file_path: str) -> ColumnarLayer:
+    """
+    Return the columnar view of a GeoJSON layer, converting it on first use
+    and again whenever the file's modification time or size changes.
+
+    Raises ValueError if the file is not GeoJSON.
+    """
+    stat = os.stat(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    max_entries = getattr(settings, 'MUNDI_COLUMNAR_CACHE_SIZE', 32)
+
+    with _layer_cache_lock:
+        cached = _layer_cache.get(file_path)
+        if cached and cached.signature == signature:
+            _layer_cache.move_to_end(file_path)
+            return cached
+        build_lock = _layer_build_locks.setdefault(file_path, threading.Lock())
+
+    with build_lock:
+        with _layer_cache_lock:
+            cached = _layer_cache.get(file_path)
+            if cached and cached.signature == signature:
+                return cached
+
+        path = columnar_path(file_path)
+        layer = _load(path, signature)
+        if layer is None:
+            with open(file_path, 'r') as f:
+                geojson = json.load(f)
+            convert_geojson(geojson, path, signature)
+            layer = ColumnarLayer(path)
+
+        with _layer_cache_lock:
+            _layer_cache[file_path] = layer
+            _layer_cache.move_to_end(file_path)
+            while len(_layer_cache) > max_entries:
+                evicted, _ = _layer_cache.popitem(last=False)
+                _layer_build_locks.pop(evicted, None)
+    return layer
@@ -1,7 +1,14 @@
 from django import forms
+from .geojson_validator import validate_geojson
 from .models import MundiMapProject, MundiLayer
 
 
+# Limits shared by the form upload and the chunked upload API
+MAX_LAYER_FILE_SIZE = 100 * 1024 * 1024
+# A .zip holds a shapefile with its .dbf, .prj and .cpg sidecars
+ALLOWED_LAYER_EXTENSIONS = ['.geojson', '.shp', '.zip', '.tif', '.las', '.laz', '.csv']
+
+
 class MundiMapProjectForm(forms.ModelForm):
     """Form for creating and editing Mundi map projects"""
     
@@ -43,7 +50,7 @@ class MundiLayerForm(forms.ModelForm):
             }),
             'file_path': forms.FileInput(attrs={
                 'class': 'form-control',
-                'accept': '.geojson,.shp,.tif,.las,.laz,.csv'
+                'accept': '.geojson,.shp,.zip,.tif,.las,.laz,.csv'
             }),
             'style_config': forms.Textarea(attrs={
                 'class': 'form-control',
@@ -58,11 +65,11 @@ class MundiLayerForm(forms.ModelForm):
             raise forms.ValidationError("Please select a file to upload.")
         
         # Check file size (max 100MB)
-        if file_path.size > 100 * 1024 * 1024:
+        if file_path.size > MAX_LAYER_FILE_SIZE:
             raise forms.ValidationError("File size must be less than 100MB.")
         
         # Check file extension
-        allowed_extensions = ['.geojson', '.shp', '.tif', '.las', '.laz', '.csv']
+        allowed_extensions = ALLOWED_LAYER_EXTENSIONS
         file_extension = file_path.name.lower()
         
         if not any(file_extension.endswith(ext) for ext in allowed_extensions):
@@ -70,6 +77,15 @@ class MundiLayerForm(forms.ModelForm):
                 f"File type not supported. Allowed types: {', '.join(allowed_extensions)}"
             )
         
+        # Validate GeoJSON structure and coordinates without loading the whole file
+        if file_extension.endswith('.geojson'):
+            report = validate_geojson(file_path.chunks())
+            file_path.seek(0)
+            if not report.is_valid:
+                raise forms.ValidationError(
+                    ["File is not valid GeoJSON:"] + report.summary()
+                )
+        
         return file_path
     
     def clean_style_config(self):
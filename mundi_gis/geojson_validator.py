@@ -0,0 +1,619 @@
+"""
+Streaming GeoJSON validation.
+
+``iter_json_events`` is an incremental JSON parser: it reads a byte stream
+in chunks and yields parse events (object/array boundaries, keys and scalar
+values) tagged with their byte offsets. ``validate_geojson`` walks the top
+level of a file the same way, but parses each member of the ``features``
+array as a whole and checks it on its own, so memory stays bounded by the
+largest feature rather than the file. The first ``max_errors`` problems are
+reported with the byte offset and JSON path where they occur.
+"""
+
+import codecs
+import json
+import math
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+DEFAULT_MAX_ERRORS = 20
+
+_READ_SIZE = 64 * 1024
+
+_TOKEN = re.compile(r"""
+    [ \t\n\r]*
+    (?:
+        (?P<string>"(?:[^"\\\x00-\x1f]|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4}))*")
+      | (?P<number>-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)
+      | (?P<punct>[{}\[\]:,])
+      | (?P<literal>true|false|null)
+    )""", re.VERBOSE)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_NUMBER_RUN = re.compile(r'[-+.eE0-9]*')
+
+# Strings (skipped whole) and brackets; a lone quote is a string cut off by the end of the buffer
+_STRUCTURE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]|"', re.DOTALL)
+
+_LITERALS = {'true': True, 'false': False, 'null': None}
+
+
+def _reject_constant(name):
+    raise ValueError(f'{name} is not valid JSON')
+
+
+# NaN and Infinity are Python extensions, not JSON
+_DECODER = json.JSONDecoder(parse_constant=_reject_constant)
+
+GEOMETRY_TYPES = (
+    'Point', 'LineString', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon', 'GeometryCollection',
+)
+
+# CRS names whose coordinates are longitude/latitude degrees
+_GEOGRAPHIC_CRS = ('EPSG:4326', 'urn:ogc:def:crs:OGC:1.3:CRS84', 'urn:ogc:def:crs:EPSG::4326', 'CRS84')
+
+
+class JSONSyntaxError(ValueError):
+    """Raised for malformed JSON, with the byte offset of the problem"""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(f'{message} at byte {offset}')
+        self.message = message
+        self.offset = offset
+
+
+# ---------------------------------------------------------------------------
+# Tokenizer
+# ---------------------------------------------------------------------------
+
+class _JSONReader:
+    """
+    Tokens and values from a chunked UTF-8 byte stream. Only the unread text
+    is held; positions are mapped back to byte offsets when asked for.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self.base = 0  # Byte offset of text[0]
+        self.cursor = (0, 0)  # A (character, byte) position pair within text
+        self.started = False
+
+    def offset(self, index: int) -> int:
+        """Byte offset in the stream of text[index]"""
+        char, byte = self.cursor if index >= self.cursor[0] else (0, 0)
+        byte += len(self.text[char:index].encode('utf-8'))
+        self.cursor = (index, byte)
+        return self.base + byte
+
+    def _fill(self) -> int:
+        """Read the next chunk, dropping consumed text; returns how far positions shifted"""
+        chunk = next(self.chunks, None)
+        try:
+            decoded = self.decoder.decode(chunk or b'', final=chunk is None)
+        except UnicodeDecodeError as e:
+            raise JSONSyntaxError('Invalid UTF-8', self.bytes_read + e.start) from e
+        if chunk is None:
+            self.eof = True
+        else:
+            self.bytes_read += len(chunk)
+        shift = self.pos
+        if shift:
+            self.base = self.offset(shift)
+            self.cursor = (0, 0)
+        self.text = self.text[shift:] + decoded
+        self.pos = 0
+        # A byte order mark is allowed before the value (RFC 8259 section 8.1)
+        if not self.started and self.text:
+            self.started = True
+            if self.text[0] == '\ufeff':
+                self.pos = 1
+        return shift
+
+    def _skip_whitespace(self) -> int:
+        while True:
+            start = _WHITESPACE.match(self.text, self.pos).end()
+            if start < len(self.text) or self.eof:
+                self.pos = start
+                return start
+            self._fill()
+
+    def peek(self) -> str:
+        """The next non-whitespace character, or '' at the end of the stream"""
+        start = self._skip_whitespace()
+        return self.text[start:start + 1]
+
+    def token(self) -> Tuple[str, str, int]:
+        """(kind, token, offset) of the next token; kind is 'eof' at the end of the stream"""
+        while True:
+            match = _TOKEN.match(self.text, self.pos)
+            # A token running up to the end of the buffer may continue in the next chunk
+            if match is None or (not self.eof and _token_end(match) == len(self.text)):
+                start = _WHITESPACE.match(self.text, self.pos).end()
+                if self.eof or (match is None and not _is_token_prefix(self.text, start)):
+                    if start < len(self.text):
+                        raise JSONSyntaxError('Invalid JSON token', self.offset(start))
+                    return 'eof', '', self.offset(len(self.text))
+                self._fill()
+                continue
+            self.pos = match.end()
+            kind = match.lastgroup
+            return kind, match.group(kind), self.offset(match.start(kind))
+
+    def value(self) -> Tuple[Any, str, int]:
+        """(value, source text, offset) of the next complete JSON value"""
+        start = self._skip_whitespace()
+        if self.text[start:start + 1] not in ('{', '['):
+            kind, token, offset = self.token()
+            if kind == 'eof':
+                raise JSONSyntaxError('Unexpected end of file', offset)
+            if kind == 'punct':
+                raise JSONSyntaxError('Expected a value', offset)
+            return _scalar(kind, token, offset), token, offset
+
+        # Usually the whole value is already buffered and the C decoder parses it directly
+        try:
+            value, end = _DECODER.raw_decode(self.text, start)
+        except ValueError:
+            pass
+        else:
+            self.pos = end
+            return value, self.text[start:end], self.offset(start)
+
+        # Otherwise it is cut off by the end of the buffer, or malformed:
+        # find its end by matching brackets, reading on as needed
+        depth = 0
+        scan = start
+        while True:
+            for match in _STRUCTURE.finditer(self.text, scan):
+                token = match.group()
+                if token == '"':
+                    break
+                scan = match.end()
+                if token[0] == '"':
+                    continue
+                depth += 1 if token in ('{', '[') else -1
+                if depth == 0:
+                    source = self.text[start:scan]
+                    offset = self.offset(start)
+                    self.pos = scan
+                    return _loads(source, offset), source, offset
+            else:
+                scan = len(self.text)
+            if self.eof:
+                raise JSONSyntaxError('Unexpected end of file', self.offset(len(self.text)))
+            self.pos = start
+            shift = self._fill()
+            start -= shift
+            scan -= shift
+
+
+def _token_end(match) -> int:
+    # "1" in a buffer ending "1." matches, but the number goes on
+    if match.lastgroup == 'number':
+        return _NUMBER_RUN.match(match.string, match.end()).end()
+    return match.end()
+
+
+def _is_token_prefix(text: str, start: int) -> bool:
+    """Whether the unmatched text from start could still become a token with more input"""
+    rest = text[start:]
+    if not rest or rest[0] == '"':
+        return True
+    if rest[0] in '-0123456789':
+        return not rest.strip('-+.eE0123456789')
+    return any(literal.startswith(rest) for literal in _LITERALS)
+
+
+def _scalar(kind: str, token: str, offset: int):
+    if kind == 'string':
+        if '\\' not in token:
+            return token[1:-1]
+        try:
+            return json.loads(token)
+        except ValueError as e:
+            raise JSONSyntaxError(f'Invalid string ({e})', offset) from e
+    if kind == 'number':
+        return float(token) if token.strip('-0123456789') else int(token)
+    return _LITERALS[token]
+
+
+# ---------------------------------------------------------------------------
+# Event parser
+# ---------------------------------------------------------------------------
+
+# Parser states: what the next token may be
+_VALUE, _VALUE_OR_END, _KEY, _KEY_OR_END, _COLON, _COMMA_OR_END, _DONE = range(7)
+
+
+def iter_json_events(chunks: Iterable[bytes]) -> Iterator[Tuple[str, Any, int]]:
+    """
+    Parse JSON incrementally from an iterable of byte chunks.
+
+    Yields (event, value, offset) where event is one of start_map, end_map,
+    start_array, end_array, map_key or value. Raises JSONSyntaxError.
+    """
+    reader = _JSONReader(chunks)
+    stack: List[str] = []
+    state = _VALUE
+    while True:
+        kind, token, offset = reader.token()
+        if kind == 'eof':
+            if state != _DONE:
+                raise JSONSyntaxError('Unexpected end of file', offset)
+            return
+        if state == _DONE:
+            raise JSONSyntaxError('Extra data after the JSON value', offset)
+
+        if kind == 'punct':
+            if token == ',':
+                if state != _COMMA_OR_END:
+                    raise JSONSyntaxError("Unexpected ','", offset)
+                state = _KEY if stack[-1] == '{' else _VALUE
+                continue
+            if token == ':':
+                if state != _COLON:
+                    raise JSONSyntaxError("Unexpected ':'", offset)
+                state = _VALUE
+                continue
+            if token in ('}', ']'):
+                expected = (_COMMA_OR_END, _KEY_OR_END) if token == '}' else (_COMMA_OR_END, _VALUE_OR_END)
+                opener = '{' if token == '}' else '['
+                if not stack or stack[-1] != opener or state not in expected:
+                    raise JSONSyntaxError(f"Unexpected '{token}'", offset)
+                stack.pop()
+                state = _COMMA_OR_END if stack else _DONE
+                yield ('end_map' if token == '}' else 'end_array'), None, offset
+                continue
+
+        if state in (_KEY, _KEY_OR_END):
+            if kind != 'string':
+                raise JSONSyntaxError('Expected an object key', offset)
+            yield 'map_key', _scalar(kind, token, offset), offset
+            state = _COLON
+            continue
+        if state == _COLON:
+            raise JSONSyntaxError("Expected ':'", offset)
+        if state == _COMMA_OR_END:
+            raise JSONSyntaxError("Expected ',' or the end of the container", offset)
+
+        if kind == 'punct':
+            stack.append(token)
+            state = _KEY_OR_END if token == '{' else _VALUE_OR_END
+            yield ('start_map' if token == '{' else 'start_array'), None, offset
+            continue
+        state = _COMMA_OR_END if stack else _DONE
+        yield 'value', _scalar(kind, token, offset), offset
+
+
+def _loads(source: str, offset: int):
+    """Parse a value lifted from the stream at offset, locating any syntax error"""
+    try:
+        return _DECODER.decode(source)
+    except ValueError as e:
+        try:
+            for _ in iter_json_events([source.encode('utf-8')]):
+                pass
+        except JSONSyntaxError as located:
+            raise JSONSyntaxError(located.message, offset + located.offset) from e
+        raise JSONSyntaxError(str(e), offset) from e
+
+
+def _path_offsets(source: str, offset: int, root: str) -> Dict[str, int]:
+    """Stream offsets of every value in source, keyed by JSON path under root"""
+    offsets = {}
+    containers: List[list] = []  # [path, is_array, next index]
+    key = None
+    for event, value, position in iter_json_events([source.encode('utf-8')]):
+        if event == 'map_key':
+            key = value
+            continue
+        if event in ('end_map', 'end_array'):
+            containers.pop()
+            continue
+        if not containers:
+            path = root
+        elif containers[-1][1]:
+            path = f'{containers[-1][0]}[{containers[-1][2]}]'
+            containers[-1][2] += 1
+        else:
+            path = f'{containers[-1][0]}.{key}'
+        offsets[path] = offset + position
+        if event != 'value':
+            containers.append([path, event == 'start_array', 0])
+    return offsets
+
+
+# ---------------------------------------------------------------------------
+# GeoJSON checks
+# ---------------------------------------------------------------------------
+
+class ValidationReport:
+    """Outcome of validating a GeoJSON file"""
+
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.errors: List[Dict[str, Any]] = []
+        self.feature_count = 0
+        self.geojson_type: Optional[str] = None
+        self.truncated = False
+
+    @property
+    def is_valid(self) -> bool:
+        return not self.errors
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.errors) >= self.max_errors
+
+    def add(self, offset: int, path: str, message: str):
+        if self.is_full:
+            self.truncated = True
+            return
+        self.errors.append({'offset': offset, 'path': path, 'message': message})
+
+    def summary(self, limit: int = 5) -> List[str]:
+        """Human-readable lines for the first ``limit`` errors"""
+        lines = [f"byte {e['offset']}: {e['path']}: {e['message']}" for e in self.errors[:limit]]
+        if len(self.errors) > limit or self.truncated:
+            lines.append('... and more errors')
+        return lines
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'valid': self.is_valid,
+            'type': self.geojson_type,
+            'feature_count': self.feature_count,
+            'errors': self.errors,
+            'truncated': self.truncated,
+        }
+
+
+class _Checker:
+    """
+    Structural checks for one parsed value. Offsets are only worked out, by
+    re-reading the raw source with the event parser, once there is an error.
+    """
+
+    def __init__(self, report: ValidationReport, sources: List[Tuple[str, int, str]], geographic: bool):
+        self.report = report
+        self.sources = sources
+        self.geographic = geographic
+        self.offsets: Optional[Dict[str, int]] = None
+
+    def error(self, path: str, message: str):
+        if self.offsets is None:
+            self.offsets = {}
+            for source, offset, root in self.sources:
+                self.offsets[root] = offset
+                if source:
+                    self.offsets.update(_path_offsets(source, offset, root))
+        # A missing member is reported at the nearest value that exists
+        located = path
+        while located not in self.offsets and len(located) > 1:
+            located = located[:max(located.rfind('.'), located.rfind('['))]
+        self.report.add(self.offsets.get(located, self.sources[0][1]), path, message)
+
+    def feature(self, feature, path: str):
+        if not isinstance(feature, dict):
+            self.error(path, 'Feature must be an object')
+            return
+        if feature.get('type') != 'Feature':
+            self.error(f'{path}.type', f"Expected type 'Feature', got {feature.get('type')!r}")
+        properties = feature.get('properties')
+        if properties is not None and not isinstance(properties, dict):
+            self.error(f'{path}.properties', 'properties must be an object or null')
+        if 'geometry' not in feature:
+            self.error(path, 'Feature has no geometry member')
+        elif feature['geometry'] is not None:
+            self.geometry(feature['geometry'], f'{path}.geometry')
+
+    def geometry(self, geometry, path: str):
+        if not isinstance(geometry, dict):
+            self.error(path, 'Geometry must be an object or null')
+            return
+        geometry_type = geometry.get('type')
+        if geometry_type not in GEOMETRY_TYPES:
+            self.error(f'{path}.type', f'Unknown geometry type {geometry_type!r}')
+            return
+        if geometry_type == 'GeometryCollection':
+            geometries = geometry.get('geometries')
+            if not isinstance(geometries, list):
+                self.error(f'{path}.geometries', 'GeometryCollection needs a geometries array')
+                return
+            for i, child in enumerate(geometries):
+                self.geometry(child, f'{path}.geometries[{i}]')
+            return
+
+        path = f'{path}.coordinates'
+        coordinates = geometry.get('coordinates')
+        if not isinstance(coordinates, list):
+            self.error(path, f'{geometry_type} needs a coordinates array')
+        elif geometry_type == 'Point':
+            self.position(coordinates, path)
+        elif geometry_type in ('LineString', 'MultiPoint'):
+            self.positions(coordinates, path, 2 if geometry_type == 'LineString' else 0)
+        elif geometry_type == 'MultiLineString':
+            for i, line in self.arrays(coordinates, path):
+                self.positions(line, f'{path}[{i}]', 2)
+        elif geometry_type == 'Polygon':
+            self.polygon(coordinates, path)
+        else:
+            for i, polygon in self.arrays(coordinates, path):
+                self.polygon(polygon, f'{path}[{i}]')
+
+    def arrays(self, items: list, path: str) -> List[Tuple[int, list]]:
+        valid = []
+        for i, item in enumerate(items):
+            if isinstance(item, list):
+                valid.append((i, item))
+            else:
+                self.error(f'{path}[{i}]', 'Expected an array')
+        return valid
+
+    def polygon(self, rings: list, path: str):
+        for i, ring in self.arrays(rings, path):
+            if self.positions(ring, f'{path}[{i}]', 4) and ring[0] != ring[-1]:
+                self.error(f'{path}[{i}]', 'Linear ring is not closed')
+
+    def positions(self, positions: list, path: str, minimum: int) -> bool:
+        """Check an array of positions; True if every position is valid"""
+        if len(positions) < minimum:
+            self.error(path, f'Expected at least {minimum} positions, got {len(positions)}')
+            return False
+        if _all_positions_valid(positions, self.geographic):
+            return True
+        # Only an array with a problem is walked again to say which position and why
+        valid = True
+        for i, position in enumerate(positions):
+            valid = self.position(position, f'{path}[{i}]') and valid
+            if self.report.is_full:
+                break
+        return valid
+
+    def position(self, position, path: str) -> bool:
+        if (not isinstance(position, list) or len(position) < 2
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in position)):
+            self.error(path, 'A position must be an array of at least two numbers')
+            return False
+        if not all(math.isfinite(v) for v in position):
+            self.error(path, 'Coordinates must be finite')
+            return False
+        if self.geographic:
+            x, y = position[0], position[1]
+            if not -180 <= x <= 180:
+                self.error(path, f'Longitude {x} is outside [-180, 180]')
+                return False
+            if not -90 <= y <= 90:
+                self.error(path, f'Latitude {y} is outside [-90, 90]')
+                return False
+        return True
+
+
+def _all_positions_valid(positions: list, geographic: bool) -> bool:
+    """Fast pass over an array of positions, without saying what is wrong"""
+    for position in positions:
+        if type(position) is not list or len(position) < 2:
+            return False
+        for v in position:
+            if type(v) is not float and type(v) is not int:
+                return False
+        # Infinities make the difference NaN
+        total = sum(position)
+        if total - total != 0:
+            return False
+        if geographic and not (-180 <= position[0] <= 180 and -90 <= position[1] <= 90):
+            return False
+    return True
+
+
+def is_geographic(crs) -> bool:
+    """Whether a GeoJSON ``crs`` member (or its absence) means longitude/latitude coordinates"""
+    if not isinstance(crs, dict):
+        return True
+    name = (crs.get('properties') or {}).get('name')
+    return not name or name in _GEOGRAPHIC_CRS
+
+
+def _expect(reader: _JSONReader, allowed: Tuple[str, ...]) -> str:
+    kind, token, offset = reader.token()
+    if kind != 'punct' or token not in allowed:
+        expected = ' or '.join(f"'{t}'" for t in allowed)
+        raise JSONSyntaxError(f'Expected {expected}', offset)
+    return token
+
+
+def _validate_features(reader: _JSONReader, report: ValidationReport, geographic: bool):
+    """Check the members of a features array one at a time; the reader is just past its '['"""
+    if reader.peek() == ']':
+        reader.token()
+        return
+    while True:
+        feature, source, offset = reader.value()
+        path = f'$.features[{report.feature_count}]'
+        _Checker(report, [(source, offset, path)], geographic).feature(feature, path)
+        report.feature_count += 1
+        if report.is_full:
+            report.truncated = True
+            return
+        if _expect(reader, (',', ']')) == ']':
+            return
+
+
+def validate_geojson(chunks: Iterable[bytes], max_errors: int = DEFAULT_MAX_ERRORS) -> ValidationReport:
+    """
+    Validate GeoJSON read from an iterable of byte chunks, one feature at a time.
+
+    Longitude/latitude ranges are checked unless a ``crs`` member naming a
+    projected CRS appears before the features.
+    """
+    report = ValidationReport(max_errors)
+    reader = _JSONReader(chunks)
+    members: Dict[str, Any] = {}
+    sources: List[Tuple[str, int, str]] = []
+    has_features = False
+    try:
+        kind, token, top_offset = reader.token()
+        if kind == 'eof':
+            report.add(0, '$', 'File is empty')
+            return report
+        if token != '{':
+            report.add(top_offset, '$', 'GeoJSON must be a JSON object')
+            return report
+        sources.append(('', top_offset, '$'))
+
+        if reader.peek() == '}':
+            reader.token()
+        else:
+            while True:
+                kind, token, offset = reader.token()
+                if kind != 'string':
+                    raise JSONSyntaxError('Expected an object key', offset)
+                key = _scalar(kind, token, offset)
+                _expect(reader, (':',))
+                if key == 'features' and reader.peek() == '[':
+                    reader.token()
+                    has_features = True
+                    _validate_features(reader, report, is_geographic(members.get('crs')))
+                    if report.truncated:
+                        return report
+                else:
+                    members[key], source, offset = reader.value()
+                    sources.append((source, offset, f'$.{key}'))
+                if _expect(reader, (',', '}')) == '}':
+                    break
+
+        kind, token, offset = reader.token()
+        if kind != 'eof':
+            raise JSONSyntaxError('Extra data after the JSON value', offset)
+    except JSONSyntaxError as e:
+        report.add(e.offset, '$', e.message)
+        return report
+
+    geojson_type = members.get('type')
+    report.geojson_type = geojson_type if isinstance(geojson_type, str) else None
+    checker = _Checker(report, sources, is_geographic(members.get('crs')))
+    if geojson_type == 'FeatureCollection':
+        if not has_features:
+            checker.error('$.features', 'FeatureCollection needs a features array')
+    elif geojson_type == 'Feature':
+        report.feature_count = 1
+        checker.feature(members, '$')
+    elif geojson_type in GEOMETRY_TYPES:
+        report.feature_count = 1
+        checker.geometry(members, '$')
+    else:
+        checker.error('$.type', f'Not a GeoJSON type: {geojson_type!r}')
+    return report
+
+
+def validate_geojson_file(file_path: str, max_errors: int = DEFAULT_MAX_ERRORS) -> ValidationReport:
+    """Validate a GeoJSON file on disk in fixed-size reads"""
+    with open(file_path, 'rb') as f:
+        return validate_geojson(iter(lambda: f.read(_READ_SIZE), b''), max_errors)
@@ -0,0 +1,89 @@
+"""
+HTTP validators for the layer data endpoints.
+
+A layer's ETag is derived from its id, the SHA-256 of its file recorded at
+ingest, and the layer and statistics timestamps, so it changes exactly when
+the served data can. Clients that already hold the current representation
+get a 304 without the file being read.
+"""
+
+import hashlib
+from datetime import datetime
+from typing import Iterable, Optional
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponseNotModified
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def _statistics(layer):
+    # The file hash is recorded even when the statistics themselves failed
+    try:
+        return layer.statistics
+    except ObjectDoesNotExist:
+        return None
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:40]
+
+
+def layer_etag(layer, variant: str = '') -> Optional[str]:
+    """
+    Strong ETag for a layer's data, or None if the layer has not been
+    ingested yet and cannot be validated.
+
+    ``variant`` distinguishes representations of the same layer, such as a
+    zoom level or bbox.
+    """
+    statistics = _statistics(layer)
+    if statistics is None or not statistics.file_hash:
+        return None
+    return quote_etag(_digest(
+        layer.id, statistics.file_hash, layer.updated_at.isoformat(),
+        statistics.computed_at.isoformat(), variant,
+    ))
+
+
+def layer_last_modified(layer) -> datetime:
+    statistics = _statistics(layer)
+    return max(layer.updated_at, statistics.computed_at) if statistics else layer.updated_at
+
+
+def project_etag(layer_etags: Iterable[Optional[str]], variant: str = '') -> Optional[str]:
+    """Strong ETag combining the ETags of a project's layers, in response order"""
+    layer_etags = list(layer_etags)
+    if any(etag is None for etag in layer_etags):
+        return None
+    return quote_etag(_digest(variant, *layer_etags))
+
+
+def not_modified_response(request, etag: Optional[str], last_modified: Optional[datetime]):
+    """
+    The 304 (or 412 for failed preconditions) response when the client's copy
+    is current, or None when the full response must be sent.
+    """
+    if etag is None:
+        return None
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+    if isinstance(response, HttpResponseNotModified):
+        set_cache_headers(response, etag, last_modified)
+    return response
+
+
+def set_cache_headers(response, etag: Optional[str], last_modified: Optional[datetime]):
+    """Attach validators and Cache-Control to a layer data response"""
+    if etag is None:
+        return response
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    # Layer data belongs to one user, so only the browser may store it
+    patch_cache_control(
+        response, private=True, must_revalidate=True,
+        max_age=getattr(settings, 'MUNDI_LAYER_CACHE_MAX_AGE', 0),
+    )
+    return response
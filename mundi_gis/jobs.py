@@ -0,0 +1,141 @@
+"""
+Database-backed background job queue.
+
+Jobs are rows in ``BackgroundJob``. ``enqueue`` inserts one, and worker
+threads started by ``manage.py run_workers`` claim pending rows with a
+conditional UPDATE (so two workers never run the same job) and run the
+handler registered for the job's kind. Failed jobs are retried with
+exponential backoff. Only the database is needed, so this works locally on
+SQLite without any external broker.
+"""
+
+import logging
+import traceback
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import BackgroundJob
+
+
+logger = logging.getLogger(__name__)
+
+_handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+
+
+def job_handler(kind: str):
+    """Register a function as the handler for a job kind"""
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind: str, payload: Optional[Dict[str, Any]] = None, user=None,
+            max_attempts: int = 3, priority: int = 0) -> BackgroundJob:
+    """
+    Queue a job and return it. Jobs with a lower ``priority`` run first.
+
+    With ``MUNDI_JOBS_EAGER`` enabled the job runs immediately in the calling
+    thread, which is handy when no worker process is running.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"No handler registered for job kind '{kind}'")
+
+    job = BackgroundJob.objects.create(
+        kind=kind,
+        payload=payload or {},
+        created_by=user,
+        max_attempts=max_attempts,
+        priority=priority,
+    )
+
+    if getattr(settings, 'MUNDI_JOBS_EAGER', False):
+        claimed = BackgroundJob.objects.filter(id=job.id, status=BackgroundJob.STATUS_PENDING).update(
+            status=BackgroundJob.STATUS_RUNNING, locked_by='eager', locked_at=timezone.now(),
+            attempts=F('attempts') + 1
+        )
+        if claimed:
+            job.refresh_from_db()
+            run_job(job)
+    return job
+
+
+def claim_next_job(worker_id: str) -> Optional[BackgroundJob]:
+    """Atomically take the next runnable job, or return None if there is none"""
+    while True:
+        candidate = BackgroundJob.objects.filter(
+            status=BackgroundJob.STATUS_PENDING,
+            run_after__lte=timezone.now(),
+        ).order_by('priority', 'created_at').values_list('id', flat=True).first()
+
+        if candidate is None:
+            return None
+
+        # Only one worker's conditional update can move the row out of pending
+        claimed = BackgroundJob.objects.filter(id=candidate, status=BackgroundJob.STATUS_PENDING).update(
+            status=BackgroundJob.STATUS_RUNNING,
+            locked_by=worker_id,
+            locked_at=timezone.now(),
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return BackgroundJob.objects.get(id=candidate)
+
+
+def run_job(job: BackgroundJob) -> BackgroundJob:
+    """Run a claimed job and record its outcome, scheduling a retry on failure"""
+    handler = _handlers.get(job.kind)
+    try:
+        if handler is None:
+            raise ValueError(f"No handler registered for job kind '{job.kind}'")
+        result = handler(job.payload)
+    except Exception as e:
+        logger.exception("Job %s (%s) failed on attempt %s", job.id, job.kind, job.attempts)
+        job.error = f"{e}\n\n{traceback.format_exc()}"
+        job.locked_by = ''
+        job.locked_at = None
+        if handler is not None and job.attempts < job.max_attempts:
+            backoff = getattr(settings, 'MUNDI_JOBS_RETRY_BACKOFF', 5) * (2 ** (job.attempts - 1))
+            job.status = BackgroundJob.STATUS_PENDING
+            job.run_after = timezone.now() + timedelta(seconds=backoff)
+        else:
+            job.status = BackgroundJob.STATUS_FAILED
+            job.finished_at = timezone.now()
+        job.save()
+        return job
+
+    job.status = BackgroundJob.STATUS_SUCCEEDED
+    job.result = result
+    job.error = ''
+    job.locked_by = ''
+    job.locked_at = None
+    job.finished_at = timezone.now()
+    job.save()
+    return job
+
+
+def requeue_stale_jobs(stale_after: float) -> int:
+    """Return jobs left running by a crashed worker to the queue"""
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return BackgroundJob.objects.filter(
+        status=BackgroundJob.STATUS_RUNNING,
+        locked_at__lt=cutoff,
+    ).update(status=BackgroundJob.STATUS_PENDING, locked_by='', locked_at=None)
+
+
+def job_status(job: BackgroundJob) -> Dict[str, Any]:
+    """JSON-serializable view of a job for the status endpoint"""
+    return {
+        'id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'result': job.result,
+        'error': job.error.split('\n\n', 1)[0] if job.error else '',
+        'created_at': job.created_at.isoformat(),
+        'updated_at': job.updated_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
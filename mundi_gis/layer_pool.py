@@ -0,0 +1,128 @@
+"""
+Parallel preparation of multi-layer responses.
+
+Serializing a layer's columnar data to GeoJSON is mostly Python work that
+holds the GIL, so the layers of a project are prepared on a shared pool of
+worker processes rather than one after the other in the request thread.
+Each request may only have a bounded number of layers in flight, so one
+large project cannot take over the pool, and results come back in the order
+the layers were given whatever order they finish in.
+
+Workers only touch files (the columnar sidecars and pyramid levels, which
+are written atomically), never the database.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+from django.conf import settings
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Forking a threaded server process is unsafe, so workers start from a clean forkserver
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'MUNDI_LAYER_POOL_SIZE', None) or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+        return _executor
+
+
+def _reset_executor(broken: ProcessPoolExecutor):
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+class LayerResult:
+    """The outcome of preparing one item: its value or the exception raised, and how long it took"""
+
+    def __init__(self, value: Any = None, error: Optional[Exception] = None, duration: float = 0.0):
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+
+def _run(func: Callable, args: Tuple) -> LayerResult:
+    start = time.perf_counter()
+    try:
+        value = func(*args)
+    except Exception as e:
+        return LayerResult(error=e, duration=time.perf_counter() - start)
+    return LayerResult(value=value, duration=time.perf_counter() - start)
+
+
+def map_layers(func: Callable, arg_tuples: Sequence[Tuple],
+               max_concurrency: Optional[int] = None) -> List[LayerResult]:
+    """
+    Call ``func(*args)`` for each tuple of arguments on the worker pool, with
+    at most ``max_concurrency`` (default ``MUNDI_LAYER_REQUEST_CONCURRENCY``)
+    running at once for this call. ``func`` must be a module-level function.
+
+    Returns one LayerResult per tuple, in order; exceptions are captured in
+    the results rather than raised. If the pool has died the remaining work
+    runs in this process.
+    """
+    limit = max_concurrency or getattr(settings, 'MUNDI_LAYER_REQUEST_CONCURRENCY', 4)
+    if limit <= 1 or len(arg_tuples) <= 1:
+        return [_run(func, args) for args in arg_tuples]
+
+    executor = _get_executor()
+    slots = threading.BoundedSemaphore(limit)
+    futures = []
+    try:
+        for args in arg_tuples:
+            # Waits for one of this call's own layers to finish before submitting more
+            slots.acquire()
+            future = executor.submit(_run, func, args)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+    except BrokenProcessPool:
+        _reset_executor(executor)
+
+    results = []
+    for i, args in enumerate(arg_tuples):
+        if i >= len(futures):
+            results.append(_run(func, args))
+            continue
+        try:
+            results.append(futures[i].result())
+        except BrokenProcessPool:
+            _reset_executor(executor)
+            results.append(_run(func, args))
+        except Exception as e:
+            # The result could not be sent back, e.g. an unpicklable exception
+            results.append(LayerResult(error=e))
+    return results
+
+
+def serialize_layer_data(file_path: str, zoom: Optional[int] = None) -> bytes:
+    """A layer file's GeoJSON, at the pyramid level for zoom, serialized from its columnar copy"""
+    from .columnar import get_columnar_layer
+    from .simplify import pyramid_level_path
+
+    if zoom is not None:
+        file_path = pyramid_level_path(file_path, zoom)
+    return b''.join(get_columnar_layer(file_path).geojson_chunks())
+
+
+def server_timing(labels: Sequence[str], results: Sequence[LayerResult], total: float) -> str:
+    """A Server-Timing header value with one entry per result and the request total, in milliseconds"""
+    entries = [
+        f'layer-{i};desc="{label}";dur={result.duration * 1000:.1f}'
+        for i, (label, result) in enumerate(zip(labels, results))
+    ]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
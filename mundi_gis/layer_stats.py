@@ -0,0 +1,292 @@
+"""
+Layer statistics extracted at ingest time.
+
+The AI endpoints, dashboard and map client read these summaries from the
+database instead of reopening and parsing the uploaded file.
+"""
+
+import json
+import math
+import os
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+from django.core.exceptions import ObjectDoesNotExist
+from .storage import file_sha256, layer_file_path, layer_geojson_path
+
+
+# Distinct values are counted exactly up to this many per field
+MAX_DISTINCT_VALUES = 1000
+
+DEFAULT_CRS = 'EPSG:4326'
+
+
+def _value_type(value: Any) -> str:
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    return 'object'
+
+
+class _FieldAccumulator:
+    def __init__(self):
+        self.types = set()
+        self.count = 0
+        self.null_count = 0
+        self.min = None
+        self.max = None
+        self.distinct = set()
+        self.distinct_capped = False
+
+    def add(self, value: Any):
+        self.count += 1
+        value_type = _value_type(value)
+        if value_type == 'null':
+            self.null_count += 1
+            return
+        self.types.add(value_type)
+
+        if value_type in ('integer', 'number', 'string'):
+            if value_type == 'number' and math.isnan(value):
+                return
+            # Numbers and strings are only compared with their own kind
+            comparable = self.min is None or isinstance(value, str) == isinstance(self.min, str)
+            if comparable:
+                self.min = value if self.min is None or value < self.min else self.min
+                self.max = value if self.max is None or value > self.max else self.max
+
+        if not self.distinct_capped:
+            key = value if value_type in ('boolean', 'integer', 'number', 'string') else json.dumps(value, sort_keys=True)
+            self.distinct.add(key)
+            if len(self.distinct) > MAX_DISTINCT_VALUES:
+                self.distinct_capped = True
+                self.distinct = set()
+
+    def schema_type(self) -> str:
+        types = self.types
+        if types == {'integer', 'number'}:
+            return 'number'
+        if len(types) == 1:
+            return next(iter(types))
+        return 'mixed' if types else 'null'
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'min': self.min,
+            'max': self.max,
+            'distinct_count': None if self.distinct_capped else len(self.distinct),
+            'distinct_capped': self.distinct_capped,
+            'null_count': self.null_count,
+        }
+
+
+def _iter_positions(coordinates):
+    if not coordinates:
+        return
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for child in coordinates:
+        yield from _iter_positions(child)
+
+
+def _geometry_positions(geometry: Optional[Dict[str, Any]]):
+    if not geometry:
+        return
+    if geometry.get('type') == 'GeometryCollection':
+        for child in geometry.get('geometries') or []:
+            yield from _geometry_positions(child)
+    else:
+        yield from _iter_positions(geometry.get('coordinates'))
+
+
+def geometry_bbox(geometry: Optional[Dict[str, Any]]) -> Optional[Tuple[float, float, float, float]]:
+    """Bounding box (minx, miny, maxx, maxy) of a GeoJSON geometry, or None if it has no coordinates"""
+    minx = miny = math.inf
+    maxx = maxy = -math.inf
+    for position in _geometry_positions(geometry):
+        x, y = position[0], position[1]
+        minx, maxx = min(minx, x), max(maxx, x)
+        miny, maxy = min(miny, y), max(maxy, y)
+    return (minx, miny, maxx, maxy) if minx <= maxx else None
+
+
+def _crs_name(crs_member: Any) -> str:
+    if isinstance(crs_member, dict):
+        return (crs_member.get('properties') or {}).get('name') or DEFAULT_CRS
+    return DEFAULT_CRS
+
+
+def _numeric_column_summary(column) -> Tuple[str, Dict[str, Any]]:
+    from .columnar import INT_VALUE, NULL_VALUE, VALUE
+
+    state = column.state
+    present = state >= VALUE
+    values = column.values[present]
+    if column.type == 'bool':
+        schema_type = 'boolean'
+        minimum = maximum = None
+        distinct = np.unique(values)
+    else:
+        # Number columns always hold at least one float
+        schema_type = 'integer' if column.type == 'int64' else 'number'
+        comparable = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+        minimum = maximum = None
+        if comparable.any():
+            # Keep integers as integers, like the per-feature accumulator does
+            present_states = state[present][comparable]
+            candidates = values[comparable]
+            lo, hi = int(candidates.argmin()), int(candidates.argmax())
+            minimum, maximum = candidates[lo].item(), candidates[hi].item()
+            if column.type == 'number':
+                minimum = int(minimum) if present_states[lo] == INT_VALUE else minimum
+                maximum = int(maximum) if present_states[hi] == INT_VALUE else maximum
+        distinct = np.unique(values[comparable])
+
+    capped = len(distinct) > MAX_DISTINCT_VALUES
+    return schema_type, {
+        'min': minimum,
+        'max': maximum,
+        'distinct_count': None if capped else len(distinct),
+        'distinct_capped': capped,
+        'null_count': int((state == NULL_VALUE).sum()),
+    }
+
+
+def compute_columnar_statistics(layer) -> Dict[str, Any]:
+    """Feature count, geometry type histogram, bbox, CRS and attribute summaries of a ColumnarLayer, from its arrays"""
+    from .columnar import ABSENT, GEOMETRY_TYPE_NAMES, NULL
+
+    counts = np.bincount(layer.geometry_types, minlength=len(GEOMETRY_TYPE_NAMES) + 2).tolist()
+    geometry_types: Dict[str, int] = {}
+    if counts[NULL]:
+        geometry_types['Null'] = counts[NULL]
+    for code, name in GEOMETRY_TYPE_NAMES.items():
+        if counts[code]:
+            geometry_types[name] = counts[code]
+    for geometry in layer.opaque_geometries().values():
+        if isinstance(geometry, dict) and geometry:
+            geometry_type = geometry.get('type', 'Unknown')
+        else:
+            geometry_type = 'Null' if not geometry else 'Unknown'
+        geometry_types[geometry_type] = geometry_types.get(geometry_type, 0) + 1
+
+    bbox = None
+    boxes = layer.bbox
+    if len(boxes) and not np.isnan(boxes[:, 0]).all():
+        bbox = [float(np.nanmin(boxes[:, 0])), float(np.nanmin(boxes[:, 1])),
+                float(np.nanmax(boxes[:, 2])), float(np.nanmax(boxes[:, 3]))]
+
+    attribute_schema = {}
+    field_stats = {}
+    for column in layer.columns:
+        if column.type in ('string', 'json'):
+            accumulator = _FieldAccumulator()
+            for value in column.decode(np.flatnonzero(column.state != ABSENT)):
+                accumulator.add(value)
+            attribute_schema[column.name] = accumulator.schema_type()
+            field_stats[column.name] = accumulator.summary()
+        else:
+            attribute_schema[column.name], field_stats[column.name] = _numeric_column_summary(column)
+
+    return {
+        'feature_count': layer.feature_count,
+        'geometry_types': geometry_types,
+        'bbox': bbox,
+        'crs': _crs_name(layer.crs),
+        'attribute_schema': attribute_schema,
+        'field_stats': field_stats,
+    }
+
+
+def update_layer_statistics(layer):
+    """
+    Convert a layer to the columnar format, then compute and store its
+    statistics; failures are recorded on the row
+    """
+    from .columnar import get_columnar_layer
+    from .models import LayerStatistics
+
+    values = {
+        'feature_count': 0,
+        'geometry_types': {},
+        'bbox': None,
+        'crs': '',
+        'attribute_schema': {},
+        'field_stats': {},
+        'file_size': 0,
+        'file_hash': '',
+        'error': '',
+    }
+
+    file_path = layer_file_path(layer)
+    data_path = layer_geojson_path(layer)
+    if not file_path or not os.path.exists(file_path):
+        values['error'] = 'File not found'
+    elif not os.path.exists(data_path):
+        values['file_size'] = os.path.getsize(file_path)
+        values['error'] = 'The file has not been converted to GeoJSON'
+    else:
+        values['file_size'] = os.path.getsize(file_path)
+        try:
+            values['file_hash'] = file_sha256(file_path)
+            values.update(compute_columnar_statistics(get_columnar_layer(data_path)))
+        except (ValueError, UnicodeDecodeError) as e:
+            values['error'] = f'Statistics are only available for GeoJSON layers: {str(e)}'
+        except OSError as e:
+            values['error'] = str(e)
+
+    statistics, _ = LayerStatistics.objects.update_or_create(layer=layer, defaults=values)
+    return statistics
+
+
+def get_layer_statistics(layer):
+    """The layer's precomputed statistics, or None if they are missing or failed"""
+    try:
+        statistics = layer.statistics
+    except ObjectDoesNotExist:
+        return None
+    return None if statistics.error else statistics
+
+
+def layer_analysis_info(layer):
+    """Layer details sent to the LLM for analysis"""
+    layer_info = {
+        'name': layer.name,
+        'layer_type': layer.get_layer_type_display(),
+        'feature_count': 'Unknown',
+        'geometry_type': 'Unknown',
+        'description': f'Layer uploaded on {layer.created_at.strftime("%Y-%m-%d")}',
+        'created_at': layer.created_at.strftime("%Y-%m-%d")
+    }
+
+    statistics = get_layer_statistics(layer)
+    if statistics:
+        layer_info.update({
+            'feature_count': statistics.feature_count,
+            'geometry_type': statistics.geometry_type,
+            'bbox': statistics.bbox,
+            'crs': statistics.crs,
+            'attributes': statistics.attribute_schema,
+        })
+    return layer_info
+
+
+def project_analysis_info(project, layers=None):
+    """Project details sent to the LLM for analysis, with every layer's details"""
+    if layers is None:
+        layers = list(project.layers.select_related('statistics').order_by('created_at'))
+    return {
+        'name': project.name,
+        'description': project.description,
+        'layer_count': len(layers),
+        'layers': [layer_analysis_info(layer) for layer in layers],
+    }
@@ -0,0 +1,236 @@
+"""
+Admission control for requests to the local LLM.
+
+Ollama serves a few requests in parallel efficiently (OLLAMA_NUM_PARALLEL)
+and queues or thrashes beyond that, so every worker process keeps one
+controller per server and lets at most OLLAMA_MAX_CONCURRENT_REQUESTS
+requests through to each server at once. Further requests wait in that
+server's bounded priority queue, where interactive requests go
+ahead of background jobs. A request that finds the queue full, or is not let
+through within OLLAMA_QUEUE_TIMEOUT seconds, fails with ``LLMBusyError``,
+which the views turn into a 429 with a Retry-After estimate.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from django.conf import settings
+
+
+# Priority classes; lower values are let through first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Weight of the newest sample in the average time a slot is held
+EWMA_ALPHA = 0.2
+
+_PENDING, _GRANTED, _EVICTED, _WITHDRAWN = range(4)
+
+
+class LLMBusyError(Exception):
+    """Raised when the LLM is saturated; ``retry_after`` is a suggested wait in seconds"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """A queued request, woken through a thread event or an event loop future"""
+
+    def __init__(self, priority: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.state = _PENDING
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._resolve)
+        except RuntimeError:
+            # The loop is closed; its waiter was cancelled along with it
+            pass
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Slot:
+    """Permission to send one request; ``release`` it when the response is finished"""
+
+    def __init__(self, controller: 'AdmissionController'):
+        self.controller = controller
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(time.monotonic() - self.admitted_at)
+
+
+class AdmissionController:
+    """A counting semaphore with a bounded, prioritized and time-limited queue"""
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = max(limit, 1)
+        self.queue_size = max(queue_size, 0)
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._hold: Optional[float] = None
+        self._queue: List = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, priority: int = INTERACTIVE) -> Slot:
+        """Wait for a slot; raises LLMBusyError"""
+        waiter = _Waiter(priority)
+        if self._enter(waiter):
+            return Slot(self)
+        waiter.event.wait(self.timeout)
+        self._settle(waiter)
+        return Slot(self)
+
+    async def aacquire(self, priority: int = INTERACTIVE) -> Slot:
+        """Async version of acquire(); waits on the event loop, not in a thread"""
+        waiter = _Waiter(priority, asyncio.get_running_loop())
+        if self._enter(waiter):
+            return Slot(self)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The client went away: leave the queue, or pass on a slot granted meanwhile
+            if self._withdraw(waiter) == _GRANTED:
+                self._release(None)
+            raise
+        self._settle(waiter)
+        return Slot(self)
+
+    def has_free_slot(self) -> bool:
+        """Whether a request would be let through right now without queueing"""
+        with self._lock:
+            return self.active < self.limit and not self._queue
+
+    def check(self, priority: int = INTERACTIVE):
+        """Raise LLMBusyError if a request of this priority would be turned away right now"""
+        with self._lock:
+            if self.active >= self.limit and not self._can_queue(priority):
+                self.rejected += 1
+                raise LLMBusyError('The local LLM is busy; try again shortly', self._retry_after())
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return self._retry_after()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'queued': len(self._queue),
+                'queue_size': self.queue_size,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'average_hold_ms': None if self._hold is None else round(self._hold * 1000, 1),
+            }
+
+    def _enter(self, waiter: _Waiter) -> bool:
+        """Take a free slot (True) or queue the waiter (False); raises LLMBusyError if the queue is full"""
+        with self._lock:
+            if self.active < self.limit and not self._queue:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if not self._can_queue(waiter.priority):
+                self.rejected += 1
+                raise LLMBusyError('The local LLM is busy; try again shortly', self._retry_after())
+            if len(self._queue) >= self.queue_size:
+                # The newest of the lowest-priority waiters gives up its place
+                evicted = max(self._queue)
+                self._queue.remove(evicted)
+                heapq.heapify(self._queue)
+                evicted[2].state = _EVICTED
+                evicted[2].wake()
+            heapq.heappush(self._queue, (waiter.priority, next(self._sequence), waiter))
+            return False
+
+    def _can_queue(self, priority: int) -> bool:
+        return len(self._queue) < self.queue_size or any(entry[0] > priority for entry in self._queue)
+
+    def _settle(self, waiter: _Waiter):
+        """Outcome of a wait that ended: nothing if a slot was granted, else LLMBusyError"""
+        state = self._withdraw(waiter)
+        if state == _GRANTED:
+            return
+        with self._lock:
+            retry_after = self._retry_after()
+            if state == _WITHDRAWN:
+                self.timed_out += 1
+            else:
+                self.rejected += 1
+        if state == _WITHDRAWN:
+            raise LLMBusyError(f'The local LLM did not free up within {self.timeout:g} seconds', retry_after)
+        raise LLMBusyError('The local LLM is busy with more urgent requests; try again shortly', retry_after)
+
+    def _withdraw(self, waiter: _Waiter) -> int:
+        """Remove a waiter still in the queue; returns its final state"""
+        with self._lock:
+            if waiter.state == _PENDING:
+                self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+                heapq.heapify(self._queue)
+                waiter.state = _WITHDRAWN
+            return waiter.state
+
+    def _release(self, held: Optional[float]):
+        with self._lock:
+            if held is not None:
+                self._hold = held if self._hold is None else EWMA_ALPHA * held + (1 - EWMA_ALPHA) * self._hold
+            if self._queue:
+                # Hand the slot straight to the first waiter
+                waiter = heapq.heappop(self._queue)[2]
+                waiter.state = _GRANTED
+                self.admitted += 1
+                waiter.wake()
+            else:
+                self.active -= 1
+
+    def _retry_after(self) -> int:
+        """Seconds until the queue ahead has likely drained"""
+        hold = self._hold if self._hold is not None else 1.0
+        return max(1, math.ceil(hold * (len(self._queue) + 1) / self.limit))
+
+
+_controllers: Dict[tuple, AdmissionController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_admission_controller(url: str) -> AdmissionController:
+    """Return the process-wide controller of a backend for the current settings, creating it on first use"""
+    key = (
+        url,
+        getattr(settings, 'OLLAMA_MAX_CONCURRENT_REQUESTS', 4),
+        getattr(settings, 'OLLAMA_QUEUE_SIZE', 32),
+        getattr(settings, 'OLLAMA_QUEUE_TIMEOUT', 10),
+    )
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        if controller is None:
+            controller = _controllers[key] = AdmissionController(*key[1:])
+        return controller
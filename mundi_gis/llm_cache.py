@@ -0,0 +1,256 @@
+"""
+Content-addressed cache for LLM responses.
+
+Responses are keyed by a hash of everything that determines the output: the
+model, the prompts and the sampling options. Storage is pluggable: an
+in-process LRU, any configured Django cache, or an on-disk SQLite file.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from django.conf import settings
+
+
+class CacheBackend:
+    """Interface every response cache backend implements"""
+
+    name = 'base'
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCacheBackend(CacheBackend):
+    """Per-process LRU bounded by entry count and total size in bytes"""
+
+    name = 'lru'
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: Optional[float]):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at)
+            self._size += size
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+
+class DjangoCacheBackend(CacheBackend):
+    """Store responses in one of the caches configured in settings.CACHES"""
+
+    name = 'django'
+
+    def __init__(self, alias: str = 'default'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key: str) -> Optional[str]:
+        return self.cache.get(f'llm_response:{key}')
+
+    def set(self, key: str, value: str, ttl: Optional[float]):
+        self.cache.set(f'llm_response:{key}', value, timeout=ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """On-disk cache that survives restarts and is shared by processes on one host"""
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_responses ('
+                ' key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,'
+                ' expires_at REAL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS llm_responses_accessed ON llm_responses (accessed_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connection()
+        row = conn.execute('SELECT value, expires_at FROM llm_responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] is not None and row[1] < now:
+            conn.execute('DELETE FROM llm_responses WHERE key = ?', (key,))
+            return None
+        conn.execute('UPDATE llm_responses SET accessed_at = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float]):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO llm_responses (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            (key, value, len(value.encode('utf-8')), now + ttl if ttl else None, now)
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute('DELETE FROM llm_responses WHERE expires_at IS NOT NULL AND expires_at < ?', (now,))
+        count, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses').fetchone()
+        while count > self.max_entries or size > self.max_bytes:
+            row = conn.execute('SELECT key, size FROM llm_responses ORDER BY accessed_at LIMIT 1').fetchone()
+            if row is None:
+                break
+            conn.execute('DELETE FROM llm_responses WHERE key = ?', (row[0],))
+            count -= 1
+            size -= row[1]
+
+    def clear(self):
+        self._connection().execute('DELETE FROM llm_responses')
+
+
+class LLMResponseCache:
+    """Response cache with hit/miss accounting on top of a backend"""
+
+    def __init__(self, backend: CacheBackend, ttl: Optional[float] = 3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str, options: Dict[str, Any]) -> str:
+        """Hash everything that determines a completion into a stable cache key"""
+        material = json.dumps(
+            {'model': model, 'system': system_prompt, 'user': user_prompt, 'options': options},
+            sort_keys=True, separators=(',', ':')
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str):
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception:
+            return
+        with self._lock:
+            self.stores += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+_response_cache: Optional[LLMResponseCache] = None
+_response_cache_configured = False
+_response_cache_lock = threading.Lock()
+
+
+def _build_response_cache() -> Optional[LLMResponseCache]:
+    config = getattr(settings, 'OLLAMA_RESPONSE_CACHE', {}) or {}
+    backend_name = config.get('BACKEND')
+    if not backend_name:
+        return None
+
+    if backend_name == 'lru':
+        backend = LRUCacheBackend(
+            max_entries=config.get('MAX_ENTRIES', 512),
+            max_bytes=config.get('MAX_BYTES', 16 * 1024 * 1024),
+        )
+    elif backend_name == 'django':
+        backend = DjangoCacheBackend(config.get('LOCATION') or 'default')
+    elif backend_name == 'sqlite':
+        backend = SQLiteCacheBackend(
+            config.get('LOCATION') or os.path.join(settings.BASE_DIR, 'llm_cache.sqlite3'),
+            max_entries=config.get('MAX_ENTRIES', 10000),
+            max_bytes=config.get('MAX_BYTES', 256 * 1024 * 1024),
+        )
+    else:
+        raise ValueError(f"Unknown OLLAMA_RESPONSE_CACHE backend: {backend_name}")
+
+    return LLMResponseCache(backend, ttl=config.get('TTL', 3600))
+
+
+def get_response_cache() -> Optional[LLMResponseCache]:
+    """Return the process-wide response cache, or None when caching is disabled"""
+    global _response_cache, _response_cache_configured
+    if not _response_cache_configured:
+        with _response_cache_lock:
+            if not _response_cache_configured:
+                _response_cache = _build_response_cache()
+                _response_cache_configured = True
+    return _response_cache
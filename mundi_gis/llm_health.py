@@ -0,0 +1,190 @@
+"""
+Cached health state for LLM backends.
+
+Request paths must never block on a health probe. A ``HealthMonitor`` keeps
+the last known availability of a backend, refreshes it from a daemon thread
+and guards the backend with a ``CircuitBreaker`` so that, once it is known to
+be down, callers fail fast until a half-open probe sees it recover.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+from django.conf import settings
+
+
+class CircuitBreaker:
+    """Classic closed / open / half-open circuit breaker"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 3, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow_request(self) -> bool:
+        """Whether a call may go through; in half-open state only one trial call is let through"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class HealthMonitor:
+    """Availability of one backend, refreshed in the background"""
+
+    def __init__(self, probe: Callable[[], bool], ttl: float = 30.0, interval: float = 10.0,
+                 failure_threshold: int = 3, recovery_timeout: float = 30.0, initial_wait: float = 1.0):
+        self.probe = probe
+        self.ttl = ttl
+        self.interval = interval
+        self.initial_wait = initial_wait
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+        self._available = False
+        self._checked_at: Optional[float] = None
+        self._first_check = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        """Return the cached availability without doing any network I/O on the caller's thread"""
+        self._ensure_thread()
+        if self._checked_at is None:
+            # Give the very first background probe a moment so a freshly started
+            # worker does not report the backend as down for no reason.
+            self._first_check.wait(self.initial_wait)
+        elif time.monotonic() - self._checked_at > self.ttl:
+            self._wakeup.set()
+        return self._available and self.breaker.state != CircuitBreaker.OPEN
+
+    def start(self):
+        """Start the background probes, if they are not running yet"""
+        self._ensure_thread()
+
+    @property
+    def has_checked(self) -> bool:
+        """Whether a probe or request has reported the backend's state yet"""
+        return self._checked_at is not None
+
+    def allow_request(self) -> bool:
+        """Whether a real request should be sent, as decided by the circuit breaker"""
+        return self.breaker.allow_request()
+
+    def record_success(self):
+        self.breaker.record_success()
+        self._set_available(True)
+
+    def record_failure(self):
+        self.breaker.record_failure()
+        self._set_available(False)
+
+    def check_now(self) -> bool:
+        """Run a probe immediately and update the cached state"""
+        try:
+            ok = bool(self.probe())
+        except Exception:
+            ok = False
+        if ok:
+            self.record_success()
+        else:
+            self.record_failure()
+        return ok
+
+    def status(self) -> Dict[str, object]:
+        age = None if self._checked_at is None else round(time.monotonic() - self._checked_at, 1)
+        return {
+            'available': self._available,
+            'circuit': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'checked_seconds_ago': age,
+        }
+
+    def _set_available(self, available: bool):
+        self._available = available
+        self._checked_at = time.monotonic()
+        self._first_check.set()
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            # Threads do not survive a fork, so workers start their own
+            self._thread_pid = pid
+            self._thread = threading.Thread(target=self._run, name='llm-health-monitor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # While the circuit is open, skip probes until the recovery timeout
+            # has elapsed; the breaker then lets exactly one half-open probe out.
+            if self.breaker.allow_request():
+                self.check_now()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+
+_monitors: Dict[str, HealthMonitor] = {}
+_monitors_lock = threading.Lock()
+
+
+def get_health_monitor(key: str, probe: Callable[[], bool]) -> HealthMonitor:
+    """Return the process-wide monitor for a backend, creating it on first use"""
+    with _monitors_lock:
+        monitor = _monitors.get(key)
+        if monitor is None:
+            monitor = HealthMonitor(
+                probe,
+                ttl=getattr(settings, 'OLLAMA_HEALTH_TTL', 30),
+                interval=getattr(settings, 'OLLAMA_HEALTH_INTERVAL', 10),
+                failure_threshold=getattr(settings, 'OLLAMA_CIRCUIT_FAILURE_THRESHOLD', 3),
+                recovery_timeout=getattr(settings, 'OLLAMA_CIRCUIT_RECOVERY_TIMEOUT', 30),
+                initial_wait=getattr(settings, 'OLLAMA_HEALTH_INITIAL_WAIT', 1),
+            )
+            _monitors[key] = monitor
+        return monitor
@@ -0,0 +1,184 @@
+"""
+Load balancing across several OpenAI-compatible LLM backends.
+
+Every backend (an Ollama server or anything else speaking the OpenAI chat
+API) keeps an exponentially weighted moving average of its response time,
+its error rate and how many requests it is serving right now. The router
+orders the backends that serve a model by the time a new request can expect
+to take there, available backends first, and LocalLLMService tries them in
+that order, moving on to the next when one cannot be reached.
+"""
+
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from django.conf import settings
+from .llm_admission import AdmissionController, get_admission_controller
+from .llm_health import HealthMonitor, get_health_monitor
+
+
+# Weight of the newest sample in the latency and error rate averages
+EWMA_ALPHA = 0.3
+
+# Response time assumed for a backend before its first reply, when no other backend has replied either
+DEFAULT_LATENCY = 1.0
+
+
+class Backend:
+    """One OpenAI-compatible endpoint and its recent performance"""
+
+    def __init__(self, url: str, health: HealthMonitor, models: Sequence[str] = (), api_key: Optional[str] = None):
+        self.url = url.rstrip('/')
+        self.health = health
+        self.models = frozenset(models)
+        self.api_key = api_key
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def admission(self) -> AdmissionController:
+        """The backend's admission controller (llm_admission), which caps the requests sent to it at once"""
+        return get_admission_controller(self.url)
+
+    def serves(self, model: str) -> bool:
+        """Whether the backend may be sent requests for a model; one without a model list serves any"""
+        return not self.models or model in self.models
+
+    def dedicated_to(self, model: str) -> bool:
+        """Whether the backend's model list names the model"""
+        return model in self.models
+
+    def expected_wait(self, default_latency: float) -> float:
+        """
+        Seconds a new request can expect to take here: the average response
+        time for every request in flight plus this one, inflated by the error
+        rate since failed attempts have to be made again elsewhere
+        """
+        latency = default_latency if self.latency is None else self.latency
+        return latency * (self.in_flight + 1) / max(1.0 - self.error_rate, 0.1)
+
+    def acquire(self):
+        """Count a request as in flight"""
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+
+    def release(self):
+        """Count an in-flight request as finished"""
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+
+    def record_success(self, elapsed: float):
+        with self._lock:
+            self.latency = elapsed if self.latency is None else EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * self.latency
+            self.error_rate *= 1 - EWMA_ALPHA
+        self.health.record_success()
+
+    def record_failure(self):
+        with self._lock:
+            self.errors += 1
+            self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+        self.health.record_failure()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'models': sorted(self.models),
+            'latency_ms': None if self.latency is None else round(self.latency * 1000, 1),
+            'error_rate': round(self.error_rate, 3),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'admission': self.admission.status(),
+            **self.health.status(),
+        }
+
+
+class LLMRouter:
+    """The configured backends, ordered per request by expected wait"""
+
+    def __init__(self, backends: List[Backend]):
+        if not backends:
+            raise ValueError('At least one LLM backend is required')
+        self.backends = backends
+
+    def candidates(self, model: str) -> List[Backend]:
+        """
+        Backends to try for a request, best first: those serving the model
+        (all of them if none does), available ones before unavailable ones,
+        those that list the model before those serving any, then by
+        expected wait
+        """
+        backends = [backend for backend in self.backends if backend.serves(model)] or self.backends
+        # Start every monitor before reading any, so first probes run side by side
+        for backend in backends:
+            backend.health.start()
+        known = [backend.latency for backend in self.backends if backend.latency is not None]
+        default_latency = sum(known) / len(known) if known else DEFAULT_LATENCY
+        ranked = [
+            (not backend.health.is_available(), not backend.dedicated_to(model),
+             backend.expected_wait(default_latency), position, backend)
+            for position, backend in enumerate(backends)
+        ]
+        return [entry[-1] for entry in sorted(ranked, key=lambda entry: entry[:4])]
+
+    def best(self, model: str) -> Backend:
+        return self.candidates(model)[0]
+
+    def is_available(self, model: Optional[str] = None) -> bool:
+        """Whether any backend (serving the model, if given) is available"""
+        backends = self.backends if model is None else self.candidates(model)
+        for backend in backends:
+            backend.health.start()
+        return any(backend.health.is_available() for backend in backends)
+
+    @property
+    def has_checked(self) -> bool:
+        """Whether every backend's state is known, so is_available() will not wait"""
+        return all(backend.health.has_checked for backend in self.backends)
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [backend.status() for backend in self.backends]
+
+
+def parse_backend(spec: Any) -> Tuple[str, List[str], Optional[str]]:
+    """
+    The URL, models and API key of a backend setting: either a string
+    ``"<base url>"`` or ``"<base url>=<model>|<model>"``, or a dict with
+    ``url`` and optional ``models`` and ``api_key``
+    """
+    if isinstance(spec, dict):
+        return str(spec['url']), list(spec.get('models') or ()), spec.get('api_key')
+    url, _, models = str(spec).strip().partition('=')
+    return url.strip(), [model.strip() for model in models.split('|') if model.strip()], None
+
+
+def backend_specs() -> List[Any]:
+    """OLLAMA_BACKENDS, or just OLLAMA_BASE_URL when it is empty"""
+    return list(getattr(settings, 'OLLAMA_BACKENDS', None) or [
+        getattr(settings, 'OLLAMA_BASE_URL', 'http://localhost:11434/v1')
+    ])
+
+
+_routers: Dict[Tuple, LLMRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_llm_router(probe: Callable[[str], Callable[[], bool]]) -> LLMRouter:
+    """
+    Return the process-wide router for the configured backends, creating it
+    on first use; ``probe`` builds the health probe for a base URL
+    """
+    backends = tuple(parse_backend(spec) for spec in backend_specs())
+    key = tuple((url, tuple(models), api_key) for url, models, api_key in backends)
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = _routers[key] = LLMRouter([
+                Backend(url, get_health_monitor(url.rstrip('/'), probe(url.rstrip('/'))), models, api_key)
+                for url, models, api_key in backends
+            ])
+        return router
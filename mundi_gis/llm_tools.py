@@ -0,0 +1,261 @@
+"""
+Project queries offered to the local LLM as callable tools.
+
+The AI chat sends these function definitions with the conversation; when the
+model calls one, ``ProjectTools`` runs it against the project's precomputed
+statistics and columnar layers (see spatial_ops) and returns a small JSON
+result. Results are cached per project version, so a model that asks the
+same thing twice in a conversation, or across conversations about unchanged
+data, gets the stored answer.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+from django.conf import settings
+from .columnar import ColumnarLayer
+from .http_cache import layer_etag, project_etag
+from .layer_stats import get_layer_statistics
+from .spatial_ops import SpatialQueryError, project_layer_resolver, run_spatial_query
+
+
+# Rows listed in grouped results, so a tool result stays small enough for the model's context
+MAX_RESULT_ROWS = 20
+
+# Results longer than this are replaced with an error asking for a narrower query
+MAX_RESULT_CHARS = 8000
+
+_NAME_FIELDS = ('name', 'title', 'label')
+
+_LAYER_PARAMETER = {'type': 'string', 'description': 'Layer name (or id), as returned by list_layers'}
+_BBOX_PARAMETER = {
+    'type': 'array', 'items': {'type': 'number'}, 'minItems': 4, 'maxItems': 4,
+    'description': 'Bounding box [minx, miny, maxx, maxy] in the layer coordinates',
+}
+
+
+def _function(name: str, description: str, properties: Dict[str, Any], required: List[str]) -> Dict[str, Any]:
+    return {
+        'type': 'function',
+        'function': {
+            'name': name,
+            'description': description,
+            'parameters': {'type': 'object', 'properties': properties, 'required': required},
+        },
+    }
+
+
+TOOLS = [
+    _function('list_layers', 'List the layers of the project with their type, geometry type and feature count.', {}, []),
+    _function(
+        'layer_statistics',
+        'Feature count, geometry types, extent, CRS and a summary of every attribute '
+        '(type, min, max, distinct and null counts) of one layer.',
+        {'layer': _LAYER_PARAMETER}, ['layer'],
+    ),
+    _function(
+        'count_features',
+        'Count the features of a layer, optionally only those inside a bounding box and with given attribute values.',
+        {
+            'layer': _LAYER_PARAMETER,
+            'bbox': _BBOX_PARAMETER,
+            'where': {'type': 'object', 'description': 'Attribute values the features must have, e.g. {"type": "school"}'},
+        },
+        ['layer'],
+    ),
+    _function(
+        'summarize_attribute',
+        'Summarize one attribute of a layer: count, sum, mean, min and max of a numeric attribute, '
+        'or the most common values of any other attribute. Optionally per value of another attribute '
+        '(group_by) and only inside a bounding box.',
+        {
+            'layer': _LAYER_PARAMETER,
+            'field': {'type': 'string', 'description': 'Attribute name'},
+            'group_by': {'type': 'string', 'description': 'Attribute to group a numeric summary by'},
+            'bbox': _BBOX_PARAMETER,
+        },
+        ['layer', 'field'],
+    ),
+    _function(
+        'count_in_polygons',
+        'Count how many features of a layer fall inside each polygon of a polygon layer, busiest polygons first.',
+        {'layer': _LAYER_PARAMETER, 'polygon_layer': _LAYER_PARAMETER},
+        ['layer', 'polygon_layer'],
+    ),
+]
+
+
+_result_cache: OrderedDict = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def _cached_result(key) -> Optional[str]:
+    with _result_cache_lock:
+        content = _result_cache.get(key)
+        if content is not None:
+            _result_cache.move_to_end(key)
+        return content
+
+
+def _store_result(key, content: str):
+    max_entries = getattr(settings, 'MUNDI_TOOL_CACHE_SIZE', 256)
+    with _result_cache_lock:
+        _result_cache[key] = content
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > max_entries:
+            _result_cache.popitem(last=False)
+
+
+def project_version(layers) -> Optional[str]:
+    """
+    Identifies the current data of a project: the ETags of its layers, or
+    their ids and update times for layers not ingested yet
+    """
+    return project_etag(
+        [layer_etag(layer) or f'{layer.id}@{layer.updated_at.isoformat()}' for layer in layers], 'tools'
+    )
+
+
+class ProjectTools:
+    """
+    The TOOLS, bound to one project. ``call`` runs a tool and returns its
+    JSON result; every call is logged in ``calls``.
+    """
+
+    specs = TOOLS
+
+    def __init__(self, project):
+        self.project = project
+        self.layers = list(project.layers.select_related('statistics').order_by('created_at'))
+        self.version = project_version(self.layers)
+        self.calls: List[Dict[str, Any]] = []
+        self._resolve = project_layer_resolver(project)
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            'list_layers': self.list_layers,
+            'layer_statistics': self.layer_statistics,
+            'count_features': self.count_features,
+            'summarize_attribute': self.summarize_attribute,
+            'count_in_polygons': self.count_in_polygons,
+        }
+
+    def call(self, name: str, arguments: Any) -> str:
+        """Run a tool with the model's arguments (a JSON string or object); errors are returned as results"""
+        started = time.perf_counter()
+        entry = {'name': name, 'arguments': arguments, 'cached': False}
+        try:
+            if isinstance(arguments, str):
+                arguments = json.loads(arguments or '{}')
+            if not isinstance(arguments, dict):
+                raise SpatialQueryError('Tool arguments must be a JSON object')
+            entry['arguments'] = arguments
+            handler = self._handlers.get(name)
+            if handler is None:
+                raise SpatialQueryError(f"Unknown tool: {name}. Available tools: {', '.join(self._handlers)}")
+
+            key = (str(self.project.id), self.version, name, json.dumps(arguments, sort_keys=True))
+            content = _cached_result(key)
+            if content is None:
+                content = json.dumps(handler(arguments), default=str)
+                if len(content) > MAX_RESULT_CHARS:
+                    raise SpatialQueryError('The result is too large; narrow the query')
+                _store_result(key, content)
+            else:
+                entry['cached'] = True
+        except ValueError as e:
+            content = json.dumps({'error': str(e)})
+            entry['error'] = str(e)
+        entry['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        self.calls.append(entry)
+        return content
+
+    def _layer(self, arguments: Dict[str, Any], key: str = 'layer'):
+        reference = str(arguments.get(key) or '').strip()
+        for layer in self.layers:
+            if str(layer.id) == reference:
+                return layer
+        for layer in self.layers:
+            if layer.name.strip().lower() == reference.lower():
+                return layer
+        raise SpatialQueryError(f'No layer named {reference!r}; call list_layers for the layer names')
+
+    def _columnar(self, layer) -> ColumnarLayer:
+        return self._resolve(str(layer.id))
+
+    def list_layers(self, arguments: Dict[str, Any]) -> List[Dict[str, Any]]:
+        layers = []
+        for layer in self.layers:
+            statistics = get_layer_statistics(layer)
+            layers.append({
+                'name': layer.name,
+                'id': str(layer.id),
+                'type': layer.layer_type,
+                'geometry_type': statistics.geometry_type if statistics else None,
+                'feature_count': statistics.feature_count if statistics else None,
+            })
+        return layers
+
+    def layer_statistics(self, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        layer = self._layer(arguments)
+        statistics = get_layer_statistics(layer)
+        if statistics is None:
+            raise SpatialQueryError(f'No statistics have been computed for {layer.name}')
+        return {
+            'layer': layer.name,
+            'feature_count': statistics.feature_count,
+            'geometry_types': statistics.geometry_types,
+            'bbox': statistics.bbox,
+            'crs': statistics.crs,
+            'attributes': {
+                name: {'type': kind, **statistics.field_stats.get(name, {})}
+                for name, kind in statistics.attribute_schema.items()
+            },
+        }
+
+    def count_features(self, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        layer = self._layer(arguments)
+        result = run_spatial_query({
+            'operation': 'select', 'layer': str(layer.id), 'limit': 1,
+            'bbox': arguments.get('bbox'), 'where': arguments.get('where'),
+        }, self._resolve)
+        return {'layer': layer.name, 'count': result['count']}
+
+    def summarize_attribute(self, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        layer = self._layer(arguments)
+        field = arguments.get('field')
+        column = next((c for c in self._columnar(layer).columns if c.name == field), None)
+        if column is None:
+            raise SpatialQueryError(f'{layer.name} has no attribute {field!r}; call layer_statistics for its attributes')
+        query = {'operation': 'aggregate', 'layer': str(layer.id), 'bbox': arguments.get('bbox'),
+                 'limit': MAX_RESULT_ROWS}
+        if column.type in ('int64', 'number', 'bool'):
+            query.update({'field': field, 'group_by': arguments.get('group_by')})
+        else:
+            # Most common values of a text attribute
+            query.update({'group_by': field, 'stats': ['count']})
+        result = run_spatial_query(query, self._resolve)
+        del result['operation']
+        result.update({'layer': layer.name, 'field': field})
+        return result
+
+    def count_in_polygons(self, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        layer = self._layer(arguments)
+        polygon_layer = self._layer(arguments, 'polygon_layer')
+        # Each polygon is labelled by its name-like attribute, if it has one
+        columns = [c for c in self._columnar(polygon_layer).columns if c.type == 'string']
+        labels = [c.name for c in columns if c.name.lower() in _NAME_FIELDS] or [c.name for c in columns[:1]]
+        result = run_spatial_query({
+            'operation': 'count_in_polygons', 'layer': str(layer.id), 'limit': MAX_RESULT_ROWS,
+            'polygons': {'layer': str(polygon_layer.id)}, 'fields': labels,
+        }, self._resolve)
+        return {
+            'layer': layer.name,
+            'polygon_layer': polygon_layer.name,
+            'features': result['count'],
+            'inside': result['inside'],
+            'polygon_count': result['polygon_count'],
+            'polygons': [
+                {'index': p['index'], **p['properties'], 'count': p['count']} for p in result['polygons']
+            ],
+        }
@@ -1,30 +1,174 @@
+import atexit
+import httpx
 import requests
 import json
 import os
-from typing import Dict, List, Optional, Any
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from contextlib import aclosing, closing
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Any, Tuple
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from .async_http import async_timeout, get_async_http_client
+from .llm_admission import INTERACTIVE, LLMBusyError, Slot
+from .llm_cache import LLMResponseCache, get_response_cache
+from .llm_router import Backend, backend_specs, get_llm_router
+from .prompts import ProjectPrompt
 
 
-class LocalLLMService:
-    """Service for interacting with local LLM via Ollama"""
+_http_sessions: Dict[bool, requests.Session] = {}
+_http_session_lock = threading.Lock()
+
+
+def _build_http_session(with_retries: bool) -> requests.Session:
+    """Create a keep-alive session with a bounded connection pool and retries"""
+    pool_size = getattr(settings, 'OLLAMA_POOL_SIZE', 10)
+    max_retries = getattr(settings, 'OLLAMA_MAX_RETRIES', 2) if with_retries else 0
+    
+    # Only retry failures that happen before Ollama starts generating:
+    # connection errors and explicit "busy" status codes, never read timeouts.
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    # One connection pool per backend host
+    adapter = HTTPAdapter(pool_connections=len(backend_specs()), pool_maxsize=pool_size, max_retries=retry)
+    
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_http_session(with_retries: bool = True) -> requests.Session:
+    """
+    Return the process-wide pooled HTTP session shared by all LocalLLMService instances.
+
+    Health probes use a separate pool without retries so a probe reports a
+    failure straight away instead of backing off.
+    """
+    session = _http_sessions.get(with_retries)
+    if session is None:
+        with _http_session_lock:
+            session = _http_sessions.get(with_retries)
+            if session is None:
+                session = _http_sessions[with_retries] = _build_http_session(with_retries)
+    return session
+
+
+def close_http_session():
+    """Close the pooled sessions and their connections (runs on worker shutdown)"""
+    with _http_session_lock:
+        for session in _http_sessions.values():
+            session.close()
+        _http_sessions.clear()
+
+
+def _reset_http_session_after_fork():
+    # Pooled sockets must never be shared between a parent and a forked worker
+    global _http_session_lock
+    _http_sessions.clear()
+    _http_session_lock = threading.Lock()
+
+
+atexit.register(close_http_session)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_http_session_after_fork)
+
+
+def _timeout(read_timeout: float) -> Tuple[float, float]:
+    return (getattr(settings, 'OLLAMA_CONNECT_TIMEOUT', 3.05), read_timeout)
+
+
+def _models_probe(base_url: str):
+    """Build the health probe for an Ollama server: a GET on its /models listing"""
+    def probe() -> bool:
+        response = get_http_session(with_retries=False).get(
+            f"{base_url}/models",
+            timeout=_timeout(getattr(settings, 'OLLAMA_PROBE_TIMEOUT', 5))
+        )
+        return response.status_code == 200
+    return probe
+
+
+class LLMServiceError(Exception):
+    """Raised when a streamed LLM request cannot be completed"""
+
+
+# Tool calls run from one model reply; any beyond this are ignored
+MAX_TOOL_CALLS_PER_TURN = 8
+
+
+class _StreamedReply:
+    """The assistant message of a streamed reply, assembled from its deltas"""
     
     def __init__(self):
-        self.base_url = "http://localhost:11434/v1"
+        self.content = []
+        # Tool calls arrive in pieces keyed by their index; arguments are concatenated
+        self.calls: Dict[int, Dict[str, Any]] = {}
+    
+    def add(self, delta: Dict[str, Any]) -> str:
+        """Add a delta; returns its content"""
+        if delta.get('content'):
+            self.content.append(delta['content'])
+        for piece in delta.get('tool_calls') or []:
+            call = self.calls.setdefault(piece.get('index', len(self.calls)), {
+                "id": '', "type": "function", "function": {"name": '', "arguments": ''}
+            })
+            call['id'] = piece.get('id') or call['id']
+            function = piece.get('function') or {}
+            call['function']['name'] += function.get('name') or ''
+            arguments = function.get('arguments') or ''
+            call['function']['arguments'] += arguments if isinstance(arguments, str) else json.dumps(arguments)
+        return delta.get('content') or ''
+    
+    def message(self) -> Dict[str, Any]:
+        return {"content": ''.join(self.content), "tool_calls": [self.calls[index] for index in sorted(self.calls)]}
+
+
+class LocalLLMService:
+    """Service for interacting with local LLM via Ollama (or several, see llm_router)"""
+    
+    def __init__(self, priority: int = INTERACTIVE, raise_errors: bool = False):
+        self.router = get_llm_router(_models_probe)
+        # Requests wait for their backend's admission slot in this priority class (llm_admission)
+        self.priority = priority
+        # Failed completions raise LLMServiceError instead of returning the error as the reply
+        self.raise_errors = raise_errors
         self.model = getattr(settings, 'OLLAMA_MODEL', 'orieg/gemma3-tools:1b')
-        self.api_key = "ollama"  # Dummy key for Ollama
+        self.api_key = getattr(settings, 'OLLAMA_API_KEY', 'ollama')  # Ollama ignores it
+        self.session = get_http_session()
+        self.probe_timeout = getattr(settings, 'OLLAMA_PROBE_TIMEOUT', 5)
+        self.request_timeout = getattr(settings, 'OLLAMA_REQUEST_TIMEOUT', 30)
+        self.cache = get_response_cache()
+        self.temperature = getattr(settings, 'OLLAMA_ANALYSIS_TEMPERATURE', 0)
+        self.max_tool_iterations = getattr(settings, 'OLLAMA_TOOL_MAX_ITERATIONS', 4)
+        self.tool_timeout = getattr(settings, 'OLLAMA_TOOL_TIMEOUT', 60)
         
     def is_available(self) -> bool:
-        """Check if Ollama server is running"""
-        try:
-            response = requests.get(f"{self.base_url}/models", timeout=5)
-            return response.status_code == 200
-        except requests.exceptions.RequestException:
-            return False
+        """Check if an Ollama server for the model is running (cached, refreshed in the background)"""
+        return self.router.is_available(self.model)
+    
+    async def ais_available(self) -> bool:
+        """Async version of is_available(); the first check of a process waits in a thread, not on the event loop"""
+        if self.router.has_checked:
+            return self.router.is_available(self.model)
+        return await sync_to_async(self.router.is_available, thread_sensitive=False)(self.model)
     
     def get_available_models(self) -> List[Dict[str, Any]]:
         """Get list of available models"""
         try:
-            response = requests.get(f"{self.base_url}/models")
+            response = self.session.get(
+                f"{self.router.best(self.model).url}/models", timeout=_timeout(self.probe_timeout)
+            )
             if response.status_code == 200:
                 return response.json().get('models', [])
             return []
@@ -33,6 +177,18 @@ class LocalLLMService:
     
     def analyze_gis_data(self, layer_info: Dict[str, Any], question: str) -> str:
         """Analyze GIS data using local LLM"""
+        return self._make_chat_completion(*self._gis_analysis_prompts(layer_info, question))
+    
+    def stream_gis_analysis(self, layer_info: Dict[str, Any], question: str) -> Iterator[str]:
+        """Stream a GIS layer analysis from the local LLM as it is generated"""
+        return self.stream_chat_completion(*self._gis_analysis_prompts(layer_info, question))
+    
+    def astream_gis_analysis(self, layer_info: Dict[str, Any], question: str) -> AsyncIterator[str]:
+        """Async version of stream_gis_analysis()"""
+        return self.astream_chat_completion(*self._gis_analysis_prompts(layer_info, question))
+    
+    def _gis_analysis_prompts(self, layer_info: Dict[str, Any], question: str) -> Tuple[str, str]:
+        """Build the system and user prompts for a layer analysis"""
         system_prompt = """You are Kue, an AI assistant specialized in Geographic Information Systems (GIS) and spatial data analysis. 
         You help users understand and analyze geographic data layers, maps, and spatial relationships.
         
@@ -53,16 +209,30 @@ class LocalLLMService:
         - Geometry Type: {layer_info.get('geometry_type', 'Unknown')}
         - Description: {layer_info.get('description', 'No description')}
         - Created: {layer_info.get('created_at', 'Unknown')}
+        - Extent (minx, miny, maxx, maxy): {layer_info.get('bbox') or 'Unknown'}
+        - CRS: {layer_info.get('crs') or 'Unknown'}
+        - Attributes: {', '.join(f'{name} ({kind})' for name, kind in (layer_info.get('attributes') or {}).items()) or 'Unknown'}
         
         User Question: {question}
         
         Please analyze this GIS layer and answer the user's question.
         """
         
-        return self._make_chat_completion(system_prompt, user_prompt)
+        return system_prompt, user_prompt
+    
+    async def aanalyze_gis_data(self, layer_info: Dict[str, Any], question: str) -> str:
+        """Async version of analyze_gis_data()"""
+        return await self._amake_chat_completion(*self._gis_analysis_prompts(layer_info, question))
     
     def generate_map_description(self, project_info: Dict[str, Any]) -> str:
         """Generate a description for a map project"""
+        return self._make_chat_completion(*self._map_description_prompts(project_info))
+    
+    async def agenerate_map_description(self, project_info: Dict[str, Any]) -> str:
+        """Async version of generate_map_description()"""
+        return await self._amake_chat_completion(*self._map_description_prompts(project_info))
+    
+    def _map_description_prompts(self, project_info: Dict[str, Any]) -> Tuple[str, str]:
         system_prompt = """You are an expert GIS analyst. Generate concise, informative descriptions for map projects based on their layers and metadata."""
         
         user_prompt = f"""
@@ -73,10 +243,17 @@ class LocalLLMService:
         Generate a brief, professional description of this map project.
         """
         
-        return self._make_chat_completion(system_prompt, user_prompt)
+        return system_prompt, user_prompt
     
     def suggest_layer_styling(self, layer_info: Dict[str, Any]) -> Dict[str, Any]:
         """Suggest styling options for a GIS layer"""
+        return self._parse_styling(self._make_chat_completion(*self._styling_prompts(layer_info)))
+    
+    async def asuggest_layer_styling(self, layer_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Async version of suggest_layer_styling()"""
+        return self._parse_styling(await self._amake_chat_completion(*self._styling_prompts(layer_info)))
+    
+    def _styling_prompts(self, layer_info: Dict[str, Any]) -> Tuple[str, str]:
         system_prompt = """You are a GIS styling expert. Suggest appropriate styling options for different types of geographic data layers."""
         
         user_prompt = f"""
@@ -93,8 +270,9 @@ class LocalLLMService:
         - classification: suggested classification method
         """
         
-        response = self._make_chat_completion(system_prompt, user_prompt)
-        
+        return system_prompt, user_prompt
+    
+    def _parse_styling(self, response: str) -> Dict[str, Any]:
         # Try to parse JSON response
         try:
             # Extract JSON from response if it's wrapped in text
@@ -115,45 +293,515 @@ class LocalLLMService:
             "classification": "natural_breaks"
         }
     
-    def _make_chat_completion(self, system_prompt: str, user_prompt: str) -> str:
-        """Make a chat completion request to Ollama"""
-        try:
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "max_tokens": 1000
-                }
+    def _chat_payload(self, system_prompt: str, user_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "stream": stream,
+            "options": {
+                "temperature": self.temperature,
+                "top_p": 0.9,
+                "max_tokens": 1000
             }
+        }
+    
+    def _headers(self, backend: Backend) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {backend.api_key or self.api_key}"
+        }
+    
+    def _post(self, payload: Dict[str, Any], read_timeout: float) -> Any:
+        """
+        POST a chat completion once its backend has a free admission slot.
+        Raises LLMServiceError, or llm_admission.LLMBusyError when the
+        backend is saturated.
+        """
+        response, release = self._send(payload, read_timeout)
+        release()
+        return response
+    
+    def _open_stream(self, payload: Dict[str, Any], read_timeout: float) -> Tuple[Any, Callable[[], None]]:
+        """
+        Streamed version of _post(). Returns the response and a function to
+        call once it has been read, which frees its admission slot and backend.
+        """
+        return self._send(payload, read_timeout, stream=True)
+    
+    async def _apost(self, payload: Dict[str, Any], read_timeout: float) -> Any:
+        """Async version of _post()"""
+        response, release = await self._asend(payload, read_timeout)
+        release()
+        return response
+    
+    async def _aopen_stream(self, payload: Dict[str, Any], read_timeout: float) -> Tuple[Any, Callable[[], None]]:
+        """Async version of _open_stream(); close the response with ``aclose()`` before releasing it"""
+        return await self._asend(payload, read_timeout, stream=True)
+    
+    def _admission_order(self, model: str) -> List[Backend]:
+        """
+        The router's candidates for a model, available backends with a free
+        admission slot first; when every backend is saturated, a request
+        queues on the best one
+        """
+        candidates = self.router.candidates(model)
+        return sorted(candidates, key=lambda backend: (
+            not backend.health.is_available(), not backend.admission.has_free_slot()
+        ))
+    
+    def check_admission(self):
+        """Raise llm_admission.LLMBusyError if a request would be turned away right now"""
+        self._admission_order(self.model)[0].admission.check(self.priority)
+    
+    def _send(self, payload: Dict[str, Any], read_timeout: float, stream: bool = False) -> Tuple[Any, Callable[[], None]]:
+        """
+        POST a chat completion to the best backend for its model once that
+        backend lets it through (llm_admission), failing over to the next
+        one when a backend cannot be reached or answers with a server error.
+        A read timeout is not failed over, as the backend may still be
+        generating. Returns the response and a function to call once it has
+        been read, which frees its admission slot and backend. Raises
+        LLMServiceError, or llm_admission.LLMBusyError.
+        """
+        error = LLMServiceError("Error connecting to Ollama: every server is marked unavailable after repeated failures")
+        candidates = self._admission_order(payload['model'])
+        for position, backend in enumerate(candidates):
+            if not backend.health.allow_request():
+                continue
+            slot = backend.admission.acquire(self.priority)
+            # Only the last resort retries; the others fail over straight away
+            session = get_http_session(with_retries=position == len(candidates) - 1)
+            backend.acquire()
+            # Released in the finally, even on cancellation, unless the response is handed over
+            handed_over = False
+            started = time.monotonic()
+            try:
+                try:
+                    response = session.post(
+                        f"{backend.url}/chat/completions",
+                        json=payload,
+                        headers=self._headers(backend),
+                        timeout=_timeout(read_timeout),
+                        stream=stream
+                    )
+                except requests.exceptions.ConnectionError as e:
+                    error = LLMServiceError(f"Error connecting to Ollama: {str(e)}")
+                except requests.exceptions.Timeout as e:
+                    backend.record_failure()
+                    raise LLMServiceError(f"Ollama did not reply within {read_timeout:.1f} seconds") from e
+                except requests.exceptions.RequestException as e:
+                    error = LLMServiceError(f"Error connecting to Ollama: {str(e)}")
+                else:
+                    if response.status_code < 500:
+                        backend.record_success(time.monotonic() - started)
+                        handed_over = True
+                        return response, self._releaser(backend, slot)
+                    error = LLMServiceError(f"Error: {response.status_code} - {response.text}")
+                    response.close()
+                backend.record_failure()
+            finally:
+                if not handed_over:
+                    backend.release()
+                    slot.release()
+        raise error
+    
+    @staticmethod
+    def _releaser(backend: Backend, slot: Slot) -> Callable[[], None]:
+        def release():
+            backend.release()
+            slot.release()
+        return release
+    
+    async def _asend(self, payload: Dict[str, Any], read_timeout: float, stream: bool = False) -> Tuple[Any, Callable[[], None]]:
+        """Async version of _send() on the pooled httpx client"""
+        error = LLMServiceError("Error connecting to Ollama: every server is marked unavailable after repeated failures")
+        for backend in self._admission_order(payload['model']):
+            if not backend.health.allow_request():
+                continue
+            slot = await backend.admission.aacquire(self.priority)
+            backend.acquire()
+            # Released in the finally, also when the view is cancelled, unless the response is handed over
+            handed_over = False
+            started = time.monotonic()
+            try:
+                try:
+                    client = get_async_http_client()
+                    request = client.build_request(
+                        "POST",
+                        f"{backend.url}/chat/completions",
+                        json=payload,
+                        headers=self._headers(backend),
+                        timeout=async_timeout(read_timeout)
+                    )
+                    response = await client.send(request, stream=stream)
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    error = LLMServiceError(f"Error connecting to Ollama: {str(e)}")
+                except httpx.TimeoutException as e:
+                    backend.record_failure()
+                    raise LLMServiceError(f"Ollama did not reply within {read_timeout:.1f} seconds") from e
+                except httpx.HTTPError as e:
+                    error = LLMServiceError(f"Error connecting to Ollama: {str(e)}")
+                else:
+                    if response.status_code < 500:
+                        backend.record_success(time.monotonic() - started)
+                        handed_over = True
+                        return response, self._releaser(backend, slot)
+                    try:
+                        await response.aread()
+                        error = LLMServiceError(f"Error: {response.status_code} - {response.text}")
+                    except httpx.HTTPError as e:
+                        error = LLMServiceError(f"Error: {response.status_code} - {str(e)}")
+                    finally:
+                        await response.aclose()
+                backend.record_failure()
+            finally:
+                if not handed_over:
+                    backend.release()
+                    slot.release()
+        raise error
+    
+    def _cache_key(self, payload: Dict[str, Any], use_cache: bool) -> Optional[str]:
+        """
+        Cache key for a chat payload, or None if this call must not be cached.
+        Sampled replies (temperature above 0) are only cached when
+        OLLAMA_CACHE_NONDETERMINISTIC allows it, or every user would get the
+        same sample.
+        """
+        if not use_cache or self.cache is None:
+            return None
+        if payload['options'].get('temperature', 0) > 0 and not getattr(settings, 'OLLAMA_CACHE_NONDETERMINISTIC', False):
+            return None
+        messages = {message['role']: message['content'] for message in payload['messages']}
+        return LLMResponseCache.make_key(
+            payload['model'], messages.get('system', ''), messages.get('user', ''), payload['options']
+        )
+    
+    def _make_chat_completion(self, system_prompt: str, user_prompt: str, use_cache: bool = True) -> str:
+        """
+        Make a chat completion request to Ollama.
+
+        Successful responses are served from the response cache when one is
+        configured and the reply is deterministic (see _cache_key); pass
+        ``use_cache=False`` when a fresh sample is wanted regardless.
+        Failures are returned as an error message, or raised as
+        LLMServiceError when the service was created with ``raise_errors``;
+        llm_admission.LLMBusyError is always raised when the LLM is saturated.
+        """
+        payload = self._chat_payload(system_prompt, user_prompt)
+        cache_key = self._cache_key(payload, use_cache)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        try:
+            response = self._post(payload, self.request_timeout)
+            return self._completion_content(response, cache_key)
+        except LLMServiceError as e:
+            if self.raise_errors:
+                raise
+            return str(e)
+    
+    async def _amake_chat_completion(self, system_prompt: str, user_prompt: str, use_cache: bool = True) -> str:
+        """Async version of _make_chat_completion() on the pooled httpx client"""
+        payload = self._chat_payload(system_prompt, user_prompt)
+        cache_key = self._cache_key(payload, use_cache)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        try:
+            response = await self._apost(payload, self.request_timeout)
+            return self._completion_content(response, cache_key)
+        except LLMServiceError as e:
+            if self.raise_errors:
+                raise
+            return str(e)
+    
+    def _completion_content(self, response, cache_key: Optional[str]) -> str:
+        """Extract the reply from a requests or httpx response; raises LLMServiceError"""
+        if response.status_code != 200:
+            raise LLMServiceError(f"Error: {response.status_code} - {response.text}")
+        
+        try:
+            content = response.json()['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError) as e:
+            raise LLMServiceError(f"Error parsing response: {str(e)}") from e
+        if cache_key:
+            self.cache.set(cache_key, content)
+        return content
+    
+    def stream_chat_completion(self, system_prompt: str, user_prompt: str, use_cache: bool = True) -> Iterator[str]:
+        """
+        Yield content chunks from a streamed chat completion as Ollama produces them.
+
+        Raises LLMServiceError if the request cannot be made. Closing the
+        generator early (e.g. because the client went away) closes the upstream
+        connection, which makes Ollama stop generating. A cached response is
+        yielded as a single chunk, and a fully streamed one is cached.
+        """
+        payload = self._chat_payload(system_prompt, user_prompt, stream=True)
+        cache_key = self._cache_key(payload, use_cache)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        parts = []
+        with closing(self._stream_deltas(payload, self.request_timeout)) as deltas:
+            for delta in deltas:
+                if delta.get('content'):
+                    parts.append(delta['content'])
+                    yield delta['content']
+        
+        if cache_key and parts:
+            self.cache.set(cache_key, ''.join(parts))
+    
+    async def astream_chat_completion(self, system_prompt: str, user_prompt: str, use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Async version of stream_chat_completion() on the pooled httpx client,
+        for ASGI servers, which only stream async iterators as they go
+        """
+        payload = self._chat_payload(system_prompt, user_prompt, stream=True)
+        cache_key = self._cache_key(payload, use_cache)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        parts = []
+        async with aclosing(self._astream_deltas(payload, self.request_timeout)) as deltas:
+            async for delta in deltas:
+                if delta.get('content'):
+                    parts.append(delta['content'])
+                    yield delta['content']
+        
+        if cache_key and parts:
+            self.cache.set(cache_key, ''.join(parts))
+    
+    def _stream_deltas(self, payload: Dict[str, Any], read_timeout: float) -> Iterator[Dict[str, Any]]:
+        """Yield the deltas of a streamed reply; closing the generator closes the upstream request"""
+        response, release = self._open_stream(payload, read_timeout)
+        try:
+            if response.status_code != 200:
+                raise LLMServiceError(f"Error: {response.status_code} - {response.text}")
             
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
+            for line in response.iter_lines(decode_unicode=True):
+                delta = self._sse_delta(line)
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
+        except requests.exceptions.RequestException as e:
+            raise LLMServiceError(f"Error reading from Ollama: {str(e)}") from e
+        finally:
+            response.close()
+            release()
+    
+    async def _astream_deltas(self, payload: Dict[str, Any], read_timeout: float) -> AsyncIterator[Dict[str, Any]]:
+        """Async version of _stream_deltas()"""
+        response, release = await self._aopen_stream(payload, read_timeout)
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                raise LLMServiceError(f"Error: {response.status_code} - {response.text}")
             
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                json=payload,
-                headers=headers,
-                timeout=30
-            )
+            async for line in response.aiter_lines():
+                delta = self._sse_delta(line)
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
+        except httpx.HTTPError as e:
+            raise LLMServiceError(f"Error reading from Ollama: {str(e)}") from e
+        finally:
+            try:
+                await response.aclose()
+            finally:
+                release()
+    
+    def _sse_delta(self, line: str) -> Optional[Dict[str, Any]]:
+        """
+        The delta of one line of a streamed reply: empty for lines without
+        one, None once the reply is complete. Raises LLMServiceError.
+        """
+        if not line or not line.startswith('data:'):
+            return {}
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return None
+        try:
+            return json.loads(data)['choices'][0].get('delta') or {}
+        except (ValueError, KeyError, IndexError) as e:
+            raise LLMServiceError(f"Error parsing response: {str(e)}") from e
+    
+    def analyze_project(self, prompt: ProjectPrompt, tools=None) -> str:
+        """
+        Answer a question about a project (see prompts.build_project_prompt),
+        letting the model query it through tools (llm_tools.ProjectTools) if given
+        """
+        if tools is None:
+            return self._make_chat_completion(prompt.system, prompt.user)
+        return self.chat_with_tools(prompt.system, prompt.user, tools)
+    
+    async def aanalyze_project(self, prompt: ProjectPrompt, tools=None) -> str:
+        """Async version of analyze_project()"""
+        if tools is None:
+            return await self._amake_chat_completion(prompt.system, prompt.user)
+        return await self.achat_with_tools(prompt.system, prompt.user, tools)
+    
+    def stream_project_analysis(self, prompt: ProjectPrompt, tools=None) -> Iterator[str]:
+        """Stream the answer of analyze_project() as it is generated"""
+        if tools is None:
+            return self.stream_chat_completion(prompt.system, prompt.user)
+        return self.stream_chat_with_tools(prompt.system, prompt.user, tools)
+    
+    def astream_project_analysis(self, prompt: ProjectPrompt, tools=None) -> AsyncIterator[str]:
+        """Async version of stream_project_analysis()"""
+        if tools is None:
+            return self.astream_chat_completion(prompt.system, prompt.user)
+        return self.astream_chat_with_tools(prompt.system, prompt.user, tools)
+    
+    def _tool_payload(self, messages: List[Dict[str, Any]], tools, stream: bool = False) -> Dict[str, Any]:
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream,
+            "options": {
+                "temperature": 0.7,
+                "top_p": 0.9,
+                "max_tokens": 1000
+            }
+        }
+        if tools is not None:
+            payload["tools"] = tools.specs
+        return payload
+    
+    def _tool_conversation(self, system_prompt: str, user_prompt: str, tools, stream: bool = False):
+        """
+        Drive a tool-calling conversation, independent of how requests are made.
+
+        Yields ``('chat', payload, timeout)`` and expects the reply message
+        back, or ``('tool', name, arguments)`` and expects the tool result;
+        returns the final answer. The model gets at most
+        ``max_tool_iterations`` replies that call tools, then one more
+        without tools to answer, and the whole exchange must finish within
+        ``tool_timeout`` seconds. Tool conversations bypass the response
+        cache; the tool results are cached instead.
+        """
+        deadline = time.monotonic() + self.tool_timeout
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        for iteration in range(self.max_tool_iterations + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMServiceError(f"Tool calling did not finish within {self.tool_timeout} seconds")
+            final = iteration == self.max_tool_iterations
+            payload = self._tool_payload(messages, None if final else tools, stream=stream)
+            message = yield ('chat', payload, min(self.request_timeout, remaining))
             
-            if response.status_code == 200:
-                result = response.json()
-                return result['choices'][0]['message']['content']
-            else:
-                return f"Error: {response.status_code} - {response.text}"
-                
-        except requests.exceptions.RequestException as e:
-            return f"Error connecting to Ollama: {str(e)}"
-        except (KeyError, IndexError) as e:
-            return f"Error parsing response: {str(e)}"
+            calls = [] if final else (message.get('tool_calls') or [])[:MAX_TOOL_CALLS_PER_TURN]
+            if not calls:
+                return message.get('content') or ''
+            messages.append({"role": "assistant", "content": message.get('content') or '', "tool_calls": calls})
+            for call in calls:
+                function = call.get('function') or {}
+                result = yield ('tool', function.get('name'), function.get('arguments'))
+                messages.append({
+                    "role": "tool", "tool_call_id": call.get('id', ''), "name": function.get('name'), "content": result
+                })
+    
+    def _tool_reply(self, response) -> Dict[str, Any]:
+        """The assistant message of a non-streamed reply; raises LLMServiceError"""
+        if response.status_code != 200:
+            raise LLMServiceError(f"Error: {response.status_code} - {response.text}")
+        try:
+            return response.json()['choices'][0]['message']
+        except (ValueError, KeyError, IndexError) as e:
+            raise LLMServiceError(f"Error parsing response: {str(e)}") from e
+    
+    def chat_with_tools(self, system_prompt: str, user_prompt: str, tools) -> str:
+        """
+        Chat completion in which the model may call ``tools`` before it
+        answers (see _tool_conversation); raises LLMServiceError.
+        """
+        conversation = self._tool_conversation(system_prompt, user_prompt, tools)
+        try:
+            request = next(conversation)
+            while True:
+                if request[0] == 'tool':
+                    request = conversation.send(tools.call(request[1], request[2]))
+                    continue
+                response = self._post(request[1], request[2])
+                request = conversation.send(self._tool_reply(response))
+        except StopIteration as done:
+            return done.value
+    
+    async def achat_with_tools(self, system_prompt: str, user_prompt: str, tools) -> str:
+        """Async version of chat_with_tools(); tools run in a worker thread"""
+        conversation = self._tool_conversation(system_prompt, user_prompt, tools)
+        call_tool = sync_to_async(tools.call)
+        try:
+            request = next(conversation)
+            while True:
+                if request[0] == 'tool':
+                    request = conversation.send(await call_tool(request[1], request[2]))
+                    continue
+                response = await self._apost(request[1], request[2])
+                request = conversation.send(self._tool_reply(response))
+        except StopIteration as done:
+            return done.value
+    
+    def stream_chat_with_tools(self, system_prompt: str, user_prompt: str, tools) -> Iterator[str]:
+        """
+        Streamed version of chat_with_tools(): every model reply is streamed,
+        its content yielded as it arrives and its tool calls collected from
+        the deltas and run before the next reply. Raises LLMServiceError.
+        """
+        conversation = self._tool_conversation(system_prompt, user_prompt, tools, stream=True)
+        try:
+            request = next(conversation)
+            while True:
+                if request[0] == 'tool':
+                    request = conversation.send(tools.call(request[1], request[2]))
+                    continue
+                reply = _StreamedReply()
+                with closing(self._stream_deltas(request[1], request[2])) as deltas:
+                    for delta in deltas:
+                        content = reply.add(delta)
+                        if content:
+                            yield content
+                request = conversation.send(reply.message())
+        except StopIteration:
+            return
+    
+    async def astream_chat_with_tools(self, system_prompt: str, user_prompt: str, tools) -> AsyncIterator[str]:
+        """Async version of stream_chat_with_tools(); tools run in a worker thread"""
+        conversation = self._tool_conversation(system_prompt, user_prompt, tools, stream=True)
+        call_tool = sync_to_async(tools.call)
+        try:
+            request = next(conversation)
+            while True:
+                if request[0] == 'tool':
+                    request = conversation.send(await call_tool(request[1], request[2]))
+                    continue
+                reply = _StreamedReply()
+                async with aclosing(self._astream_deltas(request[1], request[2])) as deltas:
+                    async for delta in deltas:
+                        content = reply.add(delta)
+                        if content:
+                            yield content
+                request = conversation.send(reply.message())
+        except StopIteration:
+            return
     
     def analyze_text(self, text: str) -> str:
         """Analyze text using the local LLM"""
@@ -163,62 +811,102 @@ class LocalLLMService:
         )
     
     def test_connection(self) -> Dict[str, Any]:
-        """Test the connection to Ollama and return status"""
+        """Test the connection to Ollama (the best server for the model) and return status"""
+        backend = self.router.best(self.model)
         try:
             # Test basic connectivity
-            models_response = requests.get(f"{self.base_url}/models", timeout=5)
-            
-            if models_response.status_code != 200:
-                return {
-                    "status": "error",
-                    "message": f"Ollama server returned status {models_response.status_code}",
-                    "available": False
-                }
-            
-            # Test model availability
-            models = models_response.json().get('models', [])
-            model_names = [model.get('name', '') for model in models]
-            
-            if self.model not in model_names:
-                return {
-                    "status": "warning",
-                    "message": f"Model {self.model} not found. Available models: {', '.join(model_names)}",
-                    "available": False,
-                    "available_models": model_names
-                }
+            models_response = self.session.get(f"{backend.url}/models", timeout=_timeout(self.probe_timeout))
+            status, model_names = self._models_status(models_response, backend)
+            if status:
+                return status
             
             # Test chat completion
-            test_response = self._make_chat_completion(
-                "You are a helpful assistant.",
-                "Say 'Hello, Ollama is working!'"
+            test_response = self._make_chat_completion(*self._test_prompts(), use_cache=False)
+            return self._chat_test_status(test_response, model_names)
+                
+        except requests.exceptions.ConnectionError:
+            return self._connection_error_status(backend)
+        except LLMBusyError:
+            raise
+        except Exception as e:
+            return self._unexpected_error_status(e)
+    
+    async def atest_connection(self) -> Dict[str, Any]:
+        """Async version of test_connection()"""
+        backend = self.router.best(self.model)
+        try:
+            models_response = await get_async_http_client().get(
+                f"{backend.url}/models", timeout=async_timeout(self.probe_timeout)
             )
+            status, model_names = self._models_status(models_response, backend)
+            if status:
+                return status
             
-            if "Hello" in test_response or "working" in test_response.lower():
-                return {
-                    "status": "success",
-                    "message": "Ollama is working correctly",
-                    "available": True,
-                    "model": self.model,
-                    "available_models": model_names
-                }
-            else:
-                return {
-                    "status": "warning",
-                    "message": "Ollama responded but may not be working as expected",
-                    "available": True,
-                    "model": self.model,
-                    "available_models": model_names
-                }
+            test_response = await self._amake_chat_completion(*self._test_prompts(), use_cache=False)
+            return self._chat_test_status(test_response, model_names)
                 
-        except requests.exceptions.ConnectionError:
+        except httpx.ConnectError:
+            return self._connection_error_status(backend)
+        except LLMBusyError:
+            raise
+        except Exception as e:
+            return self._unexpected_error_status(e)
+    
+    def _test_prompts(self) -> Tuple[str, str]:
+        return "You are a helpful assistant.", "Say 'Hello, Ollama is working!'"
+    
+    def _models_status(self, models_response, backend: Backend) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        """Error status for a failed model listing (or None) and the installed model names"""
+        if models_response.status_code != 200:
+            backend.health.record_failure()
             return {
                 "status": "error",
-                "message": "Cannot connect to Ollama server. Make sure it's running on localhost:11434",
+                "message": f"Ollama server returned status {models_response.status_code}",
                 "available": False
+            }, []
+        
+        # Test model availability
+        models = models_response.json().get('models', [])
+        model_names = [model.get('name', '') for model in models]
+        
+        if self.model not in model_names:
+            return {
+                "status": "warning",
+                "message": f"Model {self.model} not found. Available models: {', '.join(model_names)}",
+                "available": False,
+                "available_models": model_names
+            }, model_names
+        return None, model_names
+    
+    def _chat_test_status(self, test_response: str, model_names: List[str]) -> Dict[str, Any]:
+        if "Hello" in test_response or "working" in test_response.lower():
+            return {
+                "status": "success",
+                "message": "Ollama is working correctly",
+                "available": True,
+                "model": self.model,
+                "available_models": model_names
             }
-        except Exception as e:
+        else:
             return {
-                "status": "error",
-                "message": f"Unexpected error: {str(e)}",
-                "available": False
-            } 
\ No newline at end of file
+                "status": "warning",
+                "message": "Ollama responded but may not be working as expected",
+                "available": True,
+                "model": self.model,
+                "available_models": model_names
+            }
+    
+    def _connection_error_status(self, backend: Backend) -> Dict[str, Any]:
+        backend.health.record_failure()
+        return {
+            "status": "error",
+            "message": f"Cannot connect to Ollama server. Make sure it's running at {backend.url}",
+            "available": False
+        }
+    
+    def _unexpected_error_status(self, error: Exception) -> Dict[str, Any]:
+        return {
+            "status": "error",
+            "message": f"Unexpected error: {str(error)}",
+            "available": False
+        }
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from mundi_gis.models import MundiMapProject, MundiLayer
+from mundi_gis.geojson_validator import DEFAULT_MAX_ERRORS, validate_geojson_file
 import os
 from django.conf import settings
 
@@ -8,6 +9,14 @@ from django.conf import settings
 class Command(BaseCommand):
     help = 'Check and debug layer loading issues'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-errors',
+            type=int,
+            default=DEFAULT_MAX_ERRORS,
+            help='Number of GeoJSON errors to report per layer'
+        )
+
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS('Checking layers...'))
         
@@ -42,13 +51,13 @@ class Command(BaseCommand):
                             file_size = os.path.getsize(file_path)
                             self.stdout.write(f'    File size: {file_size} bytes')
                             
-                            # Try to read as JSON
-                            import json
-                            with open(file_path, 'r') as f:
-                                data = json.load(f)
-                            self.stdout.write(f'    Valid JSON: Yes')
-                            if 'features' in data:
-                                self.stdout.write(f'    Features: {len(data["features"])}')
+                            # Validate GeoJSON a feature at a time
+                            if file_path.lower().endswith('.geojson'):
+                                report = validate_geojson_file(file_path, max_errors=options['max_errors'])
+                                self.stdout.write(f'    Valid GeoJSON: {"Yes" if report.is_valid else "No"}')
+                                self.stdout.write(f'    Features: {report.feature_count}')
+                                for line in report.summary(limit=options['max_errors']):
+                                    self.stdout.write(self.style.ERROR(f'      {line}'))
                         except Exception as e:
                             self.stdout.write(f'    Error reading file: {e}')
                 else:
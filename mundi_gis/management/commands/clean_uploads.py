@@ -0,0 +1,15 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from mundi_gis.uploads import delete_stale_uploads
+
+
+class Command(BaseCommand):
+    help = 'Abort chunked uploads that have stalled and delete their partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24,
+                            help='Abort uploads with no new chunk for this many hours (default 24)')
+
+    def handle(self, *args, **options):
+        count = delete_stale_uploads(timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f'Aborted {count} stale uploads'))
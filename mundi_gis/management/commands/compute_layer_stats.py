@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from mundi_gis.models import MundiLayer
+from mundi_gis.layer_stats import update_layer_statistics
+
+
+class Command(BaseCommand):
+    help = 'Compute or refresh precomputed statistics for uploaded layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing', action='store_true',
+                            help='Only process layers that have no statistics yet')
+
+    def handle(self, *args, **options):
+        layers = MundiLayer.objects.all()
+        if options['missing']:
+            layers = layers.filter(statistics__isnull=True)
+        
+        self.stdout.write(f'Computing statistics for {layers.count()} layers...')
+        
+        for layer in layers:
+            statistics = update_layer_statistics(layer)
+            if statistics.error:
+                self.stdout.write(self.style.WARNING(f'  - {layer.name}: {statistics.error}'))
+            else:
+                self.stdout.write(
+                    f'  - {layer.name}: {statistics.feature_count} features ({statistics.geometry_type})'
+                )
+        
+        self.stdout.write(self.style.SUCCESS('Layer statistics complete!'))
@@ -0,0 +1,73 @@
+import os
+import signal
+import socket
+import threading
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from mundi_gis.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = 'Run background job workers (layer processing, AI analysis)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2,
+                            help='Number of worker threads (default: 2)')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty (default: 1)')
+        parser.add_argument('--stale-after', type=float, default=600,
+                            help='Requeue jobs left running longer than this many seconds (default: 600)')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling forever')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        
+        def request_stop(signum, frame):
+            self.stdout.write('Stopping workers after their current job...')
+            stop.set()
+        
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        
+        requeued = requeue_stale_jobs(options['stale_after'])
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Requeued {requeued} stale jobs'))
+        
+        prefix = f'{socket.gethostname()}:{os.getpid()}'
+        threads = [
+            threading.Thread(
+                target=self._work,
+                args=(f'{prefix}:{i}', stop, options['poll_interval'], options['once']),
+                name=f'mundi-worker-{i}',
+            )
+            for i in range(max(1, options['threads']))
+        ]
+        
+        self.stdout.write(f'Starting {len(threads)} worker threads ({prefix})')
+        for thread in threads:
+            thread.start()
+        
+        # Joining with a timeout keeps the main thread responsive to signals
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        
+        self.stdout.write(self.style.SUCCESS('Workers stopped'))
+
+    def _work(self, worker_id, stop, poll_interval, once):
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                job = claim_next_job(worker_id)
+                if job is None:
+                    if once:
+                        return
+                    stop.wait(poll_interval)
+                    continue
+                
+                job = run_job(job)
+                self.stdout.write(f'[{worker_id}] {job.kind} {job.id}: {job.status}')
+        finally:
+            # Each thread has its own database connection
+            connection.close()
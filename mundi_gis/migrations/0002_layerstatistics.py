@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-17 00:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mundi_gis', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feature_count', models.IntegerField(default=0)),
+                ('geometry_types', models.JSONField(blank=True, default=dict)),
+                ('bbox', models.JSONField(blank=True, null=True)),
+                ('crs', models.CharField(blank=True, max_length=255)),
+                ('attribute_schema', models.JSONField(blank=True, default=dict)),
+                ('field_stats', models.JSONField(blank=True, default=dict)),
+                ('file_size', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+                ('layer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='mundi_gis.mundilayer')),
+            ],
+            options={
+                'verbose_name_plural': 'layer statistics',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-17 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mundi_gis', '0003_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layerstatistics',
+            name='file_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the uploaded file', max_length=64),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 
 
@@ -61,3 +62,113 @@ class MundiMapRender(models.Model):
     
     def __str__(self):
         return f"Render {self.render_id} for {self.map_project.name}"
+
+
+class LayerStatistics(models.Model):
+    """Summary of a layer's contents, computed once when the layer is ingested"""
+    layer = models.OneToOneField(MundiLayer, on_delete=models.CASCADE, related_name='statistics')
+    feature_count = models.IntegerField(default=0)
+    geometry_types = models.JSONField(default=dict, blank=True)
+    bbox = models.JSONField(null=True, blank=True)
+    crs = models.CharField(max_length=255, blank=True)
+    attribute_schema = models.JSONField(default=dict, blank=True)
+    field_stats = models.JSONField(default=dict, blank=True)
+    file_size = models.BigIntegerField(default=0)
+    file_hash = models.CharField(max_length=64, blank=True, help_text='SHA-256 of the uploaded file')
+    error = models.TextField(blank=True)
+    computed_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name_plural = 'layer statistics'
+    
+    def __str__(self):
+        return f"Statistics for {self.layer.name}"
+    
+    @property
+    def geometry_type(self):
+        """Geometry types present in the layer, most common first"""
+        if not self.geometry_types:
+            return 'Unknown'
+        ordered = sorted(self.geometry_types.items(), key=lambda item: -item[1])
+        return ', '.join(name for name, _ in ordered)
+
+
+class BackgroundJob(models.Model):
+    """A unit of work queued in the database and run by `manage.py run_workers`"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    priority = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} ({self.get_status_display()})"
+    
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCEEDED, self.STATUS_FAILED)
+
+
+class UploadSession(models.Model):
+    """A chunked, resumable layer upload in progress"""
+    STATUS_ACTIVE = 'active'
+    STATUS_COMPLETED = 'completed'
+    STATUS_ABORTED = 'aborted'
+    STATUS_CHOICES = [
+        (STATUS_ACTIVE, 'Active'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_ABORTED, 'Aborted'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    map_project = models.ForeignKey(MundiMapProject, on_delete=models.CASCADE, related_name='upload_sessions')
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    layer_type = models.CharField(max_length=20, choices=MundiLayer.LAYER_TYPES)
+    style_config = models.JSONField(default=dict, blank=True)
+    filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    received_size = models.BigIntegerField(default=0)
+    validation_state = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_ACTIVE)
+    layer = models.ForeignKey(MundiLayer, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Upload of {self.filename} ({self.received_size}/{self.total_size} bytes)"
+    
+    @property
+    def is_complete(self):
+        return self.received_size >= self.total_size
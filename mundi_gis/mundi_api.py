@@ -0,0 +1,133 @@
+import os
+import uuid
+import httpx
+import requests
+from .async_http import get_async_http_client
+
+
+# Mundi API configuration
+MUNDI_API_BASE_URL = os.getenv('MUNDI_API_BASE_URL', 'https://app.mundi.ai/api')
+MUNDI_API_KEY = os.getenv('MUNDI_API_KEY', '')
+
+
+def mundi_api_request(endpoint, method='GET', data=None, headers=None):
+    """Helper function to make requests to Mundi API"""
+    url = f"{MUNDI_API_BASE_URL}/{endpoint}"
+    
+    default_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {MUNDI_API_KEY}'
+    }
+    
+    if headers:
+        default_headers.update(headers)
+    
+    try:
+        if method.upper() == 'GET':
+            response = requests.get(url, headers=default_headers)
+        elif method.upper() == 'POST':
+            response = requests.post(url, json=data, headers=default_headers)
+        elif method.upper() == 'PUT':
+            response = requests.put(url, json=data, headers=default_headers)
+        elif method.upper() == 'DELETE':
+            response = requests.delete(url, headers=default_headers)
+        
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        return {'error': str(e)}
+
+
+async def amundi_api_request(endpoint, method='GET', data=None, headers=None):
+    """Async version of mundi_api_request() on the pooled httpx client"""
+    url = f"{MUNDI_API_BASE_URL}/{endpoint}"
+    
+    default_headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {MUNDI_API_KEY}'
+    }
+    
+    if headers:
+        default_headers.update(headers)
+    
+    try:
+        json_data = data if method.upper() in ('POST', 'PUT') else None
+        response = await get_async_http_client().request(method.upper(), url, json=json_data, headers=default_headers)
+        response.raise_for_status()
+        return response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        return {'error': str(e)}
+
+
+def uses_mundi_api(project):
+    """Whether a project is linked to a remote Mundi map"""
+    return bool(MUNDI_API_KEY) and not project.mundi_project_id.startswith('local_')
+
+
+class MultipartFileBody:
+    """
+    A multipart/form-data body holding one file field, read from disk as it
+    is sent. It has a length, so requests sends a Content-Length instead of
+    building the whole body in memory as it does for ``files=``.
+    """
+    
+    def __init__(self, field_name, file_path, content_type='application/octet-stream'):
+        self.boundary = uuid.uuid4().hex
+        filename = os.path.basename(file_path).replace('"', '%22')
+        self._head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode('utf-8')
+        self._tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self._file = open(file_path, 'rb')
+        self._length = len(self._head) + os.fstat(self._file.fileno()).st_size + len(self._tail)
+        self._pending = self._head
+        self._tail_sent = False
+    
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+    
+    def __len__(self):
+        return self._length
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        out = b''
+        while len(out) < size:
+            if self._pending:
+                take = self._pending[:size - len(out)]
+                self._pending = self._pending[len(take):]
+                out += take
+                continue
+            data = self._file.read(size - len(out))
+            if data:
+                out += data
+            elif not self._tail_sent:
+                self._pending = self._tail
+                self._tail_sent = True
+            else:
+                break
+        return out
+    
+    def close(self):
+        self._file.close()
+
+
+def upload_layer_file(project, file_path):
+    """Upload a layer file to the project's Mundi map, streamed from disk; raises RequestException on failure"""
+    upload_url = f"{MUNDI_API_BASE_URL}/maps/{project.mundi_project_id}/layers"
+    
+    body = MultipartFileBody('file', file_path)
+    headers = {
+        'Authorization': f'Bearer {MUNDI_API_KEY}',
+        'Content-Type': body.content_type,
+    }
+    try:
+        response = requests.post(upload_url, data=body, headers=headers)
+    finally:
+        body.close()
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,547 @@
+"""
+Level-of-detail octree for LAS/LAZ point cloud layers.
+
+At ingest every point of the cloud is sorted along a Morton (Z-order) curve
+over a cube enclosing it, and the octree is filled top-down: each node keeps
+at most one point per cell of a 64x64x64 grid over its own cube (and at most
+``NODE_CAPACITY`` points), and the rest are passed on to its eight children.
+Every level is therefore an evenly spread sample that the levels below it
+refine, and a viewer can stop at any depth.
+
+The sort is external, so a build's memory does not grow with the cloud: the
+points are written to temporary files by octant, an octant too large to sort
+at once is split by its own octants, and the sorted runs are appended to one
+file. The nodes are then built from ranges of that file, read through a
+memory map a chunk at a time.
+
+The nodes are written to one file beside the upload (``<file>.octree``):
+fixed-size point records, node by node, followed by a table of fixed-size
+node records, with a small manifest (``<file>.octree.json``) recording the
+bounds, quantization and which source file (mtime and size) it was built
+from.
+
+A query walks the octree coarse to fine, keeping the nodes that intersect a
+bbox or view frustum, until a point budget is reached, so a request returns
+a bounded number of points however large the cloud is.
+"""
+
+import heapq
+import json
+import math
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from .readers import ReaderError, iter_las_points, las_crs, read_las_header
+
+
+POINT_CLOUD_EXTENSIONS = ('.las', '.laz')
+
+OCTREE_VERSION = 1
+
+# Most points a node keeps before passing the rest to its children
+NODE_CAPACITY = 8192
+
+# Each node keeps one point per cell of a 2**_SAMPLING_BITS grid per axis
+_SAMPLING_BITS = 6
+_MORTON_BITS = 21
+MAX_DEPTH = _MORTON_BITS - _SAMPLING_BITS
+
+DEFAULT_POINT_BUDGET = 100_000
+MAX_POINT_BUDGET = 1_000_000
+
+# Coordinates are stored as offsets from the cube's minimum corner, in steps of the manifest scale
+POINT_DTYPE = np.dtype([
+    ('x', '<u4'), ('y', '<u4'), ('z', '<u4'),
+    ('intensity', '<u2'), ('classification', 'u1'), ('reserved', 'u1'),
+])
+
+_MAGIC = b'MOCT'
+_HEADER = struct.Struct('<4sIIQ')
+# Byte offset and count of a node's points, its cell at its depth, and which children it has
+_NODE = struct.Struct('<QIIIIBB2x')
+_NODE_DTYPE = np.dtype({
+    'names': ['offset', 'count', 'ix', 'iy', 'iz', 'depth', 'child_mask'],
+    'formats': ['<u8', '<u4', '<u4', '<u4', '<u4', 'u1', 'u1'],
+    'offsets': [0, 8, 12, 16, 20, 24, 25],
+    'itemsize': _NODE.size,
+})
+
+# A point as sorted while building: its position on the curve, then its record
+_SORT_DTYPE = np.dtype([('code', '<u8'), ('point', POINT_DTYPE)])
+
+# Most points sorted in memory at once; larger octants are split first
+_SORT_POINTS = 1 << 21
+
+# Points read at once while choosing a node's sample
+_SCAN_POINTS = 1 << 20
+
+_CACHE_SIZE = 16
+
+
+def is_point_cloud(file_path: str) -> bool:
+    return os.path.splitext(file_path.lower())[1] in POINT_CLOUD_EXTENSIONS
+
+
+def octree_path(file_path: str) -> str:
+    return f'{file_path}.octree'
+
+
+def manifest_path(file_path: str) -> str:
+    return f'{file_path}.octree.json'
+
+
+def _signature(file_path: str) -> List[int]:
+    stat = os.stat(file_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+# ---------------------------------------------------------------------------
+# Building
+# ---------------------------------------------------------------------------
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    """Move the low 21 bits of each value to every third bit"""
+    v = values.astype(np.uint64) & np.uint64(0x1FFFFF)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1F00000000FFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1F0000FF0000FF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return v
+
+
+def _point_bounds(file_path: str) -> Tuple[int, np.ndarray, np.ndarray]:
+    """The number of points of a LAS/LAZ file and their actual (min xyz, max xyz)"""
+    count = 0
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for xyz, _, _ in iter_las_points(file_path):
+        if len(xyz):
+            count += len(xyz)
+            low = np.minimum(low, xyz.min(axis=0))
+            high = np.maximum(high, xyz.max(axis=0))
+    if not count:
+        raise ReaderError('The point cloud has no points')
+    return count, low, high
+
+
+def _read_sort_records(path: str) -> Iterator[np.ndarray]:
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(_SORT_POINTS * _SORT_DTYPE.itemsize)
+            if not data:
+                break
+            yield np.frombuffer(data, _SORT_DTYPE)
+
+
+def _split_by_octant(batches: Iterable[np.ndarray], depth: int, directory: str) -> List[Tuple[str, int]]:
+    """Write points to eight files by their octant at ``depth``, in their order; returns (path, count) per octant"""
+    shift = np.uint64(3 * (_MORTON_BITS - depth - 1))
+    files = [tempfile.NamedTemporaryFile(dir=directory, delete=False) for _ in range(8)]
+    counts = [0] * 8
+    try:
+        for records in batches:
+            octants = (records['code'] >> shift) & np.uint64(7)
+            order = np.argsort(octants, kind='stable')
+            bounds = np.searchsorted(octants[order], np.arange(9, dtype=np.uint64))
+            records = records[order]
+            for c in range(8):
+                files[c].write(records[bounds[c]:bounds[c + 1]].tobytes())
+                counts[c] += int(bounds[c + 1] - bounds[c])
+    finally:
+        for f in files:
+            f.close()
+    return [(f.name, count) for f, count in zip(files, counts)]
+
+
+def _append_sorted(path: str, count: int, depth: int, directory: str, points_out, codes_out):
+    """Append the points of an octant file to the outputs in curve order, then remove it"""
+    if count <= _SORT_POINTS or depth >= _MORTON_BITS:
+        records = np.fromfile(path, _SORT_DTYPE)
+        os.remove(path)
+        # A stable sort keeps points at the same position in file order
+        records = records[np.argsort(records['code'], kind='stable')]
+        points_out.write(records['point'].tobytes())
+        codes_out.write(records['code'].tobytes())
+        return
+    octants = _split_by_octant(_read_sort_records(path), depth, directory)
+    os.remove(path)
+    for octant_path, octant_count in octants:
+        _append_sorted(octant_path, octant_count, depth + 1, directory, points_out, codes_out)
+
+
+class _OctreeWriter:
+    """Writes each node's points as it is built and collects the node table"""
+
+    def __init__(self, out, codes: np.ndarray, points: np.ndarray):
+        self.out = out
+        self.codes = codes
+        self.points = points
+        self.nodes: List[Tuple] = []
+        self.offset = _HEADER.size
+
+    def _chunks(self, start: int, end: int, excluded: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+        """(first position, mask of the points not excluded) for each chunk of [start, end)"""
+        for chunk_start in range(start, end, _SCAN_POINTS):
+            chunk_end = min(end, chunk_start + _SCAN_POINTS)
+            keep = np.ones(chunk_end - chunk_start, dtype=bool)
+            keep[excluded[np.searchsorted(excluded, chunk_start):np.searchsorted(excluded, chunk_end)] - chunk_start] = False
+            yield chunk_start, keep
+
+    def _write(self, data: bytes):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def build(self, start: int, end: int, excluded: np.ndarray, depth: int, ix: int, iy: int, iz: int) -> int:
+        """
+        Write the node holding the points at [start, end) of the curve order,
+        except the sorted positions ``excluded`` that its ancestors took, and
+        its subtree; returns its id
+        """
+        node_id = len(self.nodes)
+        self.nodes.append([self.offset, end - start - len(excluded), ix, iy, iz, depth, 0])
+        if end - start - len(excluded) <= NODE_CAPACITY or depth >= MAX_DEPTH:
+            for chunk_start, keep in self._chunks(start, end, excluded):
+                self._write(self.points[chunk_start:chunk_start + len(keep)][keep].tobytes())
+            return node_id
+
+        # The first point of each occupied sampling cell, thinned evenly along the curve if too many
+        shift = np.uint64(3 * (_MORTON_BITS - depth - _SAMPLING_BITS))
+        firsts, previous = [], None
+        for chunk_start, keep in self._chunks(start, end, excluded):
+            positions = np.flatnonzero(keep)
+            cells = self.codes[chunk_start:chunk_start + len(keep)][keep] >> shift
+            if not len(cells):
+                continue
+            new = np.r_[cells[0] != previous, cells[1:] != cells[:-1]]
+            firsts.append(positions[new] + chunk_start)
+            previous = cells[-1]
+        taken = np.concatenate(firsts)
+        if len(taken) > NODE_CAPACITY:
+            taken = taken[np.linspace(0, len(taken) - 1, NODE_CAPACITY).astype(np.intp)]
+        self.nodes[node_id][1] = len(taken)
+        self._write(self.points[taken].tobytes())
+
+        # The node's points share their first ``depth`` octants, so each child's are one contiguous run
+        excluded = np.union1d(excluded, taken)
+        child_bits = 3 * (_MORTON_BITS - depth - 1)
+        base = int(self.codes[start]) >> (child_bits + 3) << (child_bits + 3)
+        bounds = start + np.searchsorted(
+            self.codes[start:end], np.array([base + (c << child_bits) for c in range(8)], dtype=np.uint64)
+        )
+        bounds = np.r_[bounds, end]
+        for c in range(8):
+            low, high = np.searchsorted(excluded, bounds[c]), np.searchsorted(excluded, bounds[c + 1])
+            if bounds[c + 1] - bounds[c] > high - low:
+                self.nodes[node_id][6] |= 1 << c
+                self.build(int(bounds[c]), int(bounds[c + 1]), excluded[low:high], depth + 1,
+                           ix * 2 + (c & 1), iy * 2 + (c >> 1 & 1), iz * 2 + (c >> 2 & 1))
+        return node_id
+
+
+def _sort_batches(file_path: str, count: int, low: np.ndarray, size: float,
+                  scale: np.ndarray) -> Iterator[np.ndarray]:
+    """The points of a cloud as quantized records with their curve position, a batch at a time"""
+    start = 0
+    for xyz, intensity, classification in iter_las_points(file_path):
+        end = min(count, start + len(xyz))
+        xyz = xyz[:end - start]
+        records = np.zeros(end - start, _SORT_DTYPE)
+        batch = records['point']
+        quantized = np.rint((xyz - low) / scale).astype(np.uint32)
+        batch['x'], batch['y'], batch['z'] = quantized[:, 0], quantized[:, 1], quantized[:, 2]
+        batch['intensity'] = intensity[:end - start]
+        batch['classification'] = classification[:end - start]
+        cells = np.minimum(((xyz - low) / size * 2 ** _MORTON_BITS).astype(np.int64), 2 ** _MORTON_BITS - 1)
+        records['code'] = _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1)) \
+            | (_spread_bits(cells[:, 2]) << np.uint64(2))
+        start = end
+        yield records
+    if start < count:
+        raise ReaderError('The point cloud changed while it was being read')
+
+
+def write_octree(file_path: str) -> Dict[str, Any]:
+    """Build the octree of a point cloud, write it and its manifest, and return the manifest"""
+    signature = _signature(file_path)
+    header = read_las_header(file_path)
+    # A first pass finds the cube, so the second can quantize each batch as it is read
+    count, low, high = _point_bounds(file_path)
+    size = float((high - low).max()) or 1.0
+    # Keep the file's precision unless the cube is too large for 32-bit offsets
+    scale = np.maximum(header.scale, size / (2 ** 32 - 1))
+
+    tmp_path = f'{octree_path(file_path)}.{os.getpid()}.tmp'
+    try:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_path))) as directory:
+            points_path, codes_path = os.path.join(directory, 'points'), os.path.join(directory, 'codes')
+            with open(points_path, 'wb') as points_out, open(codes_path, 'wb') as codes_out:
+                for octant_path, octant_count in _split_by_octant(
+                        _sort_batches(file_path, count, low, size, scale), 0, directory):
+                    _append_sorted(octant_path, octant_count, 1, directory, points_out, codes_out)
+
+            with open(tmp_path, 'wb') as out:
+                out.write(b'\0' * _HEADER.size)
+                writer = _OctreeWriter(
+                    out, np.memmap(codes_path, np.uint64, 'r'), np.memmap(points_path, POINT_DTYPE, 'r')
+                )
+                writer.build(0, count, np.zeros(0, np.int64), 0, 0, 0, 0)
+                for node in writer.nodes:
+                    out.write(_NODE.pack(*node))
+                out.seek(0)
+                out.write(_HEADER.pack(_MAGIC, OCTREE_VERSION, len(writer.nodes), writer.offset))
+                # Release the memory maps before their files are removed
+                writer.codes = writer.points = None
+        os.replace(tmp_path, octree_path(file_path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    manifest = {
+        'signature': signature,
+        'version': OCTREE_VERSION,
+        'crs': las_crs(file_path, header),
+        'bounds': low.tolist() + high.tolist(),
+        'cube': {'min': low.tolist(), 'size': size},
+        'scale': scale.tolist(),
+        'point_count': count,
+        'node_count': len(writer.nodes),
+        'depth': max(node[5] for node in writer.nodes),
+    }
+    # The manifest goes last so it never describes an octree that is not written yet
+    tmp_path = f'{manifest_path(file_path)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(file_path))
+    return manifest
+
+
+# ---------------------------------------------------------------------------
+# Queries
+# ---------------------------------------------------------------------------
+
+def parse_bounds(raw: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Parse 'minx,miny,maxx,maxy' or 'minx,miny,minz,maxx,maxy,maxz'; raises ValueError if malformed"""
+    values = [float(v) for v in raw.split(',')]
+    if len(values) not in (4, 6) or not all(math.isfinite(v) for v in values):
+        raise ValueError('bbox must be minx,miny,maxx,maxy or minx,miny,minz,maxx,maxy,maxz')
+    if len(values) == 4:
+        values = values[:2] + [-math.inf] + values[2:] + [math.inf]
+    low, high = np.array(values[:3]), np.array(values[3:])
+    if (low > high).any():
+        raise ValueError('bbox minimums must not exceed its maximums')
+    return low, high
+
+
+def parse_frustum(raw: str) -> np.ndarray:
+    """Parse planes 'a,b,c,d,...' (points inside have ax+by+cz+d >= 0); raises ValueError if malformed"""
+    values = [float(v) for v in raw.split(',')]
+    if not values or len(values) % 4 or len(values) > 4 * 8 or not all(math.isfinite(v) for v in values):
+        raise ValueError('frustum must be up to eight planes of four numbers a,b,c,d')
+    return np.array(values).reshape(-1, 4)
+
+
+def parse_camera(raw: str) -> np.ndarray:
+    values = [float(v) for v in raw.split(',')]
+    if len(values) != 3 or not all(math.isfinite(v) for v in values):
+        raise ValueError('camera must be three numbers: x,y,z')
+    return np.array(values)
+
+
+class PointQueryResult:
+    """The points selected by a query, still quantized, and how they were chosen"""
+
+    def __init__(self, points: np.ndarray, nodes: List[int], complete: bool, spacing: Optional[float]):
+        self.points = points
+        self.nodes = nodes
+        self.complete = complete
+        self.spacing = spacing
+
+
+class PointCloudOctree:
+    """Reads the nodes of a point cloud's octree file"""
+
+    def __init__(self, file_path: str, manifest: Dict[str, Any]):
+        self.path = octree_path(file_path)
+        self.manifest = manifest
+        self.scale = np.array(manifest['scale'])
+        self.origin = np.array(manifest['cube']['min'])
+        self.size = manifest['cube']['size']
+        with open(self.path, 'rb') as f:
+            magic, version, node_count, table_offset = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or version != OCTREE_VERSION:
+                raise ValueError('Not a current point cloud octree file')
+            f.seek(table_offset)
+            self.nodes = np.frombuffer(f.read(node_count * _NODE.size), _NODE_DTYPE, node_count)
+        self.children = self._children()
+
+    def _children(self) -> List[List[int]]:
+        # Nodes are stored depth first, so a node's children follow it in child order
+        children: List[List[int]] = [[] for _ in range(len(self.nodes))]
+        stack: List[int] = []
+        for node_id in range(len(self.nodes)):
+            depth = self.nodes[node_id]['depth']
+            while stack and self.nodes[stack[-1]]['depth'] >= depth:
+                stack.pop()
+            if stack:
+                children[stack[-1]].append(node_id)
+            stack.append(node_id)
+        return children
+
+    def node_bounds(self, node_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        node = self.nodes[node_id]
+        size = self.size / 2 ** int(node['depth'])
+        low = self.origin + size * np.array([node['ix'], node['iy'], node['iz']], dtype=np.float64)
+        return low, low + size
+
+    def read_node(self, node_id: int) -> np.ndarray:
+        node = self.nodes[node_id]
+        with open(self.path, 'rb') as f:
+            f.seek(int(node['offset']))
+            data = f.read(int(node['count']) * POINT_DTYPE.itemsize)
+        return np.frombuffer(data, POINT_DTYPE)
+
+    def coordinates(self, points: np.ndarray) -> np.ndarray:
+        """Real (x, y, z) coordinates of quantized point records"""
+        return np.column_stack([points['x'], points['y'], points['z']]) * self.scale + self.origin
+
+    def query(self, bounds: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+              planes: Optional[np.ndarray] = None, camera: Optional[np.ndarray] = None,
+              budget: int = DEFAULT_POINT_BUDGET) -> PointQueryResult:
+        """
+        The points inside ``bounds`` and ``planes``, taking whole nodes coarse
+        to fine (or, with a camera position, largest on screen first) until the
+        next one would exceed ``budget`` points. A budget too small for the
+        first node gets an even sample of it.
+        """
+        selected, nodes = [], []
+        count = 0
+        complete = True
+        spacing = None
+        heap = [(0.0, 0)]
+        while heap:
+            _, node_id = heapq.heappop(heap)
+            low, high = self.node_bounds(node_id)
+            if bounds is not None and ((high < bounds[0]).any() or (low > bounds[1]).any()):
+                continue
+            if planes is not None:
+                # The corner of the box furthest along each plane's normal
+                corners = np.where(planes[:, :3] >= 0, high, low)
+                if ((corners * planes[:, :3]).sum(axis=1) + planes[:, 3] < 0).any():
+                    continue
+
+            points = self.read_node(node_id)
+            if bounds is not None or planes is not None:
+                xyz = self.coordinates(points)
+                inside = np.ones(len(points), dtype=bool)
+                if bounds is not None:
+                    inside &= ((xyz >= bounds[0]) & (xyz <= bounds[1])).all(axis=1)
+                if planes is not None:
+                    inside &= (xyz @ planes[:, :3].T + planes[:, 3] >= 0).all(axis=1)
+                points = points[inside]
+            if count + len(points) > budget:
+                complete = False
+                if not selected:
+                    # A budget smaller than the root still gets an even sample of it
+                    selected.append(points[np.linspace(0, len(points) - 1, budget).astype(np.intp)])
+                    nodes.append(node_id)
+                break
+
+            selected.append(points)
+            nodes.append(node_id)
+            count += len(points)
+            node_spacing = (high[0] - low[0]) / 2 ** _SAMPLING_BITS
+            spacing = node_spacing if spacing is None else min(spacing, node_spacing)
+            for child in self.children[node_id]:
+                heapq.heappush(heap, (self._priority(child, camera), child))
+
+        points = np.concatenate(selected) if selected else np.zeros(0, POINT_DTYPE)
+        return PointQueryResult(points, nodes, complete, spacing)
+
+    def _priority(self, node_id: int, camera: Optional[np.ndarray]) -> float:
+        if camera is None:
+            return float(self.nodes[node_id]['depth'])
+        low, high = self.node_bounds(node_id)
+        distance = float(np.linalg.norm(np.clip(camera, low, high) - camera))
+        # Nodes that would cover more of the screen come first
+        return -(high[0] - low[0]) / max(distance, 1e-9)
+
+    def info(self) -> Dict[str, Any]:
+        return {key: value for key, value in self.manifest.items() if key != 'signature'}
+
+
+def _load_manifest(file_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(manifest_path(file_path), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('signature') != _signature(file_path) or manifest.get('version') != OCTREE_VERSION:
+        return None
+    return manifest
+
+
+_octree_cache: OrderedDict = OrderedDict()
+_octree_cache_lock = threading.Lock()
+_build_locks: Dict[str, threading.Lock] = {}
+
+
+def _cache(file_path: str, signature: List[int], octree: PointCloudOctree) -> PointCloudOctree:
+    with _octree_cache_lock:
+        _octree_cache[file_path] = (signature, octree)
+        _octree_cache.move_to_end(file_path)
+        while len(_octree_cache) > _CACHE_SIZE:
+            evicted, _ = _octree_cache.popitem(last=False)
+            _build_locks.pop(evicted, None)
+    return octree
+
+
+def _find_octree(file_path: str) -> Optional[PointCloudOctree]:
+    signature = _signature(file_path)
+    with _octree_cache_lock:
+        cached = _octree_cache.get(file_path)
+        if cached and cached[0] == signature:
+            _octree_cache.move_to_end(file_path)
+            return cached[1]
+    manifest = _load_manifest(file_path)
+    if manifest is None:
+        return None
+    return _cache(file_path, signature, PointCloudOctree(file_path, manifest))
+
+
+def get_octree(file_path: str) -> PointCloudOctree:
+    """A point cloud's octree, (re)building it if it is missing or stale; raises ReaderError"""
+    octree = _find_octree(file_path)
+    if octree is not None:
+        return octree
+
+    with _octree_cache_lock:
+        build_lock = _build_locks.setdefault(file_path, threading.Lock())
+    with build_lock:
+        # Another thread may have finished the build while this one waited
+        octree = _find_octree(file_path)
+        if octree is None:
+            try:
+                manifest = write_octree(file_path)
+            except (OSError, struct.error) as e:
+                raise ReaderError(f'Could not read {os.path.basename(file_path)}: {e}') from e
+            octree = _cache(file_path, manifest['signature'], PointCloudOctree(file_path, manifest))
+    return octree
+
+
+def points_json(octree: PointCloudOctree, result: PointQueryResult) -> Dict[str, List]:
+    """The selected points as columns of real coordinates and attributes"""
+    xyz = octree.coordinates(result.points)
+    decimals = max(0, math.ceil(-math.log10(float(octree.scale.min()))))
+    xyz = np.round(xyz, decimals)
+    return {
+        'x': xyz[:, 0].tolist(),
+        'y': xyz[:, 1].tolist(),
+        'z': xyz[:, 2].tolist(),
+        'intensity': result.points['intensity'].tolist(),
+        'classification': result.points['classification'].tolist(),
+    }
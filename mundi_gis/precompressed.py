@@ -0,0 +1,197 @@
+"""
+Precompressed layer data responses.
+
+The ``layer_data`` body of a layer, and of each of its simplified zoom
+levels, is compressed once at ingest into gzip and (when the optional
+``brotli`` package is installed) brotli files beside the upload. The view
+negotiates ``Accept-Encoding`` and streams the matching file as-is, so no
+request pays for compression or sends the uncompressed GeoJSON.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from .columnar import get_columnar_layer
+from .simplify import PYRAMID_ZOOMS, pyramid_level_path
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip variants are written
+    brotli = None
+
+
+GZIP_LEVEL = 9
+
+# Quality 11 is only marginally smaller and many times slower on large layers
+BROTLI_QUALITY = 9
+
+_SUFFIXES = {'br': 'br', 'gzip': 'gz'}
+
+# Preferred first when the client accepts several
+_PREFERENCE = ('br', 'gzip')
+
+
+def layer_metadata(layer) -> Dict[str, Any]:
+    """The members that wrap a layer's GeoJSON in the layer_data response"""
+    return {
+        'layer_id': str(layer.id),
+        'layer_name': layer.name,
+        'layer_type': layer.layer_type,
+    }
+
+
+def layer_data_chunks(layer, data_path: str) -> Iterator[bytes]:
+    """The layer_data response body, serialized from the columnar copy of data_path"""
+    columnar = get_columnar_layer(data_path)
+    metadata = json.dumps(layer_metadata(layer)).encode('utf-8')
+    yield metadata[:-1] + b', "geojson": '
+    yield from columnar.geojson_chunks()
+    yield b'}'
+
+
+def manifest_path(data_path: str) -> str:
+    return f'{data_path}.response.json'
+
+
+def encoded_path(data_path: str, encoding: str) -> str:
+    return f'{data_path}.response.{_SUFFIXES[encoding]}'
+
+
+def _signature(data_path: str, layer) -> Dict[str, Any]:
+    # The body embeds the layer's metadata, so a rename invalidates it too
+    stat = os.stat(data_path)
+    metadata = json.dumps(layer_metadata(layer), sort_keys=True).encode('utf-8')
+    return {
+        'file': [stat.st_mtime_ns, stat.st_size],
+        'metadata': hashlib.sha256(metadata).hexdigest(),
+    }
+
+
+def _load_manifest(layer, data_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(manifest_path(data_path), 'r') as f:
+            manifest = json.load(f)
+        signature = _signature(data_path, layer)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('signature') != signature:
+        return None
+    return manifest
+
+
+class _Writer:
+    """Streams chunks into one compressed file"""
+
+    def __init__(self, encoding: str, path: str):
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.raw = open(self.tmp_path, 'wb')
+        if encoding == 'gzip':
+            # mtime=0 keeps the output byte-identical across rebuilds
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+            self.compressor = None
+        else:
+            self.stream = None
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def write(self, chunk: bytes):
+        if self.stream is not None:
+            self.stream.write(chunk)
+        else:
+            self.raw.write(self.compressor.process(chunk))
+
+    def close(self, commit: bool = True):
+        if self.stream is not None:
+            self.stream.close()
+        elif commit:
+            self.raw.write(self.compressor.finish())
+        self.raw.close()
+        if commit:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_precompressed(layer, data_path: str) -> Dict[str, Any]:
+    """Compress the layer_data body for data_path in every available encoding and return the manifest"""
+    signature = _signature(data_path, layer)
+    encodings = [encoding for encoding in _PREFERENCE if encoding != 'br' or brotli is not None]
+    writers = {encoding: _Writer(encoding, encoded_path(data_path, encoding)) for encoding in encodings}
+
+    size = 0
+    try:
+        for chunk in layer_data_chunks(layer, data_path):
+            size += len(chunk)
+            for writer in writers.values():
+                writer.write(chunk)
+    except BaseException:
+        for writer in writers.values():
+            writer.close(commit=False)
+        raise
+    for writer in writers.values():
+        writer.close()
+
+    manifest = {
+        'signature': signature,
+        'bytes': size,
+        'encodings': {
+            encoding: {
+                'file': os.path.basename(writer.path),
+                'bytes': os.path.getsize(writer.path),
+            }
+            for encoding, writer in writers.items()
+        },
+    }
+    # The manifest goes last so it never points at files that are not written yet
+    tmp_path = f'{manifest_path(data_path)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(data_path))
+    return manifest
+
+
+def precompress_layer(layer, file_path: str) -> List[str]:
+    """Precompress a layer's responses for its upload and every pyramid level; returns the encodings written"""
+    manifest = write_precompressed(layer, file_path)
+    level_paths = {pyramid_level_path(file_path, zoom) for zoom in PYRAMID_ZOOMS} - {file_path}
+    for level_path in sorted(level_paths):
+        write_precompressed(layer, level_path)
+    return list(manifest['encodings'])
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Map each content-coding in an Accept-Encoding header to its q-value"""
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def find_precompressed(layer, data_path: str, accept_encoding: str) -> Optional[Tuple[str, str]]:
+    """(path, encoding) of a current precompressed body the client accepts, or None"""
+    accepted = parse_accept_encoding(accept_encoding or '')
+    if not accepted:
+        return None
+    manifest = _load_manifest(layer, data_path)
+    if manifest is None:
+        return None
+    for encoding in _PREFERENCE:
+        if encoding in manifest['encodings'] and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            path = os.path.join(os.path.dirname(data_path), manifest['encodings'][encoding]['file'])
+            if os.path.exists(path):
+                return path, encoding
+    return None
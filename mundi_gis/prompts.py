@@ -0,0 +1,171 @@
+"""
+Token-budgeted prompts for questions about a whole project.
+
+The instructions live in a constant system prompt, so every project question
+starts with the same tokens and Ollama reuses its cached prefix instead of
+re-reading them. The variable part (project details, layer summaries and the
+question) goes in the user message. Layer summaries are ranked by relevance
+to the question, shortened or left out to fit OLLAMA_PROMPT_TOKEN_BUDGET,
+and listed in project order, so questions about the same project also share
+the layer block.
+"""
+
+import re
+from typing import Any, Dict, List, Optional
+from django.conf import settings
+
+
+PROJECT_SYSTEM_PROMPT = """You are Kue, a GIS (Geographic Information System) expert assistant. You answer questions about a map project and its data layers.
+Provide a detailed, helpful response that demonstrates your GIS expertise. If the question is about data analysis, suggest what insights could be gained. If it's about styling, provide specific recommendations. If it's about the project structure, explain the components and their purposes."""
+
+PROJECT_TOOLS_SYSTEM_PROMPT = PROJECT_SYSTEM_PROMPT + """
+You can call tools that compute facts about the project's layers: the layer list, layer statistics, feature counts, attribute summaries and counts of features inside polygons.
+Whenever a question involves numbers, counts, extents or attribute values, call the tools and base your answer on their results instead of guessing. Quote the computed values in your answer."""
+
+# Longest project description, layer description and question kept, in tokens
+MAX_DESCRIPTION_TOKENS = 120
+MAX_QUESTION_TOKENS = 400
+
+# Attributes named in a layer's full summary
+MAX_SUMMARY_ATTRIBUTES = 12
+
+_TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+_TERM_PATTERN = re.compile(r'[a-z0-9]{3,}')
+_STOP_WORDS = frozenset((
+    'the', 'and', 'for', 'are', 'how', 'many', 'much', 'what', 'which', 'with', 'this', 'that', 'there',
+    'from', 'does', 'layer', 'layers', 'project', 'map', 'show', 'tell', 'about', 'into', 'have', 'has',
+))
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimated token count of text: one per symbol and per four characters of
+    a word, which errs slightly high for the SentencePiece vocabularies of
+    the local models
+    """
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PATTERN.findall(text))
+
+
+def truncate_tokens(text: str, limit: int) -> str:
+    """text cut to at most about limit tokens, at a token boundary"""
+    used = 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        used += (len(match.group()) + 3) // 4
+        if used > limit:
+            return text[:match.start()].rstrip() + '...'
+    return text
+
+
+class ProjectPrompt:
+    """System and user messages for a project question, and what went into them"""
+
+    def __init__(self, system: str, user: str, layers_included: int, layers_omitted: int):
+        self.system = system
+        self.user = user
+        self.tokens = count_tokens(system) + count_tokens(user)
+        self.layers_included = layers_included
+        self.layers_omitted = layers_omitted
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'tokens': self.tokens,
+            'layers_included': self.layers_included,
+            'layers_omitted': self.layers_omitted,
+        }
+
+
+def _layer_type(layer: Dict[str, Any]) -> str:
+    return str(layer.get('layer_type') or layer.get('type') or 'Unknown')
+
+
+def _compact_summary(layer: Dict[str, Any]) -> str:
+    details = [_layer_type(layer)]
+    if layer.get('geometry_type') not in (None, '', 'Unknown'):
+        details.append(str(layer['geometry_type']))
+    if layer.get('feature_count') not in (None, '', 'Unknown'):
+        details.append(f"{layer['feature_count']} features")
+    return f"- {layer.get('name', 'Unknown')} ({', '.join(details)})"
+
+
+def _full_summary(layer: Dict[str, Any]) -> str:
+    summary = _compact_summary(layer)
+    if layer.get('description'):
+        summary += f": {truncate_tokens(str(layer['description']), MAX_DESCRIPTION_TOKENS)}"
+    attributes = layer.get('attributes')
+    if isinstance(attributes, dict) and attributes:
+        names = [f'{name} ({kind})' for name, kind in list(attributes.items())[:MAX_SUMMARY_ATTRIBUTES]]
+        more = len(attributes) - len(names)
+        summary += f"\n  Attributes: {', '.join(names)}" + (f' and {more} more' if more > 0 else '')
+    if layer.get('bbox'):
+        summary += f"\n  Extent (minx, miny, maxx, maxy): {layer['bbox']}"
+    if layer.get('crs'):
+        summary += f"; CRS: {layer['crs']}"
+    return summary
+
+
+def _relevance(layer: Dict[str, Any], terms: set) -> int:
+    """How many question terms a layer mentions; its name counts three times"""
+    if not terms:
+        return 0
+    name = set(_TERM_PATTERN.findall(str(layer.get('name', '')).lower()))
+    text = ' '.join(str(v) for v in (layer.get('description'), _layer_type(layer), layer.get('geometry_type')))
+    text += ' ' + ' '.join(layer.get('attributes') or {}) if isinstance(layer.get('attributes'), dict) else ''
+    other = set(_TERM_PATTERN.findall(text.lower()))
+    return 3 * len(terms & name) + len(terms & other)
+
+
+def build_project_prompt(project_info: Dict[str, Any], question: str, tools: bool = False,
+                         budget: Optional[int] = None) -> ProjectPrompt:
+    """
+    The prompts for a question about a project, fitted to ``budget`` tokens
+    (OLLAMA_PROMPT_TOKEN_BUDGET by default).
+
+    ``project_info`` has the project's name, description, layer_count and
+    layers, each a dict like layer_stats.layer_analysis_info() returns (or
+    just name, type and description). Every layer gets a one-line summary in
+    order of relevance while they fit, then the most relevant get their full
+    summary; the rest are counted but not listed.
+    """
+    budget = budget or getattr(settings, 'OLLAMA_PROMPT_TOKEN_BUDGET', 1500)
+    system = PROJECT_TOOLS_SYSTEM_PROMPT if tools else PROJECT_SYSTEM_PROMPT
+    layers: List[Dict[str, Any]] = [
+        layer for layer in project_info.get('layers') or [] if isinstance(layer, dict)
+    ]
+
+    description = truncate_tokens(str(project_info.get('description') or 'No description'), MAX_DESCRIPTION_TOKENS)
+    header = (
+        f"Project: {project_info.get('name', 'Unknown')}\n"
+        f"Description: {description}\n"
+        f"Number of Layers: {project_info.get('layer_count', len(layers))}\n"
+        f"\nLayers:\n"
+    )
+    footer = f"\n\nUser Question: {truncate_tokens(question, MAX_QUESTION_TOKENS)}"
+    omitted_note = '- ... {} more layers not listed' + (' (call list_layers to see them)' if tools else '')
+    available = (budget - count_tokens(system) - count_tokens(header) - count_tokens(footer)
+                 - count_tokens(omitted_note.format(len(layers))))
+
+    terms = set(_TERM_PATTERN.findall(question.lower())) - _STOP_WORDS
+    ranked = sorted(range(len(layers)), key=lambda i: (-_relevance(layers[i], terms), i))
+
+    summaries: Dict[int, str] = {}
+    for i in ranked:
+        line = _compact_summary(layers[i])
+        cost = count_tokens(line) + 1
+        if cost <= available:
+            summaries[i] = line
+            available -= cost
+    for i in ranked:
+        if i not in summaries:
+            continue
+        line = _full_summary(layers[i])
+        extra = count_tokens(line) - count_tokens(summaries[i])
+        if extra <= available:
+            summaries[i] = line
+            available -= extra
+
+    lines = [summaries[i] for i in sorted(summaries)]
+    omitted = len(layers) - len(summaries)
+    if omitted:
+        lines.append(omitted_note.format(omitted))
+    user = header + ('\n'.join(lines) or '- (no layers)') + footer
+    return ProjectPrompt(system, user, len(summaries), omitted)
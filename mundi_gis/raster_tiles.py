@@ -0,0 +1,512 @@
+"""
+XYZ tile pyramid for GeoTIFF raster layers.
+
+A GeoTIFF is read once with Pillow, resampled onto the Web Mercator pixel
+grid of the zoom closest to its native resolution, and cut into 256px tiles.
+Every lower zoom is built from the level above by averaging 2x2 pixel blocks
+(with premultiplied alpha, so transparent edges do not darken), one row of
+tiles at a time, so only a couple of rows per zoom are ever held in memory.
+
+The encoded tiles are packed into one file beside the upload
+(``<file>.tiles``) and a manifest (``<file>.tiles.json``) records the byte
+range of each tile, the bounds and zoom range, and which source file (mtime
+and size) they were built from. Serving a tile is a single ranged read of
+the pack, so zooming out over a large raster never touches full-resolution
+pixels. Zooms past the deepest level are cut from its tiles and upscaled.
+
+Rasters must be north-up, in geographic coordinates (EPSG:4326 and the
+like) or Web Mercator (EPSG:3857); other projections are not reprojected.
+"""
+
+import io
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from django.conf import settings
+from PIL import Image, features
+from .vector_tiles import MAX_LATITUDE, MAX_ZOOM, mercator
+
+
+RASTER_EXTENSIONS = ('.tif', '.tiff')
+
+TILE_SIZE = 256
+
+TILE_CONTENT_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+# Web Mercator spans this many metres along each axis
+_MERCATOR_EXTENT = 2 * math.pi * 6378137
+
+# GeoTIFF tags and GeoKeys
+_TAG_PIXEL_SCALE = 33550
+_TAG_TIEPOINT = 33922
+_TAG_TRANSFORMATION = 34264
+_TAG_GEO_KEYS = 34735
+_TAG_GDAL_NODATA = 42113
+_KEY_MODEL_TYPE = 1024
+_KEY_RASTER_TYPE = 1025
+_KEY_PROJECTED_CRS = 3072
+_MODEL_GEOGRAPHIC = 2
+_RASTER_PIXEL_IS_POINT = 2
+_WEB_MERCATOR_CODES = (3857, 3785, 900913, 102100, 102113)
+
+# High-bit-depth rasters are stretched between these percentiles of their values
+_STRETCH_PERCENTILES = (2, 98)
+_STRETCH_SAMPLE = 1_000_000
+
+_CACHE_SIZE = 32
+
+
+class RasterError(ValueError):
+    """Raised when a raster cannot be read or placed on the map"""
+
+
+def is_raster(file_path: str) -> bool:
+    return os.path.splitext(file_path.lower())[1] in RASTER_EXTENSIONS
+
+
+def tile_format() -> str:
+    """MUNDI_RASTER_TILE_FORMAT, falling back to PNG when Pillow has no WebP support"""
+    name = getattr(settings, 'MUNDI_RASTER_TILE_FORMAT', 'png').lower()
+    if name == 'webp' and features.check('webp'):
+        return 'webp'
+    return 'png'
+
+
+def _encode(image: Image.Image, format_name: str) -> bytes:
+    out = io.BytesIO()
+    if format_name == 'webp':
+        image.save(out, 'WEBP', lossless=True)
+    else:
+        image.save(out, 'PNG')
+    return out.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Georeferencing
+# ---------------------------------------------------------------------------
+
+def _geo_keys(tags) -> Dict[int, int]:
+    """The GeoKeys stored inline in the GeoKeyDirectory tag"""
+    directory = tags.get(_TAG_GEO_KEYS)
+    if not directory or len(directory) < 4:
+        return {}
+    keys = {}
+    for i in range(1, min(directory[3], len(directory) // 4 - 1) + 1):
+        key_id, location, _, value = directory[i * 4:i * 4 + 4]
+        if location == 0:
+            keys[key_id] = value
+    return keys
+
+
+class RasterGeoreference:
+    """
+    A north-up raster's placement: the model coordinates of its top-left
+    corner, the size of a pixel, and whether those coordinates are Web
+    Mercator metres or longitude/latitude degrees.
+    """
+
+    def __init__(self, origin_x: float, origin_y: float, pixel_width: float, pixel_height: float,
+                 width: int, height: int, is_mercator: bool):
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.pixel_width = pixel_width
+        self.pixel_height = pixel_height
+        self.width = width
+        self.height = height
+        self.is_mercator = is_mercator
+
+    @classmethod
+    def from_tags(cls, tags, width: int, height: int) -> 'RasterGeoreference':
+        keys = _geo_keys(tags)
+        transformation = tags.get(_TAG_TRANSFORMATION)
+        scale = tags.get(_TAG_PIXEL_SCALE)
+        tiepoint = tags.get(_TAG_TIEPOINT)
+        if transformation and len(transformation) >= 8:
+            if transformation[1] or transformation[4]:
+                raise RasterError('Rotated rasters are not supported')
+            pixel_width, pixel_height = transformation[0], -transformation[5]
+            origin_x, origin_y = transformation[3], transformation[7]
+        elif scale and tiepoint and len(scale) >= 2 and len(tiepoint) >= 6:
+            pixel_width, pixel_height = scale[0], scale[1]
+            origin_x = tiepoint[3] - tiepoint[0] * pixel_width
+            origin_y = tiepoint[4] + tiepoint[1] * pixel_height
+        else:
+            raise RasterError('The raster has no georeferencing (GeoTIFF tags)')
+        if not pixel_width or not pixel_height:
+            raise RasterError('The raster has a zero pixel size')
+
+        if keys.get(_KEY_RASTER_TYPE) == _RASTER_PIXEL_IS_POINT:
+            # Coordinates name pixel centres; shift them to the corner
+            origin_x -= pixel_width / 2
+            origin_y += pixel_height / 2
+
+        projected_crs = keys.get(_KEY_PROJECTED_CRS)
+        if projected_crs in _WEB_MERCATOR_CODES:
+            is_mercator = True
+        elif keys.get(_KEY_MODEL_TYPE) == _MODEL_GEOGRAPHIC or (not keys and abs(origin_x) <= 360):
+            is_mercator = False
+        else:
+            code = f'EPSG:{projected_crs}' if projected_crs else 'a projected coordinate system'
+            raise RasterError(
+                f'Rasters in {code} cannot be tiled; reproject it to EPSG:4326 or EPSG:3857 first'
+            )
+        return cls(origin_x, origin_y, pixel_width, pixel_height, width, height, is_mercator)
+
+    def _to_unit(self, x: float, y: float) -> Tuple[float, float]:
+        if self.is_mercator:
+            return (
+                min(1.0, max(0.0, x / _MERCATOR_EXTENT + 0.5)),
+                min(1.0, max(0.0, 0.5 - y / _MERCATOR_EXTENT)),
+            )
+        return mercator(max(-180.0, min(180.0, x)), y)
+
+    def unit_bounds(self) -> Tuple[float, float, float, float]:
+        """(min x, min y, max x, max y) in the Web Mercator unit square, y growing southwards"""
+        x0, y0 = self._to_unit(self.origin_x, self.origin_y)
+        x1, y1 = self._to_unit(self.origin_x + self.width * self.pixel_width,
+                               self.origin_y - self.height * self.pixel_height)
+        return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+    def columns(self, unit_x: np.ndarray) -> np.ndarray:
+        """Source column of each unit-square x, or -1 outside the raster"""
+        x = (unit_x - 0.5) * _MERCATOR_EXTENT if self.is_mercator else unit_x * 360.0 - 180.0
+        return self._indices((x - self.origin_x) / self.pixel_width, self.width)
+
+    def rows(self, unit_y: np.ndarray) -> np.ndarray:
+        """Source row of each unit-square y, or -1 outside the raster"""
+        if self.is_mercator:
+            y = (0.5 - unit_y) * _MERCATOR_EXTENT
+        else:
+            y = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * unit_y))))
+        return self._indices((self.origin_y - y) / self.pixel_height, self.height)
+
+    @staticmethod
+    def _indices(positions: np.ndarray, size: int) -> np.ndarray:
+        indices = np.floor(positions)
+        return np.where((indices >= 0) & (indices < size), indices, -1).astype(np.intp)
+
+
+def _unit_to_lon_lat(x: float, y: float) -> Tuple[float, float]:
+    return x * 360.0 - 180.0, math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+
+def _nodata(tags) -> Optional[float]:
+    value = tags.get(_TAG_GDAL_NODATA)
+    try:
+        return float(str(value).strip('\0 ')) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _rgba_pixels(image: Image.Image, nodata: Optional[float]) -> np.ndarray:
+    """The raster as an (height, width, 4) uint8 array; nodata pixels are transparent"""
+    if image.mode in ('I', 'F') or image.mode.startswith('I;16'):
+        # Single-band data (elevation, indices...) is drawn as a grey ramp
+        values = np.asarray(image, dtype=np.float64)
+        valid = np.isfinite(values)
+        if nodata is not None:
+            valid &= values != nodata
+        samples = values[valid]
+        low, high = 0.0, 1.0
+        if samples.size:
+            step = max(1, samples.size // _STRETCH_SAMPLE)
+            low, high = np.percentile(samples[::step], _STRETCH_PERCENTILES)
+        with np.errstate(invalid='ignore'):
+            grey = np.clip((values - low) * (255.0 / ((high - low) or 1.0)), 0, 255)
+        grey = np.where(valid, grey, 0).astype(np.uint8)
+        return np.dstack([grey, grey, grey, valid.astype(np.uint8) * 255])
+
+    pixels = np.array(image.convert('RGBA'))
+    if nodata is not None and image.mode in ('L', 'RGB'):
+        bands = np.asarray(image)
+        bands = bands[..., None] if bands.ndim == 2 else bands
+        pixels[(bands == nodata).all(axis=2), 3] = 0
+    return pixels
+
+
+def read_raster(file_path: str) -> Tuple[np.ndarray, RasterGeoreference]:
+    """The RGBA pixels and georeference of a GeoTIFF; raises RasterError if it cannot be used"""
+    try:
+        with Image.open(file_path) as image:
+            if image.format != 'TIFF':
+                raise RasterError('Not a TIFF file')
+            tags = dict(image.tag_v2)
+            georeference = RasterGeoreference.from_tags(tags, image.width, image.height)
+            image.load()
+            pixels = _rgba_pixels(image, _nodata(tags))
+    except RasterError:
+        raise
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise RasterError(f'Could not read {os.path.basename(file_path)}: {e}') from e
+    return pixels, georeference
+
+
+def native_zoom(georeference: RasterGeoreference) -> int:
+    """The zoom whose pixels are closest in size to the raster's own"""
+    min_x, min_y, max_x, max_y = georeference.unit_bounds()
+    resolution = min((max_x - min_x) / georeference.width, (max_y - min_y) / georeference.height)
+    if resolution <= 0:
+        raise RasterError('The raster lies outside the Web Mercator extent')
+    return max(0, min(MAX_ZOOM, round(math.log2(1 / (TILE_SIZE * resolution)))))
+
+
+# ---------------------------------------------------------------------------
+# Pyramid building
+# ---------------------------------------------------------------------------
+
+class _PackWriter:
+    """Appends encoded tiles to a pack file and records each one's byte range"""
+
+    def __init__(self, path: str, format_name: str):
+        self.file = open(path, 'wb')
+        self.format_name = format_name
+        self.index: Dict[str, List[int]] = {}
+        self.offset = 0
+
+    def add(self, z: int, x: int, y: int, tile: Image.Image):
+        if tile.getchannel('A').getbbox() is None:
+            # Fully transparent tiles are not stored; the endpoint serves a blank tile
+            return
+        data = _encode(tile, self.format_name)
+        self.file.write(data)
+        self.index[f'{z}/{x}/{y}'] = [self.offset, len(data)]
+        self.offset += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class _PyramidBuilder:
+    """
+    Takes the rows of tiles of the deepest zoom from top to bottom. Each row
+    is cut into tiles and pasted into its parent row, which is reduced and
+    passed on to the zoom above once both of its halves are in.
+    """
+
+    def __init__(self, writer: _PackWriter, max_zoom: int, first_column: int, last_column: int):
+        self.writer = writer
+        self.max_zoom = max_zoom
+        self.columns = {
+            z: (first_column >> (max_zoom - z), last_column >> (max_zoom - z)) for z in range(max_zoom + 1)
+        }
+        self.pending: Dict[int, Tuple[int, Image.Image]] = {}
+
+    def add_row(self, z: int, ty: int, row: Image.Image):
+        first, last = self.columns[z]
+        for tx in range(first, last + 1):
+            left = (tx - first) * TILE_SIZE
+            self.writer.add(z, tx, ty, row.crop((left, 0, left + TILE_SIZE, TILE_SIZE)))
+        if z == 0:
+            return
+
+        pending = self.pending.get(z)
+        if pending and pending[0] != ty >> 1:
+            self._flush(z)
+            pending = None
+        parent_first, parent_last = self.columns[z - 1]
+        if pending is None:
+            size = ((parent_last - parent_first + 1) * 2 * TILE_SIZE, 2 * TILE_SIZE)
+            pending = (ty >> 1, Image.new('RGBa', size))
+            self.pending[z] = pending
+        pending[1].paste(row.convert('RGBa'), ((first - 2 * parent_first) * TILE_SIZE, (ty & 1) * TILE_SIZE))
+
+    def _flush(self, z: int):
+        pending = self.pending.pop(z, None)
+        if pending:
+            parent_ty, image = pending
+            self.add_row(z - 1, parent_ty, image.reduce(2).convert('RGBA'))
+
+    def finish(self):
+        for z in range(self.max_zoom, 0, -1):
+            self._flush(z)
+
+
+def _deepest_rows(pixels: np.ndarray, georeference: RasterGeoreference, zoom: int,
+                  columns: Tuple[int, int], rows: Tuple[int, int]) -> Iterator[Tuple[int, Image.Image]]:
+    """Resample the raster (nearest neighbour) onto each row of tiles at the deepest zoom"""
+    scale = TILE_SIZE * 2 ** zoom
+    unit_x = (np.arange(columns[0] * TILE_SIZE, (columns[1] + 1) * TILE_SIZE) + 0.5) / scale
+    source_columns = georeference.columns(unit_x)
+    outside_columns = source_columns < 0
+    for ty in range(rows[0], rows[1] + 1):
+        unit_y = (np.arange(ty * TILE_SIZE, (ty + 1) * TILE_SIZE) + 0.5) / scale
+        source_rows = georeference.rows(unit_y)
+        row = pixels[np.ix_(source_rows, source_columns)]
+        row[source_rows < 0] = 0
+        row[:, outside_columns] = 0
+        yield ty, Image.fromarray(row, 'RGBA')
+
+
+def manifest_path(file_path: str) -> str:
+    return f'{file_path}.tiles.json'
+
+
+def pack_path(file_path: str) -> str:
+    return f'{file_path}.tiles'
+
+
+def _signature(file_path: str) -> List[int]:
+    stat = os.stat(file_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def write_raster_tiles(file_path: str) -> Dict[str, Any]:
+    """Build the tile pyramid of a GeoTIFF, write its pack and manifest, and return the manifest"""
+    signature = _signature(file_path)
+    pixels, georeference = read_raster(file_path)
+    max_zoom = native_zoom(georeference)
+    min_x, min_y, max_x, max_y = georeference.unit_bounds()
+    tiles_across = 2 ** max_zoom
+    columns = (min(int(min_x * tiles_across), tiles_across - 1), min(int(max_x * tiles_across), tiles_across - 1))
+    rows = (min(int(min_y * tiles_across), tiles_across - 1), min(int(max_y * tiles_across), tiles_across - 1))
+
+    format_name = tile_format()
+    tmp_path = f'{pack_path(file_path)}.{os.getpid()}.tmp'
+    writer = _PackWriter(tmp_path, format_name)
+    try:
+        builder = _PyramidBuilder(writer, max_zoom, *columns)
+        for ty, row in _deepest_rows(pixels, georeference, max_zoom, columns, rows):
+            builder.add_row(max_zoom, ty, row)
+        builder.finish()
+        writer.close()
+        os.replace(tmp_path, pack_path(file_path))
+    finally:
+        writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    west, north = _unit_to_lon_lat(min_x, min_y)
+    east, south = _unit_to_lon_lat(max_x, max_y)
+    manifest = {
+        'signature': signature,
+        'format': format_name,
+        'bounds': [west, max(south, -MAX_LATITUDE), east, min(north, MAX_LATITUDE)],
+        'minzoom': 0,
+        'maxzoom': max_zoom,
+        'tiles': writer.index,
+    }
+    # The manifest goes last so it never points into a pack that is not written yet
+    tmp_path = f'{manifest_path(file_path)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(file_path))
+    return manifest
+
+
+# ---------------------------------------------------------------------------
+# Serving
+# ---------------------------------------------------------------------------
+
+class RasterTiles:
+    """Reads tiles out of a raster's pack file"""
+
+    def __init__(self, file_path: str, manifest: Dict[str, Any]):
+        self.pack_path = pack_path(file_path)
+        self.format = manifest['format']
+        self.content_type = TILE_CONTENT_TYPES[self.format]
+        self.bounds = manifest['bounds']
+        self.max_zoom = manifest['maxzoom']
+        self._tiles = manifest['tiles']
+
+    def _read(self, z: int, x: int, y: int) -> Optional[bytes]:
+        entry = self._tiles.get(f'{z}/{x}/{y}')
+        if entry is None:
+            return None
+        offset, length = entry
+        with open(self.pack_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """The encoded tile, or None where the raster has no visible pixels"""
+        if z <= self.max_zoom:
+            return self._read(z, x, y)
+
+        # Past the deepest level, enlarge the part of its tile that covers this one
+        depth = z - self.max_zoom
+        data = self._read(self.max_zoom, x >> depth, y >> depth)
+        if data is None:
+            return None
+        size = TILE_SIZE / 2 ** depth
+        left = (x - ((x >> depth) << depth)) * size
+        top = (y - ((y >> depth) << depth)) * size
+        with Image.open(io.BytesIO(data)) as parent:
+            box = (int(left), int(top), max(int(left) + 1, int(left + size)), max(int(top) + 1, int(top + size)))
+            tile = parent.convert('RGBA').crop(box).resize((TILE_SIZE, TILE_SIZE), Image.NEAREST)
+        if tile.getchannel('A').getbbox() is None:
+            return None
+        return _encode(tile, self.format)
+
+    def info(self) -> Dict[str, Any]:
+        return {'format': self.format, 'bounds': self.bounds, 'maxzoom': self.max_zoom}
+
+
+_blank_tiles: Dict[str, bytes] = {}
+
+
+def blank_tile(format_name: str) -> bytes:
+    """A fully transparent tile, for requests outside a raster's visible pixels"""
+    if format_name not in _blank_tiles:
+        _blank_tiles[format_name] = _encode(Image.new('RGBA', (TILE_SIZE, TILE_SIZE)), format_name)
+    return _blank_tiles[format_name]
+
+
+def _load_manifest(file_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(manifest_path(file_path), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('signature') != _signature(file_path):
+        return None
+    return manifest
+
+
+_tiles_cache: OrderedDict = OrderedDict()
+_tiles_cache_lock = threading.Lock()
+_build_locks: Dict[str, threading.Lock] = {}
+
+
+def _cache(file_path: str, signature: List[int], tiles: RasterTiles) -> RasterTiles:
+    with _tiles_cache_lock:
+        _tiles_cache[file_path] = (signature, tiles)
+        _tiles_cache.move_to_end(file_path)
+        while len(_tiles_cache) > _CACHE_SIZE:
+            evicted, _ = _tiles_cache.popitem(last=False)
+            _build_locks.pop(evicted, None)
+    return tiles
+
+
+def find_raster_tiles(file_path: str) -> Optional[RasterTiles]:
+    """A raster's tiles if they are built and current, without building them"""
+    signature = _signature(file_path)
+    with _tiles_cache_lock:
+        cached = _tiles_cache.get(file_path)
+        if cached and cached[0] == signature:
+            _tiles_cache.move_to_end(file_path)
+            return cached[1]
+    manifest = _load_manifest(file_path)
+    if manifest is None:
+        return None
+    return _cache(file_path, signature, RasterTiles(file_path, manifest))
+
+
+def get_raster_tiles(file_path: str) -> RasterTiles:
+    """A raster's tiles, (re)building the pyramid if it is missing or stale; raises RasterError"""
+    tiles = find_raster_tiles(file_path)
+    if tiles is not None:
+        return tiles
+
+    with _tiles_cache_lock:
+        build_lock = _build_locks.setdefault(file_path, threading.Lock())
+    with build_lock:
+        # Another thread may have finished the build while this one waited
+        tiles = find_raster_tiles(file_path)
+        if tiles is None:
+            manifest = write_raster_tiles(file_path)
+            tiles = _cache(file_path, manifest['signature'], RasterTiles(file_path, manifest))
+    return tiles
@@ -0,0 +1,581 @@
+"""
+Ingest readers for non-GeoJSON layer uploads.
+
+Shapefiles (a bare ``.shp`` or a ``.zip`` with its ``.dbf``/``.prj``/``.cpg``
+sidecars), CSV files with latitude/longitude columns and LAS/LAZ point
+clouds are converted at ingest into a GeoJSON file beside the upload. Every
+later stage (columnar storage, statistics, spatial and tile indexes, the
+simplification pyramid) then works on that file exactly as on an uploaded
+GeoJSON layer.
+
+Each reader yields one feature at a time from a streamed read of its input
+and the output is written as it is produced, so memory does not grow with
+the size of the upload. Point clouds are decimated to at most
+``MUNDI_POINT_CLOUD_MAX_POINTS`` points, evenly spaced through the file.
+
+Layers are served as longitude/latitude, so, as for rasters, files in a
+projected coordinate system (or whose coordinates are out of range when they
+name none) are rejected with ``ReaderError`` rather than reprojected.
+"""
+
+import codecs
+import csv
+import json
+import math
+import os
+import struct
+import zipfile
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from django.conf import settings
+
+try:
+    import laspy
+except ImportError:  # Optional: without it .laz files cannot be read
+    laspy = None
+
+
+CONVERTED_SUFFIX = '.geojson'
+
+CONVERTIBLE_EXTENSIONS = ('.shp', '.zip', '.csv', '.las', '.laz')
+
+_LATITUDE_COLUMNS = ('lat', 'latitude', 'lat_dd', 'y')
+_LONGITUDE_COLUMNS = ('lon', 'lng', 'long', 'longitude', 'lon_dd', 'x')
+
+# Point records read per numpy batch
+_LAS_BATCH_POINTS = 1 << 20
+
+
+class ReaderError(ValueError):
+    """Raised when an upload cannot be read as its declared format"""
+
+
+def _extension(file_path: str) -> str:
+    return os.path.splitext(file_path.lower())[1]
+
+
+def needs_conversion(file_path: str) -> bool:
+    return _extension(file_path) in CONVERTIBLE_EXTENSIONS
+
+
+def converted_path(file_path: str) -> str:
+    """Where the GeoJSON derived from an upload is written"""
+    return f'{file_path}{CONVERTED_SUFFIX}'
+
+
+# ---------------------------------------------------------------------------
+# Shapefile
+# ---------------------------------------------------------------------------
+
+_SHP_NULL = 0
+_SHP_POINT_TYPES = (1, 11, 21)
+_SHP_POLYLINE_TYPES = (3, 13, 23)
+_SHP_POLYGON_TYPES = (5, 15, 25)
+_SHP_MULTIPOINT_TYPES = (8, 18, 28)
+
+_SHP_HEADER_SIZE = 100
+_SHP_RECORD_HEADER = struct.Struct('>ii')
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ReaderError('Shapefile is truncated')
+    return data
+
+
+def _signed_area(ring: np.ndarray) -> float:
+    x, y = ring[:, 0], ring[:, 1]
+    return float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def _contains(ring: np.ndarray, x: float, y: float) -> bool:
+    """Ray-casting point in ring test"""
+    x0, y0 = ring[:-1, 0], ring[:-1, 1]
+    x1, y1 = ring[1:, 0], ring[1:, 1]
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crosses & (x < at)) % 2)
+
+
+def _polygon_geometry(rings: List[np.ndarray]) -> Optional[Dict[str, Any]]:
+    """
+    Group shapefile rings into polygons. Outer rings run clockwise and holes
+    counter-clockwise; GeoJSON wants the opposite (RFC 7946 section 3.1.6).
+    """
+    polygons: List[List[np.ndarray]] = []
+    holes = []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        if _signed_area(ring) <= 0:
+            polygons.append([ring[::-1]])
+        else:
+            holes.append(ring)
+    for hole in holes:
+        owner = next((p for p in polygons if _contains(p[0], hole[0, 0], hole[0, 1])), None)
+        if owner is not None:
+            owner.append(hole[::-1])
+        else:
+            # A hole outside every outer ring is a badly wound outer ring
+            polygons.append([hole])
+    if not polygons:
+        return None
+    coordinates = [[ring.tolist() for ring in polygon] for polygon in polygons]
+    if len(coordinates) == 1:
+        return {'type': 'Polygon', 'coordinates': coordinates[0]}
+    return {'type': 'MultiPolygon', 'coordinates': coordinates}
+
+
+def _shape_geometry(content: bytes) -> Optional[Dict[str, Any]]:
+    shape_type = struct.unpack_from('<i', content)[0]
+    if shape_type == _SHP_NULL:
+        return None
+    if shape_type in _SHP_POINT_TYPES:
+        x, y = struct.unpack_from('<2d', content, 4)
+        return {'type': 'Point', 'coordinates': [x, y]}
+    if shape_type in _SHP_MULTIPOINT_TYPES:
+        count = struct.unpack_from('<i', content, 36)[0]
+        points = np.frombuffer(content, '<f8', count * 2, 40).reshape(-1, 2)
+        return {'type': 'MultiPoint', 'coordinates': points.tolist()}
+    if shape_type in _SHP_POLYLINE_TYPES + _SHP_POLYGON_TYPES:
+        part_count, point_count = struct.unpack_from('<2i', content, 36)
+        parts = np.frombuffer(content, '<i4', part_count, 44).tolist() + [point_count]
+        points = np.frombuffer(content, '<f8', point_count * 2, 44 + 4 * part_count).reshape(-1, 2)
+        rings = [points[parts[i]:parts[i + 1]] for i in range(part_count)]
+        if shape_type in _SHP_POLYGON_TYPES:
+            return _polygon_geometry(rings)
+        lines = [ring.tolist() for ring in rings if len(ring) >= 2]
+        if not lines:
+            return None
+        if len(lines) == 1:
+            return {'type': 'LineString', 'coordinates': lines[0]}
+        return {'type': 'MultiLineString', 'coordinates': lines}
+    raise ReaderError(f'Unsupported shapefile shape type {shape_type}')
+
+
+def _iter_shapes(stream: BinaryIO) -> Iterator[Optional[Dict[str, Any]]]:
+    header = _read_exactly(stream, _SHP_HEADER_SIZE)
+    # The file code and length are big-endian, the rest of the header little-endian
+    if struct.unpack_from('>i', header)[0] != 9994:
+        raise ReaderError('Not a shapefile')
+    remaining = struct.unpack_from('>i', header, 24)[0] * 2 - _SHP_HEADER_SIZE
+    while remaining > 0:
+        header = stream.read(_SHP_RECORD_HEADER.size)
+        if not header:
+            break
+        _, content_words = _SHP_RECORD_HEADER.unpack(header)
+        content = _read_exactly(stream, content_words * 2)
+        remaining -= _SHP_RECORD_HEADER.size + content_words * 2
+        yield _shape_geometry(content)
+
+
+def _dbf_value(raw: bytes, field_type: str, decimals: int, encoding: str):
+    text = raw.strip(b' \x00')
+    if field_type in 'NF':
+        if not text or text.startswith(b'*'):
+            return None
+        try:
+            return int(text) if field_type == 'N' and decimals == 0 else float(text)
+        except ValueError:
+            try:
+                return float(text)
+            except ValueError:
+                return None
+    if field_type == 'L':
+        return {b'T': True, b't': True, b'Y': True, b'y': True,
+                b'F': False, b'f': False, b'N': False, b'n': False}.get(text[:1])
+    if field_type == 'D':
+        if len(text) != 8 or not text.isdigit():
+            return None
+        return f'{text[:4].decode()}-{text[4:6].decode()}-{text[6:8].decode()}'
+    return text.decode(encoding, errors='replace') if text else None
+
+
+def _iter_dbf_records(stream: BinaryIO, encoding: str) -> Iterator[Optional[Dict[str, Any]]]:
+    """Each record's attributes, or None for a record marked deleted"""
+    header = _read_exactly(stream, 32)
+    record_count, header_length, record_length = struct.unpack_from('<IHH', header, 4)
+    descriptors = _read_exactly(stream, header_length - 32)
+    fields = []
+    position = 1  # After the deletion flag
+    for offset in range(0, len(descriptors) - 31, 32):
+        descriptor = descriptors[offset:offset + 32]
+        if descriptor[0] == 0x0D:
+            break
+        name = descriptor[:11].split(b'\x00')[0].decode(encoding, errors='replace')
+        field_type = chr(descriptor[11])
+        length, decimals = descriptor[16], descriptor[17]
+        fields.append((name, field_type, decimals, position, position + length))
+        position += length
+
+    for _ in range(record_count):
+        record = stream.read(record_length)
+        if len(record) < record_length:
+            return
+        if record[:1] == b'*':
+            yield None
+            continue
+        yield {
+            name: _dbf_value(record[start:end], field_type, decimals, encoding)
+            for name, field_type, decimals, start, end in fields
+        }
+
+
+def _prj_crs(wkt: str) -> Optional[Dict[str, Any]]:
+    """A GeoJSON crs member for a projected .prj; None for geographic coordinates"""
+    wkt = wkt.strip()
+    if not wkt.upper().startswith('PROJCS'):
+        return None
+    name = wkt.split('"')[1] if wkt.count('"') >= 2 else 'unknown'
+    return {'type': 'name', 'properties': {'name': name}}
+
+
+def _shp_bounds(header: bytes) -> Tuple[float, float, float, float]:
+    """(min x, min y, max x, max y) from a .shp header"""
+    if len(header) < _SHP_HEADER_SIZE or struct.unpack_from('>i', header)[0] != 9994:
+        raise ReaderError('Not a shapefile')
+    return struct.unpack_from('<4d', header, 36)
+
+
+def _require_lon_lat(crs: Optional[Dict[str, Any]], bounds: Tuple[float, float, float, float]):
+    """Raise ReaderError unless a file's coordinates are longitude/latitude"""
+    if crs:
+        name = crs['properties']['name']
+        raise ReaderError(f'The file is in {name}; reproject it to EPSG:4326 (longitude/latitude) first')
+    min_x, min_y, max_x, max_y = bounds
+    if not (-180 <= min_x <= max_x <= 180 and -90 <= min_y <= max_y <= 90):
+        raise ReaderError(
+            'The coordinates are not longitude/latitude and the file names no coordinate system; '
+            'reproject it to EPSG:4326 first'
+        )
+
+
+def _dbf_encoding(cpg: Optional[str]) -> str:
+    if cpg:
+        try:
+            return codecs.lookup(cpg.strip()).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def _shapefile_features(shp: BinaryIO, dbf: Optional[BinaryIO], encoding: str) -> Iterator[Dict[str, Any]]:
+    records = _iter_dbf_records(dbf, encoding) if dbf else None
+    for geometry in _iter_shapes(shp):
+        properties = next(records, {}) if records else {}
+        if properties is None:
+            continue
+        yield {'type': 'Feature', 'properties': properties, 'geometry': geometry}
+
+
+def read_shapefile(file_path: str) -> Tuple[Optional[Dict[str, Any]], Iterator[Dict[str, Any]]]:
+    """(crs member, features) of a .shp, with attributes from a .dbf beside it if there is one"""
+    stem = os.path.splitext(file_path)[0]
+
+    def sidecar(extension):
+        for candidate in (stem + extension, stem + extension.upper()):
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    prj, cpg, dbf = sidecar('.prj'), sidecar('.cpg'), sidecar('.dbf')
+    crs = _prj_crs(open(prj, errors='replace').read()) if prj else None
+    with open(file_path, 'rb') as shp:
+        _require_lon_lat(crs, _shp_bounds(shp.read(_SHP_HEADER_SIZE)))
+    encoding = _dbf_encoding(open(cpg, errors='replace').read() if cpg else None)
+
+    def features():
+        with open(file_path, 'rb') as shp:
+            if dbf is None:
+                yield from _shapefile_features(shp, None, encoding)
+                return
+            with open(dbf, 'rb') as dbf_stream:
+                yield from _shapefile_features(shp, dbf_stream, encoding)
+
+    return crs, features()
+
+
+def read_shapefile_zip(file_path: str) -> Tuple[Optional[Dict[str, Any]], Iterator[Dict[str, Any]]]:
+    """(crs member, features) of the first shapefile in a .zip, read without extracting it"""
+    try:
+        archive = zipfile.ZipFile(file_path)
+    except zipfile.BadZipFile as e:
+        raise ReaderError(f'Not a zip file: {e}') from e
+    names = {name.lower(): name for name in archive.namelist() if not name.endswith('/')}
+    shp_name = next((names[name] for name in sorted(names) if name.endswith('.shp')), None)
+    if shp_name is None:
+        archive.close()
+        raise ReaderError('The zip file does not contain a .shp file')
+    stem = os.path.splitext(shp_name)[0].lower()
+
+    def member_text(extension):
+        name = names.get(stem + extension)
+        return archive.read(name).decode('utf-8', errors='replace') if name else None
+
+    crs = _prj_crs(member_text('.prj') or '')
+    try:
+        with archive.open(shp_name) as shp:
+            _require_lon_lat(crs, _shp_bounds(shp.read(_SHP_HEADER_SIZE)))
+    except ReaderError:
+        archive.close()
+        raise
+    encoding = _dbf_encoding(member_text('.cpg'))
+    dbf_name = names.get(stem + '.dbf')
+
+    def features():
+        with archive, archive.open(shp_name) as shp:
+            if dbf_name is None:
+                yield from _shapefile_features(shp, None, encoding)
+                return
+            with archive.open(dbf_name) as dbf:
+                yield from _shapefile_features(shp, dbf, encoding)
+
+    return crs, features()
+
+
+# ---------------------------------------------------------------------------
+# CSV
+# ---------------------------------------------------------------------------
+
+def _csv_value(value: str):
+    if value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return number if math.isfinite(number) else value
+
+
+def _find_column(fieldnames: List[str], candidates: Tuple[str, ...]) -> Optional[str]:
+    by_name = {name.strip().lower(): name for name in fieldnames}
+    return next((by_name[c] for c in candidates if c in by_name), None)
+
+
+def read_csv(file_path: str) -> Tuple[Optional[Dict[str, Any]], Iterator[Dict[str, Any]]]:
+    """(None, Point features) for a CSV file with latitude and longitude columns"""
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        fieldnames = next(csv.reader(f), None)
+    if not fieldnames:
+        raise ReaderError('CSV file is empty')
+    lat_column = _find_column(fieldnames, _LATITUDE_COLUMNS)
+    lon_column = _find_column(fieldnames, _LONGITUDE_COLUMNS)
+    if lat_column is None or lon_column is None:
+        raise ReaderError('CSV files need latitude and longitude columns (e.g. "lat" and "lon")')
+
+    def features():
+        with open(file_path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                try:
+                    lon, lat = float(row[lon_column]), float(row[lat_column])
+                except (TypeError, ValueError):
+                    # Rows without a usable location are kept without a geometry
+                    geometry = None
+                else:
+                    valid = -180 <= lon <= 180 and -90 <= lat <= 90
+                    geometry = {'type': 'Point', 'coordinates': [lon, lat]} if valid else None
+                properties = {
+                    key: _csv_value(value) for key, value in row.items()
+                    if key is not None and key not in (lat_column, lon_column)
+                }
+                yield {'type': 'Feature', 'properties': properties, 'geometry': geometry}
+
+    return None, features()
+
+
+# ---------------------------------------------------------------------------
+# LAS / LAZ point clouds
+# ---------------------------------------------------------------------------
+
+class LASHeader:
+    """The fields of a LAS public header block that point reading needs"""
+
+    def __init__(self, data: bytes):
+        if data[:4] != b'LASF':
+            raise ReaderError('Not a LAS file')
+        self.version = (data[24], data[25])
+        self.header_size, self.point_offset, self.vlr_count = struct.unpack_from('<HII', data, 94)
+        self.point_format = data[104] & 0x3F
+        self.compressed = bool(data[104] & 0xC0)
+        self.record_length = struct.unpack_from('<H', data, 105)[0]
+        self.point_count = struct.unpack_from('<I', data, 107)[0]
+        if self.header_size >= 375 and len(data) >= 255:
+            # LAS 1.4 keeps a 64-bit count; the legacy field may be zero
+            self.point_count = struct.unpack_from('<Q', data, 247)[0] or self.point_count
+        self.scale = np.array(struct.unpack_from('<3d', data, 131))
+        self.offset = np.array(struct.unpack_from('<3d', data, 155))
+        max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from('<6d', data, 179)
+        self.bounds = (min_x, min_y, min_z, max_x, max_y, max_z)
+
+    @property
+    def classification_offset(self) -> int:
+        # Formats 6 and up moved classification into its own byte
+        return 16 if self.point_format >= 6 else 15
+
+    @property
+    def classification_mask(self) -> int:
+        return 0xFF if self.point_format >= 6 else 0x1F
+
+
+def read_las_header(file_path: str) -> LASHeader:
+    with open(file_path, 'rb') as f:
+        return LASHeader(f.read(375))
+
+
+def las_crs(file_path: str, header: LASHeader) -> Optional[Dict[str, Any]]:
+    """
+    A GeoJSON crs member from the LASF_Projection records: the WKT record, or
+    the EPSG code of a GeoTIFF ProjectedCSTypeGeoKey. None when geographic.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(header.header_size)
+        records = f.read(max(0, header.point_offset - header.header_size))
+    position = 0
+    for _ in range(header.vlr_count):
+        if position + 54 > len(records):
+            break
+        user_id = records[position + 2:position + 18].rstrip(b'\0')
+        record_id, length = struct.unpack_from('<HH', records, position + 18)
+        body = records[position + 54:position + 54 + length]
+        position += 54 + length
+        if user_id != b'LASF_Projection':
+            continue
+        if record_id == 2112:
+            return _prj_crs(body.rstrip(b'\0').decode('utf-8', 'replace'))
+        if record_id == 34735 and len(body) >= 8:
+            key_count = struct.unpack_from('<H', body, 6)[0]
+            for i in range(min(key_count, len(body) // 8 - 1)):
+                key_id, location, _, value = struct.unpack_from('<4H', body, 8 + i * 8)
+                if key_id == 3072 and location == 0:
+                    return {'type': 'name', 'properties': {'name': f'EPSG:{value}'}}
+    return None
+
+
+def point_stride(point_count: int) -> int:
+    """Keep every nth point so at most MUNDI_POINT_CLOUD_MAX_POINTS remain"""
+    max_points = getattr(settings, 'MUNDI_POINT_CLOUD_MAX_POINTS', 200_000)
+    return max(1, math.ceil(point_count / max_points)) if max_points > 0 else 1
+
+
+def iter_las_points(file_path: str, stride: int = 1) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Yield batches of (xyz float64 array, intensity, classification) for every
+    stride-th point of a LAS file, reading at most a batch of records at a time.
+    """
+    header = read_las_header(file_path)
+    if header.compressed or _extension(file_path) == '.laz':
+        yield from _iter_laz_points(file_path, stride)
+        return
+
+    dtype = np.dtype({
+        'names': ['xyz', 'intensity', 'classification'],
+        'formats': [('<i4', 3), '<u2', 'u1'],
+        'offsets': [0, 12, header.classification_offset],
+        'itemsize': header.record_length,
+    })
+    # Whole strides per batch keep the sampling even across batch boundaries
+    batch = max(stride, _LAS_BATCH_POINTS // stride * stride)
+    with open(file_path, 'rb') as f:
+        f.seek(header.point_offset)
+        remaining = header.point_count
+        while remaining > 0:
+            count = min(batch, remaining)
+            data = f.read(count * header.record_length)
+            count = len(data) // header.record_length
+            if not count:
+                break
+            records = np.frombuffer(data, dtype, count)[::stride]
+            remaining -= count
+            yield (
+                records['xyz'] * header.scale + header.offset,
+                records['intensity'],
+                records['classification'] & header.classification_mask,
+            )
+
+
+def _iter_laz_points(file_path: str, stride: int) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    if laspy is None:
+        raise ReaderError('Reading .laz files needs the optional laspy package with a LAZ backend (lazrs)')
+    batch = max(stride, _LAS_BATCH_POINTS // stride * stride)
+    try:
+        with laspy.open(file_path) as reader:
+            for points in reader.chunk_iterator(batch):
+                points = points[::stride]
+                xyz = np.column_stack([np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)])
+                yield xyz, np.asarray(points.intensity), np.asarray(points.classification)
+    except laspy.errors.LaspyException as e:
+        raise ReaderError(f'Could not read point cloud: {e}') from e
+
+
+def read_point_cloud(file_path: str) -> Tuple[Optional[Dict[str, Any]], Iterator[Dict[str, Any]]]:
+    """(crs, decimated Point features) of a LAS or LAZ point cloud"""
+    header = read_las_header(file_path)
+    crs = las_crs(file_path, header)
+    min_x, min_y, _, max_x, max_y, _ = header.bounds
+    _require_lon_lat(crs, (min_x, min_y, max_x, max_y))
+    stride = point_stride(header.point_count)
+
+    def features():
+        for xyz, intensity, classification in iter_las_points(file_path, stride):
+            for (x, y, z), i, c in zip(xyz.tolist(), intensity.tolist(), classification.tolist()):
+                yield {
+                    'type': 'Feature',
+                    'properties': {'z': z, 'intensity': i, 'classification': c},
+                    'geometry': {'type': 'Point', 'coordinates': [x, y]},
+                }
+
+    return crs, features()
+
+
+# ---------------------------------------------------------------------------
+# Conversion
+# ---------------------------------------------------------------------------
+
+_READERS = {
+    '.shp': read_shapefile,
+    '.zip': read_shapefile_zip,
+    '.csv': read_csv,
+    '.las': read_point_cloud,
+    '.laz': read_point_cloud,
+}
+
+
+def convert_layer_file(file_path: str) -> Dict[str, Any]:
+    """
+    Write the GeoJSON for a non-GeoJSON upload to converted_path(file_path),
+    one feature at a time. Raises ReaderError if the file cannot be read.
+    """
+    reader = _READERS.get(_extension(file_path))
+    if reader is None:
+        raise ReaderError(f'No reader for {_extension(file_path)} files')
+
+    out_path = converted_path(file_path)
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    count = 0
+    without_geometry = 0
+    try:
+        # The readers reject projected coordinates, so the output needs no crs member
+        _, features = reader(file_path)
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            out.write('{"type": "FeatureCollection", "features": [')
+            for feature in features:
+                if count:
+                    out.write(', ')
+                out.write(json.dumps(feature))
+                count += 1
+                without_geometry += feature['geometry'] is None
+            out.write(']}')
+        os.replace(tmp_path, out_path)
+    except (OSError, struct.error, UnicodeDecodeError, csv.Error, zipfile.BadZipFile) as e:
+        raise ReaderError(f'Could not read {os.path.basename(file_path)}: {e}') from e
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {'path': os.path.basename(out_path), 'features': count, 'without_geometry': without_geometry}
@@ -0,0 +1,366 @@
+"""
+Zoom-dependent simplification pyramid for GeoJSON layers.
+
+Lines and polygon rings are split into arcs at the points where geometries
+meet, and every shared arc is stored once (as in TopoJSON). Each arc is
+simplified with Douglas-Peucker in Web Mercator space, so neighbouring
+polygons keep a common boundary with no gaps or overlaps at any level.
+Every level is written beside the upload as a compact GeoJSON file with
+coordinates rounded to the precision visible at that zoom. A small manifest
+records which source file (mtime and size) the levels were built from, and
+the pyramid is rebuilt when that changes.
+"""
+
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from .vector_tiles import mercator, vertex_significance
+
+
+# Zoom levels with a precomputed level; other zooms use the closest level below
+PYRAMID_ZOOMS = (0, 2, 4, 6, 8, 10, 12)
+
+# Vertices closer than this many screen pixels to the simplified line are dropped
+TOLERANCE_PIXELS = 1.0
+TILE_SIZE = 256
+
+Point = Tuple[float, float]
+
+
+def level_for_zoom(zoom: int) -> Optional[int]:
+    """Pyramid level to serve at a map zoom, or None when the full-resolution file is needed"""
+    if zoom > PYRAMID_ZOOMS[-1] + 1:
+        return None
+    return max(level for level in PYRAMID_ZOOMS if level <= zoom)
+
+
+def _sq_tolerance(zoom: int) -> float:
+    # Mercator coordinates span the unit square, i.e. TILE_SIZE * 2**zoom pixels
+    tolerance = TOLERANCE_PIXELS / (TILE_SIZE * 2 ** zoom)
+    return tolerance * tolerance
+
+
+def _decimals(zoom: int) -> int:
+    # Keep a tenth of a pixel of precision at the level's zoom
+    pixel_degrees = 360.0 / (TILE_SIZE * 2 ** zoom)
+    return max(0, math.ceil(-math.log10(pixel_degrees / 10)))
+
+
+# ---------------------------------------------------------------------------
+# Geometry traversal
+# ---------------------------------------------------------------------------
+
+def _geometry_sequences(geometry: Optional[Dict[str, Any]], out: List[Tuple[List[Point], bool]]):
+    """Append every line and ring of a geometry to out as (points, closed), in traversal order"""
+    if not geometry:
+        return
+    geom_type = geometry.get('type')
+    coords = geometry.get('coordinates') or []
+    if geom_type == 'LineString':
+        out.append((_points(coords), False))
+    elif geom_type == 'MultiLineString':
+        out.extend((_points(line), False) for line in coords)
+    elif geom_type == 'Polygon':
+        out.extend((_points(ring), True) for ring in coords)
+    elif geom_type == 'MultiPolygon':
+        out.extend((_points(ring), True) for polygon in coords for ring in polygon)
+    elif geom_type == 'GeometryCollection':
+        for child in geometry.get('geometries') or []:
+            _geometry_sequences(child, out)
+
+
+def _points(coords) -> List[Point]:
+    return [(float(c[0]), float(c[1])) for c in coords]
+
+
+def _iter_feature_objects(geojson: Dict[str, Any]):
+    geojson_type = geojson.get('type')
+    if geojson_type == 'FeatureCollection':
+        yield from (f for f in geojson.get('features') or [] if isinstance(f, dict))
+    elif geojson_type == 'Feature':
+        yield geojson
+
+
+# ---------------------------------------------------------------------------
+# Topology
+# ---------------------------------------------------------------------------
+
+class _Topology:
+    """Lines and rings of a layer decomposed into shared arcs"""
+
+    def __init__(self, sequences: List[Tuple[List[Point], bool]]):
+        self.arcs: List[List[Point]] = []
+        self._arc_ids: Dict[Tuple[Point, ...], Tuple[int, bool]] = {}
+        junctions = self._junctions(sequences)
+        # Each sequence becomes a list of (arc id, reversed)
+        self.sequences = [self._cut(points, closed, junctions) for points, closed in sequences]
+
+    @staticmethod
+    def _junctions(sequences) -> set:
+        """Points where geometries meet or diverge, i.e. seen with different neighbours"""
+        neighbours: Dict[Point, Tuple[Point, Point]] = {}
+        junctions = set()
+        for points, closed in sequences:
+            if closed:
+                ring = points[:-1] if len(points) > 1 and points[0] == points[-1] else points
+                n = len(ring)
+                for i, point in enumerate(ring):
+                    pair = (ring[i - 1], ring[(i + 1) % n])
+                    pair = pair if pair[0] <= pair[1] else (pair[1], pair[0])
+                    seen = neighbours.setdefault(point, pair)
+                    if seen != pair:
+                        junctions.add(point)
+            else:
+                if points:
+                    junctions.add(points[0])
+                    junctions.add(points[-1])
+                for i in range(1, len(points) - 1):
+                    pair = (points[i - 1], points[i + 1])
+                    pair = pair if pair[0] <= pair[1] else (pair[1], pair[0])
+                    seen = neighbours.setdefault(points[i], pair)
+                    if seen != pair:
+                        junctions.add(points[i])
+        return junctions
+
+    def _cut(self, points: List[Point], closed: bool, junctions: set) -> List[Tuple[int, bool]]:
+        if len(points) < 2:
+            return [self._arc(points)]
+
+        if closed:
+            ring = points[:-1] if points[0] == points[-1] else points
+            starts = [i for i, p in enumerate(ring) if p in junctions]
+            # Rotate so the ring starts on a junction, or on its smallest
+            # point when it touches nothing, so shared rings are cut identically
+            start = starts[0] if starts else min(range(len(ring)), key=ring.__getitem__)
+            points = ring[start:] + ring[:start] + [ring[start]]
+
+        refs = []
+        arc_start = 0
+        for i in range(1, len(points) - 1):
+            if points[i] in junctions:
+                refs.append(self._arc(points[arc_start:i + 1]))
+                arc_start = i
+        refs.append(self._arc(points[arc_start:]))
+        return refs
+
+    def _arc(self, points: List[Point]) -> Tuple[int, bool]:
+        key = tuple(points)
+        ref = self._arc_ids.get(key)
+        if ref is None:
+            ref = self._arc_ids.get(key[::-1])
+            ref = (ref[0], not ref[1]) if ref else None
+        if ref is None:
+            ref = (len(self.arcs), False)
+            self.arcs.append(points)
+            self._arc_ids[key] = ref
+        return ref
+
+
+# ---------------------------------------------------------------------------
+# Level construction
+# ---------------------------------------------------------------------------
+
+class _Level:
+    """The arcs of a topology simplified and rounded for one zoom level"""
+
+    def __init__(self, topology: _Topology, significance: List[List[float]], zoom: int):
+        sq_tolerance = _sq_tolerance(zoom)
+        decimals = _decimals(zoom)
+        self.arcs = [
+            [(round(x, decimals), round(y, decimals)) for (x, y), s in zip(arc, sig) if s > sq_tolerance]
+            for arc, sig in zip(topology.arcs, significance)
+        ]
+        self.decimals = decimals
+        self.sequences = topology.sequences
+        self.vertex_count = 0
+
+    def sequence(self, index: int) -> List[List[float]]:
+        points: List[Point] = []
+        for arc_id, reverse in self.sequences[index]:
+            arc = self.arcs[arc_id]
+            for point in (reversed(arc) if reverse else arc):
+                # Rounding can make neighbours coincide; never repeat a point
+                if not points or points[-1] != point:
+                    points.append(point)
+        return [list(p) for p in points]
+
+    def point(self, coords) -> List[float]:
+        return [round(float(coords[0]), self.decimals), round(float(coords[1]), self.decimals)]
+
+    def geometry(self, geometry: Optional[Dict[str, Any]], counter: List[int]) -> Optional[Dict[str, Any]]:
+        """Rebuild a geometry from simplified sequences; None if it collapses entirely"""
+        if not geometry:
+            return geometry
+        geom_type = geometry.get('type')
+        coords = geometry.get('coordinates') or []
+
+        def next_sequence():
+            counter[0] += 1
+            return self.sequence(counter[0] - 1)
+
+        def line():
+            points = next_sequence()
+            return points if len(points) >= 2 else None
+
+        def ring():
+            points = next_sequence()
+            return points if len(points) >= 4 else None
+
+        def polygon(rings):
+            parts = [ring() for _ in rings]
+            if not parts or parts[0] is None:
+                return None
+            return [parts[0]] + [hole for hole in parts[1:] if hole is not None]
+
+        if geom_type == 'Point':
+            new_coords = self.point(coords) if coords else coords
+        elif geom_type == 'MultiPoint':
+            new_coords = [self.point(c) for c in coords]
+        elif geom_type == 'LineString':
+            new_coords = line()
+        elif geom_type == 'MultiLineString':
+            new_coords = [part for part in (line() for _ in coords) if part is not None] or None
+        elif geom_type == 'Polygon':
+            new_coords = polygon(coords)
+        elif geom_type == 'MultiPolygon':
+            new_coords = [part for part in (polygon(p) for p in coords) if part is not None] or None
+        elif geom_type == 'GeometryCollection':
+            children = [self.geometry(child, counter) for child in geometry.get('geometries') or []]
+            children = [child for child in children if child is not None]
+            return {**geometry, 'geometries': children} if children else None
+        else:
+            return geometry
+
+        if new_coords is None:
+            return None
+        self.vertex_count += _count_vertices(new_coords)
+        return {**geometry, 'coordinates': new_coords}
+
+
+def _count_vertices(coords) -> int:
+    if not coords:
+        return 0
+    if isinstance(coords[0], (int, float)):
+        return 1
+    return sum(_count_vertices(c) for c in coords)
+
+
+def build_pyramid(geojson: Dict[str, Any], zooms=PYRAMID_ZOOMS) -> Dict[int, Tuple[Dict[str, Any], int]]:
+    """Simplify a GeoJSON object at each zoom; returns {zoom: (geojson, vertex count)}"""
+    if not isinstance(geojson, dict) or 'type' not in geojson:
+        raise ValueError('Not a GeoJSON object')
+
+    features = list(_iter_feature_objects(geojson))
+    bare_geometry = not features and geojson['type'] not in ('FeatureCollection', 'Feature')
+    geometries = [geojson] if bare_geometry else [f.get('geometry') for f in features]
+
+    sequences: List[Tuple[List[Point], bool]] = []
+    for geometry in geometries:
+        _geometry_sequences(geometry, sequences)
+
+    topology = _Topology(sequences)
+    significance = [vertex_significance([mercator(x, y) for x, y in arc]) for arc in topology.arcs]
+
+    levels = {}
+    for zoom in zooms:
+        level = _Level(topology, significance, zoom)
+        counter = [0]
+        new_geometries = [level.geometry(geometry, counter) for geometry in geometries]
+
+        if bare_geometry:
+            simplified = new_geometries[0] or {'type': 'GeometryCollection', 'geometries': []}
+        elif geojson['type'] == 'Feature':
+            simplified = {**geojson, 'geometry': new_geometries[0]}
+        else:
+            simplified = {
+                **geojson,
+                'features': [{**f, 'geometry': g} for f, g in zip(features, new_geometries)],
+            }
+        levels[zoom] = (simplified, level.vertex_count)
+    return levels
+
+
+# ---------------------------------------------------------------------------
+# Files beside the upload
+# ---------------------------------------------------------------------------
+
+def manifest_path(file_path: str) -> str:
+    return f'{file_path}.pyramid.json'
+
+
+def _level_path(file_path: str, zoom: int) -> str:
+    return f'{file_path}.z{zoom}.geojson'
+
+
+def _signature(file_path: str) -> List[int]:
+    stat = os.stat(file_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _load_manifest(file_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(manifest_path(file_path), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('signature') != _signature(file_path):
+        return None
+    return manifest
+
+
+def write_pyramid(file_path: str) -> Dict[str, Any]:
+    """Build the pyramid for a GeoJSON file, write its levels and manifest, and return the manifest"""
+    signature = _signature(file_path)
+    with open(file_path, 'r') as f:
+        geojson = json.load(f)
+
+    manifest = {'signature': signature, 'source_bytes': signature[1], 'levels': {}}
+    for zoom, (simplified, vertex_count) in build_pyramid(geojson).items():
+        path = _level_path(file_path, zoom)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(simplified, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        manifest['levels'][str(zoom)] = {
+            'file': os.path.basename(path),
+            'vertices': vertex_count,
+            'bytes': os.path.getsize(path),
+        }
+
+    # The manifest goes last so it never points at levels that are not written yet
+    tmp_path = f'{manifest_path(file_path)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(file_path))
+    return manifest
+
+
+_build_locks: Dict[str, threading.Lock] = {}
+_build_locks_lock = threading.Lock()
+
+
+def get_pyramid(file_path: str) -> Dict[str, Any]:
+    """Return the manifest of a file's pyramid, (re)building it if it is missing or stale"""
+    manifest = _load_manifest(file_path)
+    if manifest is not None:
+        return manifest
+
+    with _build_locks_lock:
+        build_lock = _build_locks.setdefault(file_path, threading.Lock())
+    with build_lock:
+        # Another thread may have finished the build while this one waited
+        manifest = _load_manifest(file_path)
+        if manifest is None:
+            manifest = write_pyramid(file_path)
+    return manifest
+
+
+def pyramid_level_path(file_path: str, zoom: int) -> str:
+    """The file to serve for a layer at a map zoom: a simplified level or the original"""
+    level = level_for_zoom(zoom)
+    if level is None:
+        return file_path
+    manifest = get_pyramid(file_path)
+    return os.path.join(os.path.dirname(file_path), manifest['levels'][str(level)]['file'])
@@ -0,0 +1,280 @@
+"""
+Packed R-tree over the features of an uploaded GeoJSON layer.
+
+The index records, for every feature of a FeatureCollection, its bounding box
+and the byte range it occupies in the file. Entries are bulk-loaded with
+Sort-Tile-Recursive (STR) packing, so a bbox query visits O(log n) nodes and
+the matching features are copied straight out of the file without parsing
+it. The index is saved next to the layer file and rebuilt whenever the
+file's modification time or size changes.
+"""
+
+import json
+import math
+import os
+import re
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from django.conf import settings
+from .layer_stats import geometry_bbox
+
+
+NODE_SIZE = 16
+
+_MAGIC = b'MRTREE01'
+_HEADER = struct.Struct('<8sqqiqi')
+
+# Strings (with escapes) and the structural characters of JSON
+_JSON_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}:]', re.DOTALL)
+
+BBox = Tuple[float, float, float, float]
+
+
+class SpatialIndexError(ValueError):
+    """Raised when a file cannot be indexed"""
+
+
+def iter_feature_spans(data: bytes) -> Iterator[Tuple[int, int]]:
+    """Yield the (start, end) byte range of every object in a FeatureCollection's features array"""
+    depth = 0
+    key = None
+    last_string = None
+    features_depth = None
+    feature_start = None
+
+    for match in _JSON_TOKEN.finditer(data):
+        token = match.group()
+        char = token[:1]
+        if char == b'"':
+            last_string = token
+        elif char == b':':
+            if depth == 1:
+                key = last_string
+        elif char in b'[{':
+            if features_depth is None and depth == 1 and char == b'[' and key == b'"features"':
+                features_depth = depth + 1
+            elif features_depth is not None and depth == features_depth and char == b'{':
+                feature_start = match.start()
+            depth += 1
+        else:
+            depth -= 1
+            if features_depth is not None:
+                if depth == features_depth and char == b'}' and feature_start is not None:
+                    yield feature_start, match.end()
+                    feature_start = None
+                elif depth < features_depth:
+                    return
+            if depth == 0:
+                break
+
+    if features_depth is None:
+        raise SpatialIndexError('Only GeoJSON FeatureCollections can be spatially indexed')
+
+
+def _str_order(entries: List[tuple], node_size: int) -> List[tuple]:
+    """Sort-Tile-Recursive order: vertical slices by x center, each sorted by y center"""
+    if not entries:
+        return []
+    leaf_count = math.ceil(len(entries) / node_size)
+    slice_size = node_size * math.ceil(math.sqrt(leaf_count))
+    by_x = sorted(entries, key=lambda e: e[0] + e[2])
+    ordered = []
+    for i in range(0, len(by_x), slice_size):
+        ordered.extend(sorted(by_x[i:i + slice_size], key=lambda e: e[1] + e[3]))
+    return ordered
+
+
+class SpatialIndex:
+    """STR-packed R-tree mapping bounding boxes to feature byte ranges"""
+
+    def __init__(self, levels: List[Tuple[array, array]], spans: array, node_size: int = NODE_SIZE):
+        # Each level holds a flat box array (minx, miny, maxx, maxy per entry)
+        # and a ref array: (feature index, 0) on the leaf level and the
+        # (start, end) range of child entries in the level below otherwise.
+        self.levels = levels
+        self.spans = spans
+        self.node_size = node_size
+
+    @property
+    def feature_count(self) -> int:
+        return len(self.spans) // 2
+
+    @classmethod
+    def build(cls, data: bytes, node_size: int = NODE_SIZE) -> 'SpatialIndex':
+        """Index the features of a GeoJSON FeatureCollection held in memory"""
+        spans = array('q')
+        entries = []
+        for start, end in iter_feature_spans(data):
+            feature_index = len(spans) // 2
+            spans.extend((start, end))
+            try:
+                feature = json.loads(data[start:end])
+            except ValueError as e:
+                raise SpatialIndexError(f'Invalid feature at byte {start}: {str(e)}') from e
+            bbox = geometry_bbox(feature.get('geometry'))
+            # Features without coordinates can never intersect a bbox
+            if bbox is not None:
+                entries.append((*bbox, feature_index, 0))
+
+        levels = []
+        level = _str_order(entries, node_size)
+        while True:
+            levels.append((
+                array('d', [v for e in level for v in e[:4]]),
+                array('q', [v for e in level for v in e[4:]]),
+            ))
+            if len(level) <= 1:
+                break
+            parents = []
+            for i in range(0, len(level), node_size):
+                children = level[i:i + node_size]
+                parents.append((
+                    min(c[0] for c in children), min(c[1] for c in children),
+                    max(c[2] for c in children), max(c[3] for c in children),
+                    i, i + len(children),
+                ))
+            # Parents keep explicit child ranges, so they can be reordered freely
+            level = _str_order(parents, node_size) if len(parents) > node_size else parents
+        return cls(levels, spans, node_size)
+
+    def query(self, bbox: BBox) -> List[int]:
+        """Indices of the features whose bounding box intersects bbox, in file order"""
+        minx, miny, maxx, maxy = bbox
+        top = len(self.levels) - 1
+        stack = [(top, i) for i in range(len(self.levels[top][0]) // 4)]
+        found = []
+        while stack:
+            level, i = stack.pop()
+            boxes, refs = self.levels[level]
+            b = 4 * i
+            if boxes[b] > maxx or boxes[b + 2] < minx or boxes[b + 1] > maxy or boxes[b + 3] < miny:
+                continue
+            if level == 0:
+                found.append(refs[2 * i])
+            else:
+                stack.extend((level - 1, child) for child in range(refs[2 * i], refs[2 * i + 1]))
+        found.sort()
+        return found
+
+    def feature_span(self, feature_index: int) -> Tuple[int, int]:
+        return self.spans[2 * feature_index], self.spans[2 * feature_index + 1]
+
+    def save(self, path: str, signature: Tuple[int, int]):
+        """Write the index atomically, tagged with the source file's (mtime_ns, size)"""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, signature[0], signature[1], self.node_size,
+                                     self.feature_count, len(self.levels)))
+                self.spans.tofile(f)
+                for boxes, refs in self.levels:
+                    f.write(struct.pack('<q', len(boxes) // 4))
+                    boxes.tofile(f)
+                    refs.tofile(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path: str, signature: Tuple[int, int]) -> Optional['SpatialIndex']:
+        """Read a saved index, or return None if it is missing, corrupt or stale"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(_HEADER.size)
+                if len(header) != _HEADER.size:
+                    return None
+                magic, mtime_ns, size, node_size, feature_count, level_count = _HEADER.unpack(header)
+                if magic != _MAGIC or (mtime_ns, size) != tuple(signature):
+                    return None
+                spans = array('q')
+                spans.fromfile(f, 2 * feature_count)
+                levels = []
+                for _ in range(level_count):
+                    (count,) = struct.unpack('<q', f.read(8))
+                    boxes, refs = array('d'), array('q')
+                    boxes.fromfile(f, 4 * count)
+                    refs.fromfile(f, 2 * count)
+                    levels.append((boxes, refs))
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(levels, spans, node_size)
+
+
+def index_path(file_path: str) -> str:
+    return f'{file_path}.rtree'
+
+
+_index_cache: OrderedDict = OrderedDict()
+_index_cache_lock = threading.Lock()
+_index_build_locks: Dict[str, threading.Lock] = {}
+
+
+def get_spatial_index(file_path: str) -> SpatialIndex:
+    """
+    Return the spatial index for a GeoJSON file, loading or (re)building it as needed.
+
+    Raises SpatialIndexError if the file is not an indexable FeatureCollection.
+    """
+    stat = os.stat(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    max_entries = getattr(settings, 'MUNDI_SPATIAL_INDEX_CACHE_SIZE', 32)
+
+    with _index_cache_lock:
+        cached = _index_cache.get(file_path)
+        if cached and cached[0] == signature:
+            _index_cache.move_to_end(file_path)
+            return cached[1]
+        build_lock = _index_build_locks.setdefault(file_path, threading.Lock())
+
+    with build_lock:
+        with _index_cache_lock:
+            cached = _index_cache.get(file_path)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+        index = SpatialIndex.load(index_path(file_path), signature)
+        if index is None:
+            with open(file_path, 'rb') as f:
+                index = SpatialIndex.build(f.read())
+            index.save(index_path(file_path), signature)
+
+        with _index_cache_lock:
+            _index_cache[file_path] = (signature, index)
+            _index_cache.move_to_end(file_path)
+            while len(_index_cache) > max_entries:
+                evicted, _ = _index_cache.popitem(last=False)
+                _index_build_locks.pop(evicted, None)
+    return index
+
+
+def parse_bbox(raw: str) -> BBox:
+    """Parse 'minx,miny,maxx,maxy'; raises ValueError if malformed"""
+    values = [float(v) for v in raw.split(',')]
+    if len(values) != 4 or not all(math.isfinite(v) for v in values):
+        raise ValueError('bbox must be four numbers: minx,miny,maxx,maxy')
+    minx, miny, maxx, maxy = values
+    if minx > maxx or miny > maxy:
+        raise ValueError('bbox minimums must not exceed its maximums')
+    return minx, miny, maxx, maxy
+
+
+def read_features(file_path: str, index: SpatialIndex, feature_indices: Sequence[int],
+                  chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Yield the raw bytes of the given features, comma separated, straight from the file"""
+    with open(file_path, 'rb') as f:
+        for n, feature_index in enumerate(feature_indices):
+            start, end = index.feature_span(feature_index)
+            if n:
+                yield b','
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
@@ -0,0 +1,787 @@
+"""
+Vectorized spatial queries over stored layers.
+
+Every operation runs on the NumPy arrays of a layer's memory-mapped columnar
+copy (see columnar.py), so answering "how many points fall inside polygon X"
+or "what is the total area of these parcels" never builds a Python object
+per vertex. Queries and results are plain JSON, for the ``spatial/`` API and
+for the AI chat to ground its answers in computed numbers.
+
+Distances, lengths and areas are in metres for longitude/latitude layers
+(great-circle distances and spherical areas) and in the layer's CRS units
+for projected ones. Geometry collections are skipped by the geometric
+operations.
+"""
+
+import json
+import math
+import os
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from .columnar import (
+    ABSENT, LINESTRING, MULTILINESTRING, MULTIPOINT, MULTIPOLYGON, NULL, NULL_VALUE, OPAQUE, POINT, POLYGON,
+    VALUE, ColumnarLayer, get_columnar_layer,
+)
+from .geojson_validator import is_geographic
+from .spatial_index import parse_bbox
+
+
+# Features listed in a result unless the query asks for fewer
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# Mean Earth radius in metres
+EARTH_RADIUS = 6371008.8
+
+OPERATIONS = ('select', 'count_in_polygons', 'nearest', 'measure', 'aggregate')
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+
+# Point/segment pairs compared per block by the distance and point-in-polygon kernels
+_BLOCK = 1 << 20
+
+_KINDS = {
+    POINT: 'point', MULTIPOINT: 'point', LINESTRING: 'line', MULTILINESTRING: 'line',
+    POLYGON: 'polygon', MULTIPOLYGON: 'polygon',
+}
+_POLYGON_CODES = (POLYGON, MULTIPOLYGON)
+
+LayerResolver = Callable[[Any], ColumnarLayer]
+
+
+class SpatialQueryError(ValueError):
+    """Raised when a spatial query is malformed or cannot run on its layers"""
+
+
+# ---------------------------------------------------------------------------
+# Kernels
+# ---------------------------------------------------------------------------
+
+def _range_indices(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Concatenation of arange(start, end) for every pair, without a Python loop"""
+    lengths = ends - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype=np.int64) - np.repeat(offsets - starts, lengths)
+
+
+def _ring_segments(coords: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                   closed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Segments (x1, y1, x2, y2) of the rings coords[start:end] and the ring of
+    each; closed rings also get the segment from their last vertex back to
+    their first
+    """
+    lengths = ends - starts
+    index = _range_indices(starts, ends)
+    following = index + 1
+    filled = lengths > 0
+    last = (np.cumsum(lengths) - 1)[filled]
+    following[last] = starts[filled]
+    keep = np.ones(len(index), dtype=bool)
+    keep[last[~closed[filled]]] = False
+    ring = np.repeat(np.arange(len(starts)), lengths)
+    segments = np.hstack((coords[index, :2], coords[following, :2]))
+    return segments[keep], ring[keep]
+
+
+def _crossings(x: np.ndarray, y: np.ndarray, segments: np.ndarray) -> np.ndarray:
+    """Number of segments crossed by a ray from each point towards +x"""
+    x1, y1, x2, y2 = segments.T
+    counts = np.zeros(len(x), dtype=np.int64)
+    step = max(1, _BLOCK // max(len(segments), 1))
+    for start in range(0, len(x), step):
+        px = x[start:start + step, None]
+        py = y[start:start + step, None]
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            at = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        counts[start:start + step] = (straddles & (px < at)).sum(axis=1)
+    return counts
+
+
+def _point_segment_distances(x: np.ndarray, y: np.ndarray, segments: np.ndarray,
+                             per_segment: bool = False) -> np.ndarray:
+    """
+    Planar distance from each point to its nearest segment or, with
+    per_segment, from each segment to its nearest point
+    """
+    result = np.full(len(segments) if per_segment else len(x), np.inf)
+    if not len(segments) or not len(x):
+        return result
+    x1, y1, x2, y2 = segments.T
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    # A zero-length segment is its first point (t is 0 either way)
+    length2[length2 == 0] = 1
+    step = max(1, _BLOCK // len(segments))
+    for start in range(0, len(x), step):
+        px = x[start:start + step, None]
+        py = y[start:start + step, None]
+        t = np.clip(((px - x1) * dx + (py - y1) * dy) / length2, 0, 1)
+        distances = np.hypot(px - x1 - t * dx, py - y1 - t * dy)
+        if per_segment:
+            np.minimum(result, distances.min(axis=0), out=result)
+        else:
+            result[start:start + step] = distances.min(axis=1)
+    return result
+
+
+def _segments_cross(segments: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Whether each segment touches or crosses any of the others"""
+    result = np.zeros(len(segments), dtype=bool)
+    if not len(segments) or not len(others):
+        return result
+    bx1, by1, bx2, by2 = others.T
+
+    def orientation(ax, ay, bx, by, cx, cy):
+        return np.sign((bx - ax) * (cy - ay) - (by - ay) * (cx - ax))
+
+    step = max(1, _BLOCK // len(others))
+    for start in range(0, len(segments), step):
+        ax1, ay1, ax2, ay2 = (segments[start:start + step, i, None] for i in range(4))
+        straddle = ((orientation(ax1, ay1, ax2, ay2, bx1, by1) * orientation(ax1, ay1, ax2, ay2, bx2, by2) <= 0) &
+                    (orientation(bx1, by1, bx2, by2, ax1, ay1) * orientation(bx1, by1, bx2, by2, ax2, ay2) <= 0))
+        # Collinear segments pass the orientation tests; they only meet if their extents overlap
+        overlap = ((np.minimum(ax1, ax2) <= np.maximum(bx1, bx2)) & (np.minimum(bx1, bx2) <= np.maximum(ax1, ax2)) &
+                   (np.minimum(ay1, ay2) <= np.maximum(by1, by2)) & (np.minimum(by1, by2) <= np.maximum(ay1, ay2)))
+        result[start:start + step] = (straddle & overlap).any(axis=1)
+    return result
+
+
+def _great_circle(lon1, lat1, lon2, lat2) -> np.ndarray:
+    """Haversine distance in metres between longitude/latitude degrees (broadcasting)"""
+    lon1, lat1, lon2, lat2 = (np.radians(v) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class _Plane:
+    """
+    Distances in a layer's units: geographic coordinates are projected onto
+    a plane tangent at the query's latitude for segment distances, and
+    vertex-to-vertex distances are great-circle
+    """
+
+    def __init__(self, geographic: bool, latitude: float = 0.0):
+        self.geographic = geographic
+        self.ky = math.pi / 180 * EARTH_RADIUS
+        self.kx = self.ky * math.cos(math.radians(latitude))
+
+    def project(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.geographic:
+            return x, y
+        return x * self.kx, y * self.ky
+
+    def project_segments(self, segments: np.ndarray) -> np.ndarray:
+        x1, y1 = self.project(segments[:, 0], segments[:, 1])
+        x2, y2 = self.project(segments[:, 2], segments[:, 3])
+        return np.column_stack((x1, y1, x2, y2))
+
+    def vertex_distances(self, x: np.ndarray, y: np.ndarray, px: np.ndarray, py: np.ndarray) -> np.ndarray:
+        """Distance from each (x, y) to the nearest of the points (px, py)"""
+        result = np.full(len(x), np.inf)
+        if not len(px):
+            return result
+        step = max(1, _BLOCK // len(px))
+        for start in range(0, len(x), step):
+            xs, ys = x[start:start + step, None], y[start:start + step, None]
+            if self.geographic:
+                distances = _great_circle(xs, ys, px, py)
+            else:
+                distances = np.hypot(xs - px, ys - py)
+            result[start:start + step] = distances.min(axis=1)
+        return result
+
+    def expand(self, bbox: Sequence[float], distance: float) -> Tuple[float, float, float, float]:
+        """A box holding every position within distance of bbox"""
+        minx, miny, maxx, maxy = bbox
+        if not self.geographic:
+            return minx - distance, miny - distance, maxx + distance, maxy + distance
+        dy = distance / self.ky
+        latitude = min(max(abs(miny), abs(maxy)) + dy, 90.0)
+        cosine = math.cos(math.radians(latitude))
+        dx = 360.0 if cosine < 1e-9 else distance / (self.ky * cosine)
+        return minx - dx, miny - dy, maxx + dx, maxy + dy
+
+
+# ---------------------------------------------------------------------------
+# Geometries
+# ---------------------------------------------------------------------------
+
+class Shape:
+    """A query geometry as flat arrays: its vertices and segments"""
+
+    def __init__(self, kind: str, rings: List[np.ndarray]):
+        self.kind = kind
+        rings = [ring for ring in rings if len(ring)]
+        if not rings:
+            raise SpatialQueryError('Geometry has no coordinates')
+        lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+        self.coords = np.concatenate(rings)
+        ends = np.cumsum(lengths)
+        self.segments = np.empty((0, 4))
+        if kind != 'point':
+            closed = np.full(len(rings), kind == 'polygon')
+            self.segments, _ = _ring_segments(self.coords, ends - lengths, ends, closed)
+        self.bbox = (*self.coords.min(axis=0).tolist(), *self.coords.max(axis=0).tolist())
+
+    @property
+    def center_latitude(self) -> float:
+        return (self.bbox[1] + self.bbox[3]) / 2
+
+    def contains(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Even-odd point-in-polygon test over all rings, so holes and multipolygons need no special case"""
+        inside = np.zeros(len(x), dtype=bool)
+        if self.kind != 'polygon':
+            return inside
+        minx, miny, maxx, maxy = self.bbox
+        candidates = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        inside[candidates] = _crossings(x[candidates], y[candidates], self.segments) % 2 == 1
+        return inside
+
+
+def shape_from_geojson(geometry: Any) -> Shape:
+    """A Shape for a GeoJSON geometry (or the geometry of a Feature)"""
+    if isinstance(geometry, dict) and geometry.get('type') == 'Feature':
+        geometry = geometry.get('geometry')
+    if not isinstance(geometry, dict):
+        raise SpatialQueryError('Expected a GeoJSON geometry')
+    geometry_type, coordinates = geometry.get('type'), geometry.get('coordinates')
+    try:
+        if geometry_type == 'Point':
+            kind, rings = 'point', [[coordinates]]
+        elif geometry_type == 'MultiPoint':
+            kind, rings = 'point', [coordinates]
+        elif geometry_type == 'LineString':
+            kind, rings = 'line', [coordinates]
+        elif geometry_type == 'MultiLineString':
+            kind, rings = 'line', coordinates
+        elif geometry_type == 'Polygon':
+            kind, rings = 'polygon', coordinates
+        elif geometry_type == 'MultiPolygon':
+            kind, rings = 'polygon', [ring for polygon in coordinates for ring in polygon]
+        else:
+            raise SpatialQueryError(f'Unsupported geometry type: {geometry_type}')
+        arrays = [np.asarray(ring, dtype=np.float64) for ring in rings]
+    except (TypeError, ValueError) as e:
+        if isinstance(e, SpatialQueryError):
+            raise
+        raise SpatialQueryError(f'Invalid {geometry_type} coordinates') from e
+    for ring in arrays:
+        if ring.size and (ring.ndim != 2 or ring.shape[1] < 2 or not np.isfinite(ring[:, :2]).all()):
+            raise SpatialQueryError(f'Invalid {geometry_type} coordinates')
+    return Shape(kind, [ring[:, :2] if ring.size else ring.reshape(0, 2) for ring in arrays])
+
+
+def feature_shape(layer: ColumnarLayer, row: int) -> Shape:
+    """A Shape for one feature of a layer, by its index"""
+    if not 0 <= row < layer.feature_count:
+        raise SpatialQueryError(f'Feature {row} does not exist; the layer has {layer.feature_count} features')
+    code = int(layer.geometry_types[row])
+    if code == OPAQUE:
+        return shape_from_geojson(layer.opaque.decode(np.array([row]))[0])
+    if code == NULL:
+        raise SpatialQueryError(f'Feature {row} has no geometry')
+    first = layer.part_offsets[layer.feature_offsets[row]]
+    last = layer.part_offsets[layer.feature_offsets[row + 1]]
+    bounds = layer.ring_offsets[first:last + 1].tolist()
+    return Shape(_KINDS[code], [layer.coords[start:end, :2] for start, end in zip(bounds[:-1], bounds[1:])])
+
+
+def _feature_rings(layer: ColumnarLayer, rows: np.ndarray):
+    """For every ring of the given features: its feature's position in rows, its index and coordinate range"""
+    first = layer.part_offsets[layer.feature_offsets[rows]]
+    last = layer.part_offsets[layer.feature_offsets[rows + 1]]
+    ring_index = _range_indices(first, last)
+    position = np.repeat(np.arange(len(rows)), last - first)
+    return position, ring_index, layer.ring_offsets[ring_index], layer.ring_offsets[ring_index + 1]
+
+
+def _feature_segments(layer: ColumnarLayer, rows: np.ndarray):
+    """Segments of the given features, with each one's feature position and whether it bounds a polygon"""
+    position, ring_index, starts, ends = _feature_rings(layer, rows)
+    polygon = np.isin(layer.geometry_types[rows], _POLYGON_CODES)[position]
+    segments, ring = _ring_segments(layer.coords, starts, ends, polygon)
+    return segments, position[ring], polygon[ring]
+
+
+def representative_points(layer: ColumnarLayer, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    One position per feature for point-in-polygon tests: the point itself,
+    or the mean of a feature's vertices; NaN for features without coordinates
+    """
+    ranges = layer.coordinate_ranges()[rows]
+    counts = ranges[:, 1] - ranges[:, 0]
+    x = np.full(len(rows), np.nan)
+    y = np.full(len(rows), np.nan)
+    filled = counts > 0
+    if filled.any():
+        coords = layer.coords[_range_indices(ranges[filled, 0], ranges[filled, 1])]
+        starts = np.cumsum(counts[filled]) - counts[filled]
+        x[filled] = np.add.reduceat(coords[:, 0], starts) / counts[filled]
+        y[filled] = np.add.reduceat(coords[:, 1], starts) / counts[filled]
+    return x, y
+
+
+def feature_distances(layer: ColumnarLayer, rows: np.ndarray, shape: Shape, plane: _Plane) -> np.ndarray:
+    """
+    Distance from each feature to the shape: zero where they touch, overlap
+    or one contains the other, inf for features without coordinates
+    """
+    distances = np.full(len(rows), np.inf)
+    ranges = layer.coordinate_ranges()[rows]
+    counts = ranges[:, 1] - ranges[:, 0]
+    filled = counts > 0
+    if not filled.any():
+        return distances
+    coords = layer.coords[_range_indices(ranges[filled, 0], ranges[filled, 1])]
+    x, y = coords[:, 0], coords[:, 1]
+    shape_x, shape_y = shape.coords[:, 0], shape.coords[:, 1]
+
+    # Feature vertices to the shape's vertices and segments
+    vertex = plane.vertex_distances(x, y, shape_x, shape_y)
+    projected_shape = plane.project_segments(shape.segments)
+    if len(shape.segments):
+        vertex = np.minimum(vertex, _point_segment_distances(*plane.project(x, y), projected_shape))
+    vertex[shape.contains(x, y)] = 0
+    distances[filled] = np.minimum.reduceat(vertex, np.cumsum(counts[filled]) - counts[filled])
+
+    # The shape's vertices to feature segments, and segments that cross
+    segments, segment_feature, polygon = _feature_segments(layer, rows)
+    if len(segments):
+        projected = plane.project_segments(segments)
+        nearest = _point_segment_distances(*plane.project(shape_x, shape_y), projected, per_segment=True)
+        nearest[_segments_cross(projected, projected_shape)] = 0
+        np.minimum.at(distances, segment_feature, nearest)
+        # Polygons holding the shape: a ray from its first vertex crosses their rings an odd number of times
+        if polygon.any():
+            px, py = shape_x[0], shape_y[0]
+            x1, y1, x2, y2 = segments[polygon].T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                at = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            crossed = ((y1 > py) != (y2 > py)) & (px < at)
+            distances[np.bincount(segment_feature[polygon][crossed], minlength=len(rows)) % 2 == 1] = 0
+    return distances
+
+
+def measure_features(layer: ColumnarLayer, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Area and length of each feature: polygon area (holes subtracted) and
+    perimeter, line length, zero for points
+    """
+    position, ring_index, starts, ends = _feature_rings(layer, rows)
+    polygon_ring = np.isin(layer.geometry_types[rows], _POLYGON_CODES)[position]
+    segments, ring = _ring_segments(layer.coords, starts, ends, polygon_ring)
+    x1, y1, x2, y2 = segments.T
+    if is_geographic(layer.crs):
+        lengths = _great_circle(x1, y1, x2, y2)
+        # Spherical ring area (Chamberlain and Duquette, 2007)
+        lon1, lat1, lon2, lat2 = np.radians(x1), np.radians(y1), np.radians(x2), np.radians(y2)
+        terms = (lon2 - lon1) * (2 + np.sin(lat1) + np.sin(lat2))
+        scale = EARTH_RADIUS * EARTH_RADIUS / 2
+    else:
+        lengths = np.hypot(x2 - x1, y2 - y1)
+        terms = x1 * y2 - x2 * y1
+        scale = 0.5
+    length = np.bincount(position[ring], weights=lengths, minlength=len(rows))
+
+    ring_area = np.abs(np.bincount(ring, weights=terms, minlength=len(starts))) * scale
+    # The first ring of each part is its shell, the others are holes
+    shell = np.isin(ring_index, layer.part_offsets[:-1])
+    ring_area = np.where(shell, ring_area, -ring_area) * polygon_ring
+    area = np.bincount(position, weights=ring_area, minlength=len(rows))
+    return area, length
+
+
+# ---------------------------------------------------------------------------
+# Query parameters
+# ---------------------------------------------------------------------------
+
+def _check_crs(layer: ColumnarLayer, other: ColumnarLayer):
+    if is_geographic(layer.crs) and is_geographic(other.crs):
+        return
+    if layer.crs != other.crs:
+        raise SpatialQueryError('The layers are in different coordinate reference systems')
+
+
+def _shape_param(value: Any, layer: ColumnarLayer, resolve: LayerResolver, name: str) -> Shape:
+    """A geometry given inline as GeoJSON or as {"layer": <id>, "feature": <index>}"""
+    if isinstance(value, dict) and 'layer' in value:
+        source = resolve(value['layer'])
+        _check_crs(layer, source)
+        return feature_shape(source, _int_param(value.get('feature'), f'{name}.feature'))
+    if isinstance(value, dict) and 'type' in value:
+        return shape_from_geojson(value)
+    raise SpatialQueryError(f'{name} must be a GeoJSON geometry or {{"layer": <id>, "feature": <index>}}')
+
+
+def _int_param(value: Any, name: str, minimum: int = 0, maximum: Optional[int] = None) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum or (maximum and value > maximum):
+        bounds = f'between {minimum} and {maximum}' if maximum else f'of at least {minimum}'
+        raise SpatialQueryError(f'{name} must be an integer {bounds}')
+    return value
+
+
+def _number_param(value: Any, name: str) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        raise SpatialQueryError(f'{name} must be a non-negative number')
+    return float(value)
+
+
+def _bbox_param(value: Any) -> Tuple[float, float, float, float]:
+    try:
+        return parse_bbox(value if isinstance(value, str) else ','.join(repr(float(v)) for v in value))
+    except (TypeError, ValueError) as e:
+        raise SpatialQueryError(f'Invalid bbox: {str(e)}') from e
+
+
+def _column(layer: ColumnarLayer, field: Any):
+    for column in layer.columns:
+        if column.name == field:
+            return column
+    raise SpatialQueryError(f'Unknown field: {field}')
+
+
+def _matches(layer: ColumnarLayer, rows: np.ndarray, field: str, expected: Any) -> np.ndarray:
+    column = _column(layer, field)
+    state = column.state[rows]
+    if expected is None:
+        return state == NULL_VALUE
+    if column.type not in ('string', 'json') and isinstance(expected, (int, float)):
+        return (state >= VALUE) & (column.values[rows] == expected)
+    return np.fromiter(
+        (s >= VALUE and value == expected for s, value in zip(state.tolist(), column.decode(rows))),
+        dtype=bool, count=len(rows),
+    )
+
+
+def _select(layer: ColumnarLayer, query: Dict[str, Any], resolve: LayerResolver) -> np.ndarray:
+    """
+    Indices of the features matching every filter of the query: ``bbox``,
+    ``where`` (attribute equality), ``within`` (polygon) and ``buffer``
+    (within ``distance`` of a geometry)
+    """
+    rows = np.arange(layer.feature_count)
+    if query.get('bbox') is not None:
+        rows = layer.intersecting(_bbox_param(query['bbox']))
+    where = query.get('where')
+    if where is not None:
+        if not isinstance(where, dict):
+            raise SpatialQueryError('where must be an object of field values')
+        for field, expected in where.items():
+            rows = rows[_matches(layer, rows, field, expected)]
+    if query.get('within') is not None:
+        shape = _shape_param(query['within'], layer, resolve, 'within')
+        if shape.kind != 'polygon':
+            raise SpatialQueryError('within must be a Polygon or MultiPolygon')
+        rows = rows[shape.contains(*representative_points(layer, rows))]
+    buffer = query.get('buffer')
+    if buffer is not None:
+        if not isinstance(buffer, dict):
+            raise SpatialQueryError('buffer must be {"geometry": ..., "distance": <number>}')
+        shape = _shape_param(buffer.get('geometry'), layer, resolve, 'buffer.geometry')
+        distance = _number_param(buffer.get('distance'), 'buffer.distance')
+        plane = _Plane(is_geographic(layer.crs), shape.center_latitude)
+        minx, miny, maxx, maxy = plane.expand(shape.bbox, distance)
+        boxes = layer.bbox[rows]
+        rows = rows[(boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx) & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny)]
+        rows = rows[feature_distances(layer, rows, shape, plane) <= distance]
+    return rows
+
+
+def _limit(query: Dict[str, Any], default: int = DEFAULT_LIMIT) -> int:
+    return _int_param(query.get('limit', default), 'limit', 1, MAX_LIMIT)
+
+
+def _units(layer: ColumnarLayer) -> str:
+    return 'metres' if is_geographic(layer.crs) else 'crs units'
+
+
+def describe_features(layer: ColumnarLayer, rows: Sequence[int], fields: Optional[Sequence[str]] = None,
+                      **values: Sequence[Any]) -> List[Dict[str, Any]]:
+    """Index, id and properties (all, or only ``fields``) of features, plus any per-feature values given"""
+    rows = np.asarray(rows, dtype=np.int64)
+    described = [{'index': row} for row in rows.tolist()]
+    if layer.ids is not None:
+        present = (layer.ids.state[rows] != ABSENT).tolist()
+        for item, has_id, value in zip(described, present, layer.ids.decode(rows)):
+            if has_id:
+                item['id'] = value
+    columns = [column for column in layer.columns if fields is None or column.name in fields]
+    for item in described:
+        item['properties'] = {}
+    for column in columns:
+        present = (column.state[rows] != ABSENT).tolist()
+        for item, has_value, value in zip(described, present, column.decode(rows)):
+            if has_value:
+                item['properties'][column.name] = value
+    for name, per_feature in values.items():
+        for item, value in zip(described, per_feature):
+            item[name] = value
+    return described
+
+
+def _fields_param(query: Dict[str, Any]) -> Optional[List[str]]:
+    fields = query.get('fields')
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+        raise SpatialQueryError('fields must be a list of field names')
+    return fields
+
+
+def _groups(layer: ColumnarLayer, rows: np.ndarray, field: Any) -> Tuple[List[Any], np.ndarray]:
+    """The distinct values of field over rows (None for missing ones) and each row's group"""
+    column = _column(layer, field)
+    present = (column.state[rows] >= VALUE).tolist()
+    keys: Dict[Any, int] = {}
+    labels: List[Any] = []
+    inverse = np.empty(len(rows), dtype=np.int64)
+    for n, (has_value, value) in enumerate(zip(present, column.decode(rows))):
+        value = value if has_value else None
+        key = json.dumps(value, sort_keys=True) if isinstance(value, (list, dict)) else value
+        group = keys.get(key)
+        if group is None:
+            group = keys[key] = len(labels)
+            labels.append(value)
+        inverse[n] = group
+    return labels, inverse
+
+
+def _sorted_groups(labels: List[Any], inverse: np.ndarray, limit: int,
+                   totals: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    counts = np.bincount(inverse, minlength=len(labels))
+    order = sorted(range(len(labels)), key=lambda g: -counts[g])[:limit]
+    return [
+        {'key': labels[g], 'count': int(counts[g]), **{name: values[g] for name, values in totals.items()}}
+        for g in order
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Operations
+# ---------------------------------------------------------------------------
+
+def select_features(layer: ColumnarLayer, query: Dict[str, Any], resolve: LayerResolver) -> Dict[str, Any]:
+    """Features matching the query's filters"""
+    rows = _select(layer, query, resolve)
+    limit = _limit(query)
+    return {
+        'count': len(rows),
+        'truncated': len(rows) > limit,
+        'features': describe_features(layer, rows[:limit], _fields_param(query)),
+    }
+
+
+def count_in_polygons(layer: ColumnarLayer, query: Dict[str, Any], resolve: LayerResolver) -> Dict[str, Any]:
+    """
+    How many of the layer's (filtered) features fall inside each polygon of
+    ``polygons``: {"layer": <id>, "features": [<index>, ...]}, every polygon
+    of that layer if features is omitted; most populated polygons first
+    """
+    polygons = query.get('polygons')
+    if not isinstance(polygons, dict) or 'layer' not in polygons:
+        raise SpatialQueryError('polygons must be {"layer": <id>, "features": [<index>, ...]}')
+    polygon_layer = resolve(polygons['layer'])
+    _check_crs(layer, polygon_layer)
+    if polygons.get('features') is None:
+        polygon_rows = np.flatnonzero(np.isin(polygon_layer.geometry_types, _POLYGON_CODES))
+    elif isinstance(polygons['features'], list):
+        polygon_rows = np.array([_int_param(row, 'polygons.features') for row in polygons['features']],
+                                dtype=np.int64)
+    else:
+        raise SpatialQueryError('polygons.features must be a list of feature indices')
+
+    rows = _select(layer, query, resolve)
+    x, y = representative_points(layer, rows)
+    order = np.argsort(x)
+    order = order[~np.isnan(x[order])]
+    x, y = x[order], y[order]
+
+    counts = np.zeros(len(polygon_rows), dtype=np.int64)
+    for n, row in enumerate(polygon_rows.tolist()):
+        shape = feature_shape(polygon_layer, row)
+        if shape.kind != 'polygon':
+            raise SpatialQueryError(f'Feature {row} of the polygon layer is not a polygon')
+        # Points are sorted by x, so only the slice under the polygon's extent is tested
+        minx, _, maxx, _ = shape.bbox
+        start, end = np.searchsorted(x, minx, 'left'), np.searchsorted(x, maxx, 'right')
+        counts[n] = shape.contains(x[start:end], y[start:end]).sum()
+
+    limit = _limit(query)
+    ranked = np.argsort(-counts, kind='stable')[:limit]
+    return {
+        'count': len(rows),
+        'inside': int(counts.sum()),
+        'polygon_count': len(polygon_rows),
+        'truncated': len(polygon_rows) > limit,
+        'polygons': describe_features(polygon_layer, polygon_rows[ranked], _fields_param(query),
+                                      count=counts[ranked].tolist()),
+    }
+
+
+def nearest_features(layer: ColumnarLayer, query: Dict[str, Any], resolve: LayerResolver) -> Dict[str, Any]:
+    """The ``limit`` (default 5) filtered features closest to ``point`` [x, y] or ``geometry``, nearest first"""
+    if query.get('point') is not None:
+        try:
+            x, y = (float(v) for v in query['point'])
+        except (TypeError, ValueError) as e:
+            raise SpatialQueryError('point must be [x, y]') from e
+        shape = shape_from_geojson({'type': 'Point', 'coordinates': [x, y]})
+    else:
+        shape = _shape_param(query.get('geometry'), layer, resolve, 'geometry')
+    limit = _limit(query, 5)
+
+    rows = _select(layer, query, resolve)
+    distances = feature_distances(layer, rows, shape, _Plane(is_geographic(layer.crs), shape.center_latitude))
+    reachable = np.flatnonzero(np.isfinite(distances))
+    if len(reachable) > limit:
+        reachable = reachable[np.argpartition(distances[reachable], limit - 1)[:limit]]
+    nearest = reachable[np.argsort(distances[reachable], kind='stable')]
+    return {
+        'count': len(rows),
+        'units': _units(layer),
+        'features': describe_features(layer, rows[nearest], _fields_param(query),
+                                      distance=distances[nearest].tolist()),
+    }
+
+
+def measure(layer: ColumnarLayer, query: Dict[str, Any], resolve: LayerResolver) -> Dict[str, Any]:
+    """
+    Total area and length of the filtered features, per ``group_by`` value
+    if given, with the largest features listed
+    """
+    rows = _select(layer, query, resolve)
+    limit = _limit(query)
+    area, length = measure_features(layer, rows)
+    result = {
+        'count': len(rows),
+        'units': _units(layer),
+        'area': float(area.sum()),
+        'length': float(length.sum()),
+    }
+    if query.get('group_by') is not None:
+        labels, inverse = _groups(layer, rows, query['group_by'])
+        result['groups'] = _sorted_groups(labels, inverse, limit, {
+            'area': np.bincount(inverse, weights=area, minlength=len(labels)).tolist(),
+            'length': np.bincount(inverse, weights=length, minlength=len(labels)).tolist(),
+        })
+    largest = np.lexsort((-length, -area))[:limit]
+    result['truncated'] = len(rows) > limit
+    result['features'] = describe_features(layer, rows[largest], _fields_param(query),
+                                           area=area[largest].tolist(), length=length[largest].tolist())
+    return result
+
+
+def aggregate(layer: ColumnarLayer, query: Dict[str, Any], resolve: LayerResolver) -> Dict[str, Any]:
+    """
+    ``stats`` (count, sum, mean, min, max) of a numeric ``field`` over the
+    filtered features, per ``group_by`` value if given; count needs no field
+    """
+    stats = query.get('stats') or list(AGGREGATES if query.get('field') is not None else ('count',))
+    if not isinstance(stats, list) or not set(stats) <= set(AGGREGATES):
+        raise SpatialQueryError(f"stats must be a list of: {', '.join(AGGREGATES)}")
+    rows = _select(layer, query, resolve)
+
+    if query.get('group_by') is not None:
+        labels, inverse = _groups(layer, rows, query['group_by'])
+    else:
+        labels, inverse = [None], np.zeros(len(rows), dtype=np.int64)
+    groups = len(labels)
+
+    totals: Dict[str, List[Any]] = {}
+    numeric = [stat for stat in stats if stat != 'count']
+    if numeric:
+        if query.get('field') is None:
+            raise SpatialQueryError(f"{', '.join(numeric)} need a field")
+        column = _column(layer, query['field'])
+        if column.type not in ('int64', 'number', 'bool'):
+            raise SpatialQueryError(f"{query['field']} is not a numeric field")
+        values = column.values[rows].astype(np.float64)
+        valid = (column.state[rows] >= VALUE) & ~np.isnan(values)
+        group_of, values = inverse[valid], values[valid]
+        value_counts = np.bincount(group_of, minlength=groups)
+        sums = np.bincount(group_of, weights=values, minlength=groups)
+        minimums = np.full(groups, np.inf)
+        maximums = np.full(groups, -np.inf)
+        np.minimum.at(minimums, group_of, values)
+        np.maximum.at(maximums, group_of, values)
+        integral = column.type == 'int64'
+
+        def number(value, present):
+            if not present:
+                return None
+            return int(value) if integral else float(value)
+
+        totals['values'] = value_counts.tolist()
+        for stat in numeric:
+            if stat == 'sum':
+                totals['sum'] = [number(v, True) for v in sums]
+            elif stat == 'mean':
+                totals['mean'] = [float(s / c) if c else None for s, c in zip(sums, value_counts)]
+            elif stat == 'min':
+                totals['min'] = [number(v, c > 0) for v, c in zip(minimums, value_counts)]
+            else:
+                totals['max'] = [number(v, c > 0) for v, c in zip(maximums, value_counts)]
+
+    result = {'count': len(rows), 'field': query.get('field')}
+    if query.get('group_by') is None:
+        result.update({name: values[0] for name, values in totals.items()})
+    else:
+        limit = _limit(query)
+        result['group_by'] = query['group_by']
+        result['group_count'] = groups
+        result['truncated'] = groups > limit
+        result['groups'] = _sorted_groups(labels, inverse, limit, totals)
+    return result
+
+
+_OPERATIONS = {
+    'select': select_features,
+    'count_in_polygons': count_in_polygons,
+    'nearest': nearest_features,
+    'measure': measure,
+    'aggregate': aggregate,
+}
+
+
+def run_spatial_query(query: Any, resolve: LayerResolver) -> Dict[str, Any]:
+    """
+    Run one query, ``{"operation": ..., "layer": <layer id>, ...}``, with
+    resolve mapping layer ids to columnar layers; raises SpatialQueryError
+    """
+    if not isinstance(query, dict):
+        raise SpatialQueryError('The query must be a JSON object')
+    operation = _OPERATIONS.get(query.get('operation'))
+    if operation is None:
+        raise SpatialQueryError(f"operation must be one of: {', '.join(OPERATIONS)}")
+    if query.get('layer') is None:
+        raise SpatialQueryError('layer is required')
+    layer = resolve(query['layer'])
+    result = operation(layer, query, resolve)
+    return {'operation': query['operation'], 'layer': str(query['layer']), **result}
+
+
+def project_layer_resolver(project) -> LayerResolver:
+    """Resolve layer ids of one project to their columnar layers, rejecting anything else"""
+    from .models import MundiLayer
+    from .storage import layer_geojson_path
+
+    resolved: Dict[str, ColumnarLayer] = {}
+
+    def resolve(layer_id: Any) -> ColumnarLayer:
+        key = str(layer_id)
+        if key in resolved:
+            return resolved[key]
+        try:
+            layer = project.layers.get(id=uuid.UUID(key))
+        except (ValueError, MundiLayer.DoesNotExist) as e:
+            raise SpatialQueryError(f'Layer {key} is not in this project') from e
+        data_path = layer_geojson_path(layer)
+        if not data_path or not os.path.exists(data_path):
+            raise SpatialQueryError(f'Layer {layer.name} has no vector data')
+        try:
+            resolved[key] = get_columnar_layer(data_path)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise SpatialQueryError(f'Layer {layer.name} is not a vector layer: {str(e)}') from e
+        return resolved[key]
+
+    return resolve
@@ -0,0 +1,37 @@
+import hashlib
+import os
+from typing import Optional
+from django.conf import settings
+
+
+def layer_file_path(layer) -> Optional[str]:
+    """Return the absolute path of a layer's uploaded file, or None if it has none"""
+    if not layer.file_path:
+        return None
+
+    # Handle both string paths and FieldFile objects
+    if hasattr(layer.file_path, 'path'):
+        return layer.file_path.path
+    return os.path.join(settings.MEDIA_ROOT, str(layer.file_path))
+
+
+def layer_geojson_path(layer) -> Optional[str]:
+    """
+    The GeoJSON file served for a layer: its upload, or for other vector and
+    point cloud formats the GeoJSON converted from it at ingest.
+    """
+    from .readers import converted_path, needs_conversion
+
+    file_path = layer_file_path(layer)
+    if file_path and needs_conversion(file_path):
+        return converted_path(file_path)
+    return file_path
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hex SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
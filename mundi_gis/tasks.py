@@ -0,0 +1,132 @@
+"""
+Background job handlers for Mundi GIS.
+
+Each handler takes the job payload and returns a JSON-serializable result
+that is stored on the ``BackgroundJob`` row. Raising marks the attempt as
+failed and lets the queue retry it.
+"""
+
+import requests
+from .jobs import job_handler
+from .layer_stats import layer_analysis_info, update_layer_statistics
+from .llm_admission import BACKGROUND
+from .local_llm import LocalLLMService
+from .models import MundiLayer, MundiMapProject
+from .mundi_api import upload_layer_file, uses_mundi_api
+from .point_cloud import get_octree, is_point_cloud
+from .precompressed import precompress_layer
+from .raster_tiles import RasterError, get_raster_tiles, is_raster
+from .simplify import get_pyramid
+from .spatial_index import SpatialIndexError, get_spatial_index
+from .readers import ReaderError, convert_layer_file, needs_conversion
+from .storage import layer_file_path, layer_geojson_path
+from .vector_tiles import get_tile_index
+
+
+def _llm_service() -> LocalLLMService:
+    # Failed completions raise, so the queue retries them instead of storing the error as the result
+    llm_service = LocalLLMService(priority=BACKGROUND, raise_errors=True)
+    if not llm_service.is_available():
+        # Raising lets the queue retry once Ollama is back
+        raise RuntimeError('Local LLM (Ollama) is not available.')
+    return llm_service
+
+
+@job_handler('layer_ingest')
+def ingest_layer(payload):
+    """Upload a new layer to Mundi AI, convert non-GeoJSON formats to GeoJSON and then to columnar storage, extract its statistics, build its tile and spatial indexes and simplification pyramid, precompress its responses, tile rasters, and build point cloud octrees"""
+    layer = MundiLayer.objects.select_related('map_project').get(id=payload['layer_id'])
+    project = layer.map_project
+    result = {'layer_id': str(layer.id), 'mundi': 'local'}
+
+    file_path = layer_file_path(layer)
+    if not layer.mundi_layer_id.startswith('local_'):
+        # Uploaded by an earlier attempt of this job; a retry must not create a duplicate remote layer
+        result['mundi'] = 'uploaded'
+    elif uses_mundi_api(project) and file_path:
+        # A failed Mundi upload is not retried: the layer is still usable locally
+        try:
+            mundi_response = upload_layer_file(project, file_path)
+            layer.mundi_layer_id = mundi_response.get('id', layer.mundi_layer_id)
+            layer.save(update_fields=['mundi_layer_id'])
+            result['mundi'] = 'uploaded'
+        except (requests.exceptions.RequestException, ValueError, OSError) as e:
+            result['mundi'] = 'failed'
+            result['mundi_error'] = str(e)
+
+    # Shapefiles, CSV and point clouds are converted to GeoJSON for every later stage.
+    # A file that cannot be read is not retried: the statistics record the failure
+    if file_path and needs_conversion(file_path):
+        try:
+            result['converted'] = convert_layer_file(file_path)
+        except ReaderError as e:
+            result['conversion_error'] = str(e)
+
+    statistics = update_layer_statistics(layer)
+    result['feature_count'] = statistics.feature_count
+    result['statistics_error'] = result.get('conversion_error') or statistics.error
+
+    # Only GeoJSON layers can be tiled; the statistics pass already checked that
+    data_path = layer_geojson_path(layer)
+    result['tile_index'] = False
+    result['spatial_index'] = False
+    result['pyramid'] = False
+    result['precompressed'] = []
+    if data_path and not statistics.error:
+        get_tile_index(data_path, persist=True)
+        result['tile_index'] = True
+        try:
+            get_spatial_index(data_path)
+            result['spatial_index'] = True
+        except SpatialIndexError as e:
+            result['spatial_index_error'] = str(e)
+        get_pyramid(data_path)
+        result['pyramid'] = True
+        result['precompressed'] = precompress_layer(layer, data_path)
+
+    # A raster that cannot be placed on the map is not retried either
+    if file_path and is_raster(file_path):
+        try:
+            result['raster_tiles'] = get_raster_tiles(file_path).info()
+        except RasterError as e:
+            result['raster_tiles_error'] = str(e)
+
+    if file_path and is_point_cloud(file_path):
+        try:
+            octree = get_octree(file_path)
+            result['octree'] = {key: octree.manifest[key] for key in ('point_count', 'node_count', 'depth')}
+        except ReaderError as e:
+            result['octree_error'] = str(e)
+
+    return result
+
+
+@job_handler('ai_analyze_layer')
+def analyze_layer(payload):
+    """Answer a question about a layer with the local LLM"""
+    layer = MundiLayer.objects.select_related('statistics').get(id=payload['layer_id'])
+    question = payload.get('question') or 'Tell me about this layer'
+
+    analysis = _llm_service().analyze_gis_data(layer_analysis_info(layer), question)
+    return {
+        'analysis': analysis,
+        'question': question,
+        'layer_name': layer.name,
+    }
+
+
+@job_handler('ai_generate_description')
+def generate_description(payload):
+    """Generate a project description with the local LLM"""
+    project = MundiMapProject.objects.get(id=payload['project_id'])
+    project_info = {
+        'name': project.name,
+        'description': project.description,
+        'layer_count': project.layers.count()
+    }
+
+    description = _llm_service().generate_map_description(project_info)
+    return {
+        'description': description,
+        'project_name': project.name,
+    }
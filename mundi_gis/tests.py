@@ -1,3 +1,2054 @@
-from django.test import TestCase
+import asyncio
+import codecs
+import gzip
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+from unittest import mock
+import httpx
+import numpy as np
+import requests
+from PIL import Image, TiffImagePlugin, TiffTags
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from .columnar import columnar_path, get_columnar_layer
+from .geojson_validator import JSONSyntaxError, iter_json_events, validate_geojson, validate_geojson_file
+from .jobs import claim_next_job, enqueue, job_handler, run_job
+from .layer_stats import update_layer_statistics
+from .llm_admission import BACKGROUND, INTERACTIVE, AdmissionController, LLMBusyError, get_admission_controller
+from .llm_cache import LLMResponseCache, LRUCacheBackend, SQLiteCacheBackend
+from .llm_tools import ProjectTools, _result_cache
+from .llm_health import HealthMonitor
+from .llm_router import Backend, LLMRouter, parse_backend
+from .local_llm import LLMServiceError, LocalLLMService
+from .models import BackgroundJob, MundiLayer, MundiMapProject, UploadSession
+from .prompts import PROJECT_SYSTEM_PROMPT, PROJECT_TOOLS_SYSTEM_PROMPT, build_project_prompt, count_tokens, truncate_tokens
+from .raster_tiles import RasterError, get_raster_tiles, read_raster
+from .readers import ReaderError, convert_layer_file, converted_path, read_csv, read_point_cloud, read_shapefile
+from .point_cloud import get_octree, octree_path, write_octree
+from .precompressed import parse_accept_encoding, precompress_layer
+from . import precompressed
+from .simplify import PYRAMID_ZOOMS, build_pyramid, manifest_path, pyramid_level_path
+from .spatial_index import SpatialIndex, SpatialIndexError, get_spatial_index, index_path, parse_bbox, read_features
+from .uploads import delete_stale_uploads, partial_path
+from .vector_tiles import BUFFER, EXTENT, _index_cache, _sidecar_path, get_tile_index, mercator
 
-# Create your tests here.
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for the condition')
+        time.sleep(0.005)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    """Priority queueing in front of the local LLM"""
+
+    def _acquire_in_thread(self, controller, priority, outcomes, name):
+        def run():
+            try:
+                slot = controller.acquire(priority)
+            except LLMBusyError:
+                outcomes.append((name, 'busy'))
+                return
+            outcomes.append((name, 'admitted'))
+            slot.release()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_free_slots_are_taken_immediately(self):
+        controller = AdmissionController(limit=2, queue_size=0, timeout=1)
+        first, second = controller.acquire(), controller.acquire()
+        self.assertEqual(controller.status()['active'], 2)
+        with self.assertRaises(LLMBusyError):
+            controller.acquire()
+        first.release()
+        second.release()
+        self.assertEqual(controller.status()['active'], 0)
+
+    def test_interactive_requests_go_ahead_of_background_ones(self):
+        controller = AdmissionController(limit=1, queue_size=4, timeout=5)
+        held = controller.acquire()
+        outcomes = []
+        threads = [self._acquire_in_thread(controller, BACKGROUND, outcomes, 'background')]
+        _wait_until(lambda: controller.status()['queued'] == 1)
+        threads.append(self._acquire_in_thread(controller, INTERACTIVE, outcomes, 'interactive'))
+        _wait_until(lambda: controller.status()['queued'] == 2)
+
+        held.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(outcomes, [('interactive', 'admitted'), ('background', 'admitted')])
+        self.assertEqual(controller.status()['active'], 0)
+
+    def test_full_queue_evicts_the_lowest_priority_waiter(self):
+        controller = AdmissionController(limit=1, queue_size=1, timeout=5)
+        held = controller.acquire()
+        outcomes = []
+        background = self._acquire_in_thread(controller, BACKGROUND, outcomes, 'background')
+        _wait_until(lambda: controller.status()['queued'] == 1)
+
+        interactive = self._acquire_in_thread(controller, INTERACTIVE, outcomes, 'interactive')
+        background.join(5)
+        self.assertEqual(outcomes, [('background', 'busy')])
+
+        held.release()
+        interactive.join(5)
+        self.assertEqual(outcomes[-1], ('interactive', 'admitted'))
+        self.assertEqual(controller.status()['rejected'], 1)
+
+    def test_full_queue_rejects_requests_of_the_same_priority(self):
+        controller = AdmissionController(limit=1, queue_size=1, timeout=5)
+        held = controller.acquire()
+        outcomes = []
+        waiting = self._acquire_in_thread(controller, INTERACTIVE, outcomes, 'first')
+        _wait_until(lambda: controller.status()['queued'] == 1)
+
+        with self.assertRaises(LLMBusyError) as raised:
+            controller.acquire(INTERACTIVE)
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+        held.release()
+        waiting.join(5)
+        self.assertEqual(outcomes, [('first', 'admitted')])
+
+    def test_waiting_times_out(self):
+        controller = AdmissionController(limit=1, queue_size=4, timeout=0.05)
+        held = controller.acquire()
+        with self.assertRaises(LLMBusyError):
+            controller.acquire()
+        status = controller.status()
+        self.assertEqual((status['queued'], status['timed_out'], status['active']), (0, 1, 1))
+        held.release()
+        self.assertEqual(controller.status()['active'], 0)
+
+    def test_cancelled_waiter_hands_a_granted_slot_on(self):
+        controller = AdmissionController(limit=1, queue_size=4, timeout=5)
+
+        async def scenario():
+            held = controller.acquire()
+            first = asyncio.ensure_future(controller.aacquire())
+            second = asyncio.ensure_future(controller.aacquire())
+            while controller.status()['queued'] < 2:
+                await asyncio.sleep(0)
+
+            # The slot goes to the first waiter, which is cancelled before it wakes up
+            held.release()
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            slot = await asyncio.wait_for(second, 5)
+            self.assertEqual(controller.status()['active'], 1)
+            slot.release()
+
+        asyncio.run(scenario())
+        status = controller.status()
+        self.assertEqual((status['active'], status['queued']), (0, 0))
+
+    @override_settings(OLLAMA_MAX_CONCURRENT_REQUESTS=3)
+    def test_every_backend_has_its_own_limit(self):
+        first = get_admission_controller('http://first.test/v1')
+        second = get_admission_controller('http://second.test/v1')
+        self.assertIsNot(first, second)
+        self.assertIs(get_admission_controller('http://first.test/v1'), first)
+        self.assertEqual((first.limit, second.limit), (3, 3))
+
+
+_attempt_errors = []
+
+
+@job_handler('test_flaky')
+def _flaky_job(payload):
+    if _attempt_errors:
+        raise RuntimeError(_attempt_errors.pop(0))
+    return {'echo': payload.get('value')}
+
+
+@override_settings(MUNDI_JOBS_EAGER=False, MUNDI_JOBS_RETRY_BACKOFF=10)
+class JobQueueTests(TestCase):
+    """Claiming jobs and retrying failed ones with backoff"""
+
+    def tearDown(self):
+        _attempt_errors.clear()
+
+    def _run_failing(self, job):
+        with self.assertLogs('mundi_gis.jobs', 'ERROR'):
+            return run_job(job)
+
+    def _claim_now(self, job):
+        # Skip the backoff instead of waiting it out
+        BackgroundJob.objects.filter(id=job.id).update(run_after=timezone.now())
+        claimed = claim_next_job('test-worker')
+        self.assertEqual(claimed.id, job.id)
+        return claimed
+
+    def test_jobs_are_claimed_by_priority_and_only_once(self):
+        later = enqueue('test_flaky', {'value': 'later'}, priority=5)
+        sooner = enqueue('test_flaky', {'value': 'sooner'}, priority=0)
+
+        claimed = claim_next_job('test-worker')
+        self.assertEqual(claimed.id, sooner.id)
+        self.assertEqual((claimed.status, claimed.attempts, claimed.locked_by),
+                         (BackgroundJob.STATUS_RUNNING, 1, 'test-worker'))
+        self.assertEqual(claim_next_job('test-worker').id, later.id)
+        self.assertIsNone(claim_next_job('test-worker'))
+
+    def test_successful_job_stores_its_result(self):
+        enqueue('test_flaky', {'value': 3})
+        job = run_job(claim_next_job('test-worker'))
+        self.assertEqual(job.status, BackgroundJob.STATUS_SUCCEEDED)
+        self.assertEqual(job.result, {'echo': 3})
+        self.assertEqual((job.error, job.locked_by), ('', ''))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_failed_job_is_retried_with_exponential_backoff(self):
+        _attempt_errors.extend(['first failure', 'second failure'])
+        job = enqueue('test_flaky', {'value': 'retried'}, max_attempts=3)
+
+        before = timezone.now()
+        job = self._run_failing(claim_next_job('test-worker'))
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.STATUS_PENDING, 1))
+        self.assertTrue(job.error.startswith('first failure'))
+        self.assertGreaterEqual(job.run_after, before + timedelta(seconds=10))
+        self.assertLess(job.run_after, before + timedelta(seconds=20))
+        # Not runnable again until the backoff has passed
+        self.assertIsNone(claim_next_job('test-worker'))
+
+        before = timezone.now()
+        job = self._run_failing(self._claim_now(job))
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.STATUS_PENDING, 2))
+        self.assertGreaterEqual(job.run_after, before + timedelta(seconds=20))
+
+        job = run_job(self._claim_now(job))
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.STATUS_SUCCEEDED, 3))
+        self.assertEqual(job.result, {'echo': 'retried'})
+
+    def test_job_fails_after_its_last_attempt(self):
+        _attempt_errors.extend(['always'] * 2)
+        job = enqueue('test_flaky', max_attempts=2)
+
+        job = self._run_failing(claim_next_job('test-worker'))
+        self.assertEqual(job.status, BackgroundJob.STATUS_PENDING)
+        job = self._run_failing(self._claim_now(job))
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.STATUS_FAILED, 2))
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(claim_next_job('test-worker'))
+
+
+class ColumnarRoundTripTests(SimpleTestCase):
+    """A GeoJSON layer read back from its columnar file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _round_trip(self, geojson):
+        path = os.path.join(self.directory, 'layer.geojson')
+        with open(path, 'w') as f:
+            json.dump(geojson, f)
+        layer = get_columnar_layer(path)
+        self.assertTrue(os.path.exists(columnar_path(path)))
+        return layer, json.loads(b''.join(layer.geojson_chunks()))
+
+    def test_feature_collection_round_trips(self):
+        geojson = {
+            'type': 'FeatureCollection',
+            'name': 'sample',
+            'features': [
+                {
+                    'type': 'Feature', 'id': 1,
+                    'properties': {'name': 'café', 'population': 1200, 'area': 2.5, 'open': True},
+                    'geometry': {'type': 'Point', 'coordinates': [10.25, -45.5]},
+                },
+                {
+                    'type': 'Feature', 'id': 'b',
+                    'properties': {'name': None, 'tags': ['x', 'y'], 'nested': {'a': 1}},
+                    'geometry': {'type': 'Polygon', 'coordinates': [
+                        [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0], [0.0, 0.0]],
+                        [[1.0, 1.0], [1.0, 2.0], [2.0, 2.0], [1.0, 1.0]],
+                    ]},
+                },
+                {
+                    'type': 'Feature',
+                    'properties': {'population': 7},
+                    'geometry': {'type': 'MultiLineString', 'coordinates': [
+                        [[1.5, 2.5], [3.5, 4.5]], [[-1.0, -2.0], [-3.0, -4.0], [-5.0, -6.0]],
+                    ]},
+                },
+                {'type': 'Feature', 'properties': {}, 'geometry': None},
+                {
+                    'type': 'Feature', 'properties': {'name': 'mixed'},
+                    'geometry': {'type': 'GeometryCollection', 'geometries': [
+                        {'type': 'Point', 'coordinates': [1.0, 2.0]},
+                    ]},
+                },
+            ],
+        }
+        layer, restored = self._round_trip(geojson)
+        self.assertEqual(layer.feature_count, 5)
+        self.assertEqual(restored, geojson)
+
+    def test_bounding_boxes_select_features(self):
+        geojson = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'n': n}, 'geometry': {'type': 'Point', 'coordinates': [n, n]}}
+            for n in range(10)
+        ]}
+        layer, _ = self._round_trip(geojson)
+        indices = layer.intersecting((2.5, 2.5, 5.0, 5.0))
+        self.assertEqual(indices.tolist(), [3, 4, 5])
+        subset = json.loads(b''.join(layer.geojson_chunks(indices)))
+        self.assertEqual([f['properties']['n'] for f in subset['features']], [3, 4, 5])
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_fields(data):
+    """(field number, value) pairs of a protobuf message; length-delimited values as bytes"""
+    fields, pos = [], 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        else:
+            raise AssertionError(f'Unexpected wire type {wire_type}')
+        fields.append((key >> 3, value))
+    return fields
+
+
+def _packed(data):
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = _read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _decode_value(data):
+    field, value = _read_fields(data)[0]
+    if field == 1:
+        return value.decode('utf-8')
+    if field == 3:
+        return struct.unpack('<d', value)[0]
+    if field == 6:
+        return _unzigzag(value)
+    if field == 7:
+        return bool(value)
+    return value
+
+
+def _decode_geometry(commands):
+    """The parts of a feature geometry in absolute tile coordinates; rings are left open"""
+    parts, x, y, i = [], 0, 0, 0
+    while i < len(commands):
+        command, count = commands[i] & 0x7, commands[i] >> 3
+        i += 1
+        if command == 7:
+            continue
+        if command == 1:
+            parts.append([])
+        for _ in range(count):
+            x, y = x + _unzigzag(commands[i]), y + _unzigzag(commands[i + 1])
+            parts[-1].append((x, y))
+            i += 2
+    return parts
+
+
+def _decode_tile(data):
+    """The layers of a Mapbox Vector Tile, by name"""
+    layers = {}
+    for field, layer_data in _read_fields(data):
+        fields = _read_fields(layer_data)
+        keys = [value.decode('utf-8') for number, value in fields if number == 3]
+        values = [_decode_value(value) for number, value in fields if number == 4]
+        features = []
+        for number, feature_data in fields:
+            if number != 2:
+                continue
+            feature = {'id': None, 'properties': {}}
+            for feature_field, value in _read_fields(feature_data):
+                if feature_field == 1:
+                    feature['id'] = value
+                elif feature_field == 2:
+                    tags = _packed(value)
+                    feature['properties'] = {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])}
+                elif feature_field == 3:
+                    feature['type'] = value
+                elif feature_field == 4:
+                    feature['geometry'] = _decode_geometry(_packed(value))
+            features.append(feature)
+        layer = dict(fields)
+        layers[layer[1].decode('utf-8')] = {'version': layer[15], 'extent': layer[5], 'features': features}
+    return layers
+
+
+def _signed_area(ring):
+    return sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]))
+
+
+class VectorTileTests(SimpleTestCase):
+    """Mapbox Vector Tiles cut from a GeoJSON layer, decoded again"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(_index_cache.clear)
+
+    def _index(self, features, persist=False):
+        path = os.path.join(self.directory, 'layer.geojson')
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+        return path, get_tile_index(path, persist=persist)
+
+    def test_points_and_properties_round_trip(self):
+        _, index = self._index([{
+            'type': 'Feature', 'id': 7,
+            'properties': {'name': 'café', 'count': 3, 'offset': -2, 'ratio': 0.25, 'open': True, 'empty': None},
+            'geometry': {'type': 'Point', 'coordinates': [90.0, 45.0]},
+        }])
+        layer = _decode_tile(index.get_tile(0, 0, 0, 'places'))['places']
+        self.assertEqual((layer['version'], layer['extent']), (2, EXTENT))
+        feature, = layer['features']
+        self.assertEqual((feature['id'], feature['type']), (7, 1))
+        self.assertEqual(feature['properties'], {'name': 'café', 'count': 3, 'offset': -2, 'ratio': 0.25, 'open': True})
+        x, y = mercator(90.0, 45.0)
+        self.assertEqual(feature['geometry'], [[(round(x * EXTENT), round(y * EXTENT))]])
+
+    def test_polygon_rings_are_wound_and_clipped(self):
+        square = [[-20, -20], [20, -20], [20, 20], [-20, 20], [-20, -20]]
+        hole = [[-5, -5], [-5, 5], [5, 5], [5, -5], [-5, -5]]
+        _, index = self._index([{
+            'type': 'Feature', 'properties': {},
+            'geometry': {'type': 'Polygon', 'coordinates': [square, hole]},
+        }])
+        exterior, interior = _decode_tile(index.get_tile(0, 0, 0))['layer']['features'][0]['geometry']
+        self.assertGreater(_signed_area(exterior), 0)
+        self.assertLess(_signed_area(interior), 0)
+
+        # Tile 1/1/0 gets the north-eastern quarters, clipped to the tile and its buffer
+        feature, = _decode_tile(index.get_tile(1, 1, 0))['layer']['features']
+        exterior, interior = feature['geometry']
+        self.assertGreater(_signed_area(exterior), 0)
+        self.assertLess(_signed_area(interior), 0)
+        for x, y in exterior + interior:
+            self.assertTrue(-BUFFER <= x <= EXTENT + BUFFER and -BUFFER <= y <= EXTENT + BUFFER)
+        self.assertEqual(min(x for x, _ in exterior), -BUFFER)
+
+    def test_tiles_without_features_are_empty(self):
+        _, index = self._index([{
+            'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [10.0, 10.0]},
+        }])
+        self.assertEqual(index.get_tile(2, 0, 3), b'')
+
+    def test_persisted_index_serves_the_same_tiles(self):
+        features = [
+            {'type': 'Feature', 'id': n, 'properties': {'n': n}, 'geometry': {'type': 'LineString', 'coordinates': [
+                [n, -n], [n + 3, n], [n + 6, -n / 2],
+            ]}}
+            for n in range(20)
+        ]
+        path, built = self._index(features, persist=True)
+        self.assertTrue(os.path.exists(_sidecar_path(path)))
+        with open(_sidecar_path(path)) as f:
+            json.load(f)
+
+        _index_cache.clear()
+        loaded = get_tile_index(path)
+        self.assertIsNot(loaded, built)
+        for z, x, y in [(0, 0, 0), (3, 4, 3), (5, 16, 15)]:
+            self.assertEqual(loaded.get_tile(z, x, y), built.get_tile(z, x, y))
+
+        # A sidecar that cannot be read is ignored and the index rebuilt
+        with open(_sidecar_path(path), 'w') as f:
+            f.write('not json')
+        _index_cache.clear()
+        self.assertEqual(get_tile_index(path).get_tile(0, 0, 0), built.get_tile(0, 0, 0))
+
+
+class _ProjectTestCase(TestCase):
+    """A logged-in user with a local project whose layer files go to a temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('mapper', password='secret')
+        self.project = MundiMapProject.objects.create(name='Test', created_by=self.user, mundi_project_id='local_test')
+        self.client.force_login(self.user)
+
+    def _layer(self, name, content, file_name=None, layer_type='vector'):
+        layer = MundiLayer(name=name, layer_type=layer_type, map_project=self.project, mundi_layer_id=f'local_{name}')
+        if content is not None:
+            if not isinstance(content, bytes):
+                content = json.dumps(content).encode('utf-8')
+            layer.file_path.save(file_name or f'{name}.geojson', ContentFile(content), save=False)
+        layer.save()
+        return layer
+
+
+def _points(count, start=0):
+    return {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'n': n}, 'geometry': {'type': 'Point', 'coordinates': [n, n / 2]}}
+        for n in range(start, start + count)
+    ]}
+
+
+@mock.patch('mundi_gis.views.LAYER_STREAM_CHUNK_SIZE', 16)
+class StreamedLayersTests(_ProjectTestCase):
+    """?stream=1 on the project layers endpoint, which copies the layer files as they are"""
+
+    def setUp(self):
+        super().setUp()
+        self.first = self._layer('first', _points(3))
+        # A byte order mark is dropped, not copied into the middle of the JSON
+        self.second = self._layer('second', codecs.BOM_UTF8 + json.dumps(_points(2, start=10)).encode('utf-8'))
+        self._layer('not_an_object', b'[1, 2, 3]')
+        self._layer('without_file', None)
+        self.url = f'/mundi/projects/{self.project.id}/layers-data/?stream=1'
+
+    def _check_layers(self, response, body):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        layers = {layer['name']: layer for layer in json.loads(body)['layers']}
+        self.assertEqual(set(layers), {'first', 'second'})
+        self.assertEqual(layers['first']['geojson'], _points(3))
+        self.assertEqual(layers['second']['geojson'], _points(2, start=10))
+        self.assertEqual(layers['first']['id'], str(self.first.id))
+        self.assertEqual(layers['second']['layer_type'], 'vector')
+
+    def test_layers_are_streamed_under_wsgi(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        with self.assertLogs('mundi_gis.views', 'WARNING'):
+            body = b''.join(response.streaming_content)
+        self._check_layers(response, body)
+
+    async def test_layers_are_streamed_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url)
+        self.assertTrue(response.is_async)
+        with self.assertLogs('mundi_gis.views', 'WARNING'):
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        self._check_layers(response, body)
+
+    def test_layer_filter_applies(self):
+        response = self.client.get(f'{self.url}&layers={self.second.id}')
+        layers = json.loads(b''.join(response.streaming_content))['layers']
+        self.assertEqual([layer['name'] for layer in layers], ['second'])
+
+
+class ResponseCacheTests(SimpleTestCase):
+    """Cached LLM replies: hits, misses, expiry and eviction"""
+
+    def test_lru_hits_misses_and_expiry(self):
+        cache = LLMResponseCache(LRUCacheBackend(), ttl=60)
+        key = LLMResponseCache.make_key('model', 'system', 'user', {'temperature': 0})
+        self.assertIsNone(cache.get(key))
+        cache.set(key, 'reply')
+        self.assertEqual(cache.get(key), 'reply')
+        self.assertEqual(cache.stats(), {'backend': 'lru', 'hits': 1, 'misses': 1, 'stores': 1, 'hit_rate': 0.5})
+
+        with mock.patch('mundi_gis.llm_cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get(key))
+        self.assertIsNone(cache.get(key))
+
+    def test_keys_depend_on_everything_that_shapes_the_reply(self):
+        key = LLMResponseCache.make_key('model', 'system', 'user', {'temperature': 0, 'top_p': 0.9})
+        self.assertEqual(key, LLMResponseCache.make_key('model', 'system', 'user', {'top_p': 0.9, 'temperature': 0}))
+        self.assertNotEqual(key, LLMResponseCache.make_key('other', 'system', 'user', {'temperature': 0, 'top_p': 0.9}))
+        self.assertNotEqual(key, LLMResponseCache.make_key('model', 'system', 'user?', {'temperature': 0, 'top_p': 0.9}))
+        self.assertNotEqual(key, LLMResponseCache.make_key('model', 'system', 'user', {'temperature': 1, 'top_p': 0.9}))
+
+    def test_lru_evicts_the_least_recently_used_entries(self):
+        backend = LRUCacheBackend(max_entries=2, max_bytes=10)
+        backend.set('a', 'aaa', None)
+        backend.set('b', 'bbb', None)
+        backend.get('a')
+        backend.set('c', 'ccc', None)
+        self.assertEqual([backend.get(key) for key in 'abc'], ['aaa', None, 'ccc'])
+
+        # Over the byte budget the oldest entries go, and a value larger than all of it is not kept
+        backend.set('d', 'dddddddd', None)
+        self.assertEqual([backend.get(key) for key in 'acd'], [None, None, 'dddddddd'])
+        backend.set('e', 'e' * 11, None)
+        self.assertIsNone(backend.get('e'))
+
+    def test_sqlite_backend_persists_expires_and_evicts(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'cache', 'llm.sqlite3')
+        backend = SQLiteCacheBackend(path, max_entries=2)
+        backend.set('a', 'first', None)
+        backend.set('b', 'second', 30)
+        self.assertEqual(SQLiteCacheBackend(path).get('a'), 'first')
+
+        with mock.patch('mundi_gis.llm_cache.time.time', return_value=time.time() + 31):
+            self.assertIsNone(backend.get('b'))
+        backend.set('c', 'third', None)
+        backend.set('d', 'fourth', None)
+        self.assertEqual([backend.get(key) for key in 'acd'], [None, 'third', 'fourth'])
+
+
+def _completion(content):
+    """A successful non-streamed chat completion response"""
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+    return response
+
+
+class CachedCompletionTests(SimpleTestCase):
+    """LocalLLMService answering repeated questions from its response cache"""
+
+    def setUp(self):
+        self.service = LocalLLMService()
+        self.service.cache = LLMResponseCache(LRUCacheBackend())
+        post = mock.patch.object(LocalLLMService, '_post', return_value=_completion('An answer'))
+        self.post = post.start()
+        self.addCleanup(post.stop)
+
+    def test_deterministic_replies_are_served_from_the_cache(self):
+        self.service.temperature = 0
+        replies = [self.service.analyze_text('What is a shapefile?') for _ in range(3)]
+        self.assertEqual(replies, ['An answer'] * 3)
+        self.assertEqual(self.post.call_count, 1)
+        self.assertEqual((self.service.cache.hits, self.service.cache.misses), (2, 1))
+
+        self.service.analyze_text('Something else')
+        self.assertEqual(self.post.call_count, 2)
+
+    def test_sampled_replies_bypass_the_cache(self):
+        self.service.temperature = 0.7
+        for _ in range(2):
+            self.service.analyze_text('What is a shapefile?')
+        self.assertEqual(self.post.call_count, 2)
+        self.assertEqual(self.service.cache.stores, 0)
+
+        with override_settings(OLLAMA_CACHE_NONDETERMINISTIC=True):
+            for _ in range(2):
+                self.service.analyze_text('What is a shapefile?')
+        self.assertEqual(self.post.call_count, 3)
+
+    def test_failed_replies_are_not_cached(self):
+        self.service.temperature = 0
+        self.post.return_value = mock.Mock(status_code=404, text='model not found')
+        self.assertEqual(self.service.analyze_text('Hello'), 'Error: 404 - model not found')
+        self.post.return_value = _completion('Hello there')
+        self.assertEqual(self.service.analyze_text('Hello'), 'Hello there')
+        self.assertEqual(self.post.call_count, 2)
+
+
+def _random_features(count, seed):
+    rng = random.Random(seed)
+    features = []
+    for n in range(count):
+        x, y = rng.uniform(-170, 160), rng.uniform(-80, 70)
+        size = rng.uniform(0.01, 10)
+        geometry = rng.choice([
+            {'type': 'Point', 'coordinates': [x, y]},
+            {'type': 'LineString', 'coordinates': [[x, y], [x + size, y + size / 2], [x + size / 3, y + size]]},
+            {'type': 'Polygon', 'coordinates': [[[x, y], [x + size, y], [x + size, y + size], [x, y]]]},
+            {'type': 'MultiPoint', 'coordinates': [[x, y], [x - size, y - size]]},
+            None,
+        ])
+        features.append({'type': 'Feature', 'properties': {'n': n, 'label': 'a "quoted" {brace}'}, 'geometry': geometry})
+    return features
+
+
+def _coordinates(value):
+    if isinstance(value[0], (int, float)):
+        yield value
+    else:
+        for item in value:
+            yield from _coordinates(item)
+
+
+def _intersects(feature, bbox):
+    if feature['geometry'] is None:
+        return False
+    points = list(_coordinates(feature['geometry']['coordinates']))
+    xs, ys = [p[0] for p in points], [p[1] for p in points]
+    return min(xs) <= bbox[2] and max(xs) >= bbox[0] and min(ys) <= bbox[3] and max(ys) >= bbox[1]
+
+
+class SpatialIndexTests(SimpleTestCase):
+    """The packed R-tree behind ?bbox= queries"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.features = _random_features(500, seed=10)
+        self.path = os.path.join(self.directory, 'layer.geojson')
+        self._write(self.features)
+
+    def _write(self, features):
+        with open(self.path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'name': 'x', 'features': features}, f, indent=1)
+
+    def test_queries_match_a_full_scan(self):
+        index = get_spatial_index(self.path)
+        self.assertEqual(index.feature_count, 500)
+        rng = random.Random(3)
+        for _ in range(50):
+            x, y = rng.uniform(-180, 170), rng.uniform(-90, 80)
+            bbox = (x, y, x + rng.uniform(0, 40), y + rng.uniform(0, 20))
+            expected = [n for n, feature in enumerate(self.features) if _intersects(feature, bbox)]
+            self.assertEqual(index.query(bbox), expected)
+        self.assertEqual(len(index.query((-180, -90, 180, 90))), sum(f['geometry'] is not None for f in self.features))
+
+    def test_small_nodes_build_a_deep_tree(self):
+        with open(self.path, 'rb') as f:
+            index = SpatialIndex.build(f.read(), node_size=4)
+        self.assertGreater(len(index.levels), 4)
+        bbox = (-20.0, -20.0, 20.0, 20.0)
+        self.assertEqual(index.query(bbox), [n for n, f in enumerate(self.features) if _intersects(f, bbox)])
+
+    def test_matching_features_are_copied_from_the_file(self):
+        index = get_spatial_index(self.path)
+        matches = index.query((0, 0, 30, 30))
+        self.assertTrue(matches)
+        copied = json.loads(b'[' + b''.join(read_features(self.path, index, matches, chunk_size=7)) + b']')
+        self.assertEqual(copied, [self.features[n] for n in matches])
+
+    def test_saved_index_is_reused_until_the_file_changes(self):
+        index = get_spatial_index(self.path)
+        stat = os.stat(self.path)
+        loaded = SpatialIndex.load(index_path(self.path), (stat.st_mtime_ns, stat.st_size))
+        self.assertEqual(loaded.query((-50, -50, 50, 50)), index.query((-50, -50, 50, 50)))
+        self.assertIsNone(SpatialIndex.load(index_path(self.path), (stat.st_mtime_ns + 1, stat.st_size)))
+
+        self._write(self.features[:10])
+        self.assertEqual(get_spatial_index(self.path).feature_count, 10)
+
+    def test_only_feature_collections_are_indexed(self):
+        with self.assertRaises(SpatialIndexError):
+            SpatialIndex.build(json.dumps({'type': 'Point', 'coordinates': [1, 2]}).encode('utf-8'))
+
+    def test_bbox_parsing(self):
+        self.assertEqual(parse_bbox('-1,-2.5,3,4'), (-1.0, -2.5, 3.0, 4.0))
+        for raw in ['1,2,3', '1,2,3,x', '3,0,1,1', '0,0,nan,1']:
+            with self.assertRaises(ValueError):
+                parse_bbox(raw)
+
+
+class BBoxLayerDataTests(_ProjectTestCase):
+    """?bbox= on the layer data endpoint"""
+
+    def test_only_intersecting_features_are_returned(self):
+        features = _random_features(200, seed=4)
+        layer = self._layer('random', {'type': 'FeatureCollection', 'features': features})
+        url = f'/mundi/projects/{self.project.id}/layers/{layer.id}/data/'
+        bbox = (-40.0, -30.0, 40.0, 30.0)
+
+        response = self.client.get(url, {'bbox': ','.join(map(str, bbox))})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(b''.join(response.streaming_content))
+        expected = [f for f in features if _intersects(f, bbox)]
+        self.assertEqual(data['feature_count'], len(expected))
+        self.assertEqual(data['geojson']['features'], expected)
+
+        self.assertEqual(self.client.get(url, {'bbox': '1,2,3'}).status_code, 400)
+
+
+def _neighbours(vertices=400, seed=11):
+    """Two squares sharing a wiggly border, plus a line and a point of their own"""
+    rng = random.Random(seed)
+    border = [[10.0, 0.0]] + [[10.0 + rng.uniform(-0.05, 0.05), 10.0 * n / vertices] for n in range(1, vertices)] + [[10.0, 10.0]]
+    west = [[0.0, 0.0]] + border + [[0.0, 10.0], [0.0, 0.0]]
+    east = [[10.0, 0.0], [20.0, 0.0], [20.0, 10.0]] + border[::-1]
+    return {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'name': 'west'}, 'geometry': {'type': 'Polygon', 'coordinates': [west]}},
+        {'type': 'Feature', 'properties': {'name': 'east'}, 'geometry': {'type': 'Polygon', 'coordinates': [east]}},
+        {'type': 'Feature', 'properties': {'name': 'river'}, 'geometry': {'type': 'LineString', 'coordinates': [
+            [30.0 + n * 0.01, math.sin(n / 10)] for n in range(500)
+        ]}},
+        {'type': 'Feature', 'properties': {'name': 'well'}, 'geometry': {'type': 'Point', 'coordinates': [1.123456789, 2.987654321]}},
+    ]}
+
+
+def _segments(ring):
+    return [tuple(sorted((tuple(a), tuple(b)))) for a, b in zip(ring, ring[1:])]
+
+
+def _on_outline(segment):
+    (x1, y1), (x2, y2) = segment
+    return (y1 == y2 and y1 in (0, 10)) or (x1 == x2 and x1 in (0, 20))
+
+
+class SimplificationPyramidTests(SimpleTestCase):
+    """Zoom levels simplified without opening gaps between neighbouring polygons"""
+
+    def test_shared_borders_stay_shared_at_every_level(self):
+        levels = build_pyramid(_neighbours())
+        self.assertEqual(set(levels), set(PYRAMID_ZOOMS))
+        for zoom, (geojson, _) in levels.items():
+            counts = {}
+            for feature in geojson['features'][:2]:
+                for segment in _segments(feature['geometry']['coordinates'][0]):
+                    counts[segment] = counts.get(segment, 0) + 1
+            # Every segment off the outer outline belongs to both squares
+            self.assertEqual([s for s, count in counts.items() if count == 1 and not _on_outline(s)], [], zoom)
+            self.assertFalse([s for s, count in counts.items() if count > 2], zoom)
+
+    def test_low_zooms_keep_fewer_vertices(self):
+        source = _neighbours()
+        levels = build_pyramid(source)
+        vertices = [levels[zoom][1] for zoom in PYRAMID_ZOOMS]
+        self.assertEqual(vertices, sorted(vertices))
+        self.assertLess(vertices[0], 50)
+        # Coordinates are rounded to a tenth of a pixel at the level's zoom
+        self.assertEqual(levels[0][0]['features'][3]['geometry']['coordinates'], [1.1, 3.0])
+        self.assertEqual(levels[12][0]['features'][3]['geometry']['coordinates'], [1.12346, 2.98765])
+        self.assertEqual(levels[0][0]['features'][3]['properties'], {'name': 'well'})
+
+    def test_levels_are_written_beside_the_file_and_rebuilt_when_it_changes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'layer.geojson')
+        with open(path, 'w') as f:
+            json.dump(_neighbours(), f)
+
+        self.assertEqual(pyramid_level_path(path, 20), path)
+        level_path = pyramid_level_path(path, 5)
+        self.assertEqual(os.path.dirname(level_path), directory)
+        with open(level_path) as f:
+            self.assertEqual(json.load(f), build_pyramid(_neighbours())[4][0])
+        with open(manifest_path(path)) as f:
+            built_from = json.load(f)['signature']
+
+        with open(path, 'w') as f:
+            json.dump(_neighbours(vertices=50), f)
+        pyramid_level_path(path, 5)
+        with open(manifest_path(path)) as f:
+            self.assertNotEqual(json.load(f)['signature'], built_from)
+
+
+class ConditionalLayerDataTests(_ProjectTestCase):
+    """ETags and 304 responses on the layer data endpoints"""
+
+    def setUp(self):
+        super().setUp()
+        self.layer = self._layer('points', _points(5))
+        self.url = f'/mundi/projects/{self.project.id}/layers/{self.layer.id}/data/'
+
+    def test_layers_get_validators_once_ingested(self):
+        self.assertNotIn('ETag', self.client.get(self.url))
+        update_layer_statistics(self.layer)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', response)
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_current_copies_get_a_304(self):
+        update_layer_statistics(self.layer)
+        response = self.client.get(self.url)
+
+        not_modified = self.client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        since = self.client.get(self.url, headers={'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(since.status_code, 304)
+
+        # Each zoom level and bbox is its own representation
+        zoomed = self.client.get(self.url, {'zoom': 3}, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(zoomed.status_code, 200)
+        self.assertNotEqual(zoomed['ETag'], response['ETag'])
+        boxed = self.client.get(self.url, {'bbox': '0,0,2,2'}, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(boxed.status_code, 200)
+
+    def test_new_file_changes_the_etag(self):
+        update_layer_statistics(self.layer)
+        etag = self.client.get(self.url)['ETag']
+
+        self.layer.file_path.save('points.geojson', ContentFile(json.dumps(_points(6)).encode('utf-8')))
+        update_layer_statistics(self.layer)
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(json.loads(response.content)['geojson']['features']), 6)
+
+    def test_project_etag_covers_every_layer(self):
+        update_layer_statistics(self.layer)
+        url = f'/mundi/projects/{self.project.id}/layers-data/'
+        etag = self.client.get(url, {'stream': 1})['ETag']
+        self.assertEqual(self.client.get(url, {'stream': 1}, headers={'If-None-Match': etag}).status_code, 304)
+
+        update_layer_statistics(self._layer('more', _points(2)))
+        response = self.client.get(url, {'stream': 1}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # A layer that has not been ingested yet cannot be validated
+        self._layer('pending', _points(1))
+        self.assertNotIn('ETag', self.client.get(url, {'stream': 1}))
+
+
+class PrecompressedLayerDataTests(_ProjectTestCase):
+    """Layer data sent in the compressed form written at ingest"""
+
+    def setUp(self):
+        super().setUp()
+        self.layer = self._layer('points', _points(50))
+        self.url = f'/mundi/projects/{self.project.id}/layers/{self.layer.id}/data/'
+        update_layer_statistics(self.layer)
+        self.plain = self.client.get(self.url, headers={'Accept-Encoding': 'identity'})
+        self.encodings = precompress_layer(self.layer, self.layer.file_path.path)
+
+    def _get(self, accept_encoding, **params):
+        response = self.client.get(self.url, params, headers={'Accept-Encoding': accept_encoding})
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_accept_encoding_parsing(self):
+        self.assertEqual(parse_accept_encoding('gzip, br;q=0.5, *;q=0'), {'gzip': 1.0, 'br': 0.5, '*': 0.0})
+        self.assertEqual(parse_accept_encoding('deflate;q=x'), {'deflate': 0.0})
+        self.assertEqual(parse_accept_encoding(''), {})
+
+    def test_gzip_body_matches_the_plain_response(self):
+        self.assertIn('gzip', self.encodings)
+        response, body = self._get('gzip;q=1.0, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(body), self.plain.content)
+        self.assertNotEqual(response['ETag'], self.plain['ETag'])
+
+    def test_brotli_is_preferred_when_available(self):
+        if precompressed.brotli is None:
+            self.skipTest('brotli is not installed')
+        response, body = self._get('gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(precompressed.brotli.decompress(body), self.plain.content)
+
+    def test_plain_response_without_an_accepted_encoding(self):
+        for accept_encoding in ('', 'identity', 'deflate', 'gzip;q=0, br;q=0'):
+            response, body = self._get(accept_encoding)
+            self.assertNotIn('Content-Encoding', response)
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(body, self.plain.content)
+
+        # Zoom levels were compressed too; bbox responses never are
+        response, body = self._get('gzip', zoom=2)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response, _ = self._get('gzip', bbox='0,0,5,5')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_stale_files_are_not_served(self):
+        # The body embeds the layer name, so renaming it outdates the compressed copies
+        self.layer.name = 'renamed'
+        self.layer.save()
+        response, body = self._get('gzip')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(json.loads(body)['layer_name'], 'renamed')
+
+
+@override_settings(MUNDI_UPLOAD_CHUNK_SIZE=64, MUNDI_JOBS_EAGER=False)
+class ChunkedUploadTests(_ProjectTestCase):
+    """Resumable uploads sent as a sequence of raw chunks"""
+
+    def _start(self, content, filename='places.geojson', **fields):
+        response = self.client.post(
+            f'/mundi/projects/{self.project.id}/uploads/',
+            json.dumps({'name': 'Places', 'layer_type': 'vector', 'filename': filename, 'size': len(content), **fields}),
+            content_type='application/json',
+        )
+        return response
+
+    def _put(self, upload_id, offset, chunk):
+        return self.client.put(f'/mundi/uploads/{upload_id}/?offset={offset}', chunk, content_type='application/octet-stream')
+
+    def _upload(self, content, chunk_size=64, **fields):
+        response = self._start(content, **fields)
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()['upload_id']
+        for offset in range(0, len(content), chunk_size):
+            response = self._put(upload_id, offset, content[offset:offset + chunk_size])
+            if response.status_code != 200:
+                break
+        return upload_id, response
+
+    def test_chunks_are_assembled_into_a_layer(self):
+        # Multi-byte characters straddle the chunk boundaries
+        content = json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'Zürich ☃ ' * n}, 'geometry': {'type': 'Point', 'coordinates': [8.5, 47.4]}}
+            for n in range(4)
+        ]}, ensure_ascii=False).encode('utf-8')
+        upload_id, response = self._upload(content, chunk_size=63)
+        self.assertEqual(response.json()['offset'], len(content))
+
+        response = self.client.post(f'/mundi/uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 201)
+        layer = MundiLayer.objects.get(id=response.json()['layer_id'])
+        self.assertEqual((layer.name, layer.layer_type, layer.map_project), ('Places', 'vector', self.project))
+        with open(layer.file_path.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertTrue(BackgroundJob.objects.filter(id=response.json()['job_id'], kind='layer_ingest').exists())
+
+        session = UploadSession.objects.get(id=upload_id)
+        self.assertEqual((session.status, session.layer), (UploadSession.STATUS_COMPLETED, layer))
+        self.assertFalse(os.path.exists(partial_path(session)))
+        self.assertEqual(self.client.post(f'/mundi/uploads/{upload_id}/complete/').status_code, 409)
+
+    def test_interrupted_upload_resumes_from_the_acknowledged_offset(self):
+        content = json.dumps(_points(10)).encode('utf-8')
+        upload_id = self._start(content).json()['upload_id']
+        self.assertEqual(self._put(upload_id, 0, content[:64]).status_code, 200)
+
+        # A chunk sent twice, or out of order, is refused with the offset to resume from
+        for offset in (0, 128):
+            response = self._put(upload_id, offset, content[offset:offset + 64])
+            self.assertEqual((response.status_code, response.json()['offset']), (409, 64))
+        response = self.client.post(f'/mundi/uploads/{upload_id}/complete/')
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 64))
+
+        offset = self.client.get(f'/mundi/uploads/{upload_id}/').json()['offset']
+        for start in range(offset, len(content), 64):
+            self.assertEqual(self._put(upload_id, start, content[start:start + 64]).status_code, 200)
+        self.assertEqual(self.client.post(f'/mundi/uploads/{upload_id}/complete/').status_code, 201)
+
+    def test_bad_chunks_are_rejected(self):
+        upload_id = self._start(b'x' * 200).json()['upload_id']
+        self.assertEqual(self._put(upload_id, 0, b'{' + b' ' * 64).status_code, 400)
+        self.assertEqual(self._put(upload_id, 0, b'').status_code, 400)
+
+        # Content that is not what the file claims to be ends the upload at its first chunk
+        response = self._put(upload_id, 0, b'[1, 2, 3]')
+        self.assertEqual(response.status_code, 422)
+        session = UploadSession.objects.get(id=upload_id)
+        self.assertEqual(session.status, UploadSession.STATUS_ABORTED)
+        self.assertFalse(os.path.exists(partial_path(session)))
+        self.assertEqual(self._put(upload_id, 0, b'{').status_code, 400)
+
+        _, response = self._upload(b'\x00\x01\x02\x03' + b'x' * 10, filename='image.tif')
+        self.assertEqual(response.status_code, 422)
+        _, response = self._upload(b'{"name": "\xff"}')
+        self.assertEqual(response.status_code, 422)
+
+    def test_invalid_geojson_is_rejected_on_completion(self):
+        content = json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': ['x', 1]}},
+        ]}).encode('utf-8')
+        upload_id, _ = self._upload(content)
+        response = self.client.post(f'/mundi/uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 422)
+        self.assertTrue(response.json()['errors'])
+        self.assertFalse(MundiLayer.objects.exists())
+
+    def test_uploads_are_declared_up_front(self):
+        self.assertEqual(self._start(b'x' * 10, filename='notes.txt').status_code, 400)
+        self.assertEqual(self._start(b'', filename='empty.geojson').status_code, 400)
+        self.assertEqual(self._start(b'x' * 10, layer_type='mesh').status_code, 400)
+
+    def test_stale_uploads_are_deleted(self):
+        upload_id = self._start(b'x' * 100).json()['upload_id']
+        UploadSession.objects.filter(id=upload_id).update(updated_at=timezone.now() - timedelta(days=2))
+        self._start(b'x' * 100)
+        self.assertEqual(delete_stale_uploads(timedelta(days=1)), 1)
+        self.assertEqual(UploadSession.objects.get(id=upload_id).status, UploadSession.STATUS_ABORTED)
+
+
+def _chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class GeoJSONValidatorTests(SimpleTestCase):
+    """Streaming validation gives the same answer however the bytes are split"""
+
+    def _collection(self, features, **members):
+        return json.dumps({'type': 'FeatureCollection', **members, 'features': features}, ensure_ascii=False).encode('utf-8')
+
+    def test_events_do_not_depend_on_chunk_boundaries(self):
+        data = '{"name": "Zürich ☃", "n": [1, -2.5e3, true, null], "escaped": "\\u00e9\\"", "empty": {}}'.encode('utf-8')
+        whole = list(iter_json_events([data]))
+        for size in (1, 2, 3, 7):
+            self.assertEqual(list(iter_json_events(_chunked(data, size))), whole)
+
+        values = [value for event, value, _ in whole if event == 'value']
+        self.assertEqual(values, ['Zürich ☃', 1, -2500.0, True, None, 'é"'])
+        # Offsets count bytes, so they land after the multi-byte characters correctly
+        for event, value, offset in whole:
+            if event == 'map_key':
+                self.assertEqual(data[offset:offset + len(value) + 2], f'"{value}"'.encode('utf-8'))
+
+    def test_syntax_errors_report_their_byte_offset(self):
+        for data, offset in ((b'{"a": 1,}', 8), (b'{"a": [1 2]}', 9), (b'{"a": 1} x', 9), (b'{"a": NaN}', 6), (b'{"a": "\xff"}', 7)):
+            with self.assertRaises(JSONSyntaxError) as raised:
+                list(iter_json_events(_chunked(data, 2)))
+            self.assertEqual(raised.exception.offset, offset, data)
+        with self.assertRaisesMessage(JSONSyntaxError, 'Unexpected end of file'):
+            list(iter_json_events([b'{"a": [1, 2']))
+
+    def test_valid_collection(self):
+        features = [{'type': 'Feature', 'properties': {'name': f'Ort {i} ☃'}, 'geometry': {
+            'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]],
+        }} for i in range(50)]
+        data = b'\xef\xbb\xbf' + self._collection(features)
+        for size in (1, 13, len(data)):
+            report = validate_geojson(_chunked(data, size))
+            self.assertTrue(report.is_valid, report.errors)
+            self.assertEqual((report.geojson_type, report.feature_count), ('FeatureCollection', 50))
+
+    def test_errors_name_the_feature_and_where_it_starts(self):
+        features = [{'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [1, 2]}}] * 3
+        features[1] = {'type': 'Feature', 'properties': {}, 'geometry': {
+            'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1]]],
+        }}
+        features[2] = {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [200, 2]}}
+        data = self._collection(features)
+        report = validate_geojson(_chunked(data, 5))
+
+        self.assertFalse(report.is_valid)
+        self.assertEqual([(e['path'], e['message']) for e in report.errors], [
+            ('$.features[1].geometry.coordinates[0]', 'Linear ring is not closed'),
+            ('$.features[2].geometry.coordinates', 'Longitude 200 is outside [-180, 180]'),
+        ])
+        self.assertTrue(data[report.errors[0]['offset']:].startswith(b'[[0, 0]'))
+        self.assertTrue(data[report.errors[1]['offset']:].startswith(b'[200, 2]'))
+
+    def test_projected_coordinates_are_not_range_checked(self):
+        features = [{'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [500000, 4649776]}}]
+        self.assertFalse(validate_geojson([self._collection(features)]).is_valid)
+        crs = {'type': 'name', 'properties': {'name': 'EPSG:32633'}}
+        self.assertTrue(validate_geojson([self._collection(features, crs=crs)]).is_valid)
+
+    def test_error_list_is_capped(self):
+        features = [{'type': 'Feature', 'properties': {}, 'geometry': None, 'extra': i} for i in range(5)]
+        features += [{'type': 'Point'}] * 100
+        report = validate_geojson([self._collection(features)], max_errors=10)
+        self.assertEqual(len(report.errors), 10)
+        self.assertTrue(report.truncated)
+        # Validation stops once the list is full instead of reading the rest of the file
+        self.assertLess(report.feature_count, 105)
+
+    def test_not_geojson(self):
+        for data, message in ((b'', 'File is empty'), (b'[1, 2]', 'GeoJSON must be a JSON object'),
+                              (b'{"type": "Map"}', "Not a GeoJSON type: 'Map'"),
+                              (b'{"type": "FeatureCollection"}', 'FeatureCollection needs a features array')):
+            report = validate_geojson([data])
+            self.assertEqual([e['message'] for e in report.errors], [message], data)
+
+    def test_file_is_read_in_pieces(self):
+        features = [{'type': 'Feature', 'properties': {'n': n}, 'geometry': {'type': 'Point', 'coordinates': [n % 360 - 180, 0]}}
+                    for n in range(2000)]
+        data = self._collection(features)
+        with tempfile.NamedTemporaryFile(suffix='.geojson', delete=False) as f:
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+        report = validate_geojson_file(f.name)
+        self.assertTrue(report.is_valid, report.errors)
+        self.assertEqual(report.feature_count, 2000)
+
+
+def _shp(records):
+    """A .shp file from (shape type, [part coordinates, ...]) records; type 1 takes one (x, y)"""
+    contents = []
+    for shape_type, shape in records:
+        if shape_type == 1:
+            content = struct.pack('<i2d', 1, *shape)
+        else:
+            points = [point for part in shape for point in part]
+            starts = [sum(len(part) for part in shape[:i]) for i in range(len(shape))]
+            content = struct.pack(f'<i4d2i{len(shape)}i', shape_type, 0, 0, 0, 0, len(shape), len(points), *starts)
+            content += b''.join(struct.pack('<2d', *point) for point in points)
+        contents.append(content)
+    coordinates = [point for shape_type, shape in records
+                   for point in ([shape] if shape_type == 1 else [p for part in shape for p in part])]
+    xs, ys = [x for x, _ in coordinates], [y for _, y in coordinates]
+    body = b''.join(struct.pack('>2i', n, len(c) // 2) + c for n, c in enumerate(contents, 1))
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, (100 + len(body)) // 2)
+    header += struct.pack('<2i4d4d', 1000, records[0][0], min(xs), min(ys), max(xs), max(ys), 0, 0, 0, 0)
+    return header + body
+
+
+def _dbf(fields, records, deleted=()):
+    """A .dbf file from (name, type, length, decimals) fields and rows of already formatted bytes"""
+    record_length = 1 + sum(length for _, _, length, _ in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    data = struct.pack('<4BIHH20x', 3, 124, 1, 1, len(records), header_length, record_length)
+    for name, field_type, length, decimals in fields:
+        data += struct.pack('<11sc4xBB14x', name.encode(), field_type.encode(), length, decimals)
+    data += b'\r'
+    for n, row in enumerate(records):
+        data += b'*' if n in deleted else b' '
+        data += b''.join(value.ljust(length) for value, (_, _, length, _) in zip(row, fields))
+    return data + b'\x1a'
+
+
+def _las(points, scale=0.001, offset=(0, 0, 0), geokey_epsg=None):
+    """A LAS 1.2 point format 0 file from (x, y, z, intensity, classification) tuples"""
+    records = b''.join(
+        struct.pack('<3iHBB2xH', *(round((v - o) / scale) for v, o in zip((x, y, z), offset)), intensity, 0, classification, 0)
+        for x, y, z, intensity, classification in points
+    )
+    vlrs = b''
+    if geokey_epsg is not None:
+        keys = struct.pack('<4H', 1, 1, 0, 1) + struct.pack('<4H', 3072, 0, 1, geokey_epsg)
+        vlrs = struct.pack('<H16sHH32s', 0, b'LASF_Projection', 34735, len(keys), b'') + keys
+    xs, ys, zs = ([p[i] for p in points] for i in range(3))
+    header = bytearray(227)
+    header[:4] = b'LASF'
+    header[24:26] = bytes((1, 2))
+    struct.pack_into('<HII', header, 94, 227, 227 + len(vlrs), 1 if vlrs else 0)
+    header[104] = 0
+    struct.pack_into('<HI', header, 105, 20, len(points))
+    struct.pack_into('<3d3d6d', header, 131, scale, scale, scale, *offset,
+                     max(xs), min(xs), max(ys), min(ys), max(zs), min(zs))
+    return bytes(header) + vlrs + records
+
+
+class ReaderTests(_ProjectTestCase):
+    """Shapefile, CSV and LAS uploads converted to GeoJSON at ingest"""
+
+    # A square with a square hole; shapefile outer rings run clockwise, holes counter-clockwise
+    OUTER = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]
+    HOLE = [(2, 2), (4, 2), (4, 4), (2, 4), (2, 2)]
+
+    def _file(self, name, data):
+        file_path = os.path.join(settings.MEDIA_ROOT, name)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def _converted(self, file_path):
+        result = convert_layer_file(file_path)
+        with open(converted_path(file_path), encoding='utf-8') as f:
+            return result, json.load(f)
+
+    def _shapefile_parts(self):
+        shp = _shp([(5, [self.OUTER, self.HOLE]), (5, [self.OUTER]), (1, (5.5, 7.25))])
+        fields = [('NAME', 'C', 20, 0), ('AREA', 'N', 10, 2), ('COUNT', 'N', 5, 0), ('SURVEYED', 'D', 8, 0), ('OPEN', 'L', 1, 0)]
+        dbf = _dbf(fields, [
+            ['Zürich'.encode('latin-1'), b'96.00', b'3', b'20240131', b'T'],
+            [b'gone', b'', b'', b'', b'?'],
+            [b'Well', b'', b'**', b'', b'F'],
+        ], deleted={1})
+        return shp, dbf
+
+    def _check_shapefile_features(self, features):
+        polygon, point = features
+        self.assertEqual(polygon['properties'], {'NAME': 'Zürich', 'AREA': 96.0, 'COUNT': 3, 'SURVEYED': '2024-01-31', 'OPEN': True})
+        # GeoJSON winds the other way round: exterior rings counter-clockwise
+        self.assertEqual(polygon['geometry'], {'type': 'Polygon', 'coordinates': [
+            [list(p) for p in reversed(self.OUTER)], [list(p) for p in reversed(self.HOLE)],
+        ]})
+        self.assertEqual(point, {'type': 'Feature', 'properties': {'NAME': 'Well', 'AREA': None, 'COUNT': None, 'SURVEYED': None, 'OPEN': False},
+                                 'geometry': {'type': 'Point', 'coordinates': [5.5, 7.25]}})
+
+    def test_shapefile(self):
+        shp, dbf = self._shapefile_parts()
+        file_path = self._file('parcels.shp', shp)
+        self._file('parcels.dbf', dbf)
+        self._file('parcels.cpg', b'ISO-8859-1')
+        result, data = self._converted(file_path)
+        self.assertEqual((result['features'], result['without_geometry']), (2, 0))
+        self._check_shapefile_features(data['features'])
+
+    def test_zipped_shapefile(self):
+        shp, dbf = self._shapefile_parts()
+        file_path = os.path.join(settings.MEDIA_ROOT, 'parcels.zip')
+        with zipfile.ZipFile(file_path, 'w') as archive:
+            archive.writestr('parcels/PARCELS.SHP', shp)
+            archive.writestr('parcels/parcels.dbf', dbf)
+            archive.writestr('parcels/parcels.cpg', 'latin1')
+        self._check_shapefile_features(self._converted(file_path)[1]['features'])
+
+    def test_projected_shapefile_is_rejected(self):
+        shp = self._file('utm.shp', _shp([(1, (500000, 4649776))]))
+        with self.assertRaisesMessage(ReaderError, 'not longitude/latitude'):
+            read_shapefile(shp)
+        self._file('utm.prj', b'PROJCS["WGS 84 / UTM zone 33N",GEOGCS["WGS 84"]]')
+        with self.assertRaisesMessage(ReaderError, 'WGS 84 / UTM zone 33N'):
+            read_shapefile(shp)
+
+    def test_csv(self):
+        file_path = self._file('sites.csv', codecs.BOM_UTF8 + (
+            'Name,Latitude,Longitude,visitors,rating\n'
+            'Café,47.37,8.54,1200,4.5\n'
+            'Nowhere,,,0,\n'
+            'Off the map,95,8,3,x\n'
+        ).encode('utf-8'))
+        result, data = self._converted(file_path)
+        self.assertEqual((result['features'], result['without_geometry']), (3, 2))
+        self.assertEqual(data['features'][0], {'type': 'Feature', 'properties': {'Name': 'Café', 'visitors': 1200, 'rating': 4.5},
+                                               'geometry': {'type': 'Point', 'coordinates': [8.54, 47.37]}})
+        self.assertEqual([f['geometry'] for f in data['features'][1:]], [None, None])
+        self.assertEqual(data['features'][2]['properties']['rating'], 'x')
+
+        with self.assertRaisesMessage(ReaderError, 'latitude and longitude columns'):
+            read_csv(self._file('table.csv', b'name,value\na,1\n'))
+
+    @override_settings(MUNDI_POINT_CLOUD_MAX_POINTS=4)
+    def test_point_cloud_is_thinned_evenly(self):
+        points = [(8 + n / 100, 47 + n / 1000, 400 + n, n * 10, n % 3) for n in range(10)]
+        file_path = self._file('scan.las', _las(points, offset=(8, 47, 0)))
+        _, features = read_point_cloud(file_path)
+        features = list(features)
+        self.assertEqual(len(features), 4)
+        for feature, n in zip(features, (0, 3, 6, 9)):
+            x, y, z, intensity, classification = points[n]
+            self.assertEqual(feature['properties'], {'z': z, 'intensity': intensity, 'classification': classification})
+            for actual, expected in zip(feature['geometry']['coordinates'], (x, y)):
+                self.assertAlmostEqual(actual, expected, places=6)
+
+    def test_projected_point_cloud_is_rejected(self):
+        points = [(500000, 4649776, 10, 0, 2), (500010, 4649786, 12, 0, 2)]
+        with self.assertRaisesMessage(ReaderError, 'EPSG:32633'):
+            read_point_cloud(self._file('utm.las', _las(points, offset=(500000, 4649000, 0), geokey_epsg=32633)))
+
+    def test_ingest_serves_the_converted_layer(self):
+        layer = self._layer('sites', b'lat,lon,name\n1.5,2.5,a\n', file_name='sites.csv')
+        enqueue('layer_ingest', {'layer_id': str(layer.id)})
+        job = run_job(claim_next_job('test-worker'))
+        self.assertEqual(job.status, BackgroundJob.STATUS_SUCCEEDED)
+
+        response = self.client.get(f'/mundi/projects/{self.project.id}/layers/{layer.id}/data/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['geojson']['features'], [{'type': 'Feature', 'properties': {'name': 'a'},
+                                             'geometry': {'type': 'Point', 'coordinates': [2.5, 1.5]}}])
+
+        broken = self._layer('broken', b'not a shapefile', file_name='broken.shp')
+        enqueue('layer_ingest', {'layer_id': str(broken.id)})
+        job = run_job(claim_next_job('test-worker'))
+        self.assertIn('Not a shapefile', job.result['conversion_error'])
+
+
+def _geotiff(file_path, image, origin, pixel_size, geo_keys=((1024, 2),), nodata=None):
+    """Save an image as a north-up GeoTIFF with its top-left corner at origin"""
+    tags = TiffImagePlugin.ImageFileDirectory_v2()
+    tags[33550] = (pixel_size, pixel_size, 0.0)
+    tags.tagtype[33550] = TiffTags.DOUBLE
+    tags[33922] = (0.0, 0.0, 0.0, origin[0], origin[1], 0.0)
+    tags.tagtype[33922] = TiffTags.DOUBLE
+    tags[34735] = (1, 1, 0, len(geo_keys)) + tuple(v for key, value in geo_keys for v in (key, 0, 1, value))
+    tags.tagtype[34735] = TiffTags.SHORT
+    if nodata is not None:
+        tags[42113] = str(nodata)
+        tags.tagtype[42113] = TiffTags.ASCII
+    image.save(file_path, tiffinfo=tags)
+
+
+class RasterTileTests(_ProjectTestCase):
+    """GeoTIFF layers served as XYZ image tiles from a prebuilt pyramid"""
+
+    RED, BLUE = (255, 0, 0, 255), (0, 0, 255, 255)
+
+    def setUp(self):
+        super().setUp()
+        # 0-22.5°E by 0-22.5°N, red in the west and blue in the east; its native zoom is 2
+        self.layer = self._layer('relief', None, layer_type='raster')
+        self.file_path = os.path.join(settings.MEDIA_ROOT, 'relief.tif')
+        self._write(self.RED[:3], self.BLUE[:3])
+        self.layer.file_path.name = 'relief.tif'
+        self.layer.save()
+
+    def _write(self, west, east, **kwargs):
+        pixels = np.zeros((64, 64, 3), dtype=np.uint8)
+        pixels[:, :33], pixels[:, 33:] = west, east
+        _geotiff(self.file_path, Image.fromarray(pixels, 'RGB'), (0.0, 22.5), 22.5 / 64, **kwargs)
+
+    def _tile(self, z, x, y, **headers):
+        response = self.client.get(f'/mundi/projects/{self.project.id}/layers/{self.layer.id}/tiles/{z}/{x}/{y}.png', **headers)
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/png'))
+        return Image.open(io.BytesIO(response.content)).convert('RGBA')
+
+    def _pixel(self, z, lon, lat):
+        """The colour drawn at lon, lat on the map at zoom z"""
+        x, y = (value * 2 ** z * 256 for value in mercator(lon, lat))
+        return self._tile(z, int(x) // 256, int(y) // 256).getpixel((int(x) % 256, int(y) % 256))
+
+    def test_tiles_show_the_raster_in_place(self):
+        tiles = get_raster_tiles(self.file_path)
+        self.assertEqual(tiles.max_zoom, 2)
+        for actual, expected in zip(tiles.bounds, (0, 0, 22.5, 22.5)):
+            self.assertAlmostEqual(actual, expected, places=6)
+
+        for z in (0, 1, 2):
+            self.assertEqual(self._pixel(z, 5, 10), self.RED, z)
+            self.assertEqual(self._pixel(z, 17, 10), self.BLUE, z)
+            self.assertEqual(self._pixel(z, 40, 10)[3], 0, z)
+        # Past the deepest level tiles are enlarged from it
+        self.assertEqual(self._pixel(6, 5, 10), self.RED)
+        self.assertEqual(self._pixel(6, 17, 10), self.BLUE)
+        self.assertEqual(self._tile(6, 32, 31).getpixel((0, 255)), self.RED)
+
+    def test_lower_zooms_are_averaged(self):
+        # The red/blue boundary falls inside a pixel at zoom 1, which mixes the two
+        x, y = (value * 2 * 256 for value in mercator(11.4, 10))
+        tile = self._tile(1, int(x) // 256, int(y) // 256)
+        red, green, blue, alpha = tile.getpixel((int(x) % 256, int(y) % 256))
+        self.assertEqual((green, alpha), (0, 255))
+        self.assertEqual({red, blue} & {0, 255}, set())
+
+    def test_tiles_without_the_raster_are_blank(self):
+        tile = self._tile(2, 0, 0)
+        self.assertIsNone(tile.getchannel('A').getbbox())
+        self.assertFalse(get_raster_tiles(self.file_path).get_tile(2, 0, 0))
+
+    def test_changed_raster_is_retiled(self):
+        self.assertEqual(self._pixel(2, 5, 10), self.RED)
+        self._write((0, 255, 0), self.BLUE[:3])
+        # The pyramid is matched to the file by mtime and size
+        os.utime(self.file_path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        self.assertEqual(self._pixel(2, 5, 10), (0, 255, 0, 255))
+
+    def test_nodata_is_transparent(self):
+        pixels = np.full((64, 64), 200, dtype=np.uint8)
+        pixels[:, :32] = 0
+        _geotiff(self.file_path, Image.fromarray(pixels, 'L'), (0.0, 22.5), 22.5 / 64, nodata=0)
+        rgba, _ = read_raster(self.file_path)
+        self.assertEqual(rgba[0, 0].tolist(), [0, 0, 0, 0])
+        self.assertEqual(rgba[0, 63].tolist(), [200, 200, 200, 255])
+
+    def test_rasters_that_cannot_be_placed(self):
+        # Only longitude/latitude and Web Mercator rasters are tiled
+        _geotiff(self.file_path, Image.new('RGB', (64, 64)), (500000.0, 4650000.0), 10.0, geo_keys=((1024, 1), (3072, 32633)))
+        with self.assertRaisesMessage(RasterError, 'EPSG:32633'):
+            read_raster(self.file_path)
+        response = self.client.get(f'/mundi/projects/{self.project.id}/layers/{self.layer.id}/tiles/2/2/1.png')
+        self.assertEqual(response.status_code, 422)
+
+        Image.new('RGB', (64, 64)).save(self.file_path)
+        with self.assertRaisesMessage(RasterError, 'no georeferencing'):
+            read_raster(self.file_path)
+
+    def test_tile_requests_are_checked(self):
+        base = f'/mundi/projects/{self.project.id}/layers/{self.layer.id}/tiles'
+        self.assertEqual(self.client.get(f'{base}/2/4/0.png').status_code, 400)
+        self.assertEqual(self.client.get(f'{base}/2/2/1.webp').status_code, 404)
+
+
+# Small nodes and sort runs, so a few thousand points make a deep tree and an external sort
+@mock.patch('mundi_gis.point_cloud.NODE_CAPACITY', 64)
+@mock.patch('mundi_gis.point_cloud._SORT_POINTS', 500)
+@mock.patch('mundi_gis.point_cloud._SCAN_POINTS', 300)
+class PointCloudOctreeTests(_ProjectTestCase):
+    """Level-of-detail octrees of LAS point clouds and the points endpoint"""
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(20)
+        # A dense cluster in one corner and a sparse spread over the rest, on the file's 0.01 grid
+        self.points = [
+            (round(rng.uniform(0, 10) if n % 3 else rng.uniform(0, 100), 2), round(rng.uniform(0, 50), 2),
+             round(rng.uniform(0, 20), 2), n % 1000, n % 7)
+            for n in range(3000)
+        ]
+        self.layer = self._layer('scan', _las(self.points, scale=0.01, offset=(1000, 2000, 0)), file_name='scan.las')
+        self.file_path = self.layer.file_path.path
+        self.xyz = np.array([p[:3] for p in self.points])
+
+    def _keys(self, xyz):
+        return sorted(map(tuple, np.round(xyz, 2).tolist()))
+
+    def test_every_point_is_kept_once(self):
+        octree = get_octree(self.file_path)
+        self.assertEqual(octree.manifest['point_count'], 3000)
+        self.assertGreater(octree.manifest['depth'], 1)
+
+        result = octree.query(budget=10_000)
+        self.assertTrue(result.complete)
+        self.assertEqual(sorted(result.nodes), list(range(len(octree.nodes))))
+        self.assertEqual(self._keys(octree.coordinates(result.points)), self._keys(self.xyz))
+        self.assertEqual(sorted(result.points['intensity'].tolist()), sorted(p[3] for p in self.points))
+
+    def test_nodes_nest_and_hold_their_own_points(self):
+        octree = get_octree(self.file_path)
+        for node_id in range(len(octree.nodes)):
+            low, high = octree.node_bounds(node_id)
+            xyz = octree.coordinates(octree.read_node(node_id))
+            self.assertTrue(((xyz >= low - 0.01) & (xyz <= high + 0.01)).all(), node_id)
+            self.assertLessEqual(len(xyz), 64)
+            for child in octree.children[node_id]:
+                self.assertEqual(octree.nodes[child]['depth'], octree.nodes[node_id]['depth'] + 1)
+                child_low, child_high = octree.node_bounds(child)
+                self.assertTrue((child_low >= low - 1e-9).all() and (child_high <= high + 1e-9).all())
+
+    def test_budget_takes_coarse_levels_first(self):
+        octree = get_octree(self.file_path)
+        result = octree.query(budget=500)
+        self.assertFalse(result.complete)
+        self.assertLessEqual(len(result.points), 500)
+        depths = [int(octree.nodes[node_id]['depth']) for node_id in result.nodes]
+        self.assertEqual(depths, sorted(depths))
+        # The coarse levels already span the whole cloud, not just the dense corner
+        xyz = octree.coordinates(result.points)
+        self.assertGreater(xyz[:, 0].max(), 80)
+
+        # A budget smaller than the root gets an even sample of it
+        self.assertEqual(len(octree.query(budget=10).points), 10)
+
+    def test_bbox_and_frustum_queries_match_a_full_scan(self):
+        octree = get_octree(self.file_path)
+        # Box edges fall between grid values, so rounding cannot move a point across one
+        low, high = np.array([5.005, 10.005, -1.0]), np.array([40.005, 30.005, 15.005])
+        result = octree.query(bounds=(low, high), budget=10_000)
+        inside = self.xyz[((self.xyz >= low) & (self.xyz <= high)).all(axis=1)]
+        self.assertEqual(self._keys(octree.coordinates(result.points)), self._keys(inside))
+
+        # The half-spaces x >= 50.005 and y <= 20.005
+        planes = np.array([[1, 0, 0, -50.005], [0, -1, 0, 20.005]])
+        result = octree.query(planes=planes, budget=10_000)
+        inside = self.xyz[(self.xyz[:, 0] >= 50.005) & (self.xyz[:, 1] <= 20.005)]
+        self.assertEqual(self._keys(octree.coordinates(result.points)), self._keys(inside))
+
+    def test_camera_puts_nearby_nodes_first(self):
+        octree = get_octree(self.file_path)
+        camera = np.array([100.0, 50.0, 20.0])
+        near = octree.query(camera=camera, budget=400)
+        plain = octree.query(budget=400)
+        distance = lambda result: np.linalg.norm(octree.coordinates(result.points) - camera, axis=1).mean()
+        self.assertLess(distance(near), distance(plain))
+
+    def test_stale_octree_is_rebuilt(self):
+        first = write_octree(self.file_path)
+        with open(self.file_path, 'wb') as f:
+            f.write(_las(self.points[:100], scale=0.01, offset=(1000, 2000, 0)))
+        os.utime(self.file_path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        octree = get_octree(self.file_path)
+        self.assertNotEqual(octree.manifest['signature'], first['signature'])
+        self.assertEqual(octree.manifest['point_count'], 100)
+
+    def test_points_endpoint(self):
+        url = f'/mundi/projects/{self.project.id}/layers/{self.layer.id}/points/'
+        response = self.client.get(url, {'bbox': '0,0,10.005,10.005', 'budget': 10_000})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        inside = self.xyz[(self.xyz[:, 0] <= 10.005) & (self.xyz[:, 1] <= 10.005)]
+        self.assertEqual((data['count'], data['complete']), (len(inside), True))
+        self.assertEqual(sorted(zip(data['points']['x'], data['points']['y'], data['points']['z'])), self._keys(inside))
+        self.assertTrue(os.path.exists(octree_path(self.file_path)))
+
+        response = self.client.get(url, {'budget': 50, 'format': 'binary'})
+        self.assertEqual((response['X-Point-Count'], response['X-Point-Complete']), ('50', 'false'))
+        self.assertEqual(len(response.content), 50 * 16)
+
+        self.assertEqual(self.client.get(url, {'budget': 0}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'bbox': '1,2,3'}).status_code, 400)
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+def _square(minx, miny, maxx, maxy):
+    return [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+
+
+class SpatialQueryTests(_ProjectTestCase):
+    """Vectorized spatial queries checked against plain Python over the same features"""
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(21)
+        self.points = []
+        for n in range(300):
+            properties = {'kind': rng.choice(['well', 'spring', 'pump']), 'depth': rng.randint(1, 90)}
+            if n % 10 == 0:
+                properties['depth'] = None
+            self.points.append({'type': 'Feature', 'properties': properties, 'geometry': {
+                'type': 'Point', 'coordinates': [round(rng.uniform(0, 10), 4), round(rng.uniform(0, 10), 4)],
+            }})
+        self.wells = self._layer('wells', {'type': 'FeatureCollection', 'features': self.points})
+        self.areas = self._layer('areas', {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'west'}, 'geometry': {
+                'type': 'Polygon', 'coordinates': [_square(0, 0, 5, 10), _square(1, 1, 3, 3)]}},
+            {'type': 'Feature', 'properties': {'name': 'north-east'}, 'geometry': {
+                'type': 'Polygon', 'coordinates': [_square(5, 5, 10, 10)]}},
+            {'type': 'Feature', 'properties': {'name': 'equator'}, 'geometry': {
+                'type': 'Polygon', 'coordinates': [_square(20, 0, 21, 1)]}},
+            {'type': 'Feature', 'properties': {'name': 'road'}, 'geometry': {
+                'type': 'LineString', 'coordinates': [[20, 0], [21, 0], [21, 1]]}},
+        ]})
+
+    def _query(self, **query):
+        response = self.client.post(f'/mundi/projects/{self.project.id}/spatial/', json.dumps(query),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def _error(self, **query):
+        response = self.client.post(f'/mundi/projects/{self.project.id}/spatial/', json.dumps(query),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        return response.json()['error']
+
+    def _where(self, test):
+        return [n for n, feature in enumerate(self.points) if test(*feature['geometry']['coordinates'], feature['properties'])]
+
+    def test_count_in_polygons(self):
+        result = self._query(operation='count_in_polygons', layer=str(self.wells.id),
+                             polygons={'layer': str(self.areas.id)})
+        west = len(self._where(lambda x, y, p: x < 5 and not (1 < x < 3 and 1 < y < 3)))
+        north_east = len(self._where(lambda x, y, p: x > 5 and y > 5))
+        self.assertEqual((result['count'], result['polygon_count']), (300, 3))
+        self.assertEqual([(p['properties']['name'], p['count']) for p in result['polygons']],
+                         [('west', west), ('north-east', north_east), ('equator', 0)])
+        self.assertEqual(result['inside'], west + north_east)
+
+    def test_select_combines_filters(self):
+        result = self._query(operation='select', layer=str(self.wells.id), bbox=[2, 2, 8, 8],
+                             where={'kind': 'well'}, within={'layer': str(self.areas.id), 'feature': 1},
+                             fields=['kind'], limit=1000)
+        expected = self._where(lambda x, y, p: 5 < x <= 8 and 5 < y <= 8 and p['kind'] == 'well')
+        self.assertEqual(sorted(f['index'] for f in result['features']), expected)
+        self.assertEqual(result['features'][0]['properties'], {'kind': 'well'})
+
+        result = self._query(operation='select', layer=str(self.wells.id), where={'depth': None}, limit=5)
+        self.assertEqual((result['count'], result['truncated'], len(result['features'])), (30, True, 5))
+
+    def test_nearest_and_buffer_use_great_circle_distances(self):
+        distances = [_haversine(*f['geometry']['coordinates'], 5, 5) for f in self.points]
+        result = self._query(operation='nearest', layer=str(self.wells.id), point=[5, 5], limit=3)
+        self.assertEqual(result['units'], 'metres')
+        self.assertEqual([f['index'] for f in result['features']], sorted(range(300), key=distances.__getitem__)[:3])
+        for feature in result['features']:
+            self.assertAlmostEqual(feature['distance'], distances[feature['index']], delta=0.01)
+
+        result = self._query(operation='select', layer=str(self.wells.id), limit=1000,
+                             buffer={'geometry': {'type': 'Point', 'coordinates': [5, 5]}, 'distance': 200_000})
+        self.assertEqual(sorted(f['index'] for f in result['features']),
+                         [n for n, d in enumerate(distances) if d <= 200_000])
+
+    def test_measure(self):
+        result = self._query(operation='measure', layer=str(self.areas.id), where={'name': 'equator'})
+        # One degree square on the equator: R² · π/180 · sin(1°)
+        area = 6371008.8 ** 2 * math.radians(1) * math.sin(math.radians(1))
+        self.assertAlmostEqual(result['area'] / area, 1, places=3)
+
+        result = self._query(operation='measure', layer=str(self.areas.id), where={'name': 'road'})
+        self.assertEqual(result['area'], 0)
+        self.assertAlmostEqual(result['length'], _haversine(20, 0, 21, 0) + _haversine(21, 0, 21, 1), delta=0.01)
+
+        # Projected layers are measured in their own units, and the hole is subtracted
+        projected = self._layer('plots', {
+            'type': 'FeatureCollection', 'crs': {'type': 'name', 'properties': {'name': 'EPSG:32633'}},
+            'features': [{'type': 'Feature', 'properties': {}, 'geometry': {
+                'type': 'Polygon', 'coordinates': [_square(500000, 4600000, 500100, 4600050),
+                                                   _square(500010, 4600010, 500020, 4600020)]}}],
+        })
+        result = self._query(operation='measure', layer=str(projected.id))
+        self.assertEqual((result['units'], result['area'], result['length']), ('crs units', 4900.0, 340.0))
+
+        error = self._error(operation='count_in_polygons', layer=str(projected.id), polygons={'layer': str(self.areas.id)})
+        self.assertIn('different coordinate reference systems', error)
+
+    def test_aggregate_by_group(self):
+        result = self._query(operation='aggregate', layer=str(self.wells.id), field='depth', group_by='kind')
+        self.assertEqual(result['group_count'], 3)
+        for group in result['groups']:
+            members = [f['properties'] for f in self.points if f['properties']['kind'] == group['key']]
+            depths = [p['depth'] for p in members if p['depth'] is not None]
+            self.assertEqual((group['count'], group['values']), (len(members), len(depths)))
+            self.assertEqual((group['sum'], group['min'], group['max']), (sum(depths), min(depths), max(depths)))
+            self.assertAlmostEqual(group['mean'], sum(depths) / len(depths))
+        counts = [group['count'] for group in result['groups']]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+        self.assertEqual(self._query(operation='aggregate', layer=str(self.wells.id))['count'], 300)
+
+    def test_bad_queries(self):
+        other = MundiMapProject.objects.create(name='Other', created_by=self.user, mundi_project_id='other')
+        foreign = MundiLayer.objects.create(name='x', layer_type='vector', map_project=other, mundi_layer_id='local_x')
+        self.assertIn('operation must be one of', self._error(operation='buffer', layer=str(self.wells.id)))
+        self.assertIn('is not in this project', self._error(operation='select', layer=str(foreign.id)))
+        self.assertIn('Unknown field', self._error(operation='select', layer=str(self.wells.id), where={'colour': 1}))
+        self.assertIn('not a numeric field', self._error(operation='aggregate', layer=str(self.wells.id), field='kind'))
+        self.assertIn('within must be a Polygon', self._error(operation='select', layer=str(self.wells.id),
+                                                               within={'type': 'Point', 'coordinates': [1, 1]}))
+
+
+def _tool_call(name, arguments, call_id='call_1'):
+    return {'id': call_id, 'type': 'function', 'function': {'name': name, 'arguments': json.dumps(arguments)}}
+
+
+def _tool_calls(*calls, content=''):
+    """A non-streamed reply that calls tools"""
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {'choices': [{'message': {'role': 'assistant', 'content': content, 'tool_calls': list(calls)}}]}
+    return response
+
+
+class ToolCallTests(_ProjectTestCase):
+    """Project tools and the conversations in which the model calls them"""
+
+    def setUp(self):
+        super().setUp()
+        _result_cache.clear()
+        self.addCleanup(_result_cache.clear)
+        self.schools = self._layer('Schools', {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': f'School {n}', 'kind': 'primary' if n % 3 else 'secondary', 'pupils': 100 + n},
+             'geometry': {'type': 'Point', 'coordinates': [n % 10 + 0.5, n // 10 + 0.5]}}
+            for n in range(30)
+        ]})
+        self.districts = self._layer('Districts', {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'Old Town'}, 'geometry': {'type': 'Polygon', 'coordinates': [_square(0, 0, 5, 3)]}},
+            {'type': 'Feature', 'properties': {'name': 'Harbour'}, 'geometry': {'type': 'Polygon', 'coordinates': [_square(5, 0, 10, 1)]}},
+        ]})
+        for layer in (self.schools, self.districts):
+            update_layer_statistics(layer)
+        self.tools = ProjectTools(self.project)
+
+    def _call(self, name, **arguments):
+        return json.loads(self.tools.call(name, json.dumps(arguments)))
+
+    def test_tools_answer_from_the_project_data(self):
+        self.assertEqual([(layer['name'], layer['feature_count']) for layer in self._call('list_layers')],
+                         [('Schools', 30), ('Districts', 2)])
+        self.assertEqual(self._call('layer_statistics', layer='schools')['attributes']['pupils']['type'], 'integer')
+        self.assertEqual(self._call('count_features', layer='Schools', where={'kind': 'secondary'}, bbox=[0, 0, 10, 1.5])['count'], 7)
+
+        summary = self._call('summarize_attribute', layer='Schools', field='pupils', group_by='kind')
+        self.assertEqual({(g['key'], g['count'], g['sum']) for g in summary['groups']},
+                         {('primary', 20, sum(100 + n for n in range(30) if n % 3)),
+                          ('secondary', 10, sum(100 + n for n in range(0, 30, 3)))})
+        kinds = self._call('summarize_attribute', layer='Schools', field='kind')
+        self.assertEqual([(g['key'], g['count']) for g in kinds['groups']], [('primary', 20), ('secondary', 10)])
+
+        counts = self._call('count_in_polygons', layer='Schools', polygon_layer=str(self.districts.id))
+        self.assertEqual([(p['name'], p['count']) for p in counts['polygons']], [('Old Town', 15), ('Harbour', 5)])
+
+    def test_errors_are_returned_to_the_model(self):
+        self.assertIn('No layer named', self._call('count_features', layer='Rivers')['error'])
+        self.assertIn('Unknown tool', self._call('drop_layer', layer='Schools')['error'])
+        self.assertIn('has no attribute', self._call('summarize_attribute', layer='Schools', field='colour')['error'])
+        self.assertIn('error', json.loads(self.tools.call('list_layers', '{not json')))
+        self.assertEqual([bool(call.get('error')) for call in self.tools.calls], [True] * 4)
+
+    def test_results_are_cached_per_project_version(self):
+        first = self.tools.call('count_features', {'layer': 'Schools'})
+        self.assertEqual(ProjectTools(self.project).call('count_features', {'layer': 'Schools'}), first)
+        self.assertEqual([call['cached'] for call in self.tools.calls], [False])
+
+        tools = ProjectTools(self.project)
+        tools.call('count_features', {'layer': 'Schools'})
+        self.assertTrue(tools.calls[0]['cached'])
+
+        # New data is a new project version
+        with open(self.schools.file_path.path, 'w') as f:
+            json.dump(_points(3), f)
+        update_layer_statistics(self.schools)
+        tools = ProjectTools(self.project)
+        self.assertEqual(json.loads(tools.call('count_features', {'layer': 'Schools'}))['count'], 3)
+        self.assertFalse(tools.calls[0]['cached'])
+
+    def _conversation(self, *replies):
+        """Patch the service to answer with replies in turn, recording each request's messages"""
+        requests = []
+
+        def post(service, payload, timeout):
+            requests.append(json.loads(json.dumps(payload)))
+            return replies[len(requests) - 1]
+
+        patcher = mock.patch.object(LocalLLMService, '_post', autospec=True, side_effect=post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return requests
+
+    def test_tool_results_are_sent_back_to_the_model(self):
+        requests = self._conversation(
+            _tool_calls(_tool_call('list_layers', {}, 'a'), _tool_call('count_features', {'layer': 'Schools'}, 'b')),
+            _completion('There are 30 schools.'),
+        )
+        answer = LocalLLMService().chat_with_tools('system', 'How many schools?', self.tools)
+
+        self.assertEqual(answer, 'There are 30 schools.')
+        self.assertEqual(requests[0]['tools'], ProjectTools.specs)
+        tool_messages = [m for m in requests[1]['messages'] if m['role'] == 'tool']
+        self.assertEqual([(m['tool_call_id'], m['name']) for m in tool_messages], [('a', 'list_layers'), ('b', 'count_features')])
+        self.assertEqual(json.loads(tool_messages[1]['content']), {'layer': 'Schools', 'count': 30})
+        self.assertEqual([call['name'] for call in self.tools.calls], ['list_layers', 'count_features'])
+
+    @override_settings(OLLAMA_TOOL_MAX_ITERATIONS=2)
+    def test_model_must_answer_after_the_last_iteration(self):
+        keeps_calling = _tool_calls(_tool_call('list_layers', {}))
+        requests = self._conversation(keeps_calling, keeps_calling, _completion('Done.'))
+        self.assertEqual(LocalLLMService().chat_with_tools('system', 'question', self.tools), 'Done.')
+        self.assertEqual(['tools' in request for request in requests], [True, True, False])
+
+    def test_streamed_tool_calls_are_assembled_from_deltas(self):
+        arguments = json.dumps({'layer': 'Schools', 'where': {'kind': 'primary'}})
+        replies = [
+            [{'tool_calls': [{'index': 0, 'id': 'c1', 'function': {'name': 'count_', 'arguments': arguments[:10]}}]},
+             {'tool_calls': [{'index': 0, 'function': {'name': 'features', 'arguments': arguments[10:]}}]}],
+            [{'content': 'Twenty '}, {'content': 'primary schools.'}],
+        ]
+        requests = []
+
+        def stream(service, payload, timeout):
+            requests.append(json.loads(json.dumps(payload)))
+            yield from replies[len(requests) - 1]
+
+        with mock.patch.object(LocalLLMService, '_stream_deltas', autospec=True, side_effect=stream):
+            chunks = list(LocalLLMService().stream_chat_with_tools('system', 'How many primary schools?', self.tools))
+
+        self.assertEqual(chunks, ['Twenty ', 'primary schools.'])
+        self.assertEqual(self.tools.calls[0]['arguments'], {'layer': 'Schools', 'where': {'kind': 'primary'}})
+        self.assertEqual(json.loads(requests[1]['messages'][-1]['content'])['count'], 20)
+        self.assertTrue(all(request['stream'] for request in requests))
+
+    async def test_async_conversation(self):
+        replies = [_tool_calls(_tool_call('count_features', {'layer': 'Districts'})), _completion('Two districts.')]
+        with mock.patch.object(LocalLLMService, '_apost', side_effect=replies):
+            answer = await LocalLLMService().achat_with_tools('system', 'How many districts?', self.tools)
+        self.assertEqual(answer, 'Two districts.')
+        self.assertEqual(self.tools.calls[0]['name'], 'count_features')
+
+
+def _project_info(layer_count, **extra):
+    layers = [{
+        'name': f'Survey {n}', 'layer_type': 'vector', 'geometry_type': 'Point', 'feature_count': 100 + n,
+        'description': f'Field survey number {n} of the valley', 'attributes': {'height': 'number', 'species': 'string'},
+        'bbox': [n, 0, n + 1, 1], 'crs': 'EPSG:4326',
+    } for n in range(layer_count)]
+    return {'name': 'Valley', 'description': 'Vegetation of the valley', 'layer_count': layer_count, 'layers': layers, **extra}
+
+
+class ProjectPromptTests(SimpleTestCase):
+    """Project prompts fitted to the token budget"""
+
+    def test_small_project_is_described_in_full(self):
+        prompt = build_project_prompt(_project_info(3), 'Which species grow here?', budget=1500)
+        self.assertEqual((prompt.layers_included, prompt.layers_omitted), (3, 0))
+        self.assertEqual(prompt.system, PROJECT_SYSTEM_PROMPT)
+        self.assertEqual(prompt.user.count('Attributes: height (number), species (string)'), 3)
+        self.assertNotIn('more layers', prompt.user)
+        self.assertTrue(prompt.user.endswith('User Question: Which species grow here?'))
+
+    def test_large_project_fits_the_budget(self):
+        for budget in (400, 800, 1500, 4000):
+            prompt = build_project_prompt(_project_info(300), 'Summarize the project', budget=budget)
+            self.assertLessEqual(prompt.tokens, budget, budget)
+            self.assertEqual(prompt.tokens, count_tokens(prompt.system) + count_tokens(prompt.user))
+            self.assertEqual(prompt.layers_included + prompt.layers_omitted, 300)
+            self.assertIn(f'- ... {prompt.layers_omitted} more layers not listed', prompt.user)
+        self.assertGreater(prompt.layers_included, 0)
+
+    def test_relevant_layers_are_kept_in_project_order(self):
+        info = _project_info(200)
+        info['layers'][150].update(name='Hospitals', description='Hospitals and clinics', attributes={'beds': 'integer'})
+        info['layers'][170].update(name='Schools', description='Primary schools')
+        question = 'How many beds do the hospitals and schools have?'
+        prompt = build_project_prompt(info, question, budget=600)
+        self.assertGreater(prompt.layers_omitted, 100)
+        self.assertIn('- Hospitals (vector, Point, 250 features)', prompt.user)
+        self.assertIn('- Schools (vector, Point, 270 features)', prompt.user)
+        self.assertLess(prompt.user.index('Hospitals'), prompt.user.index('Schools'))
+        listed = [int(n) for n in re.findall(r'^- Survey (\d+)', prompt.user, re.MULTILINE)]
+        self.assertTrue(listed)
+        self.assertEqual(listed, sorted(listed))
+
+        # Once every layer has its line, the most relevant get their full summary first
+        info['layers'] = info['layers'][:10] + [info['layers'][150], info['layers'][170]]
+        prompt = build_project_prompt(info, question, budget=800)
+        self.assertEqual(prompt.layers_omitted, 0)
+        self.assertIn('- Hospitals (vector, Point, 250 features): Hospitals and clinics\n  Attributes: beds (integer)', prompt.user)
+        self.assertLess(prompt.user.count('Attributes:'), len(info['layers']))
+
+    def test_system_prompt_does_not_depend_on_the_project(self):
+        prompts = [
+            build_project_prompt(_project_info(n), question, tools=True)
+            for n, question in ((1, 'What is here?'), (50, 'Count the surveys'))
+        ]
+        self.assertEqual({prompt.system for prompt in prompts}, {PROJECT_TOOLS_SYSTEM_PROMPT})
+        self.assertIn('(call list_layers to see them)', build_project_prompt(_project_info(300), 'x', tools=True, budget=800).user)
+
+    def test_long_text_is_truncated(self):
+        question = 'Where ' + 'exactly ' * 1000
+        info = _project_info(1, description='Very ' * 1000)
+        prompt = build_project_prompt(info, question, budget=100_000)
+        self.assertLess(prompt.tokens, 1500)
+        self.assertIn('Very Very...', prompt.user)
+        self.assertTrue(prompt.user.endswith('exactly...'))
+
+        self.assertEqual(truncate_tokens('one two three', 2), 'one two...')
+        self.assertEqual(truncate_tokens('one two three', 4), 'one two three')
+        self.assertEqual(count_tokens('Kilimanjaro, 5895 m'), 3 + 1 + 1 + 1)
+
+    @override_settings(OLLAMA_PROMPT_TOKEN_BUDGET=500)
+    def test_budget_comes_from_settings(self):
+        self.assertLessEqual(build_project_prompt(_project_info(300), 'Summarize').tokens, 500)
+
+
+class RouterOrderTests(SimpleTestCase):
+    """Which backend the router offers first"""
+
+    def _backend(self, available=True, models=(), latency=None):
+        state = {'up': available}
+        backend = Backend(f'http://{uuid.uuid4().hex[:8]}.test/v1', HealthMonitor(lambda: state['up'], interval=3600), models)
+        backend.health.check_now()
+        backend.latency = latency
+        return backend
+
+    def test_parse_backend(self):
+        self.assertEqual(parse_backend('http://gpu:11434/v1'), ('http://gpu:11434/v1', [], None))
+        self.assertEqual(parse_backend(' http://gpu:11434/v1 = llama3 | qwen2 '), ('http://gpu:11434/v1', ['llama3', 'qwen2'], None))
+        self.assertEqual(parse_backend({'url': 'https://api.example.com/v1', 'models': ['m'], 'api_key': 'k'}),
+                         ('https://api.example.com/v1', ['m'], 'k'))
+
+    def test_fastest_available_backend_comes_first(self):
+        slow, fast, down = self._backend(latency=2.0), self._backend(latency=0.5), self._backend(available=False, latency=0.1)
+        router = LLMRouter([down, slow, fast])
+        self.assertEqual(router.candidates('any'), [fast, slow, down])
+
+        # Requests in flight and recent errors make a backend's expected wait longer
+        for _ in range(4):
+            fast.acquire()
+        self.assertEqual(router.candidates('any'), [slow, fast, down])
+        for _ in range(4):
+            fast.release()
+        fast.record_failure()
+        fast.record_failure()
+        self.assertFalse(fast.health.is_available())
+        # Now down as well, and with a worse record than the other unavailable backend
+        self.assertEqual(router.candidates('any'), [slow, down, fast])
+
+    def test_backends_listing_the_model_come_first(self):
+        generic, dedicated, other = self._backend(latency=0.1), self._backend(models=['llama3'], latency=1.0), self._backend(models=['qwen2'])
+        router = LLMRouter([generic, dedicated, other])
+        self.assertEqual(router.candidates('llama3'), [dedicated, generic])
+        # Backends without a model list serve any model; when none does, every backend is tried
+        self.assertEqual(router.candidates('mistral'), [generic])
+        self.assertEqual(LLMRouter([other]).candidates('mistral'), [other])
+
+    def test_latency_is_a_moving_average(self):
+        backend = self._backend()
+        backend.record_success(1.0)
+        backend.record_success(2.0)
+        self.assertAlmostEqual(backend.latency, 0.3 * 2.0 + 0.7 * 1.0)
+        backend.record_failure()
+        self.assertAlmostEqual(backend.error_rate, 0.3)
+        backend.record_success(1.3)
+        self.assertAlmostEqual(backend.error_rate, 0.21)
+        self.assertEqual((backend.requests, backend.errors), (0, 1))
+
+
+class RouterFailoverTests(SimpleTestCase):
+    """LocalLLMService moving on to the next backend when one fails"""
+
+    def setUp(self):
+        # Fresh URLs, so the process-wide routers, health monitors and admission controllers start clean
+        self.urls = [f'http://{name}-{uuid.uuid4().hex[:8]}.test/v1' for name in ('first', 'second')]
+        self.session = mock.Mock()
+        self.session.get.return_value = mock.Mock(status_code=200)
+        self.replies = {url: [] for url in self.urls}
+        self.session.post.side_effect = self._post
+        settings_override = override_settings(OLLAMA_BACKENDS=self.urls, OLLAMA_HEALTH_INTERVAL=3600)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        session = mock.patch('mundi_gis.local_llm.get_http_session', return_value=self.session)
+        session.start()
+        self.addCleanup(session.stop)
+        self.service = LocalLLMService()
+        self.first, self.second = self.service.router.backends
+        # Let the first backend win ties on expected wait
+        self.first.latency, self.second.latency = 0.1, 0.2
+
+    def _post(self, url, **kwargs):
+        reply = self.replies[url.rsplit('/chat/completions', 1)[0]].pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def _status(self, code):
+        return mock.Mock(status_code=code, text='upstream error')
+
+    def _ask(self):
+        return self.service._make_chat_completion('system', 'question', use_cache=False)
+
+    def _check_released(self):
+        for backend in (self.first, self.second):
+            self.assertEqual((backend.in_flight, backend.admission.status()['active']), (0, 0))
+
+    def test_unreachable_backend_is_skipped(self):
+        self.replies[self.urls[0]].append(requests.exceptions.ConnectionError('refused'))
+        self.replies[self.urls[1]].append(_completion('From the second'))
+        self.assertEqual(self._ask(), 'From the second')
+        self.assertEqual((self.first.errors, self.second.errors), (1, 0))
+        self.assertFalse(self.first.health.is_available())
+        self._check_released()
+
+        # The failed backend is tried last until it recovers
+        self.replies[self.urls[1]].append(_completion('Again'))
+        self.assertEqual(self._ask(), 'Again')
+        self.assertEqual(self.service.router.candidates(self.service.model), [self.second, self.first])
+
+    def test_server_errors_fail_over_but_client_errors_do_not(self):
+        self.replies[self.urls[0]].append(self._status(503))
+        self.replies[self.urls[1]].append(_completion('Recovered'))
+        self.assertEqual(self._ask(), 'Recovered')
+
+        self.replies[self.urls[1]].append(self._status(404))
+        self.assertIn('404', self._ask())
+        self.assertEqual(self.replies, {url: [] for url in self.urls})
+        self._check_released()
+
+    def test_read_timeout_is_not_retried_elsewhere(self):
+        self.replies[self.urls[0]].append(requests.exceptions.ReadTimeout('slow'))
+        self.service.raise_errors = True
+        with self.assertRaisesMessage(LLMServiceError, 'did not reply within'):
+            self._ask()
+        self.assertEqual(self.session.post.call_count, 1)
+        self._check_released()
+
+    def test_every_backend_failing(self):
+        self.replies[self.urls[0]].append(requests.exceptions.ConnectionError('refused'))
+        self.replies[self.urls[1]].append(self._status(500))
+        self.service.raise_errors = True
+        with self.assertRaisesMessage(LLMServiceError, '500'):
+            self._ask()
+        self.assertEqual((self.first.errors, self.second.errors), (1, 1))
+        self._check_released()
+
+    async def test_async_failover(self):
+        def handler(request):
+            if request.url.host.startswith('first'):
+                raise httpx.ConnectError('refused', request=request)
+            return httpx.Response(200, json={'choices': [{'message': {'role': 'assistant', 'content': 'Async reply'}}]})
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            with mock.patch('mundi_gis.local_llm.get_async_http_client', return_value=client):
+                response = await self.service._apost({'model': self.service.model, 'messages': []}, 5)
+        self.assertEqual(response.json()['choices'][0]['message']['content'], 'Async reply')
+        self.assertEqual((self.first.errors, self.second.requests), (1, 1))
+        self._check_released()
@@ -0,0 +1,259 @@
+"""
+Chunked, resumable layer uploads.
+
+A client opens an ``UploadSession``, sends the file in order as raw chunks
+(each one tagged with its byte offset), and completes the session to create
+the layer. Chunks are written straight into a partial file under
+``MEDIA_ROOT`` and validated as they arrive, so a bad file is rejected at
+its first bad chunk and an interrupted upload resumes from the last offset
+the server acknowledged.
+"""
+
+import codecs
+import os
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from .forms import ALLOWED_LAYER_EXTENSIONS, MAX_LAYER_FILE_SIZE
+from .geojson_validator import validate_geojson_file
+from .models import MundiLayer, UploadSession
+
+
+# Partial files live beside the finished uploads so completing is a rename
+PARTIAL_UPLOAD_DIR = 'mundi_uploads'
+
+# Directory the layer FileField uploads to
+LAYER_UPLOAD_DIR = 'mundi_layers'
+
+_READ_SIZE = 64 * 1024
+
+# Leading bytes of the binary formats
+_MAGIC_NUMBERS = {
+    '.tif': (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'),
+    '.las': (b'LASF',),
+    '.laz': (b'LASF',),
+    '.shp': (b'\x00\x00\x27\x0a',),
+    '.zip': (b'PK\x03\x04',),
+}
+
+_TEXT_EXTENSIONS = ('.geojson', '.csv')
+
+
+class UploadError(ValueError):
+    """Raised when an upload request or chunk is rejected"""
+
+
+class UploadValidationError(UploadError):
+    """Raised when a chunk's content shows the file is not of its declared type"""
+
+    def __init__(self, message: str, errors: Optional[List[Dict[str, Any]]] = None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+class OffsetMismatch(UploadError):
+    """Raised when a chunk does not start where the upload left off"""
+
+    def __init__(self, expected: int):
+        super().__init__(f'Expected a chunk at offset {expected}')
+        self.expected = expected
+
+
+def chunk_size() -> int:
+    return getattr(settings, 'MUNDI_UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024)
+
+
+def partial_path(session: UploadSession) -> str:
+    return os.path.join(settings.MEDIA_ROOT, PARTIAL_UPLOAD_DIR, f'{session.id}.part')
+
+
+def _extension(filename: str) -> str:
+    return os.path.splitext(filename.lower())[1]
+
+
+def start_upload(project, user, data: Dict[str, Any]) -> UploadSession:
+    """Validate the upload's declared name, type and size and open a session for it"""
+    name = (data.get('name') or '').strip()
+    filename = os.path.basename(str(data.get('filename') or ''))
+    layer_type = data.get('layer_type')
+    style_config = data.get('style_config') or {}
+    try:
+        total_size = int(data.get('size'))
+    except (TypeError, ValueError):
+        raise UploadError('size must be the file size in bytes')
+
+    if not name:
+        raise UploadError('Layer name is required.')
+    if layer_type not in dict(MundiLayer.LAYER_TYPES):
+        raise UploadError(f"layer_type must be one of: {', '.join(dict(MundiLayer.LAYER_TYPES))}")
+    if _extension(filename) not in ALLOWED_LAYER_EXTENSIONS:
+        raise UploadError(f"File type not supported. Allowed types: {', '.join(ALLOWED_LAYER_EXTENSIONS)}")
+    if not 0 < total_size <= MAX_LAYER_FILE_SIZE:
+        raise UploadError('File size must be less than 100MB.')
+    if not isinstance(style_config, dict):
+        raise UploadError('style_config must be a JSON object')
+
+    session = UploadSession.objects.create(
+        map_project=project,
+        created_by=user,
+        name=name,
+        layer_type=layer_type,
+        style_config=style_config,
+        filename=filename,
+        total_size=total_size,
+    )
+    os.makedirs(os.path.dirname(partial_path(session)), exist_ok=True)
+    open(partial_path(session), 'wb').close()
+    return session
+
+
+def _validate_chunk(session: UploadSession, chunk: bytes, offset: int):
+    """Check a chunk against the file's format; updates session.validation_state"""
+    extension = _extension(session.filename)
+    state = session.validation_state
+
+    magic_numbers = _MAGIC_NUMBERS.get(extension)
+    if magic_numbers and offset < 4:
+        head = state.get('head', '') + chunk[:4 - offset].hex()
+        state['head'] = head
+        head = bytes.fromhex(head)
+        if not any(magic.startswith(head) or head.startswith(magic) for magic in magic_numbers):
+            raise UploadValidationError(f'File does not look like a {extension} file')
+
+    if extension in _TEXT_EXTENSIONS:
+        # A multi-byte character may straddle two chunks, so the undecoded
+        # tail of the previous chunk is carried over in the session
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        decoder.setstate((bytes.fromhex(state.get('utf8_tail', '')), 0))
+        final = offset + len(chunk) >= session.total_size
+        try:
+            text = decoder.decode(chunk, final=final)
+        except UnicodeDecodeError as e:
+            raise UploadValidationError(f'File is not valid UTF-8 near byte {offset + e.start}') from e
+        state['utf8_tail'] = decoder.getstate()[0].hex()
+
+        if extension == '.geojson' and not state.get('started'):
+            stripped = text.lstrip('\ufeff \t\r\n')
+            if stripped:
+                if not stripped.startswith('{'):
+                    raise UploadValidationError('GeoJSON files must contain a JSON object')
+                state['started'] = True
+
+
+def write_chunk(session: UploadSession, offset: int, stream, length: int) -> UploadSession:
+    """
+    Validate and append ``length`` bytes read from ``stream`` at ``offset``.
+
+    Raises OffsetMismatch when the chunk is not the next one expected, and
+    UploadError when it is too large or fails validation.
+    """
+    if session.status != UploadSession.STATUS_ACTIVE:
+        raise UploadError(f'Upload is {session.status}')
+    if offset != session.received_size:
+        raise OffsetMismatch(session.received_size)
+    if length <= 0 or length > chunk_size():
+        raise UploadError(f'Chunks must be between 1 and {chunk_size()} bytes')
+    if offset + length > session.total_size:
+        raise UploadError('Chunk extends past the declared file size')
+
+    # Validated and written a read at a time, so a chunk is never held in memory
+    written = 0
+    with open(partial_path(session), 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(_READ_SIZE, length - written))
+            if not data:
+                break
+            _validate_chunk(session, data, offset + written)
+            f.write(data)
+            written += len(data)
+        f.truncate()
+    if written != length:
+        raise UploadError('Chunk is shorter than its Content-Length')
+
+    # Only one of two concurrent requests for the same offset may advance it
+    updated = UploadSession.objects.filter(id=session.id, received_size=offset).update(
+        received_size=offset + length,
+        validation_state=session.validation_state,
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        session.refresh_from_db()
+        raise OffsetMismatch(session.received_size)
+    session.received_size = offset + length
+    return session
+
+
+def complete_upload(session: UploadSession) -> MundiLayer:
+    """
+    Move the finished file into layer storage and create its layer.
+
+    GeoJSON is validated in full first, streamed from the partial file, and
+    rejected with UploadValidationError listing the first problems found.
+    """
+    if not session.is_complete:
+        raise OffsetMismatch(session.received_size)
+    if session.status == UploadSession.STATUS_ACTIVE and _extension(session.filename) == '.geojson':
+        report = validate_geojson_file(partial_path(session))
+        if not report.is_valid:
+            raise UploadValidationError('File is not valid GeoJSON', report.errors)
+    claimed = UploadSession.objects.filter(id=session.id, status=UploadSession.STATUS_ACTIVE).update(
+        status=UploadSession.STATUS_COMPLETED, updated_at=timezone.now()
+    )
+    if not claimed:
+        session.refresh_from_db()
+        raise UploadError(f'Upload is {session.status}')
+
+    # Reserve a free name under the layer upload directory, then move the partial file there
+    name = default_storage.get_available_name(f'{LAYER_UPLOAD_DIR}/{session.filename}')
+    os.makedirs(os.path.dirname(default_storage.path(name)), exist_ok=True)
+    os.replace(partial_path(session), default_storage.path(name))
+
+    layer = MundiLayer(
+        name=session.name,
+        layer_type=session.layer_type,
+        map_project=session.map_project,
+        style_config=session.style_config,
+    )
+    layer.mundi_layer_id = f"local_{layer.id}"
+    layer.file_path.name = name
+    layer.save()
+
+    session.status = UploadSession.STATUS_COMPLETED
+    session.layer = layer
+    session.save(update_fields=['layer', 'updated_at'])
+    return layer
+
+
+def abort_upload(session: UploadSession):
+    if os.path.exists(partial_path(session)):
+        os.remove(partial_path(session))
+    session.status = UploadSession.STATUS_ABORTED
+    session.save(update_fields=['status', 'updated_at'])
+
+
+def delete_stale_uploads(max_age: timedelta) -> int:
+    """Abort active uploads untouched for max_age and delete their partial files"""
+    stale = UploadSession.objects.filter(
+        status=UploadSession.STATUS_ACTIVE, updated_at__lt=timezone.now() - max_age
+    )
+    count = 0
+    for session in stale:
+        abort_upload(session)
+        count += 1
+    return count
+
+
+def upload_status(session: UploadSession) -> Dict[str, Any]:
+    status = {
+        'upload_id': str(session.id),
+        'status': session.status,
+        'offset': session.received_size,
+        'size': session.total_size,
+        'chunk_size': chunk_size(),
+    }
+    if session.layer_id:
+        status['layer_id'] = str(session.layer_id)
+    return status
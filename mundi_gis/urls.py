@@ -16,6 +16,9 @@ urlpatterns = [
     
     # Layer management
     path('projects/<uuid:project_id>/upload-layer/', views.layer_upload, name='layer_upload'),
+    path('projects/<uuid:project_id>/uploads/', views.upload_start, name='upload_start'),
+    path('uploads/<uuid:upload_id>/', views.upload_session, name='upload_session'),
+    path('uploads/<uuid:upload_id>/complete/', views.upload_complete, name='upload_complete'),
     
     # Map rendering
     path('projects/<uuid:project_id>/render/', views.render_map, name='render_map'),
@@ -29,10 +32,24 @@ urlpatterns = [
     path('ai/generate-description/<uuid:project_id>/', views.ai_generate_description, name='ai_generate_description'),
     path('ai/test-connection/', views.test_ollama_connection, name='test_ollama_connection'),
     path('ai/analyze-project/', views.ai_analyze_project, name='ai_analyze_project'),
+    path('ai/analyze-project/stream/', views.ai_analyze_project_stream, name='ai_analyze_project_stream'),
+    path('ai/analyze-layer/<uuid:layer_id>/stream/', views.ai_analyze_layer_stream, name='ai_analyze_layer_stream'),
     path('projects/<uuid:project_id>/ai-analysis/', views.ai_analysis_page, name='ai_analysis_page'),
     path('projects/<uuid:project_id>/ai-chat/', views.ai_chat_page, name='ai_chat_page'),
     
     # Layer data endpoints
-    path('projects/<uuid:project_id>/layers/<int:layer_id>/data/', views.layer_data, name='layer_data'),
+    path('projects/<uuid:project_id>/layers/<uuid:layer_id>/data/', views.layer_data, name='layer_data'),
+    path('projects/<uuid:project_id>/layers/<uuid:layer_id>/download/', views.layer_download, name='layer_download'),
     path('projects/<uuid:project_id>/layers-data/', views.project_layers_data, name='project_layers_data'),
+    path('projects/<uuid:project_id>/layers/<uuid:layer_id>/tiles/<int:z>/<int:x>/<int:y>.pbf',
+         views.layer_vector_tile, name='layer_vector_tile'),
+    path('projects/<uuid:project_id>/layers/<uuid:layer_id>/tiles/<int:z>/<int:x>/<int:y>.<str:tile_format>',
+         views.layer_raster_tile, name='layer_raster_tile'),
+    path('projects/<uuid:project_id>/layers/<uuid:layer_id>/points/', views.layer_points, name='layer_points'),
+    
+    # Spatial analysis
+    path('projects/<uuid:project_id>/spatial/', views.project_spatial_query, name='project_spatial_query'),
+    
+    # Background jobs
+    path('jobs/<uuid:job_id>/', views.background_job_status, name='job_status'),
 ] 
\ No newline at end of file
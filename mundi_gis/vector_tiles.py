@@ -0,0 +1,611 @@
+"""
+Mapbox Vector Tile (MVT) generation for uploaded GeoJSON layers.
+
+A ``TileIndex`` is built once per layer file: geometries are projected to
+Web Mercator, every vertex gets a Douglas-Peucker significance value, and
+features are bucketed into a coarse grid. Cutting a tile is then a matter of
+picking the features that touch it, dropping vertices that are insignificant
+at that zoom, clipping to the (buffered) tile and encoding the result.
+"""
+
+import json
+import math
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from django.conf import settings
+
+
+EXTENT = 4096
+BUFFER = 64
+MAX_ZOOM = 24
+SIMPLIFY_TOLERANCE = 3  # in tile pixels at EXTENT resolution
+GRID_ZOOM = 6
+MAX_LATITUDE = 85.05112878
+
+POINT, LINESTRING, POLYGON = 1, 2, 3
+
+TILE_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+
+
+# ---------------------------------------------------------------------------
+# Projection and simplification
+# ---------------------------------------------------------------------------
+
+def mercator(lon: float, lat: float) -> Tuple[float, float]:
+    """Project lon/lat to Web Mercator in the unit square (y grows southwards)"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    sin = math.sin(math.radians(lat))
+    x = lon / 360.0 + 0.5
+    y = 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+    return x, y
+
+
+def _segment_sq_dist(px, py, ax, ay, bx, by) -> float:
+    dx, dy = bx - ax, by - ay
+    if dx or dy:
+        t = ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)
+        if t > 1:
+            ax, ay = bx, by
+        elif t > 0:
+            ax, ay = ax + dx * t, ay + dy * t
+    dx, dy = px - ax, py - ay
+    return dx * dx + dy * dy
+
+
+def vertex_significance(points: List[Tuple[float, float]]) -> List[float]:
+    """
+    Douglas-Peucker significance of every vertex, as a squared distance.
+
+    A vertex is kept at a given tolerance when its significance exceeds the
+    squared tolerance. Values are capped by the parent split so the vertices
+    kept at a coarse tolerance are always a subset of those kept at a finer one.
+    """
+    n = len(points)
+    sig = [0.0] * n
+    if n == 0:
+        return sig
+    sig[0] = sig[-1] = math.inf
+    stack = [(0, n - 1, math.inf)]
+    while stack:
+        first, last, cap = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay = points[first]
+        bx, by = points[last]
+        max_dist, index = -1.0, first
+        for i in range(first + 1, last):
+            d = _segment_sq_dist(points[i][0], points[i][1], ax, ay, bx, by)
+            if d > max_dist:
+                max_dist, index = d, i
+        max_dist = min(max_dist, cap)
+        sig[index] = max_dist
+        stack.append((first, index, max_dist))
+        stack.append((index, last, max_dist))
+    return sig
+
+
+def _prepare_path(coords: Iterable, min_sq_tolerance: float) -> List[Tuple[float, float, float]]:
+    points = [mercator(c[0], c[1]) for c in coords]
+    sig = vertex_significance(points)
+    return [(x, y, s) for (x, y), s in zip(points, sig) if s > min_sq_tolerance]
+
+
+# ---------------------------------------------------------------------------
+# Clipping
+# ---------------------------------------------------------------------------
+
+def _clip_ring(ring, minx, miny, maxx, maxy):
+    """Sutherland-Hodgman clip of a closed ring against a rectangle"""
+    def clip(points, inside, intersect):
+        output = []
+        if not points:
+            return output
+        prev = points[-1]
+        for cur in points:
+            if inside(cur):
+                if not inside(prev):
+                    output.append(intersect(prev, cur))
+                output.append(cur)
+            elif inside(prev):
+                output.append(intersect(prev, cur))
+            prev = cur
+        return output
+
+    def at_x(x):
+        def intersect(a, b):
+            t = (x - a[0]) / (b[0] - a[0])
+            return (x, a[1] + (b[1] - a[1]) * t, math.inf)
+        return intersect
+
+    def at_y(y):
+        def intersect(a, b):
+            t = (y - a[1]) / (b[1] - a[1])
+            return (a[0] + (b[0] - a[0]) * t, y, math.inf)
+        return intersect
+
+    points = ring[:-1] if len(ring) > 1 and ring[0][:2] == ring[-1][:2] else ring
+    points = clip(points, lambda p: p[0] >= minx, at_x(minx))
+    points = clip(points, lambda p: p[0] <= maxx, at_x(maxx))
+    points = clip(points, lambda p: p[1] >= miny, at_y(miny))
+    points = clip(points, lambda p: p[1] <= maxy, at_y(maxy))
+    return points
+
+
+def _clip_line(line, minx, miny, maxx, maxy):
+    """Liang-Barsky clip of a polyline, returning the parts inside the rectangle"""
+    parts, current = [], []
+    for a, b in zip(line, line[1:]):
+        dx, dy = b[0] - a[0], b[1] - a[1]
+        t0, t1 = 0.0, 1.0
+        visible = True
+        for p, q in ((-dx, a[0] - minx), (dx, maxx - a[0]), (-dy, a[1] - miny), (dy, maxy - a[1])):
+            if p == 0:
+                if q < 0:
+                    visible = False
+                    break
+            else:
+                t = q / p
+                if p < 0:
+                    t0 = max(t0, t)
+                else:
+                    t1 = min(t1, t)
+                if t0 > t1:
+                    visible = False
+                    break
+        if not visible:
+            if len(current) > 1:
+                parts.append(current)
+            current = []
+            continue
+        start = a if t0 == 0 else (a[0] + dx * t0, a[1] + dy * t0, math.inf)
+        end = b if t1 == 1 else (a[0] + dx * t1, a[1] + dy * t1, math.inf)
+        if not current:
+            current = [start]
+        current.append(end)
+        if t1 < 1:
+            parts.append(current)
+            current = []
+    if len(current) > 1:
+        parts.append(current)
+    return parts
+
+
+# ---------------------------------------------------------------------------
+# Protobuf encoding
+# ---------------------------------------------------------------------------
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _field_varint(field: int, value: int) -> bytes:
+    return _varint(field << 3) + _varint(value)
+
+
+def _field_bytes(field: int, value: bytes) -> bytes:
+    return _varint((field << 3) | 2) + _varint(len(value)) + value
+
+
+def _field_packed(field: int, values: List[int]) -> bytes:
+    return _field_bytes(field, b''.join(_varint(v) for v in values))
+
+
+def _encode_value(value: Any) -> Optional[Tuple[Tuple, bytes]]:
+    """Encode a property value as an MVT Value message, keyed for de-duplication"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return ('bool', value), _field_varint(7, int(value))
+    if isinstance(value, int) and -(1 << 63) <= value < (1 << 64):
+        if value >= 0:
+            return ('uint', value), _field_varint(5, value)
+        return ('sint', value), _field_varint(6, _zigzag(value))
+    if isinstance(value, float):
+        return ('double', value), _varint((3 << 3) | 1) + struct.pack('<d', value)
+    if not isinstance(value, str):
+        value = json.dumps(value, default=str)
+    return ('string', value), _field_bytes(1, value.encode('utf-8'))
+
+
+def _command(cmd: int, count: int) -> int:
+    return (cmd & 0x7) | (count << 3)
+
+
+def encode_tile(layer_name: str, features: List[Dict[str, Any]], extent: int = EXTENT) -> bytes:
+    """Encode tile-space features as a single-layer Mapbox Vector Tile"""
+    if not features:
+        return b''
+
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple, int] = {}
+    encoded_values: List[bytes] = []
+    body = bytearray()
+    body += _field_varint(15, 2)
+    body += _field_bytes(1, layer_name.encode('utf-8'))
+
+    for feature in features:
+        tags = []
+        for key, value in feature['properties'].items():
+            encoded = _encode_value(value)
+            if encoded is None:
+                continue
+            value_key, value_bytes = encoded
+            if key not in keys:
+                keys[key] = len(keys)
+            if value_key not in values:
+                values[value_key] = len(values)
+                encoded_values.append(value_bytes)
+            tags.extend((keys[key], values[value_key]))
+
+        message = bytearray()
+        if feature.get('id') is not None:
+            message += _field_varint(1, feature['id'])
+        if tags:
+            message += _field_packed(2, tags)
+        message += _field_varint(3, feature['type'])
+        message += _field_packed(4, feature['geometry'])
+        body += _field_bytes(2, bytes(message))
+
+    for key in keys:
+        body += _field_bytes(3, key.encode('utf-8'))
+    for value_bytes in encoded_values:
+        body += _field_bytes(4, value_bytes)
+    body += _field_varint(5, extent)
+
+    return _field_bytes(3, bytes(body))
+
+
+def _geometry_commands(geom_type: int, parts: List[List[Tuple[int, int]]]) -> List[int]:
+    commands = []
+    cx = cy = 0
+
+    def moves(points):
+        nonlocal cx, cy
+        out = []
+        for x, y in points:
+            out.extend((_zigzag(x - cx), _zigzag(y - cy)))
+            cx, cy = x, y
+        return out
+
+    if geom_type == POINT:
+        points = [p for part in parts for p in part]
+        commands.append(_command(1, len(points)))
+        commands.extend(moves(points))
+        return commands
+
+    for part in parts:
+        commands.append(_command(1, 1))
+        commands.extend(moves(part[:1]))
+        commands.append(_command(2, len(part) - 1))
+        commands.extend(moves(part[1:]))
+        if geom_type == POLYGON:
+            commands.append(_command(7, 1))
+    return commands
+
+
+def _ring_area(ring: List[Tuple[int, int]]) -> int:
+    area = 0
+    for i, (x1, y1) in enumerate(ring):
+        x2, y2 = ring[(i + 1) % len(ring)]
+        area += x1 * y2 - x2 * y1
+    return area
+
+
+# ---------------------------------------------------------------------------
+# Tile index
+# ---------------------------------------------------------------------------
+
+class _IndexedFeature:
+    __slots__ = ('type', 'parts', 'properties', 'id', 'bbox')
+
+    def __init__(self, geom_type, parts, properties, feature_id):
+        self.type = geom_type
+        self.parts = parts
+        self.properties = properties
+        self.id = feature_id
+        xs, ys = [], []
+        for part in parts:
+            rings = part if geom_type == POLYGON else [part]
+            for ring in rings:
+                xs.extend(p[0] for p in ring)
+                ys.extend(p[1] for p in ring)
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+
+
+class TileIndex:
+    """Per-layer index from which vector tiles are cut on demand"""
+
+    def __init__(self, geojson: Dict[str, Any], max_cached_tiles: int = 256):
+        self.features: List[_IndexedFeature] = []
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+        self._tiles: OrderedDict = OrderedDict()
+        self._max_cached_tiles = max_cached_tiles
+        self._lock = threading.Lock()
+
+        min_tolerance = (SIMPLIFY_TOLERANCE / ((1 << MAX_ZOOM) * EXTENT)) ** 2
+        for feature in _iter_features(geojson):
+            self._add_feature(feature, min_tolerance)
+
+    def to_json(self) -> Dict[str, Any]:
+        """The indexed features as plain data; encoded tiles are per-process and not kept"""
+        return {'features': [[f.type, f.parts, f.properties, f.id] for f in self.features]}
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'TileIndex':
+        """Rebuild an index from to_json() output; raises ValueError, KeyError or TypeError if malformed"""
+        index = cls({'type': 'FeatureCollection', 'features': []})
+        for geom_type, parts, properties, feature_id in data['features']:
+            if geom_type == POLYGON:
+                parts = [[[tuple(p) for p in ring] for ring in polygon] for polygon in parts]
+            elif geom_type in (POINT, LINESTRING):
+                parts = [[tuple(p) for p in part] for part in parts]
+            else:
+                raise ValueError(f'Unknown geometry type {geom_type}')
+            index._insert(_IndexedFeature(geom_type, parts, properties, feature_id))
+        return index
+
+    def _add_feature(self, feature: Dict[str, Any], min_tolerance: float):
+        properties = feature.get('properties') or {}
+        feature_id = feature.get('id')
+        if not (isinstance(feature_id, int) and not isinstance(feature_id, bool) and 0 <= feature_id < (1 << 64)):
+            feature_id = None
+
+        for geometry in _iter_geometries(feature.get('geometry')):
+            geom_type = geometry.get('type')
+            coords = geometry.get('coordinates')
+            if not coords:
+                continue
+
+            if geom_type == 'Point':
+                indexed = (POINT, [[mercator(coords[0], coords[1])]])
+            elif geom_type == 'MultiPoint':
+                indexed = (POINT, [[mercator(c[0], c[1]) for c in coords]])
+            elif geom_type == 'LineString':
+                indexed = (LINESTRING, [_prepare_path(coords, min_tolerance)])
+            elif geom_type == 'MultiLineString':
+                indexed = (LINESTRING, [_prepare_path(line, min_tolerance) for line in coords])
+            elif geom_type == 'Polygon':
+                indexed = (POLYGON, [[_prepare_path(ring, min_tolerance) for ring in coords]])
+            elif geom_type == 'MultiPolygon':
+                indexed = (POLYGON, [[_prepare_path(ring, min_tolerance) for ring in polygon] for polygon in coords])
+            else:
+                continue
+
+            geom_type, parts = indexed
+            if geom_type == POLYGON:
+                parts = [[ring for ring in polygon if len(ring) >= 4] for polygon in parts]
+                parts = [polygon for polygon in parts if polygon]
+            else:
+                parts = [part for part in parts if part]
+            if not parts:
+                continue
+
+            self._insert(_IndexedFeature(geom_type, parts, properties, feature_id))
+
+    def _insert(self, feature: _IndexedFeature):
+        index = len(self.features)
+        self.features.append(feature)
+        for cell in self._cells(*feature.bbox):
+            self._grid.setdefault(cell, []).append(index)
+
+    @staticmethod
+    def _cells(minx, miny, maxx, maxy):
+        size = 1 << GRID_ZOOM
+        x0 = max(0, min(size - 1, int(minx * size)))
+        x1 = max(0, min(size - 1, int(maxx * size)))
+        y0 = max(0, min(size - 1, int(miny * size)))
+        y1 = max(0, min(size - 1, int(maxy * size)))
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                yield cx, cy
+
+    def _candidates(self, minx, miny, maxx, maxy) -> List[_IndexedFeature]:
+        found = set()
+        for cell in self._cells(minx, miny, maxx, maxy):
+            found.update(self._grid.get(cell, ()))
+        candidates = []
+        for index in sorted(found):
+            feature = self.features[index]
+            fx0, fy0, fx1, fy1 = feature.bbox
+            if fx0 <= maxx and fx1 >= minx and fy0 <= maxy and fy1 >= miny:
+                candidates.append(feature)
+        return candidates
+
+    def get_tile(self, z: int, x: int, y: int, layer_name: str = 'layer') -> bytes:
+        """Return the encoded vector tile at z/x/y (empty bytes if nothing intersects it)"""
+        key = (z, x, y, layer_name)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+
+        tile = encode_tile(layer_name, self._cut_tile(z, x, y))
+
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self._max_cached_tiles:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def _cut_tile(self, z: int, x: int, y: int) -> List[Dict[str, Any]]:
+        scale = 1 << z
+        buffer = BUFFER / EXTENT
+        minx, maxx = (x - buffer) / scale, (x + 1 + buffer) / scale
+        miny, maxy = (y - buffer) / scale, (y + 1 + buffer) / scale
+        sq_tolerance = (SIMPLIFY_TOLERANCE / (scale * EXTENT)) ** 2
+
+        def to_tile(point):
+            return (int(round((point[0] * scale - x) * EXTENT)),
+                    int(round((point[1] * scale - y) * EXTENT)))
+
+        def dedupe(points):
+            out = []
+            for p in points:
+                if not out or out[-1] != p:
+                    out.append(p)
+            return out
+
+        tile_features = []
+        for feature in self._candidates(minx, miny, maxx, maxy):
+            parts = []
+            if feature.type == POINT:
+                points = [to_tile(p) for p in feature.parts[0]
+                          if minx <= p[0] <= maxx and miny <= p[1] <= maxy]
+                if points:
+                    parts.append(points)
+            elif feature.type == LINESTRING:
+                for line in feature.parts:
+                    simplified = [p for p in line if p[2] > sq_tolerance]
+                    for clipped in _clip_line(simplified, minx, miny, maxx, maxy):
+                        clipped = dedupe(to_tile(p) for p in clipped)
+                        if len(clipped) >= 2:
+                            parts.append(clipped)
+            else:
+                for polygon in feature.parts:
+                    for ring_index, ring in enumerate(polygon):
+                        simplified = [p for p in ring if p[2] > sq_tolerance]
+                        if len(simplified) < 4:
+                            if ring_index == 0:
+                                break
+                            continue
+                        clipped = dedupe(to_tile(p) for p in _clip_ring(simplified, minx, miny, maxx, maxy))
+                        if len(clipped) > 1 and clipped[0] == clipped[-1]:
+                            clipped.pop()
+                        area = _ring_area(clipped) if len(clipped) >= 3 else 0
+                        if not area:
+                            if ring_index == 0:
+                                break
+                            continue
+                        # Exterior rings must have positive area in tile space, holes negative
+                        if (ring_index == 0) != (area > 0):
+                            clipped.reverse()
+                        parts.append(clipped)
+
+            if parts:
+                tile_features.append({
+                    'id': feature.id,
+                    'type': feature.type,
+                    'properties': feature.properties,
+                    'geometry': _geometry_commands(feature.type, parts),
+                })
+        return tile_features
+
+
+def _iter_features(geojson: Dict[str, Any]):
+    if not isinstance(geojson, dict):
+        raise ValueError('GeoJSON must be a JSON object')
+    geojson_type = geojson.get('type')
+    if geojson_type == 'FeatureCollection':
+        yield from geojson.get('features') or []
+    elif geojson_type == 'Feature':
+        yield geojson
+    elif geojson_type:
+        yield {'type': 'Feature', 'geometry': geojson, 'properties': {}}
+    else:
+        raise ValueError('Not a GeoJSON object')
+
+
+def _iter_geometries(geometry: Optional[Dict[str, Any]]):
+    if not geometry:
+        return
+    if geometry.get('type') == 'GeometryCollection':
+        for child in geometry.get('geometries') or []:
+            yield from _iter_geometries(child)
+    else:
+        yield geometry
+
+
+# ---------------------------------------------------------------------------
+# Per-file index cache
+# ---------------------------------------------------------------------------
+
+_index_cache: OrderedDict = OrderedDict()
+_index_cache_lock = threading.Lock()
+_index_build_locks: Dict[str, threading.Lock] = {}
+
+
+def _sidecar_path(file_path: str) -> str:
+    return f'{file_path}.tileindex'
+
+
+def _load_sidecar(file_path: str, signature: Tuple[int, int]) -> Optional[TileIndex]:
+    """Load a persisted index if it was built from the file as it is now"""
+    try:
+        with open(_sidecar_path(file_path), 'r') as f:
+            data = json.load(f)
+        if tuple(data['signature']) != tuple(signature):
+            return None
+        return TileIndex.from_json(data)
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        return None
+
+
+def _save_sidecar(file_path: str, signature: Tuple[int, int], index: TileIndex):
+    # Written under a temporary name and renamed so readers never see a partial file
+    tmp_path = f'{_sidecar_path(file_path)}.{os.getpid()}.tmp'
+    try:
+        # JSON rather than pickle: the file sits among uploads, so loading it must not run code
+        with open(tmp_path, 'w') as f:
+            json.dump({'signature': list(signature), **index.to_json()}, f)
+        os.replace(tmp_path, _sidecar_path(file_path))
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_tile_index(file_path: str, persist: bool = False) -> TileIndex:
+    """
+    Return the tile index for a GeoJSON file, building it on first use.
+
+    Indexes are kept in a small per-process LRU and rebuilt when the file's
+    modification time or size changes. An index persisted next to the file
+    (``persist=True``, as the ingest job does) is loaded instead of rebuilt,
+    so web processes reuse the work done by background workers.
+    """
+    stat = os.stat(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    max_entries = getattr(settings, 'MUNDI_TILE_INDEX_CACHE_SIZE', 8)
+
+    with _index_cache_lock:
+        cached = _index_cache.get(file_path)
+        if cached and cached[0] == signature:
+            _index_cache.move_to_end(file_path)
+            return cached[1]
+        build_lock = _index_build_locks.setdefault(file_path, threading.Lock())
+
+    # Only one thread builds a given index; the others wait and reuse it
+    with build_lock:
+        with _index_cache_lock:
+            cached = _index_cache.get(file_path)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+        index = _load_sidecar(file_path, signature)
+        if index is None:
+            with open(file_path, 'r') as f:
+                index = TileIndex(json.load(f))
+            if persist:
+                _save_sidecar(file_path, signature, index)
+
+        with _index_cache_lock:
+            _index_cache[file_path] = (signature, index)
+            _index_cache.move_to_end(file_path)
+            while len(_index_cache) > max_entries:
+                evicted, _ = _index_cache.popitem(last=False)
+                _index_build_locks.pop(evicted, None)
+    return index
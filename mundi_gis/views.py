@@ -1,50 +1,87 @@
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
+from django.utils.cache import patch_vary_headers
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
 from django.core.paginator import Paginator
+from django.db.models import Sum
 from django.conf import settings
-import requests
+from asgiref.sync import sync_to_async
+import codecs
 import json
+import logging
 import os
-from .models import MundiMapProject, MundiLayer, MundiMapRender
+import time
+import uuid
+from .models import MundiMapProject, MundiLayer, MundiMapRender, LayerStatistics, BackgroundJob, UploadSession
 from .forms import MundiMapProjectForm, MundiLayerForm
-from .local_llm import LocalLLMService
+from .http_cache import layer_etag, layer_last_modified, not_modified_response, project_etag, set_cache_headers
+from .layer_pool import map_layers, serialize_layer_data, server_timing
+from .layer_stats import get_layer_statistics, layer_analysis_info, project_analysis_info
+from .llm_admission import LLMBusyError
+from .llm_tools import ProjectTools
+from .local_llm import LocalLLMService, LLMServiceError
+from .mundi_api import MUNDI_API_KEY, amundi_api_request
+from .point_cloud import (
+    DEFAULT_POINT_BUDGET, MAX_POINT_BUDGET, get_octree, is_point_cloud, parse_bounds, parse_camera,
+    parse_frustum, points_json,
+)
+from .precompressed import find_precompressed, layer_data_chunks, layer_metadata
+from .prompts import build_project_prompt
+from .raster_tiles import RasterError, blank_tile, find_raster_tiles, get_raster_tiles, is_raster
+from .readers import ReaderError
+from .jobs import enqueue, job_status
+from .simplify import pyramid_level_path
+from .spatial_index import SpatialIndexError, get_spatial_index, parse_bbox, read_features
+from .spatial_ops import SpatialQueryError, project_layer_resolver, run_spatial_query
+from .storage import layer_file_path, layer_geojson_path
+from .uploads import (
+    OffsetMismatch, UploadError, UploadValidationError, abort_upload, complete_upload, start_upload,
+    upload_status, write_chunk,
+)
+from .vector_tiles import get_tile_index, MAX_ZOOM, TILE_CONTENT_TYPE
 
 
-# Mundi API configuration
-MUNDI_API_BASE_URL = os.getenv('MUNDI_API_BASE_URL', 'https://app.mundi.ai/api')
-MUNDI_API_KEY = os.getenv('MUNDI_API_KEY', '')
+logger = logging.getLogger(__name__)
 
+# Size of the raw file chunks copied into streamed layer responses
+LAYER_STREAM_CHUNK_SIZE = 64 * 1024
 
-def mundi_api_request(endpoint, method='GET', data=None, headers=None):
-    """Helper function to make requests to Mundi API"""
-    url = f"{MUNDI_API_BASE_URL}/{endpoint}"
-    
-    default_headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {MUNDI_API_KEY}'
+# Template rendering may touch the ORM (e.g. request.user), so async views run it in a thread
+_arender = sync_to_async(render)
+
+
+def _map_layer_info(layer):
+    """Layer metadata the map client needs, without any geometry"""
+    layer_info = {
+        'id': str(layer.id),
+        'name': layer.name,
+        'layer_type': layer.layer_type,
+        'description': f'{layer.name} ({layer.get_layer_type_display()}) layer',
+        'created_at': layer.created_at.isoformat(),
     }
     
-    if headers:
-        default_headers.update(headers)
+    statistics = get_layer_statistics(layer)
+    if statistics:
+        layer_info.update({
+            'feature_count': statistics.feature_count,
+            'geometry_type': statistics.geometry_type,
+            'bbox': statistics.bbox,
+        })
     
-    try:
-        if method.upper() == 'GET':
-            response = requests.get(url, headers=default_headers)
-        elif method.upper() == 'POST':
-            response = requests.post(url, json=data, headers=default_headers)
-        elif method.upper() == 'PUT':
-            response = requests.put(url, json=data, headers=default_headers)
-        elif method.upper() == 'DELETE':
-            response = requests.delete(url, headers=default_headers)
-        
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        return {'error': str(e)}
+    # Rasters are drawn from image tiles once the ingest job has built them
+    file_path = layer_file_path(layer)
+    if file_path and is_raster(file_path) and os.path.exists(file_path):
+        raster_tiles = find_raster_tiles(file_path)
+        if raster_tiles:
+            layer_info['raster'] = raster_tiles.info()
+            layer_info['bbox'] = raster_tiles.bounds
+    return layer_info
 
 
 @login_required
@@ -59,12 +96,16 @@ def dashboard(request):
     total_projects = user_projects.count()
     total_layers = MundiLayer.objects.filter(map_project__created_by=request.user).count()
     total_renders = MundiMapRender.objects.filter(map_project__created_by=request.user).count()
+    total_features = LayerStatistics.objects.filter(
+        layer__map_project__created_by=request.user
+    ).aggregate(total=Sum('feature_count'))['total'] or 0
     
     context = {
         'recent_projects': recent_projects,
         'total_projects': total_projects,
         'total_layers': total_layers,
         'total_renders': total_renders,
+        'total_features': total_features,
         'mundi_api_available': bool(MUNDI_API_KEY),
         'ollama_available': LocalLLMService().is_available(),
     }
@@ -94,26 +135,27 @@ def project_list(request):
 def project_detail(request, project_id):
     """Detail view for a specific map project"""
     project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
-    layers = project.layers.all()
+    layers = project.layers.select_related('statistics')
     renders = project.renders.all()[:5]  # Recent renders
     
     context = {
         'project': project,
         'layers': layers,
         'renders': renders,
+        'map_layers': [_map_layer_info(layer) for layer in layers],
     }
     
     return render(request, 'mundi_gis/project_detail.html', context)
 
 
 @login_required
-def project_create(request):
+async def project_create(request):
     """Create a new map project"""
     if request.method == 'POST':
         form = MundiMapProjectForm(request.POST)
         if form.is_valid():
             project = form.save(commit=False)
-            project.created_by = request.user
+            project.created_by = await request.auser()
             
             # Try to create project in Mundi API (optional)
             if MUNDI_API_KEY:
@@ -122,23 +164,23 @@ def project_create(request):
                     'description': project.description,
                 }
                 
-                api_response = mundi_api_request('maps', method='POST', data=api_data)
+                api_response = await amundi_api_request('maps', method='POST', data=api_data)
                 
                 if 'error' not in api_response:
                     project.mundi_project_id = api_response.get('id')
-                    project.save()
+                    await project.asave()
                     messages.success(request, 'Map project created successfully with Mundi AI integration!')
                     return redirect('mundi_gis:project_detail', project_id=project.id)
                 else:
                     # If API fails, still save locally but warn user
                     project.mundi_project_id = f"local_{project.id}"
-                    project.save()
+                    await project.asave()
                     messages.warning(request, f'Project created locally. Mundi AI integration failed: {api_response["error"]}')
                     return redirect('mundi_gis:project_detail', project_id=project.id)
             else:
                 # No API key configured, save locally only
                 project.mundi_project_id = f"local_{project.id}"
-                project.save()
+                await project.asave()
                 messages.success(request, 'Map project created successfully! (Local mode - no Mundi AI integration)')
                 return redirect('mundi_gis:project_detail', project_id=project.id)
     else:
@@ -149,18 +191,18 @@ def project_create(request):
         'title': 'Create New Map Project',
     }
     
-    return render(request, 'mundi_gis/project_form.html', context)
+    return await _arender(request, 'mundi_gis/project_form.html', context)
 
 
 @login_required
-def project_update(request, project_id):
+async def project_update(request, project_id):
     """Update an existing map project"""
-    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    project = await aget_object_or_404(MundiMapProject, id=project_id, created_by=await request.auser())
     
     if request.method == 'POST':
         form = MundiMapProjectForm(request.POST, instance=project)
         if form.is_valid():
-            project = form.save()
+            project = await sync_to_async(form.save)()
             
             # Try to update project in Mundi API (optional)
             if MUNDI_API_KEY and not project.mundi_project_id.startswith('local_'):
@@ -169,8 +211,8 @@ def project_update(request, project_id):
                     'description': project.description,
                 }
                 
-                api_response = mundi_api_request(f'maps/{project.mundi_project_id}', 
-                                               method='PUT', data=api_data)
+                api_response = await amundi_api_request(f'maps/{project.mundi_project_id}', 
+                                                        method='PUT', data=api_data)
                 
                 if 'error' not in api_response:
                     messages.success(request, 'Map project updated successfully with Mundi AI integration!')
@@ -191,35 +233,35 @@ def project_update(request, project_id):
         'title': 'Update Map Project',
     }
     
-    return render(request, 'mundi_gis/project_form.html', context)
+    return await _arender(request, 'mundi_gis/project_form.html', context)
 
 
 @login_required
-def project_delete(request, project_id):
+async def project_delete(request, project_id):
     """Delete a map project"""
-    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    project = await aget_object_or_404(MundiMapProject, id=project_id, created_by=await request.auser())
     
     if request.method == 'POST':
         # Try to delete project from Mundi API (optional)
         if MUNDI_API_KEY and not project.mundi_project_id.startswith('local_'):
-            api_response = mundi_api_request(f'maps/{project.mundi_project_id}', 
-                                           method='DELETE')
+            api_response = await amundi_api_request(f'maps/{project.mundi_project_id}', 
+                                                    method='DELETE')
             
             if 'error' not in api_response:
                 project.is_active = False
-                project.save()
+                await project.asave()
                 messages.success(request, 'Map project deleted successfully from Mundi AI!')
                 return redirect('mundi_gis:project_list')
             else:
                 # If API fails, still delete locally
                 project.is_active = False
-                project.save()
+                await project.asave()
                 messages.warning(request, f'Project deleted locally. Mundi AI deletion failed: {api_response["error"]}')
                 return redirect('mundi_gis:project_list')
         else:
             # No API key or local project, delete locally only
             project.is_active = False
-            project.save()
+            await project.asave()
             messages.success(request, 'Map project deleted successfully! (Local mode)')
             return redirect('mundi_gis:project_list')
     
@@ -227,7 +269,23 @@ def project_delete(request, project_id):
         'project': project,
     }
     
-    return render(request, 'mundi_gis/project_confirm_delete.html', context)
+    return await _arender(request, 'mundi_gis/project_confirm_delete.html', context)
+
+
+def _report_ingest_job(request, job):
+    """Tell the user how layer processing went, or that it is still queued"""
+    if job.status == BackgroundJob.STATUS_SUCCEEDED:
+        mundi = job.result.get('mundi')
+        if mundi == 'uploaded':
+            messages.success(request, 'Layer uploaded successfully with Mundi AI integration!')
+        elif mundi == 'failed':
+            messages.warning(request, f'Layer saved locally. Mundi AI upload failed: {job.result.get("mundi_error")}')
+        else:
+            messages.success(request, 'Layer uploaded successfully! (Local mode)')
+    elif job.status == BackgroundJob.STATUS_FAILED:
+        messages.warning(request, 'Layer saved, but processing it failed. See the job status for details.')
+    else:
+        messages.success(request, 'Layer uploaded successfully! It is being processed in the background.')
 
 
 @login_required
@@ -240,38 +298,13 @@ def layer_upload(request, project_id):
         if form.is_valid():
             layer = form.save(commit=False)
             layer.map_project = project
+            layer.mundi_layer_id = f"local_{layer.id}"
+            layer.save()
             
-            # Upload file to Mundi API (optional)
-            if request.FILES.get('file_path'):
-                if MUNDI_API_KEY and not project.mundi_project_id.startswith('local_'):
-                    files = {'file': request.FILES['file_path']}
-                    headers = {'Authorization': f'Bearer {MUNDI_API_KEY}'}
-                    
-                    upload_url = f"{MUNDI_API_BASE_URL}/maps/{project.mundi_project_id}/layers"
-                    
-                    try:
-                        response = requests.post(upload_url, files=files, headers=headers)
-                        response.raise_for_status()
-                        api_response = response.json()
-                        
-                        layer.mundi_layer_id = api_response.get('id')
-                        layer.save()
-                        
-                        messages.success(request, 'Layer uploaded successfully with Mundi AI integration!')
-                        return redirect('mundi_gis:project_detail', project_id=project.id)
-                    except requests.exceptions.RequestException as e:
-                        # If API fails, still save locally
-                        layer.mundi_layer_id = f"local_{layer.id}"
-                        layer.save()
-                        messages.warning(request, f'Layer saved locally. Mundi AI upload failed: {str(e)}')
-                        return redirect('mundi_gis:project_detail', project_id=project.id)
-                else:
-                    # No API key or local project, save locally only
-                    layer.mundi_layer_id = f"local_{layer.id}"
-                    layer.save()
-                    
-                    messages.success(request, 'Layer uploaded successfully! (Local mode)')
-                    return redirect('mundi_gis:project_detail', project_id=project.id)
+            # The Mundi AI upload, statistics and tiling run as a background job
+            job = enqueue('layer_ingest', {'layer_id': str(layer.id)}, user=request.user, priority=5)
+            _report_ingest_job(request, job)
+            return redirect('mundi_gis:project_detail', project_id=project.id)
     else:
         form = MundiLayerForm()
     
@@ -283,11 +316,98 @@ def layer_upload(request, project_id):
     return render(request, 'mundi_gis/layer_upload.html', context)
 
 
+def _upload_status_response(session, status=200):
+    data = upload_status(session)
+    data['upload_url'] = reverse('mundi_gis:upload_session', kwargs={'upload_id': session.id})
+    data['complete_url'] = reverse('mundi_gis:upload_complete', kwargs={'upload_id': session.id})
+    return JsonResponse(data, status=status)
+
+
 @login_required
-def render_map(request, project_id):
-    """Render a map as PNG"""
+@require_http_methods(["POST"])
+def upload_start(request, project_id):
+    """Open a chunked upload: JSON body with name, layer_type, filename, size and optional style_config"""
     project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
     
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Request body must be JSON'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'error': 'Request body must be a JSON object'}, status=400)
+    
+    try:
+        session = start_upload(project, request.user, data)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return _upload_status_response(session, status=201)
+
+
+@login_required
+@require_http_methods(["GET", "PUT", "DELETE"])
+def upload_session(request, upload_id):
+    """
+    GET the upload's status (``offset`` is where to resume), PUT the next
+    chunk as the raw body with ``?offset=``, or DELETE to abort.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, created_by=request.user)
+    
+    if request.method == 'DELETE':
+        if session.status == UploadSession.STATUS_ACTIVE:
+            abort_upload(session)
+        return _upload_status_response(session)
+    
+    if request.method == 'PUT':
+        try:
+            offset = int(request.GET.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return JsonResponse({'error': 'offset must be the byte offset of the chunk'}, status=400)
+        
+        try:
+            write_chunk(session, offset, request, length)
+        except OffsetMismatch as e:
+            return JsonResponse({'error': str(e), 'offset': e.expected}, status=409)
+        except UploadValidationError as e:
+            # The file is not what it claims to be, so there is nothing to resume
+            abort_upload(session)
+            return JsonResponse({'error': str(e)}, status=422)
+        except UploadError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    
+    return _upload_status_response(session)
+
+
+@login_required
+@require_http_methods(["POST"])
+def upload_complete(request, upload_id):
+    """Turn a fully received upload into a layer and queue its ingest"""
+    session = get_object_or_404(UploadSession, id=upload_id, created_by=request.user)
+    
+    try:
+        layer = complete_upload(session)
+    except OffsetMismatch as e:
+        return JsonResponse({'error': f'Upload is incomplete: {e.expected} of {session.total_size} bytes received',
+                             'offset': e.expected}, status=409)
+    except UploadValidationError as e:
+        abort_upload(session)
+        return JsonResponse({'error': str(e), 'errors': e.errors}, status=422)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    
+    job = enqueue('layer_ingest', {'layer_id': str(layer.id)}, user=request.user, priority=5)
+    return JsonResponse({
+        'layer_id': str(layer.id),
+        'job_id': str(job.id),
+        'status_url': reverse('mundi_gis:job_status', kwargs={'job_id': job.id}),
+    }, status=201)
+
+
+@login_required
+async def render_map(request, project_id):
+    """Render a map as PNG"""
+    project = await aget_object_or_404(MundiMapProject, id=project_id, created_by=await request.auser())
+    
     if request.method == 'POST':
         width = request.POST.get('width', 800)
         height = request.POST.get('height', 600)
@@ -299,11 +419,11 @@ def render_map(request, project_id):
                 'height': int(height),
             }
             
-            api_response = mundi_api_request(f'maps/{project.mundi_project_id}/render', 
-                                           method='POST', data=api_data)
+            api_response = await amundi_api_request(f'maps/{project.mundi_project_id}/render', 
+                                                    method='POST', data=api_data)
             
             if 'error' not in api_response:
-                render_obj = MundiMapRender.objects.create(
+                render_obj = await MundiMapRender.objects.acreate(
                     map_project=project,
                     render_id=api_response.get('id'),
                     width=width,
@@ -319,7 +439,7 @@ def render_map(request, project_id):
         else:
             # Local mode - create a placeholder render
             import time
-            render_obj = MundiMapRender.objects.create(
+            render_obj = await MundiMapRender.objects.acreate(
                 map_project=project,
                 render_id=f"local_render_{project.id}_{int(width)}x{int(height)}_{int(time.time())}",
                 width=width,
@@ -333,7 +453,7 @@ def render_map(request, project_id):
         'project': project,
     }
     
-    return render(request, 'mundi_gis/render_map.html', context)
+    return await _arender(request, 'mundi_gis/render_map.html', context)
 
 
 @csrf_exempt
@@ -360,31 +480,140 @@ def mundi_webhook(request):
         return JsonResponse({'error': str(e)}, status=400)
 
 
+def _sse_event(data, event=None):
+    """Format one server-sent event"""
+    message = f'event: {event}\n' if event else ''
+    return f'{message}data: {json.dumps(data)}\n\n'
+
+
+def _sse_response(chunks, **metadata):
+    """
+    Relay LLM output chunks to the client as server-sent events.
+
+    Emits a ``start`` event, one ``message`` event per chunk, and a final
+    ``done`` or ``error`` event. ``chunks`` is an async iterator under ASGI
+    (see _serves_async). If the client disconnects, the server closes the
+    events generator, which closes ``chunks`` and in turn the upstream
+    Ollama request.
+    """
+    def events():
+        try:
+            yield _sse_event(metadata, event='start')
+            for chunk in chunks:
+                yield _sse_event({'delta': chunk})
+            yield _sse_event({}, event='done')
+        except LLMBusyError as e:
+            yield _sse_event({'error': str(e), 'retry_after': e.retry_after}, event='error')
+        except LLMServiceError as e:
+            yield _sse_event({'error': str(e)}, event='error')
+        finally:
+            chunks.close()
+    
+    async def aevents():
+        try:
+            yield _sse_event(metadata, event='start')
+            async for chunk in chunks:
+                yield _sse_event({'delta': chunk})
+            yield _sse_event({}, event='done')
+        except LLMBusyError as e:
+            yield _sse_event({'error': str(e), 'retry_after': e.retry_after}, event='error')
+        except LLMServiceError as e:
+            yield _sse_event({'error': str(e)}, event='error')
+        finally:
+            await chunks.aclose()
+    
+    streaming_content = aevents() if hasattr(chunks, '__aiter__') else events()
+    response = StreamingHttpResponse(streaming_content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _serves_async(request):
+    """
+    Whether the request came through ASGI. Django reads a sync iterator
+    into a list before an ASGI server gets any of it, and an async one
+    before a WSGI server does, so streamed responses use the kind the
+    server consumes as it goes.
+    """
+    return isinstance(request, ASGIRequest)
+
+
+async def _aiter_in_thread(chunks):
+    """
+    Async iterator over a blocking iterator of chunks (file reads, database
+    queries), each produced in the request's sync thread as it is needed
+    """
+    next_chunk = sync_to_async(next)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
+
+
+def _streaming_content(request, chunks):
+    """Chunks of a StreamingHttpResponse as this request's server consumes them as they go"""
+    return _aiter_in_thread(chunks) if _serves_async(request) else chunks
+
+
+def _busy_response(error):
+    """429 response telling the client when to retry a request the LLM had no room for"""
+    response = JsonResponse({'error': str(error), 'retry_after': error.retry_after, 'available': True}, status=429)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def _wants_async(request):
+    """Whether the client asked for the work to be queued (``async=1``)"""
+    return request.POST.get('async', request.GET.get('async')) in ('1', 'true')
+
+
+def _job_accepted(job):
+    """202 response pointing the client at the job status endpoint"""
+    data = job_status(job)
+    data.update({
+        'job_id': str(job.id),
+        'status_url': reverse('mundi_gis:job_status', kwargs={'job_id': job.id}),
+    })
+    return JsonResponse(data, status=202)
+
+
 @login_required
-def ai_analyze_layer(request, layer_id):
+def background_job_status(request, job_id):
+    """Poll the status and result of a background job"""
+    job = get_object_or_404(BackgroundJob, id=job_id, created_by=request.user)
+    return JsonResponse(job_status(job))
+
+
+@login_required
+async def ai_analyze_layer(request, layer_id):
     """Analyze a layer using local LLM"""
     try:
-        layer = get_object_or_404(MundiLayer, id=layer_id, map_project__created_by=request.user)
+        layer = await aget_object_or_404(
+            MundiLayer.objects.select_related('statistics'),
+            id=layer_id, map_project__created_by=await request.auser()
+        )
         question = request.POST.get('question', 'Tell me about this layer')
         
+        if _wants_async(request):
+            job = await sync_to_async(enqueue)(
+                'ai_analyze_layer', {'layer_id': str(layer.id), 'question': question}, user=await request.auser()
+            )
+            return _job_accepted(job)
+        
         llm_service = LocalLLMService()
         
-        if not llm_service.is_available():
+        if not await llm_service.ais_available():
             return JsonResponse({
                 'error': 'Local LLM (Ollama) is not available. Please make sure Ollama is running.',
                 'available': False
             }, status=503)
         
-        layer_info = {
-            'name': layer.name,
-            'layer_type': layer.get_layer_type_display(),
-            'feature_count': 'Unknown',  # Would need to be calculated from actual data
-            'geometry_type': 'Unknown',  # Would need to be extracted from file
-            'description': f'Layer uploaded on {layer.created_at.strftime("%Y-%m-%d")}',
-            'created_at': layer.created_at.strftime("%Y-%m-%d")
-        }
-        
-        analysis = llm_service.analyze_gis_data(layer_info, question)
+        analysis = await llm_service.aanalyze_gis_data(layer_analysis_info(layer), question)
         
         return JsonResponse({
             'analysis': analysis,
@@ -393,32 +622,61 @@ def ai_analyze_layer(request, layer_id):
             'available': True
         })
         
+    except LLMBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @login_required
-def ai_suggest_styling(request, layer_id):
+def ai_analyze_layer_stream(request, layer_id):
+    """Stream a layer analysis from the local LLM as server-sent events"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    layer = get_object_or_404(MundiLayer, id=layer_id, map_project__created_by=request.user)
+    question = request.POST.get('question', 'Tell me about this layer')
+    
+    llm_service = LocalLLMService()
+    
+    if not llm_service.is_available():
+        return JsonResponse({
+            'error': 'Local LLM (Ollama) is not available. Please make sure Ollama is running.',
+            'available': False
+        }, status=503)
+    
+    try:
+        llm_service.check_admission()
+    except LLMBusyError as e:
+        return _busy_response(e)
+    
+    if _serves_async(request):
+        chunks = llm_service.astream_gis_analysis(layer_analysis_info(layer), question)
+    else:
+        chunks = llm_service.stream_gis_analysis(layer_analysis_info(layer), question)
+    return _sse_response(chunks, question=question, layer_name=layer.name)
+
+
+@login_required
+async def ai_suggest_styling(request, layer_id):
     """Get AI suggestions for layer styling"""
     try:
-        layer = get_object_or_404(MundiLayer, id=layer_id, map_project__created_by=request.user)
+        layer = await aget_object_or_404(
+            MundiLayer.objects.select_related('statistics'),
+            id=layer_id, map_project__created_by=await request.auser()
+        )
         
         llm_service = LocalLLMService()
         
-        if not llm_service.is_available():
+        if not await llm_service.ais_available():
             return JsonResponse({
                 'error': 'Local LLM (Ollama) is not available.',
                 'available': False
             }, status=503)
         
-        layer_info = {
-            'name': layer.name,
-            'layer_type': layer.get_layer_type_display(),
-            'geometry_type': 'Unknown',
-            'feature_count': 'Unknown'
-        }
+        layer_info = layer_analysis_info(layer)
         
-        styling_suggestions = llm_service.suggest_layer_styling(layer_info)
+        styling_suggestions = await llm_service.asuggest_layer_styling(layer_info)
         
         return JsonResponse({
             'styling': styling_suggestions,
@@ -426,19 +684,26 @@ def ai_suggest_styling(request, layer_id):
             'available': True
         })
         
+    except LLMBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @login_required
-def ai_generate_description(request, project_id):
+async def ai_generate_description(request, project_id):
     """Generate AI description for a project"""
     try:
-        project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+        user = await request.auser()
+        project = await aget_object_or_404(MundiMapProject, id=project_id, created_by=user)
+        
+        if _wants_async(request):
+            job = await sync_to_async(enqueue)('ai_generate_description', {'project_id': str(project.id)}, user=user)
+            return _job_accepted(job)
         
         llm_service = LocalLLMService()
         
-        if not llm_service.is_available():
+        if not await llm_service.ais_available():
             return JsonResponse({
                 'error': 'Local LLM (Ollama) is not available.',
                 'available': False
@@ -447,10 +712,10 @@ def ai_generate_description(request, project_id):
         project_info = {
             'name': project.name,
             'description': project.description,
-            'layer_count': project.layers.count()
+            'layer_count': await project.layers.acount()
         }
         
-        description = llm_service.generate_map_description(project_info)
+        description = await llm_service.agenerate_map_description(project_info)
         
         return JsonResponse({
             'description': description,
@@ -458,19 +723,26 @@ def ai_generate_description(request, project_id):
             'available': True
         })
         
+    except LLMBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @login_required
-def test_ollama_connection(request):
+async def test_ollama_connection(request):
     """Test the connection to Ollama"""
     try:
         llm_service = LocalLLMService()
-        status = llm_service.test_connection()
+        status = await llm_service.atest_connection()
+        if llm_service.cache is not None:
+            status['response_cache'] = llm_service.cache.stats()
+        status['backends'] = llm_service.router.status()
         
         return JsonResponse(status)
         
+    except LLMBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return JsonResponse({
             'status': 'error',
@@ -500,13 +772,35 @@ def ai_chat_page(request, project_id):
     
     context = {
         'project': project,
+        'map_layers': [_map_layer_info(layer) for layer in project.layers.select_related('statistics')],
     }
     
     return render(request, 'mundi_gis/ai_chat.html', context)
 
 
+def _project_question(user, data, question):
+    """
+    The prompt for a question about a project and the tools to answer it
+    with. When the request names one of the user's projects, its layers are
+    described from their stored statistics instead of the client's
+    ``project_info``, and the model may query them.
+    """
+    project = None
+    if data.get('project_id'):
+        try:
+            project = MundiMapProject.objects.filter(id=data['project_id'], created_by=user).first()
+        except ValidationError:
+            pass
+    if project is None:
+        project_info = data.get('project_info')
+        return build_project_prompt(project_info if isinstance(project_info, dict) else {}, question), None
+    
+    tools = ProjectTools(project)
+    return build_project_prompt(project_analysis_info(project, tools.layers), question, tools=True), tools
+
+
 @login_required
-def ai_analyze_project(request):
+async def ai_analyze_project(request):
     """Analyze project with AI"""
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
@@ -514,114 +808,441 @@ def ai_analyze_project(request):
     try:
         data = json.loads(request.body)
         question = data.get('question', '')
-        project_info = data.get('project_info', {})
         
         if not question:
             return JsonResponse({'error': 'Question is required'}, status=400)
         
         llm_service = LocalLLMService()
         
-        if not llm_service.is_available():
+        if not await llm_service.ais_available():
             return JsonResponse({
                 'error': 'Local LLM (Ollama) is not available. Please make sure Ollama is running.',
                 'available': False
             }, status=503)
         
-        # Create a comprehensive prompt for the AI
-        prompt = f"""
-        You are a GIS (Geographic Information System) expert assistant. Analyze the following project and answer the user's question.
-
-        Project Information:
-        - Name: {project_info.get('name', 'Unknown')}
-        - Description: {project_info.get('description', 'No description')}
-        - Number of Layers: {project_info.get('layer_count', 0)}
+        prompt, tools = await sync_to_async(_project_question)(await request.auser(), data, question)
         
-        Layers:
-        {chr(10).join([f"- {layer.get('name', 'Unknown')} ({layer.get('type', 'Unknown')}): {layer.get('description', 'No description')}" for layer in project_info.get('layers', [])])}
-
-        User Question: {question}
-
-        Please provide a detailed, helpful response that demonstrates your GIS expertise. If the question is about data analysis, suggest what insights could be gained. If it's about styling, provide specific recommendations. If it's about the project structure, explain the components and their purposes.
-        """
-        
-        analysis = llm_service.analyze_text(prompt)
+        try:
+            analysis = await llm_service.aanalyze_project(prompt, tools)
+        except LLMServiceError as e:
+            return JsonResponse({
+                'error': str(e),
+                'tool_calls': tools.calls if tools is not None else []
+            }, status=502)
         
-        return JsonResponse({
+        response = {
             'analysis': analysis,
             'question': question,
+            'prompt': prompt.info(),
             'available': True
-        })
+        }
+        if tools is not None:
+            response['tool_calls'] = tools.calls
+        return JsonResponse(response)
         
+    except LLMBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+def ai_analyze_project_stream(request):
+    """Stream a project analysis from the local LLM as server-sent events"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    
+    question = data.get('question', '')
+    
+    if not question:
+        return JsonResponse({'error': 'Question is required'}, status=400)
+    
+    llm_service = LocalLLMService()
+    
+    if not llm_service.is_available():
+        return JsonResponse({
+            'error': 'Local LLM (Ollama) is not available. Please make sure Ollama is running.',
+            'available': False
+        }, status=503)
+    
+    try:
+        llm_service.check_admission()
+    except LLMBusyError as e:
+        return _busy_response(e)
+    
+    prompt, tools = _project_question(request.user, data, question)
+    if _serves_async(request):
+        chunks = llm_service.astream_project_analysis(prompt, tools)
+    else:
+        chunks = llm_service.stream_project_analysis(prompt, tools)
+    return _sse_response(chunks, question=question, prompt=prompt.info())
+
+
 @login_required
 def layer_data(request, project_id, layer_id):
-    """Serve layer data as GeoJSON"""
+    """
+    Serve layer data as GeoJSON.
+
+    ``?zoom=`` serves the layer simplified for that map zoom and
+    ``?bbox=minx,miny,maxx,maxy`` only the features within the box.
+    """
     project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
-    layer = get_object_or_404(MundiLayer, id=layer_id, project=project)
+    layer = get_object_or_404(MundiLayer, id=layer_id, map_project=project)
     
     try:
-        # Handle both string paths and FieldFile objects
-        if hasattr(layer.file_path, 'path'):
-            file_path = layer.file_path.path
-        else:
-            file_path = os.path.join(settings.MEDIA_ROOT, str(layer.file_path))
+        zoom = _parse_zoom(request)
+    except ValueError:
+        return JsonResponse({'error': f'zoom must be an integer between 0 and {MAX_ZOOM}'}, status=400)
+    
+    bbox = None
+    if request.GET.get('bbox'):
+        try:
+            bbox = parse_bbox(request.GET['bbox'])
+        except ValueError as e:
+            return JsonResponse({'error': f'Invalid bbox: {str(e)}'}, status=400)
+    
+    try:
+        file_path = _layer_data_path(layer, zoom)
         
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                geojson_data = json.load(f)
+        if file_path and os.path.exists(file_path):
+            precompressed = None
+            if bbox is None:
+                precompressed = find_precompressed(layer, file_path, request.headers.get('Accept-Encoding', ''))
+            encoding = precompressed[1] if precompressed else 'identity'
             
-            # Add layer metadata to the response
-            response_data = {
-                'layer_id': layer.id,
-                'layer_name': layer.name,
-                'layer_type': layer.layer_type,
-                'geojson': geojson_data
-            }
+            # Each encoding is a distinct representation with its own strong ETag
+            etag = layer_etag(layer, f'zoom={zoom}|bbox={bbox}|{encoding}')
+            last_modified = layer_last_modified(layer)
+            not_modified = not_modified_response(request, etag, last_modified)
+            if not_modified:
+                patch_vary_headers(not_modified, ('Accept-Encoding',))
+                return not_modified
+            
+            if bbox is not None:
+                return set_cache_headers(_bbox_layer_response(request, layer, file_path, bbox), etag, last_modified)
             
-            return JsonResponse(response_data)
+            if precompressed:
+                # Compressed once at ingest and sent as-is
+                response = FileResponse(open(precompressed[0], 'rb'), content_type='application/json')
+                response['Content-Encoding'] = encoding
+                del response['Content-Disposition']
+            else:
+                # Serialized from the memory-mapped columnar copy instead of parsing the file
+                response = HttpResponse(b''.join(layer_data_chunks(layer, file_path)), content_type='application/json')
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return set_cache_headers(response, etag, last_modified)
         else:
             return JsonResponse({'error': 'File not found'}, status=404)
+    except SpatialIndexError as e:
+        return JsonResponse({'error': str(e)}, status=422)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
+def _bbox_layer_response(request, layer, file_path, bbox):
+    """Stream the features intersecting bbox, copied from the file via the layer's spatial index"""
+    index = get_spatial_index(file_path)
+    matches = index.query(bbox)
+    
+    metadata = json.dumps({
+        **layer_metadata(layer),
+        'bbox': list(bbox),
+        'feature_count': len(matches),
+    }).encode('utf-8')
+    
+    def chunks():
+        yield metadata[:-1] + b', "geojson": {"type": "FeatureCollection", "features": ['
+        yield from read_features(file_path, index, matches, LAYER_STREAM_CHUNK_SIZE)
+        yield b']}}'
+    
+    return StreamingHttpResponse(_streaming_content(request, chunks()), content_type='application/json')
+
+
+def _parse_zoom(request):
+    """Parse the optional ?zoom= map zoom; returns None when absent"""
+    raw = request.GET.get('zoom')
+    if raw is None or raw == '':
+        return None
+    zoom = int(raw)
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError(f'zoom out of range: {zoom}')
+    return zoom
+
+
+def _layer_data_path(layer, zoom=None):
+    """The file to serve for a layer: its GeoJSON, or the copy simplified for a map zoom"""
+    file_path = layer_geojson_path(layer)
+    if zoom is None or not file_path or not os.path.exists(file_path):
+        return file_path
+    return pyramid_level_path(file_path, zoom)
+
+
+def _parse_layer_filter(request):
+    """Parse the optional ?layers=<uuid>,<uuid> filter; returns None when absent"""
+    raw = request.GET.get('layers')
+    if not raw:
+        return None
+    return [uuid.UUID(value.strip()) for value in raw.split(',') if value.strip()]
+
+
+def _stream_layers_json(layers, zoom=None):
+    """
+    Yield the project layers payload as JSON without parsing any GeoJSON.
+
+    Each layer's metadata is serialized on its own and the raw file bytes are
+    copied behind it in fixed-size chunks, so memory stays flat regardless of
+    how many layers or how large the files are.
+    """
+    yield b'{"layers": ['
+    first = True
+    for layer in layers.iterator():
+        try:
+            file_path = _layer_data_path(layer, zoom)
+        except (ValueError, OSError) as e:
+            logger.warning("Error simplifying layer %s: %s", layer.name, e)
+            continue
+        if not file_path or not os.path.exists(file_path):
+            continue
+        
+        try:
+            f = open(file_path, 'rb')
+        except OSError as e:
+            logger.warning("Error opening layer %s: %s", layer.name, e)
+            continue
+        
+        with f:
+            head = f.read(LAYER_STREAM_CHUNK_SIZE)
+            if head.startswith(codecs.BOM_UTF8):
+                head = head[len(codecs.BOM_UTF8):]
+            # Only splice in files that at least look like a JSON object
+            if not head.lstrip().startswith(b'{'):
+                logger.warning("Skipping layer %s: not a GeoJSON object", layer.name)
+                continue
+            
+            metadata = json.dumps(_map_layer_info(layer)).encode('utf-8')
+            yield (b'' if first else b', ') + metadata[:-1] + b', "geojson": '
+            first = False
+            
+            chunk = head
+            while chunk:
+                yield chunk
+                chunk = f.read(LAYER_STREAM_CHUNK_SIZE)
+            yield b'}'
+    yield b']}'
+
+
 @login_required
 def project_layers_data(request, project_id):
     """Get all layers data for a project"""
     project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
     layers = project.layers.all()
     
+    try:
+        layer_filter = _parse_layer_filter(request)
+    except ValueError:
+        return JsonResponse({'error': 'layers must be a comma-separated list of layer IDs'}, status=400)
+    if layer_filter is not None:
+        layers = layers.filter(id__in=layer_filter)
+    
+    try:
+        zoom = _parse_zoom(request)
+    except ValueError:
+        return JsonResponse({'error': f'zoom must be an integer between 0 and {MAX_ZOOM}'}, status=400)
+    
+    stream = request.GET.get('stream') in ('1', 'true')
+    layers = layers.select_related('statistics')
+    layer_list = list(layers)
+    etag = project_etag((layer_etag(layer, f'zoom={zoom}') for layer in layer_list), f'zoom={zoom}|stream={stream}')
+    last_modified = max([project.updated_at] + [layer_last_modified(layer) for layer in layer_list])
+    not_modified = not_modified_response(request, etag, last_modified)
+    if not_modified:
+        return not_modified
+    
+    if stream:
+        chunks = _streaming_content(request, _stream_layers_json(layers, zoom))
+        response = StreamingHttpResponse(chunks, content_type='application/json')
+        return set_cache_headers(response, etag, last_modified)
+    
+    started = time.perf_counter()
+    file_layers = []
+    for layer in layer_list:
+        file_path = layer_geojson_path(layer)
+        if file_path and os.path.exists(file_path):
+            file_layers.append((layer, file_path))
+    
+    # Layers are serialized in parallel; results keep the query's order
+    results = map_layers(serialize_layer_data, [(file_path, zoom) for _, file_path in file_layers])
+    
     layers_data = []
-    print(f"Processing {layers.count()} layers for project {project.name}")
-    for layer in layers:
-        print(f"Processing layer: {layer.name} (ID: {layer.id})")
-        try:
-            # Handle both string paths and FieldFile objects
-            if hasattr(layer.file_path, 'path'):
-                file_path = layer.file_path.path
-            else:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(layer.file_path))
-            
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    geojson_data = json.load(f)
-                
-                layer_info = {
-                    'id': layer.id,
-                    'name': layer.name,
-                    'layer_type': layer.layer_type,
-                    'description': f'{layer.name} ({layer.get_layer_type_display()}) layer',
-                    'created_at': layer.created_at.isoformat(),
-                    'geojson': geojson_data
-                }
-                layers_data.append(layer_info)
-        except Exception as e:
-            print(f"Error loading layer {layer.name}: {e}")
-            import traceback
-            traceback.print_exc()
+    for (layer, _), result in zip(file_layers, results):
+        if result.error is not None:
+            logger.error("Error loading layer %s", layer.name, exc_info=result.error)
             continue
+        metadata = json.dumps(_map_layer_info(layer)).encode('utf-8')
+        layers_data.append(metadata[:-1] + b', "geojson": ' + result.value + b'}')
+    
+    response = HttpResponse(b'{"layers": [' + b', '.join(layers_data) + b']}', content_type='application/json')
+    response['Server-Timing'] = server_timing(
+        [layer.id for layer, _ in file_layers], results, time.perf_counter() - started,
+    )
+    return set_cache_headers(response, etag, last_modified)
+
+
+@login_required
+def layer_download(request, project_id, layer_id):
+    """Download the layer's original uploaded file"""
+    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    layer = get_object_or_404(MundiLayer, id=layer_id, map_project=project)
+    
+    file_path = layer_file_path(layer)
+    if not file_path or not os.path.exists(file_path):
+        return JsonResponse({'error': 'File not found'}, status=404)
+    
+    return FileResponse(open(file_path, 'rb'), as_attachment=True, filename=os.path.basename(file_path))
+
+
+@login_required
+def layer_vector_tile(request, project_id, layer_id, z, x, y):
+    """Serve a Mapbox Vector Tile for a layer, cut from its tile index"""
+    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    layer = get_object_or_404(MundiLayer, id=layer_id, map_project=project)
+    
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return JsonResponse({'error': 'Tile coordinates out of range'}, status=400)
+    
+    file_path = layer_geojson_path(layer)
+    if not file_path or not os.path.exists(file_path):
+        return JsonResponse({'error': 'File not found'}, status=404)
+    
+    try:
+        tile_index = get_tile_index(file_path)
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': f'Layer cannot be tiled: {str(e)}'}, status=422)
+    except OSError as e:
+        return JsonResponse({'error': str(e)}, status=500)
+    
+    tile = tile_index.get_tile(z, x, y, layer_name=layer.name)
+    return HttpResponse(tile, content_type=TILE_CONTENT_TYPE)
+
+
+@login_required
+def layer_raster_tile(request, project_id, layer_id, z, x, y, tile_format):
+    """Serve an image tile of a raster layer, read from its tile pyramid"""
+    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    layer = get_object_or_404(MundiLayer, id=layer_id, map_project=project)
+    
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return JsonResponse({'error': 'Tile coordinates out of range'}, status=400)
+    
+    file_path = layer_file_path(layer)
+    if not file_path or not is_raster(file_path) or not os.path.exists(file_path):
+        return JsonResponse({'error': 'File not found'}, status=404)
+    
+    etag = layer_etag(layer, f'tile={z}/{x}/{y}.{tile_format}')
+    last_modified = layer_last_modified(layer)
+    not_modified = not_modified_response(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
     
-    return JsonResponse({'layers': layers_data})
+    try:
+        raster_tiles = get_raster_tiles(file_path)
+    except RasterError as e:
+        return JsonResponse({'error': f'Layer cannot be tiled: {str(e)}'}, status=422)
+    except OSError as e:
+        return JsonResponse({'error': str(e)}, status=500)
+    if tile_format != raster_tiles.format:
+        return JsonResponse({'error': f'Tiles of this layer are {raster_tiles.format} images'}, status=404)
+    
+    tile = raster_tiles.get_tile(z, x, y) or blank_tile(raster_tiles.format)
+    response = HttpResponse(tile, content_type=raster_tiles.content_type)
+    return set_cache_headers(response, etag, last_modified)
+
+
+@login_required
+def layer_points(request, project_id, layer_id):
+    """
+    Points of a point cloud layer from its level-of-detail octree, coarse to
+    fine within ``?bbox=`` or ``?frustum=`` until ``?budget=`` points
+    """
+    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    layer = get_object_or_404(MundiLayer, id=layer_id, map_project=project)
+    
+    try:
+        bounds = parse_bounds(request.GET['bbox']) if request.GET.get('bbox') else None
+        planes = parse_frustum(request.GET['frustum']) if request.GET.get('frustum') else None
+        camera = parse_camera(request.GET['camera']) if request.GET.get('camera') else None
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        budget = int(request.GET.get('budget', DEFAULT_POINT_BUDGET))
+    except ValueError:
+        budget = 0
+    if not 0 < budget <= MAX_POINT_BUDGET:
+        return JsonResponse({'error': f'budget must be an integer between 1 and {MAX_POINT_BUDGET}'}, status=400)
+    binary = request.GET.get('format') == 'binary'
+    
+    file_path = layer_file_path(layer)
+    if not file_path or not is_point_cloud(file_path) or not os.path.exists(file_path):
+        return JsonResponse({'error': 'File not found'}, status=404)
+    
+    etag = layer_etag(layer, f'points|{request.GET.urlencode()}')
+    last_modified = layer_last_modified(layer)
+    not_modified = not_modified_response(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    
+    try:
+        octree = get_octree(file_path)
+    except ReaderError as e:
+        return JsonResponse({'error': f'Point cloud cannot be read: {str(e)}'}, status=422)
+    
+    result = octree.query(bounds=bounds, planes=planes, camera=camera, budget=budget)
+    if binary:
+        # Quantized fixed-size records (point_cloud.POINT_DTYPE); real = value * scale + offset
+        response = HttpResponse(result.points.tobytes(), content_type='application/octet-stream')
+        response['X-Point-Count'] = str(len(result.points))
+        response['X-Point-Scale'] = ','.join(repr(v) for v in octree.scale.tolist())
+        response['X-Point-Offset'] = ','.join(repr(v) for v in octree.origin.tolist())
+        response['X-Point-Complete'] = 'true' if result.complete else 'false'
+        return set_cache_headers(response, etag, last_modified)
+    
+    response = JsonResponse({
+        'layer_id': str(layer.id),
+        'octree': octree.info(),
+        'budget': budget,
+        'count': len(result.points),
+        'complete': result.complete,
+        'spacing': result.spacing,
+        'nodes': result.nodes,
+        'points': points_json(octree, result),
+    })
+    return set_cache_headers(response, etag, last_modified)
+
+
+@login_required
+@require_http_methods(["POST"])
+def project_spatial_query(request, project_id):
+    """
+    Run a spatial query over the project's layers: point-in-polygon counts,
+    bbox, polygon and buffer filters, nearest features, area and length, or
+    attribute aggregation (see spatial_ops)
+    """
+    project = get_object_or_404(MundiMapProject, id=project_id, created_by=request.user)
+    
+    try:
+        query = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    
+    started = time.perf_counter()
+    try:
+        result = run_spatial_query(query, project_layer_resolver(project))
+    except SpatialQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return JsonResponse(result)
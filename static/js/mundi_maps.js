@@ -356,6 +356,74 @@ class MundiMap {
         return layer;
     }
 
+    // Add a vector tile layer served as Mapbox Vector Tiles (.pbf)
+    addVectorTileLayer(urlTemplate, options = {}) {
+        const name = options.name || 'Vector Tile Layer';
+        const style = {
+            color: '#3388ff',
+            weight: 2,
+            opacity: 0.8,
+            fill: true,
+            fillOpacity: 0.2,
+            radius: 6,
+            ...(options.style || {})
+        };
+
+        const layer = L.vectorGrid.protobuf(urlTemplate, {
+            vectorTileLayerStyles: { [name]: style },
+            rendererFactory: L.canvas.tile,
+            interactive: true,
+            maxNativeZoom: 22,
+            getFeatureId: options.getFeatureId
+        });
+
+        layer.on('click', (e) => {
+            const properties = e.layer.properties || {};
+            const popupContent = `
+                <div>
+                    <h6>${properties.name || name}</h6>
+                    <p>${JSON.stringify(properties, null, 2)}</p>
+                </div>
+            `;
+            L.popup()
+                .setLatLng(e.latlng)
+                .setContent(popupContent)
+                .openOn(this.map);
+        });
+
+        this.layers.push(layer);
+        this.layerControl.addOverlay(layer, name);
+        layer.addTo(this.map);
+
+        // Tiles carry no overall extent, so only fit when bounds are known
+        if (options.bounds && this.layers.length === 1) {
+            this.map.fitBounds(options.bounds);
+        }
+
+        return layer;
+    }
+
+    // Add a raster layer served as image tiles from its overview pyramid
+    addRasterTileLayer(urlTemplate, options = {}) {
+        const name = options.name || 'Raster Layer';
+        const layer = L.tileLayer(urlTemplate, {
+            opacity: options.opacity ?? 0.9,
+            maxNativeZoom: options.maxNativeZoom,
+            maxZoom: 22,
+            bounds: options.bounds || undefined
+        });
+
+        this.layers.push(layer);
+        this.layerControl.addOverlay(layer, name);
+        layer.addTo(this.map);
+
+        if (options.bounds && this.layers.length === 1) {
+            this.map.fitBounds(options.bounds);
+        }
+
+        return layer;
+    }
+
     // Add a marker
     addMarker(lat, lng, options = {}) {
         const defaultOptions = {
@@ -413,6 +481,15 @@ class MundiMap {
     }
 }
 
+// Leaflet bounds from a layer's precomputed [minx, miny, maxx, maxy] bbox
+function layerBounds(layer) {
+    if (!layer.bbox) {
+        return null;
+    }
+    const [minX, minY, maxX, maxY] = layer.bbox;
+    return [[minY, minX], [maxY, maxX]];
+}
+
 // Global function to export layers
 function exportLayer(layerType) {
     console.log(`Exporting ${layerType} layer`);
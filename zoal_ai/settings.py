@@ -84,6 +84,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Background workers write job rows concurrently with web requests
+            'timeout': 20,
+        },
     }
 }
 
@@ -145,3 +149,81 @@ LOGOUT_REDIRECT_URL = '/'
 OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434/v1')
 OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'gemma3:4b')
 OLLAMA_API_KEY = os.getenv('OLLAMA_API_KEY', 'ollama')
+
+# Several OpenAI-compatible servers to balance requests across, comma-separated;
+# a server only used for some models lists them: "http://gpu1:11434/v1=gemma3:4b|llama3.2".
+# Empty means just OLLAMA_BASE_URL
+OLLAMA_BACKENDS = [url.strip() for url in os.getenv('OLLAMA_BACKENDS', '').split(',') if url.strip()]
+
+# Pooled HTTP connections to Ollama (shared by every LocalLLMService in a process)
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', '10'))
+OLLAMA_MAX_RETRIES = int(os.getenv('OLLAMA_MAX_RETRIES', '2'))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '3.05'))
+OLLAMA_PROBE_TIMEOUT = float(os.getenv('OLLAMA_PROBE_TIMEOUT', '5'))
+OLLAMA_REQUEST_TIMEOUT = float(os.getenv('OLLAMA_REQUEST_TIMEOUT', '30'))
+
+# Admission control: requests each worker process sends to each Ollama server at once
+# (match Ollama's OLLAMA_NUM_PARALLEL), and how many more may wait per server, for how many seconds
+OLLAMA_MAX_CONCURRENT_REQUESTS = int(os.getenv('OLLAMA_MAX_CONCURRENT_REQUESTS', '4'))
+OLLAMA_QUEUE_SIZE = int(os.getenv('OLLAMA_QUEUE_SIZE', '32'))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', '10'))
+
+# Upper bound on concurrent outbound connections from the async views (per event loop)
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '200'))
+
+# Cached Ollama health state and circuit breaker
+OLLAMA_HEALTH_TTL = float(os.getenv('OLLAMA_HEALTH_TTL', '30'))
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '10'))
+OLLAMA_HEALTH_INITIAL_WAIT = float(os.getenv('OLLAMA_HEALTH_INITIAL_WAIT', '1'))
+OLLAMA_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('OLLAMA_CIRCUIT_FAILURE_THRESHOLD', '3'))
+OLLAMA_CIRCUIT_RECOVERY_TIMEOUT = float(os.getenv('OLLAMA_CIRCUIT_RECOVERY_TIMEOUT', '30'))
+
+# Tool calling in the AI chat: model replies that may call tools per question,
+# the time limit for the whole exchange in seconds, and cached tool results
+OLLAMA_TOOL_MAX_ITERATIONS = int(os.getenv('OLLAMA_TOOL_MAX_ITERATIONS', '4'))
+OLLAMA_TOOL_TIMEOUT = float(os.getenv('OLLAMA_TOOL_TIMEOUT', '60'))
+MUNDI_TOOL_CACHE_SIZE = int(os.getenv('MUNDI_TOOL_CACHE_SIZE', '256'))
+
+# Estimated tokens a project question may use (system prompt, layer summaries and question)
+OLLAMA_PROMPT_TOKEN_BUDGET = int(os.getenv('OLLAMA_PROMPT_TOKEN_BUDGET', '1500'))
+
+# Sampling temperature of layer and project analyses, descriptions and styling
+# suggestions; at 0 their replies are deterministic and served from the response cache
+OLLAMA_ANALYSIS_TEMPERATURE = float(os.getenv('OLLAMA_ANALYSIS_TEMPERATURE', '0'))
+
+# LLM response cache: BACKEND is 'lru' (in-process), 'django' (LOCATION is a
+# CACHES alias), 'sqlite' (LOCATION is a file path) or empty to disable
+OLLAMA_RESPONSE_CACHE = {
+    'BACKEND': os.getenv('OLLAMA_RESPONSE_CACHE_BACKEND', 'lru'),
+    'LOCATION': os.getenv('OLLAMA_RESPONSE_CACHE_LOCATION', ''),
+    'TTL': int(os.getenv('OLLAMA_RESPONSE_CACHE_TTL', '3600')),
+    'MAX_ENTRIES': int(os.getenv('OLLAMA_RESPONSE_CACHE_MAX_ENTRIES', '512')),
+    'MAX_BYTES': int(os.getenv('OLLAMA_RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024))),
+}
+
+# Also cache sampled replies (temperature above 0), so a prompt always gets the same answer
+OLLAMA_CACHE_NONDETERMINISTIC = os.getenv('OLLAMA_CACHE_NONDETERMINISTIC', 'False').lower() == 'true'
+
+# Background jobs (run with `python manage.py run_workers`). With
+# MUNDI_JOBS_EAGER enabled, jobs run inline in the request instead.
+MUNDI_JOBS_EAGER = os.getenv('MUNDI_JOBS_EAGER', 'False').lower() == 'true'
+MUNDI_JOBS_RETRY_BACKOFF = float(os.getenv('MUNDI_JOBS_RETRY_BACKOFF', '5'))
+
+# Seconds browsers may reuse layer data before revalidating it with its ETag
+MUNDI_LAYER_CACHE_MAX_AGE = int(os.getenv('MUNDI_LAYER_CACHE_MAX_AGE', '0'))
+
+# Worker processes shared by all requests for serializing layer data (0 for
+# one per CPU), and how many layers one project_layers_data request may have
+# in flight at once
+MUNDI_LAYER_POOL_SIZE = int(os.getenv('MUNDI_LAYER_POOL_SIZE', '0'))
+MUNDI_LAYER_REQUEST_CONCURRENCY = int(os.getenv('MUNDI_LAYER_REQUEST_CONCURRENCY', '4'))
+
+# Point clouds are decimated to at most this many points when converted to
+# GeoJSON at ingest
+MUNDI_POINT_CLOUD_MAX_POINTS = int(os.getenv('MUNDI_POINT_CLOUD_MAX_POINTS', '200000'))
+
+# Image format of raster layer tiles: 'png' or 'webp' (lossless, smaller)
+MUNDI_RASTER_TILE_FORMAT = os.getenv('MUNDI_RASTER_TILE_FORMAT', 'png')
+
+# Largest chunk accepted by the chunked upload API, in bytes
+MUNDI_UPLOAD_CHUNK_SIZE = int(os.getenv('MUNDI_UPLOAD_CHUNK_SIZE', str(5 * 1024 * 1024)))